@@ -8,7 +8,9 @@ Dan Clewley and Jane Whitcomb (2016-12-23)
 """
 
 import argparse
+import calendar
 import configparser
+import copy
 import csv
 import os
 import tempfile
@@ -16,10 +18,26 @@ import time
 import shutil
 
 from soilscape_upscaling import upscaling_common
+from soilscape_upscaling import cpu_budget
+from soilscape_upscaling import climate_cube
+from soilscape_upscaling import date_pipeline
 from soilscape_upscaling import stack_bands
+from soilscape_upscaling import station_index
 from soilscape_upscaling import extract_image_stats
+from soilscape_upscaling import feature_store
+from soilscape_upscaling import focal_layers
+from soilscape_upscaling import layer_providers
+from soilscape_upscaling import prediction_cube
+from soilscape_upscaling import preview
 from soilscape_upscaling import rf_upscaling
+from soilscape_upscaling import rolling_climate
+from soilscape_upscaling import run_planner
+from soilscape_upscaling import sar_pyramids
+from soilscape_upscaling import stage_cache
+from soilscape_upscaling import terrain_layers
+from soilscape_upscaling import tiling
 from soilscape_upscaling import upscaling_utilities
+from soilscape_upscaling import warp_cache
 from soilscape_upscaling.data_extractors import generic_csv_extractor
 
 MAX_SM_COL = 0.5
@@ -32,10 +50,30 @@ def check_create_dir(in_dir_path):
     if not os.path.isdir(in_dir_path):
         os.makedirs(in_dir_path)
 
-def run_scaling(config_file, debug_mode=False):   
+def run_scaling(config_file, debug_mode=False, plan_file=None,
+                run_plan_file=None, preview_factor=None, run_dates=None,
+                stage_cache_dir=None):
 
     """
     Run scaling function for a range of dates
+
+    If 'plan_file' is provided a plan is written to this file (with the
+    sensor data for each date) and no dates are processed. If
+    'run_plan_file' is provided only the dates which can be run in this
+    plan are processed, using the sensor data extracted when the plan
+    was made.
+
+    If 'preview_factor' is provided a quick-look preview is run. The model
+    is trained as for a full resolution run and applied at the output
+    resolution multiplied by this factor, then compared against the
+    full resolution output for each date (if it exists).
+
+    If 'run_dates' is provided (list of YYYYMMDD) only these dates are run,
+    and stats are written to a separate file for these dates.
+
+    If 'stage_cache_dir' is provided (or in the config) sensor data,
+    stacks and pixel values are shared with other runs using the
+    same cache.
     
     Known issues:
 
@@ -75,19 +113,114 @@ def run_scaling(config_file, debug_mode=False):
 
     bounding_box = config['default']['bounding_box'].split()
 
+    # Register any extra providers of dynamic layers
+    layer_providers.register_providers_from_config(config['default'])
+
     try:
         upscaling_model = config['default']['upscaling_model']
     except KeyError:
         upscaling_model = "RandomForestRegressor"
 
-    out_stats_file = os.path.join(out_stats_dir, 'scaling_function_stats.csv')
-    out_stats_handler = open(out_stats_file, 'w')
-    out_stats = csv.writer(out_stats_handler)
-
-    out_var_importance_file = os.path.join(out_stats_dir, 'scaling_function_var_importance.csv')
-    out_var_importance_handler = open(out_var_importance_file, 'w')
-    out_var_importancee = csv.writer(out_var_importance_handler)
-    out_var_importance_header = False
+    # Number of trees for Random Forests. If 'adaptive' trees are added
+    # until the out-of-bag RMSE converges (up to rf_max_estimators)
+    n_estimators = rf_upscaling.get_n_estimators(config['default'].get('rf_n_estimators',
+                                                                       rf_upscaling.DEFAULT_N_ESTIMATORS))
+    max_estimators = int(config['default'].get('rf_max_estimators',
+                                               rf_upscaling.ADAPTIVE_MAX_ESTIMATORS))
+    oob_tolerance = float(config['default'].get('rf_oob_tolerance',
+                                                rf_upscaling.ADAPTIVE_OOB_TOLERANCE))
+
+    # Check if the standard deviation (and optionally quantiles) of the
+    # predictions from each tree should be written alongside the prediction
+    predict_uncertainty = config['default'].getboolean('predict_uncertainty', False)
+    predict_quantiles = rf_upscaling.get_quantiles(config['default'].get('predict_quantiles'))
+
+    # Check if the bounding box should be split into tiles
+    try:
+        tile_size = int(config['default']['tile_size'])
+        tile_workers = int(config['default'].get('tile_workers', 1))
+    except KeyError:
+        tile_size = None
+
+    # Check if transforms used to warp dynamic layers should be cached
+    dynamic_warp_cache = upscaling_common.create_from_config(config['default'], 'warp_cache_dir',
+                                                             warp_cache.WarpTransformCache)
+
+    # Check if accumulators for rolling climate layers (e.g., 'prism_ppt_api7')
+    # should be saved so they can be used by later runs (always kept for
+    # the current run)
+    climate_accumulators = rolling_climate.RollingClimate(config['default'].get('rolling_climate_dir'))
+
+    # Check if AirMOSS / UAVSAR scenes should be ingested to the output grid
+    # (with overviews) so each scene is only averaged once
+    sar_scene_pyramids = upscaling_common.create_from_config(config['default'], 'sar_pyramid_dir',
+                                                             sar_pyramids.SARPyramids,
+                                                             bounding_box)
+
+    # Check if PRISM / ECMWF archives have been ingested to cubes on the
+    # output grid (see climate_cube)
+    climate_archive_cubes = upscaling_common.create_from_config(config['default'], 'climate_cube_dir',
+                                                                climate_cube.ClimateCubes)
+
+    # Check if focal layers (see focal_layers) should be stored so they
+    # are only calculated once for each grid
+    focal_stat_layers = upscaling_common.create_from_config(config['default'], 'focal_layer_dir',
+                                                            focal_layers.FocalLayers)
+
+    # Check if terrain layers (see terrain_layers) should be stored so they
+    # are only calculated once for each DEM and grid
+    dem_terrain_layers = upscaling_common.create_from_config(config['default'], 'terrain_layer_dir',
+                                                             terrain_layers.TerrainLayers)
+
+    # Check if outputs of stages which don't depend on the model (sensor
+    # data, stacks and pixel values) should be shared with other runs
+    if stage_cache_dir is None:
+        stage_cache_dir = config['default'].get('stage_cache_dir')
+    if stage_cache_dir is not None:
+        sensor_stage_cache = stage_cache.StageCache(stage_cache_dir)
+    else:
+        sensor_stage_cache = None
+
+    # Check if the pixel for each sensor should be saved so it can be
+    # used by later runs (always kept for the current run)
+    sensor_station_index = station_index.StationIndex(config['default'].get('station_index_dir'))
+
+    # Check if extracted values should be added to a feature store
+    train_feature_store = upscaling_common.create_from_config(config['default'], 'feature_store_dir',
+                                                              feature_store.FeatureStore)
+
+    # Check if predictions should be added to a time-series cube
+    sm_prediction_cube = upscaling_common.create_from_config(config['default'], 'prediction_cube_dir',
+                                                             prediction_cube.PredictionCube)
+
+    # In preview mode the model is applied to a subsampled version of the
+    # full resolution stack (not tiled) and outputs are written alongside
+    # full resolution outputs.
+    if preview_factor is not None:
+        tile_size = None
+        sm_prediction_cube = None
+        out_image_suffix = '_predict_sm_preview'
+        out_stats_suffix = '_preview'
+    else:
+        out_image_suffix = '_predict_sm'
+        out_stats_suffix = ''
+    if run_dates is not None:
+        out_stats_suffix += '_' + '_'.join(sorted(run_dates))
+
+    # Check if dates should be prepared in the background while the
+    # model is run for the current date
+    prefetch_dates = int(config['default'].get('prefetch_dates', 0))
+    prepare_workers = int(config['default'].get('prepare_workers', 1))
+
+    # Share the CPU budget between tile workers, background workers,
+    # scikit-learn, GDAL and BLAS
+    cpu_allocation = cpu_budget.set_cpu_budget(config['default'],
+                                               tile_workers=1 if tile_size is None else tile_workers,
+                                               prepare_workers=prepare_workers if prefetch_dates > 0 else 0)
+    if tile_size is not None:
+        tile_workers = cpu_allocation['tile_workers']
+    if prefetch_dates > 0:
+        prepare_workers = cpu_allocation['prepare_workers']
 
     # Get a list of data layers - to check if using UAVSAR
     data_layers_list = []
@@ -108,57 +241,166 @@ def run_scaling(config_file, debug_mode=False):
         raise ValueError('Each band must have a unique name:\n'
                          '{}\n were provided'.format(', '.join(band_names)))
 
-    # Write header
-    out_stats.writerow(['Date', 'nSamples', 'avgSM_train', 'stdSM_train', 'avgSM_predict',
-                        'stdSM_predict', 'RMSE', 'Bias', 'RSq', 'UAVSARDate'])
     
     # Set up data extractor
     csv_extractor = generic_csv_extractor.SoilSCAPECreateCSVGenericStationRowsCSV(sensor_data,
                                                                                   debug_mode=debug_mode)
 
+    # Sensor data used (to identify data in the stage cache)
+    sensor_source = stage_cache.get_sensor_source(config['default'])
+
     # Get list of all available dates in input file
     all_sensor_dates_ts = csv_extractor.get_available_dates()
 
-    # Look through all dates
-    for sensor_date_ts in all_sensor_dates_ts:
-    
+    # Only run selected dates
+    if run_dates is not None:
+        all_sensor_dates_ts = [sensor_date_ts for sensor_date_ts in all_sensor_dates_ts
+                               if time.strftime('%Y%m%d', sensor_date_ts) in run_dates]
+
+    def extract_sensor_data(sensor_date_ts, out_data_csv):
+        """
+        Extract sensor data for a date to a CSV, returns the number
+        of sensors.
+        """
+        return csv_extractor.create_csv_from_input(sensor_date_ts,
+                                                   out_data_csv,
+                                                   sensor_ids_list)
+
+    def prepare_date(sensor_date_ts):
+        """
+        Extract sensor data and create stack for a date.
+        """
+        out_base_name = time.strftime('%Y%m%d', sensor_date_ts)
+
         # Create temp DIR
-        temp_dir = tempfile.mkdtemp(prefix='soilscape_upscaling')
+        prepared = {}
+        prepared['temp_dir'] = tempfile.mkdtemp(prefix='soilscape_upscaling')
+        prepared['data_layers_list'] = copy.deepcopy(data_layers_list)
+        prepared['data_stack'] = None
+        try:
+            # Extract CSV to use for upscaling from all sensor data.
+            prepared['sensor_data_csv'] = os.path.join(prepared['temp_dir'],
+                                                       "{}_sensor_data.csv".format(out_base_name))
+
+            # Use sensor data extracted when the plan was made if available
+            date_plan = planned_dates.get(calendar.timegm(sensor_date_ts), {})
+            if os.path.isfile(date_plan.get('sensorCSV', '')):
+                shutil.copy(date_plan['sensorCSV'], prepared['sensor_data_csv'])
+            elif sensor_stage_cache is not None:
+                sensor_stage_cache.extract_sensors(sensor_source, sensor_date_ts,
+                                                   prepared['sensor_data_csv'],
+                                                   extract_sensor_data)
+            else:
+                extract_sensor_data(sensor_date_ts, prepared['sensor_data_csv'])
+
+            # Create band stack (if not using tiles)
+            if tile_size is None:
+                prepared['data_stack'] = stack_bands.make_stack(prepared['data_layers_list'],
+                                                                prepared['temp_dir'],
+                                                                sensor_date_ts,
+                                                                bounding_box=bounding_box,
+                                                                warp_cache=dynamic_warp_cache,
+                                                                rolling_climate=climate_accumulators,
+                                                                sar_pyramids=sar_scene_pyramids,
+                                                                climate_cubes=climate_archive_cubes,
+                                                                focal_layers=focal_stat_layers,
+                                                                terrain_layers=dem_terrain_layers,
+                                                                stage_cache=sensor_stage_cache)
+        except Exception:
+            shutil.rmtree(prepared['temp_dir'])
+            raise
+
+        return prepared
+
+    def cleanup_date(prepared):
+        """
+        Remove temp files for a date
+        """
+        shutil.rmtree(prepared['temp_dir'])
+
+    def prepare_error(sensor_date_ts, err):
+        """
+        Report error preparing a date
+        """
+        if debug_mode:
+            raise err
+        else:
+            print("***** {} *****".format(time.strftime('%Y%m%d', sensor_date_ts)))
+            print(err)
+
+    def process_date(sensor_date_ts, prepared):
+        """
+        Extract pixel values, train and apply Random Forests for a date.
+        """
+        nonlocal out_var_importance_header
+
+        temp_dir = prepared['temp_dir']
+        sensor_data_csv = prepared['sensor_data_csv']
+        date_layers_list = prepared['data_layers_list']
         date_str = time.strftime('%Y%m%d', sensor_date_ts)
         out_base_name = date_str
-        
-        # Extract CSV to use for upscaling from all sensor data.
-        sensor_data_csv = os.path.join(temp_dir, "{}_sensor_data.csv".format(out_base_name))
-
-        num_out_records = csv_extractor.create_csv_from_input(sensor_date_ts, sensor_data_csv,
-                                                              sensor_ids_list)
 
         try:
             print("***** {} *****".format(date_str))
 
-            # Create band stack
-            data_stack = stack_bands.make_stack(data_layers_list, temp_dir,
-                                                sensor_date_ts, bounding_box=bounding_box)
+            statscsv = os.path.join(out_csv_dir, out_base_name + '_sensor_data.csv')
+            out_sm_image = os.path.join(out_imge_dir, out_base_name + out_image_suffix + '.kea')
+            out_sm_col_image = os.path.join(out_imge_dir, out_base_name + out_image_suffix + '_col.tif')
+
+            if tile_size is not None:
+                # Create stacks, extract pixel vals and run Random Forests
+                # for each tile
+                rf_par = tiling.run_tiled_upscaling(sensor_data_csv, statscsv,
+                                                    out_sm_image, date_layers_list,
+                                                    temp_dir, sensor_date_ts,
+                                                    bounding_box=bounding_box,
+                                                    tile_size=tile_size,
+                                                    num_workers=tile_workers,
+                                                    upscaling_model=upscaling_model,
+                                                    feature_store=train_feature_store,
+                                                    depth=None,
+                                                    warp_cache=dynamic_warp_cache,
+                                                    rolling_climate=climate_accumulators,
+                                                    sar_pyramids=sar_scene_pyramids,
+                                                    climate_cubes=climate_archive_cubes,
+                                                    focal_layers=focal_stat_layers,
+                                                    terrain_layers=dem_terrain_layers,
+                                                    station_index=sensor_station_index,
+                                                    n_estimators=n_estimators,
+                                                    max_estimators=max_estimators,
+                                                    oob_tolerance=oob_tolerance,
+                                                    uncertainty=predict_uncertainty,
+                                                    quantiles=predict_quantiles)
+            else:
+                data_stack = prepared['data_stack']
+
+                # Extract pixel vals
+                extract_image_stats.extract_layer_stats_csv(sensor_data_csv,
+                                                            statscsv,
+                                                            date_layers_list, data_stack,
+                                                            feature_store=train_feature_store,
+                                                            sm_date_ts=sensor_date_ts,
+                                                            depth=None,
+                                                            station_index=sensor_station_index,
+                                                            stage_cache=sensor_stage_cache,
+                                                            bounding_box=bounding_box)
+                # Run Random Forests
+                rf_par = rf_upscaling.run_random_forests(statscsv, data_stack,
+                                                         out_sm_image, date_layers_list,
+                                                         upscaling_model=upscaling_model,
+                                                         n_estimators=n_estimators,
+                                                         max_estimators=max_estimators,
+                                                         oob_tolerance=oob_tolerance,
+                                                         uncertainty=predict_uncertainty,
+                                                         quantiles=predict_quantiles,
+                                                         preview_factor=preview_factor)
 
             # Check if using UAVSAR data
             uavsar_date_str = "NA"
-            for layer in data_layers_list:
+            for layer in date_layers_list:
                 if layer.layer_name == 'uavsar_hh':
                     uavsar_date_str = time.strftime('%Y%m%d', layer.layer_date)
 
-            # Extract pixel vals
-            statscsv = os.path.join(out_csv_dir, out_base_name + '_sensor_data.csv')
-            extract_image_stats.extract_layer_stats_csv(sensor_data_csv,
-                                                        statscsv,
-                                                        data_layers_list, data_stack)
-            # Run Random Forests
-            out_sm_image = os.path.join(out_imge_dir, out_base_name + '_predict_sm.kea')
-            out_sm_col_image = os.path.join(out_imge_dir, out_base_name + '_predict_sm_col.tif')
-
-            rf_par = rf_upscaling.run_random_forests(statscsv, data_stack,
-                                                     out_sm_image, data_layers_list,
-                                                     upscaling_model=upscaling_model)
-
             # Write out stats
             out_row = [out_base_name,
                        rf_par['nSamples'],
@@ -169,9 +411,18 @@ def run_scaling(config_file, debug_mode=False):
                        rf_par['RMSE'],
                        rf_par['Bias'],
                        rf_par['RSq'],
-                       uavsar_date_str]
+                       uavsar_date_str,
+                       rf_par['nTrees']]
+            if preview_factor is not None:
+                out_row.extend(preview.get_preview_stats_row(out_sm_image,
+                                                             os.path.join(out_imge_dir,
+                                                                          out_base_name + '_predict_sm.kea')))
             out_stats.writerow(out_row)
 
+            if sm_prediction_cube is not None:
+                sm_prediction_cube.append_image(out_base_name, out_sm_image,
+                                                stats=prediction_cube.get_model_stats(rf_par))
+
             # Write header for first record
             if not out_var_importance_header:
                 out_var_importancee.writerow(rf_par['varNames'])
@@ -193,6 +444,54 @@ def run_scaling(config_file, debug_mode=False):
         # Remove temp files
         shutil.rmtree(temp_dir)
 
+    # Check static layers, find dynamic layers and (if writing a plan)
+    # extract sensor data for each date before any processing, so only
+    # dates which can be run are scheduled.
+    plan_trees = max_estimators if n_estimators == 'adaptive' else n_estimators
+    if plan_file is not None:
+        plan = run_planner.make_plan(all_sensor_dates_ts, data_layers_list,
+                                     bounding_box=bounding_box,
+                                     extract_sensors_func=extract_sensor_data,
+                                     sensor_dir=os.path.splitext(plan_file)[0] + '_sensors',
+                                     num_trees=plan_trees)
+        run_planner.write_plan(plan, plan_file)
+        run_planner.print_plan_summary(plan)
+        print('Written plan to {}'.format(plan_file))
+        return
+    elif run_plan_file is not None:
+        plan = run_planner.read_plan(run_plan_file)
+    else:
+        plan = run_planner.make_plan(all_sensor_dates_ts, data_layers_list,
+                                     bounding_box=bounding_box,
+                                     num_trees=plan_trees)
+    run_planner.print_plan_summary(plan)
+    planned_dates = run_planner.get_run_dates(plan)
+    all_sensor_dates_ts = [sensor_date_ts for sensor_date_ts in all_sensor_dates_ts
+                           if calendar.timegm(sensor_date_ts) in planned_dates]
+
+    out_stats_file = os.path.join(out_stats_dir, 'scaling_function_stats{}.csv'.format(out_stats_suffix))
+    out_stats_handler = open(out_stats_file, 'w')
+    out_stats = csv.writer(out_stats_handler)
+
+    out_var_importance_file = os.path.join(out_stats_dir, 'scaling_function_var_importance{}.csv'.format(out_stats_suffix))
+    out_var_importance_handler = open(out_var_importance_file, 'w')
+    out_var_importancee = csv.writer(out_var_importance_handler)
+    out_var_importance_header = False
+
+    # Write header
+    out_stats_header = ['Date', 'nSamples', 'avgSM_train', 'stdSM_train', 'avgSM_predict',
+                        'stdSM_predict', 'RMSE', 'Bias', 'RSq', 'UAVSARDate', 'nTrees']
+    if preview_factor is not None:
+        out_stats_header.extend(preview.PREVIEW_STATS_HEADER)
+    out_stats.writerow(out_stats_header)
+
+    # Look through all dates
+    date_pipeline.run_pipelined(all_sensor_dates_ts, prepare_date, process_date,
+                                max_prefetch=prefetch_dates,
+                                num_workers=prepare_workers,
+                                error_func=prepare_error,
+                                cleanup_func=cleanup_date)
+
     # Close files
     out_stats_handler.close()
 
@@ -209,7 +508,23 @@ if __name__ == '__main__':
                         help="Run in debug mode (more error messages; default=False).",
                         default=False, required=False)
 
+    parser.add_argument("--plan", type=str, default=None, required=False,
+                        help="Write plan for run to this file and exit.")
+    parser.add_argument("--run_plan", type=str, default=None, required=False,
+                        help="Run the dates in this plan (created using --plan).")
+    parser.add_argument("--preview", type=float, default=None, required=False,
+                        help="Run a quick-look preview, predicting at the output resolution "
+                             "multiplied by this factor (e.g., 10).")
+    parser.add_argument("--dates", type=str, nargs='+', default=None, required=False,
+                        help="Only run these dates (YYYYMMDD).")
+    parser.add_argument("--stage_cache", type=str, default=None, required=False,
+                        help="Share sensor data, stacks and pixel values with other "
+                             "runs using this directory.")
+
     args = parser.parse_args() 
 
-    run_scaling(args.configfile, debug_mode=args.debug)
+    run_scaling(args.configfile, debug_mode=args.debug,
+                plan_file=args.plan, run_plan_file=args.run_plan,
+                preview_factor=args.preview, run_dates=args.dates,
+                stage_cache_dir=args.stage_cache)
 
@@ -14,22 +14,43 @@
 import argparse
 import calendar
 import configparser
+import copy
 import csv
 import os
 import sys
 import tempfile
+import threading
 import time
 import shutil
 
 from soilscape_upscaling import upscaling_common
+from soilscape_upscaling import cpu_budget
+from soilscape_upscaling import climate_cube
+from soilscape_upscaling import date_pipeline
 from soilscape_upscaling import stack_bands
+from soilscape_upscaling import station_index
 from soilscape_upscaling import extract_image_stats
+from soilscape_upscaling import feature_store
+from soilscape_upscaling import focal_layers
+from soilscape_upscaling import layer_providers
+from soilscape_upscaling import prediction_cube
+from soilscape_upscaling import preview
 from soilscape_upscaling import rf_upscaling
+from soilscape_upscaling import rolling_climate
+from soilscape_upscaling import run_planner
+from soilscape_upscaling import sar_pyramids
+from soilscape_upscaling import stage_cache
+from soilscape_upscaling import terrain_layers
+from soilscape_upscaling import tiling
 from soilscape_upscaling import upscaling_utilities
+from soilscape_upscaling import warp_cache
 from soilscape_upscaling.data_extractors import soilscape_db_extractor
 
 MAX_SM_COL = 0.3
 
+# Minimum number of sensors with data needed to run a date
+MIN_SENSORS = 11
+
 def check_create_dir(in_dir_path):
     """
     Check a directory exists and create if it doesn't
@@ -44,10 +65,28 @@ def py2SQLiteTime(inTimePy):
     """
     return time.strftime('%Y-%m-%d %H:%M:%S',inTimePy)
 
-def run_scaling(config_file, debugMode=False):   
+def run_scaling(config_file, debugMode=False, planFile=None, runPlanFile=None,
+                previewFactor=None, runDates=None, stageCacheDir=None):
 
     """
     Run scaling function for a range of dates
+
+    If 'planFile' is provided a plan is written to this file (with the
+    sensor data for each date) and no dates are processed. If 'runPlanFile'
+    is provided only the dates which can be run in this plan are
+    processed, using the sensor data extracted when the plan was made.
+
+    If 'previewFactor' is provided a quick-look preview is run. The model
+    is trained as for a full resolution run and applied at the output
+    resolution multiplied by this factor, then compared against the
+    full resolution output for each date (if it exists).
+
+    If 'runDates' is provided (list of YYYYMMDD) only these dates are run,
+    and stats are written to a separate file for these dates.
+
+    If 'stageCacheDir' is provided (or 'stage_cache_dir' in the config)
+    sensor data, stacks and pixel values are shared with other runs
+    using the same cache.
     
     Known issues:
 
@@ -102,30 +141,122 @@ def run_scaling(config_file, debugMode=False):
 
     bounding_box = config['default']['bounding_box'].split()
 
+    # Register any extra providers of dynamic layers
+    layer_providers.register_providers_from_config(config['default'])
+
     try:
         upscaling_model = config['default']['upscaling_model']
     except KeyError:
         upscaling_model = "RandomForestRegressor"
 
+    # Number of trees for Random Forests. If 'adaptive' trees are added
+    # until the out-of-bag RMSE converges (up to rf_max_estimators)
+    nEstimators = rf_upscaling.get_n_estimators(config['default'].get('rf_n_estimators',
+                                                                      rf_upscaling.DEFAULT_N_ESTIMATORS))
+    maxEstimators = int(config['default'].get('rf_max_estimators',
+                                              rf_upscaling.ADAPTIVE_MAX_ESTIMATORS))
+    oobTolerance = float(config['default'].get('rf_oob_tolerance',
+                                               rf_upscaling.ADAPTIVE_OOB_TOLERANCE))
+
+    # Check if the standard deviation (and optionally quantiles) of the
+    # predictions from each tree should be written alongside the prediction
+    predictUncertainty = config['default'].getboolean('predict_uncertainty', False)
+    predictQuantiles = rf_upscaling.get_quantiles(config['default'].get('predict_quantiles'))
+
+    # Check if the bounding box should be split into tiles
+    try:
+        tile_size = int(config['default']['tile_size'])
+        tile_workers = int(config['default'].get('tile_workers', 1))
+    except KeyError:
+        tile_size = None
+
+    # Check if transforms used to warp dynamic layers should be cached
+    warpCache = upscaling_common.create_from_config(config['default'], 'warp_cache_dir',
+                                                    warp_cache.WarpTransformCache)
+
+    # Check if accumulators for rolling climate layers (e.g., 'prism_ppt_api7')
+    # should be saved so they can be used by later runs (always kept for
+    # the current run)
+    rollingClimate = rolling_climate.RollingClimate(config['default'].get('rolling_climate_dir'))
+
+    # Check if AirMOSS / UAVSAR scenes should be ingested to the output grid
+    # (with overviews) so each scene is only averaged once
+    sarPyramids = upscaling_common.create_from_config(config['default'], 'sar_pyramid_dir',
+                                                      sar_pyramids.SARPyramids,
+                                                      bounding_box)
+
+    # Check if PRISM / ECMWF archives have been ingested to cubes on the
+    # output grid (see climate_cube)
+    climateCubes = upscaling_common.create_from_config(config['default'], 'climate_cube_dir',
+                                                       climate_cube.ClimateCubes)
+
+    # Check if focal layers (see focal_layers) should be stored so they
+    # are only calculated once for each grid
+    focalLayers = upscaling_common.create_from_config(config['default'], 'focal_layer_dir',
+                                                      focal_layers.FocalLayers)
+
+    # Check if terrain layers (see terrain_layers) should be stored so they
+    # are only calculated once for each DEM and grid
+    terrainLayers = upscaling_common.create_from_config(config['default'], 'terrain_layer_dir',
+                                                        terrain_layers.TerrainLayers)
+
+    # Check if outputs of stages which don't depend on the model (sensor
+    # data, stacks and pixel values) should be shared with other runs
+    if stageCacheDir is None:
+        stageCacheDir = config['default'].get('stage_cache_dir')
+    if stageCacheDir is not None:
+        stageCache = stage_cache.StageCache(stageCacheDir)
+    else:
+        stageCache = None
+
+    # Check if the pixel for each sensor should be saved so it can be
+    # used by later runs (always kept for the current run)
+    stationIndex = station_index.StationIndex(config['default'].get('station_index_dir'))
+
+    # Check if extracted values should be added to a feature store
+    featureStore = upscaling_common.create_from_config(config['default'], 'feature_store_dir',
+                                                       feature_store.FeatureStore)
+
+    # Check if predictions should be added to a time-series cube
+    predictionCube = upscaling_common.create_from_config(config['default'], 'prediction_cube_dir',
+                                                         prediction_cube.PredictionCube)
+
+    # In preview mode the model is applied to a subsampled version of the
+    # full resolution stack (not tiled) and outputs are written alongside
+    # full resolution outputs.
+    if previewFactor is not None:
+        tile_size = None
+        predictionCube = None
+        outImageSuffix = '_predict_sm_preview'
+        outStatsSuffix = '_preview'
+    else:
+        outImageSuffix = '_predict_sm'
+        outStatsSuffix = ''
+    if runDates is not None:
+        outStatsSuffix += '_' + '_'.join(sorted(runDates))
+
+    # Check if dates should be prepared in the background while the
+    # model is run for the current date
+    prefetchDates = int(config['default'].get('prefetch_dates', 0))
+    prepareWorkers = int(config['default'].get('prepare_workers', 1))
+
+    # Share the CPU budget between tile workers, background workers,
+    # scikit-learn, GDAL and BLAS
+    cpuAllocation = cpu_budget.set_cpu_budget(config['default'],
+                                              tile_workers=1 if tile_size is None else tile_workers,
+                                              prepare_workers=prepareWorkers if prefetchDates > 0 else 0)
+    if tile_size is not None:
+        tile_workers = cpuAllocation['tile_workers']
+    if prefetchDates > 0:
+        prepareWorkers = cpuAllocation['prepare_workers']
+
     # Set start and end time
     starttimeEpoch = calendar.timegm(starttime)
     endtimeEpoch = calendar.timegm(endtime)
     
     timeInterval = 3600*float(timeIntervalHours)       # Average over 'timeInterval'
     predictSpacing = 3600*24*float(predictSpacingDays) # Produce predictions with a 'predictSpacing'
-    csv_extractor = soilscape_db_extractor.SoilSCAPECreateCSVfromDB(inSQLite,
-                                                                    outSensorNum=sensorNum,
-                                                                    debugMode=debugMode)
-    
-    outStatsFile = os.path.join(outputStatsDIR, 'scaling_function_stats.csv')
-    outStatsHandler = open(outStatsFile,'w')
-    outStats = csv.writer(outStatsHandler)
     
-    outVarImportanceFile = os.path.join(outputStatsDIR, 'scaling_function_var_importance.csv')
-    outVarImportanceHandler = open(outVarImportanceFile,'w')
-    outVarImportance = csv.writer(outVarImportanceHandler)
-    outVarImportancHeader = False
-
     # Get a list of data layers - to check if using AirMOSS
     data_layers_list = []
     for section in config.sections():
@@ -148,52 +279,204 @@ def run_scaling(config_file, debugMode=False):
     # If there is a band called 'airmoss_hh' using AirMOSS
     # if there isn't aren't
     useAirMOSS = 'airmoss_hh' in band_names
-    
-    # Write header
-    outStats.writerow(['Date','nSamples','avgSM_train','stdSM_train','avgSM_predict',
-                       'stdSM_predict','RMSE','Bias','RSq','AirMOSSDate'])
-    
+
+    # Get list of dates to run
+    datesEpochList = []
     while starttimeEpoch < endtimeEpoch:
-        endIntervalTimeEpoch = starttimeEpoch + timeInterval
-    
-        startTS = time.gmtime(starttimeEpoch)
-        endTS = time.gmtime(endIntervalTimeEpoch)
-    
+        datesEpochList.append(starttimeEpoch)
+        # Add spacing to start time.
+        starttimeEpoch += predictSpacing
+
+    # Only run selected dates
+    if runDates is not None:
+        datesEpochList = [dateEpoch for dateEpoch in datesEpochList
+                          if time.strftime('%Y%m%d', time.gmtime(dateEpoch)) in runDates]
+
+    # Sensor data used (to identify data in the stage cache)
+    sensorSource = stage_cache.get_sensor_source(config['default'])
+
+    # Check if the series for each node should be read once and windows
+    # averaged for all dates using prefix sums, rather than querying for
+    # every date (off by default).
+    sensorWindowAggregation = config['default'].getboolean('sensor_window_aggregation', False)
+    windowAggregator = None
+
+    def loadSensorSeries(seriesDatesEpochList):
+        """
+        Read the series for each node covering a list of dates (if
+        sensor_window_aggregation is set).
+        """
+        nonlocal windowAggregator
+        if not sensorWindowAggregation or len(seriesDatesEpochList) == 0:
+            return
+        seriesExtractor = soilscape_db_extractor.SoilSCAPECreateCSVfromDB(inSQLite,
+                                                                         outSensorNum=sensorNum,
+                                                                         debugMode=debugMode)
+        seriesStartTS = time.gmtime(min(seriesDatesEpochList))
+        seriesEndTS = time.gmtime(max(seriesDatesEpochList) + timeInterval)
+        windowAggregator = seriesExtractor.loadSeries(physicalIDsList,
+                                                      py2SQLiteTime(seriesStartTS),
+                                                      py2SQLiteTime(seriesEndTS))
+        windowAggregator.precompute(seriesDatesEpochList, [timeInterval])
+        seriesExtractor.sensordb.close()
+
+    # SQLite connections can only be used from the thread which created
+    # them so create a separate extractor for each preparation thread.
+    # The window aggregator is only read so is shared.
+    extractorThreadData = threading.local()
+
+    def extractSensorData(startTS, outDataCSV):
+        """
+        Extract sensor data for a date to a CSV, returns the number
+        of sensors.
+        """
+        if not hasattr(extractorThreadData, 'csv_extractor'):
+            extractorThreadData.csv_extractor = \
+                soilscape_db_extractor.SoilSCAPECreateCSVfromDB(inSQLite,
+                                                                outSensorNum=sensorNum,
+                                                                debugMode=debugMode)
+            extractorThreadData.csv_extractor.windowAggregator = windowAggregator
+        endTS = time.gmtime(calendar.timegm(startTS) + timeInterval)
+        return extractorThreadData.csv_extractor.createCSVFromDB(physicalIDsList,
+                                                                 outDataCSV,
+                                                                 py2SQLiteTime(startTS),
+                                                                 py2SQLiteTime(endTS))
+
+    def prepareDate(dateEpoch):
+        """
+        Extract sensor data and create stack for a date.
+        """
+        startTS = time.gmtime(dateEpoch)
+
         # Create temp DIR
-        tempDIR = tempfile.mkdtemp(prefix='soilscape_upscaling')
+        prepared = {}
+        prepared['tempDIR'] = tempfile.mkdtemp(prefix='soilscape_upscaling')
+        prepared['startTS'] = startTS
+        prepared['data_layers_list'] = copy.deepcopy(data_layers_list)
+        prepared['data_stack'] = None
+        try:
+            # Extract CSV from dB
+            prepared['sensorDataCSV'] = os.path.join(prepared['tempDIR'],
+                                                     "{}_sensor_data.csv".format(time.strftime('%Y%m%d',startTS)))
+
+            # Use sensor data extracted when the plan was made if available
+            datePlan = plannedDates.get(dateEpoch, {})
+            if os.path.isfile(datePlan.get('sensorCSV', '')):
+                shutil.copy(datePlan['sensorCSV'], prepared['sensorDataCSV'])
+                prepared['nOutRecords'] = datePlan['numSensors']
+            elif stageCache is not None:
+                prepared['nOutRecords'] = stageCache.extract_sensors(sensorSource, startTS,
+                                                                     prepared['sensorDataCSV'],
+                                                                     extractSensorData)
+            else:
+                prepared['nOutRecords'] = extractSensorData(startTS,
+                                                            prepared['sensorDataCSV'])
+            # Create band stack (if not using tiles)
+            if prepared['nOutRecords'] >= MIN_SENSORS and tile_size is None:
+                prepared['data_stack'] = stack_bands.make_stack(prepared['data_layers_list'],
+                                                                prepared['tempDIR'],
+                                                                startTS, bounding_box=bounding_box,
+                                                                warp_cache=warpCache,
+                                                                rolling_climate=rollingClimate,
+                                                                sar_pyramids=sarPyramids,
+                                                                climate_cubes=climateCubes,
+                                                                focal_layers=focalLayers,
+                                                                terrain_layers=terrainLayers,
+                                                                stage_cache=stageCache)
+        except Exception:
+            shutil.rmtree(prepared['tempDIR'])
+            raise
+
+        return prepared
+
+    def cleanupDate(prepared):
+        """
+        Remove temp files for a date
+        """
+        shutil.rmtree(prepared['tempDIR'])
+
+    def prepareError(dateEpoch, err):
+        """
+        Report error preparing a date
+        """
+        if debugMode:
+            raise err
+        else:
+            print("***** {} *****".format(time.strftime('%Y%m%d', time.gmtime(dateEpoch))))
+            print(err)
+
+    def processDate(dateEpoch, prepared):
+        """
+        Extract pixel values, train and apply Random Forests for a date.
+        """
+        nonlocal outVarImportancHeader
+
+        startTS = prepared['startTS']
+        tempDIR = prepared['tempDIR']
+        sensorDataCSV = prepared['sensorDataCSV']
+        date_layers_list = prepared['data_layers_list']
         dateStr = time.strftime('%Y%m%d',startTS)
         outBaseName = dateStr
-        
-        # Extract CSV from dB
-        sensorDataCSV = os.path.join(tempDIR, "{}_sensor_data.csv".format(outBaseName))
 
-        nOutRecords = csv_extractor.createCSVFromDB(physicalIDsList, sensorDataCSV,
-                                                    py2SQLiteTime(startTS),
-                                                    py2SQLiteTime(endTS))
-        if nOutRecords > 10:
+        if prepared['nOutRecords'] >= MIN_SENSORS:
             try:
                 print("***** {} *****".format(dateStr))
-                # Create band stack 
-                data_stack = stack_bands.make_stack(data_layers_list, tempDIR,
-                                                    startTS, bounding_box=bounding_box)
+                statscsv = os.path.join(outputCSVDIR, outBaseName + '_sensor_data.csv')
+                outSMimage = os.path.join(outputImageDIR, outBaseName + outImageSuffix + '.kea')
+                outSMColimage = os.path.join(outputImageDIR, outBaseName + outImageSuffix + '_col.tif')
+
+                if tile_size is not None:
+                    # Create stacks, extract pixel vals and run Random Forests
+                    # for each tile
+                    rfPar = tiling.run_tiled_upscaling(sensorDataCSV, statscsv,
+                                                       outSMimage, date_layers_list,
+                                                       tempDIR, startTS,
+                                                       bounding_box=bounding_box,
+                                                       tile_size=tile_size,
+                                                       num_workers=tile_workers,
+                                                       upscaling_model=upscaling_model,
+                                                       feature_store=featureStore,
+                                                       depth=sensorNum,
+                                                       warp_cache=warpCache,
+                                                       rolling_climate=rollingClimate,
+                                                       sar_pyramids=sarPyramids,
+                                                       climate_cubes=climateCubes,
+                                                       focal_layers=focalLayers,
+                                                       terrain_layers=terrainLayers,
+                                                       station_index=stationIndex,
+                                                       n_estimators=nEstimators,
+                                                       max_estimators=maxEstimators,
+                                                       oob_tolerance=oobTolerance,
+                                                       uncertainty=predictUncertainty,
+                                                       quantiles=predictQuantiles)
+                else:
+                    data_stack = prepared['data_stack']
+
+                    # Extract pixel vals
+                    extract_image_stats.extract_layer_stats_csv(sensorDataCSV,
+                                                                statscsv,
+                                                                date_layers_list, data_stack,
+                                                                feature_store=featureStore,
+                                                                sm_date_ts=startTS,
+                                                                depth=sensorNum,
+                                                                station_index=stationIndex,
+                                                                stage_cache=stageCache,
+                                                                bounding_box=bounding_box)
+                    # Run Random Forests
+                    rfPar = rf_upscaling.run_random_forests(statscsv, data_stack,
+                                                            outSMimage, date_layers_list,
+                                                            upscaling_model=upscaling_model,
+                                                            n_estimators=nEstimators,
+                                                            max_estimators=maxEstimators,
+                                                            oob_tolerance=oobTolerance,
+                                                            uncertainty=predictUncertainty,
+                                                            quantiles=predictQuantiles,
+                                                            preview_factor=previewFactor)
 
                 airmossDateStr = "NA"
-                for layer in data_layers_list:
+                for layer in date_layers_list:
                     if layer.layer_name == 'airmoss_hh':
                         airmossDateStr = time.strftime('%Y%m%d', layer.layer_date)
-
-                # Extract pixel vals
-                statscsv = os.path.join(outputCSVDIR, outBaseName + '_sensor_data.csv')
-                extract_image_stats.extract_layer_stats_csv(sensorDataCSV,
-                                                            statscsv,
-                                                            data_layers_list, data_stack)
-                # Run Random Forests
-                outSMimage = os.path.join(outputImageDIR, outBaseName + '_predict_sm.kea')
-                outSMColimage = os.path.join(outputImageDIR, outBaseName + '_predict_sm_col.tif')
-    
-                rfPar = rf_upscaling.run_random_forests(statscsv, data_stack,
-                                                        outSMimage, data_layers_list,
-                                                        upscaling_model=upscaling_model)
         
                 # Write out stats
                 outRow = [outBaseName,
@@ -205,8 +488,17 @@ def run_scaling(config_file, debugMode=False):
                           rfPar['RMSE'],
                           rfPar['Bias'],
                           rfPar['RSq'],
-                          airmossDateStr]
+                          airmossDateStr,
+                          rfPar['nTrees']]
+                if previewFactor is not None:
+                    outRow.extend(preview.get_preview_stats_row(outSMimage,
+                                                                os.path.join(outputImageDIR,
+                                                                             outBaseName + '_predict_sm.kea')))
                 outStats.writerow(outRow)
+
+                if predictionCube is not None:
+                    predictionCube.append_image(outBaseName, outSMimage,
+                                                stats=prediction_cube.get_model_stats(rfPar))
     
                 # Write header for first record
                 if not outVarImportancHeader:
@@ -229,8 +521,60 @@ def run_scaling(config_file, debugMode=False):
         # Remove temp files
         shutil.rmtree(tempDIR)
 
-        # Add spacing to start time.
-        starttimeEpoch += predictSpacing
+    # Check static layers, find dynamic layers and (if writing a plan)
+    # extract sensor data for each date before any processing, so only
+    # dates which can be run are scheduled.
+    datesTSList = [time.gmtime(dateEpoch) for dateEpoch in datesEpochList]
+    planTrees = maxEstimators if nEstimators == 'adaptive' else nEstimators
+    if planFile is not None:
+        loadSensorSeries(datesEpochList)
+        plan = run_planner.make_plan(datesTSList, data_layers_list,
+                                     bounding_box=bounding_box,
+                                     extract_sensors_func=extractSensorData,
+                                     sensor_dir=os.path.splitext(planFile)[0] + '_sensors',
+                                     min_sensors=MIN_SENSORS,
+                                     num_trees=planTrees)
+        run_planner.write_plan(plan, planFile)
+        run_planner.print_plan_summary(plan)
+        print('Written plan to {}'.format(planFile))
+        return
+    elif runPlanFile is not None:
+        plan = run_planner.read_plan(runPlanFile)
+    else:
+        plan = run_planner.make_plan(datesTSList, data_layers_list,
+                                     bounding_box=bounding_box,
+                                     num_trees=planTrees)
+    run_planner.print_plan_summary(plan)
+    plannedDates = run_planner.get_run_dates(plan)
+    datesEpochList = [dateEpoch for dateEpoch in datesEpochList
+                      if dateEpoch in plannedDates]
+
+    # Only read series for dates where sensor data weren't extracted
+    # when the plan was made
+    loadSensorSeries([dateEpoch for dateEpoch in datesEpochList
+                      if not os.path.isfile(plannedDates[dateEpoch].get('sensorCSV', ''))])
+
+    outStatsFile = os.path.join(outputStatsDIR, 'scaling_function_stats{}.csv'.format(outStatsSuffix))
+    outStatsHandler = open(outStatsFile,'w')
+    outStats = csv.writer(outStatsHandler)
+    
+    outVarImportanceFile = os.path.join(outputStatsDIR, 'scaling_function_var_importance{}.csv'.format(outStatsSuffix))
+    outVarImportanceHandler = open(outVarImportanceFile,'w')
+    outVarImportance = csv.writer(outVarImportanceHandler)
+    outVarImportancHeader = False
+
+    # Write header
+    outStatsHeader = ['Date','nSamples','avgSM_train','stdSM_train','avgSM_predict',
+                      'stdSM_predict','RMSE','Bias','RSq','AirMOSSDate','nTrees']
+    if previewFactor is not None:
+        outStatsHeader.extend(preview.PREVIEW_STATS_HEADER)
+    outStats.writerow(outStatsHeader)
+
+    date_pipeline.run_pipelined(datesEpochList, prepareDate, processDate,
+                                max_prefetch=prefetchDates,
+                                num_workers=prepareWorkers,
+                                error_func=prepareError,
+                                cleanup_func=cleanupDate)
 
     # Close files
     outStatsHandler.close()
@@ -247,8 +591,23 @@ if __name__ == '__main__':
     parser.add_argument("--debug", action='store_true',
                         help="Run in debug mode (more error messages; default=False).",
                         default=False, required=False)
+    parser.add_argument("--plan", type=str, default=None, required=False,
+                        help="Write plan for run to this file and exit.")
+    parser.add_argument("--run_plan", type=str, default=None, required=False,
+                        help="Run the dates in this plan (created using --plan).")
+    parser.add_argument("--preview", type=float, default=None, required=False,
+                        help="Run a quick-look preview, predicting at the output resolution "
+                             "multiplied by this factor (e.g., 10).")
+    parser.add_argument("--dates", type=str, nargs='+', default=None, required=False,
+                        help="Only run these dates (YYYYMMDD).")
+    parser.add_argument("--stage_cache", type=str, default=None, required=False,
+                        help="Share sensor data, stacks and pixel values with other "
+                             "runs using this directory.")
 
     args = parser.parse_args() 
 
-    run_scaling(args.configfile, debugMode=args.debug)
+    run_scaling(args.configfile, debugMode=args.debug,
+                planFile=args.plan, runPlanFile=args.run_plan,
+                previewFactor=args.preview, runDates=args.dates,
+                stageCacheDir=args.stage_cache)
 
@@ -11,6 +11,7 @@ Modified from script for SoilSCAPE network in Tonzi (Dan Clewley)
 import argparse
 import calendar
 import configparser
+import copy
 import csv
 import os
 import os.path
@@ -22,10 +23,27 @@ import numpy
 import pandas
 
 from soilscape_upscaling import upscaling_common
+from soilscape_upscaling import cpu_budget
+from soilscape_upscaling import climate_cube
+from soilscape_upscaling import date_pipeline
 from soilscape_upscaling import stack_bands
+from soilscape_upscaling import station_index
 from soilscape_upscaling import extract_image_stats
+from soilscape_upscaling import feature_store
+from soilscape_upscaling import focal_layers
+from soilscape_upscaling import layer_providers
+from soilscape_upscaling import prediction_cube
+from soilscape_upscaling import preview
+from soilscape_upscaling import pooled_training
 from soilscape_upscaling import rf_upscaling
+from soilscape_upscaling import rolling_climate
+from soilscape_upscaling import run_planner
+from soilscape_upscaling import sar_pyramids
+from soilscape_upscaling import stage_cache
+from soilscape_upscaling import terrain_layers
+from soilscape_upscaling import tiling
 from soilscape_upscaling import upscaling_utilities
+from soilscape_upscaling import warp_cache
 from soilscape_upscaling.data_extractors import txson_extractor
 
 MAX_SM_COL = 0.4
@@ -39,10 +57,34 @@ def check_create_dir(in_dir_path):
         os.makedirs(in_dir_path)
 
 
-def run_scaling(outfolder, config_file, debugMode=False):   
+def run_scaling(outfolder, config_file, debugMode=False, planFile=None,
+                runPlanFile=None, previewFactor=None, splitSeed=None,
+                runDates=None, stageCacheDir=None):
 
     """
     Run scaling function for a range of dates
+
+    If 'planFile' is provided a plan is written to this file (with the
+    training node data for each date) and no dates are processed. If
+    'runPlanFile' is provided only the dates which can be run in this plan
+    are processed, using the node data extracted when the plan was made
+    and the same split into training and validation sites.
+
+    If 'previewFactor' is provided a quick-look preview is run. The model
+    is trained as for a full resolution run and applied at the output
+    resolution multiplied by this factor, then compared against the
+    full resolution output for each date (if it exists).
+
+    If 'splitSeed' is provided it is used to seed the random split into
+    training and validation sites, so the same split is used when dates
+    are run separately (e.g., by work_queue on multiple machines).
+
+    If 'runDates' is provided (list of YYYYMMDD) only these dates are run,
+    and stats are written to a separate file for these dates.
+
+    If 'stageCacheDir' is provided (or 'stage_cache_dir' in the config)
+    node data, stacks and pixel values are shared with other runs
+    using the same cache.
     
     Known issues:
 
@@ -97,17 +139,40 @@ def run_scaling(outfolder, config_file, debugMode=False):
         raise Exception('The number of training and validation nodes must'
                         ' be less than the total number of nodes')
 
-    # Split into training and testing data by putting input list of sites in
-    # a random order then taking ones at the start for training and ones
-    # at the end for validation
-    numpy.random.shuffle(all_sites_list)
-
-    train_site_ids_list = all_sites_list[:num_train_sites]
-    validation_site_ids_list = all_sites_list[(-1*num_val_sites):]
-
-    # Sort back into order (will spped up site selection later)
-    train_site_ids_list = numpy.sort(train_site_ids_list)
-    validation_site_ids_list = numpy.sort(validation_site_ids_list)
+    # When running a plan use the split of sites the plan was made with,
+    # as the node data saved in the plan are for these training sites
+    if runPlanFile is not None:
+        plan = run_planner.read_plan(runPlanFile)
+        siteSplit = run_planner.get_site_split(plan)
+        if siteSplit is None:
+            raise Exception('The plan {} does not contain the split into training '
+                            'and validation sites'.format(runPlanFile))
+        if splitSeed is not None and splitSeed != siteSplit['seed']:
+            raise Exception('The split seed ({}) is different to the seed the plan '
+                            'was made with ({})'.format(splitSeed, siteSplit['seed']))
+        splitSeed = siteSplit['seed']
+        train_site_ids_list = numpy.array(siteSplit['trainSiteIDs'])
+        validation_site_ids_list = numpy.array(siteSplit['validationSiteIDs'])
+    else:
+        # Split into training and testing data by putting input list of sites in
+        # a random order then taking ones at the start for training and ones
+        # at the end for validation
+        if splitSeed is not None:
+            numpy.random.RandomState(int(splitSeed)).shuffle(all_sites_list)
+        else:
+            numpy.random.shuffle(all_sites_list)
+
+        train_site_ids_list = all_sites_list[:num_train_sites]
+        validation_site_ids_list = all_sites_list[(-1*num_val_sites):]
+
+        # Sort back into order (will spped up site selection later)
+        train_site_ids_list = numpy.sort(train_site_ids_list)
+        validation_site_ids_list = numpy.sort(validation_site_ids_list)
+
+    # Split recorded in plans
+    siteSplit = {'seed' : splitSeed,
+                 'trainSiteIDs' : [str(siteID) for siteID in train_site_ids_list],
+                 'validationSiteIDs' : [str(siteID) for siteID in validation_site_ids_list]}
 
     print('Number of training nodes: {0}, '
           'Number of validation nodes: {1}'.format(len(train_site_ids_list),
@@ -123,12 +188,145 @@ def run_scaling(outfolder, config_file, debugMode=False):
                                                                   outSensorNum=sensorNum,
                                                                   debugMode=debugMode)
 
+    # Nodes used for training and validation (to identify node data in
+    # the stage cache)
+    trainSensorSource = stage_cache.get_sensor_source(config['default'],
+                                                      site_ids=train_site_ids_list)
+    validSensorSource = stage_cache.get_sensor_source(config['default'],
+                                                      site_ids=validation_site_ids_list)
+
     # Geographic region to be included in the data layer stack:
     bounding_box = config['default']['bounding_box'].split()
 
+    # Register any extra providers of dynamic layers
+    layer_providers.register_providers_from_config(config['default'])
+
     # Resolution defines the pixel size:
     upscaling_res = config['default']['upscaling_res']
 
+    # Number of trees for Random Forests. If 'adaptive' trees are added
+    # until the out-of-bag RMSE converges (up to rf_max_estimators)
+    nEstimators = rf_upscaling.get_n_estimators(config['default'].get('rf_n_estimators',
+                                                                      rf_upscaling.DEFAULT_N_ESTIMATORS))
+    maxEstimators = int(config['default'].get('rf_max_estimators',
+                                              rf_upscaling.ADAPTIVE_MAX_ESTIMATORS))
+    oobTolerance = float(config['default'].get('rf_oob_tolerance',
+                                               rf_upscaling.ADAPTIVE_OOB_TOLERANCE))
+
+    # Check if the standard deviation (and optionally quantiles) of the
+    # predictions from each tree should be written alongside the prediction
+    predictUncertainty = config['default'].getboolean('predict_uncertainty', False)
+    predictQuantiles = rf_upscaling.get_quantiles(config['default'].get('predict_quantiles'))
+
+    # Check if the bounding box should be split into tiles
+    try:
+        tile_size = int(config['default']['tile_size'])
+        tile_workers = int(config['default'].get('tile_workers', 1))
+    except KeyError:
+        tile_size = None
+
+    # Check if transforms used to warp dynamic layers should be cached
+    warpCache = upscaling_common.create_from_config(config['default'], 'warp_cache_dir',
+                                                    warp_cache.WarpTransformCache)
+
+    # Check if accumulators for rolling climate layers (e.g., 'prism_ppt_api7')
+    # should be saved so they can be used by later runs (always kept for
+    # the current run)
+    rollingClimate = rolling_climate.RollingClimate(config['default'].get('rolling_climate_dir'))
+
+    # Check if AirMOSS / UAVSAR scenes should be ingested to the output grid
+    # (with overviews) so each scene is only averaged once
+    sarPyramids = upscaling_common.create_from_config(config['default'], 'sar_pyramid_dir',
+                                                      sar_pyramids.SARPyramids,
+                                                      bounding_box,
+                                                      base_res=upscaling_res)
+
+    # Check if PRISM / ECMWF archives have been ingested to cubes on the
+    # output grid (see climate_cube)
+    climateCubes = upscaling_common.create_from_config(config['default'], 'climate_cube_dir',
+                                                       climate_cube.ClimateCubes)
+
+    # Check if focal layers (see focal_layers) should be stored so they
+    # are only calculated once for each grid
+    focalLayers = upscaling_common.create_from_config(config['default'], 'focal_layer_dir',
+                                                      focal_layers.FocalLayers)
+
+    # Check if terrain layers (see terrain_layers) should be stored so they
+    # are only calculated once for each DEM and grid
+    terrainLayers = upscaling_common.create_from_config(config['default'], 'terrain_layer_dir',
+                                                        terrain_layers.TerrainLayers)
+
+    # Check if outputs of stages which don't depend on the model (sensor
+    # data, stacks and pixel values) should be shared with other runs
+    if stageCacheDir is None:
+        stageCacheDir = config['default'].get('stage_cache_dir')
+    if stageCacheDir is not None:
+        stageCache = stage_cache.StageCache(stageCacheDir)
+    else:
+        stageCache = None
+
+    # Check if the pixel for each sensor should be saved so it can be
+    # used by later runs (always kept for the current run)
+    stationIndex = station_index.StationIndex(config['default'].get('station_index_dir'))
+
+    # Check if extracted values should be added to a feature store
+    featureStore = upscaling_common.create_from_config(config['default'], 'feature_store_dir',
+                                                       feature_store.FeatureStore)
+
+    # Check if predictions should be added to a time-series cube
+    predictionCube = upscaling_common.create_from_config(config['default'], 'prediction_cube_dir',
+                                                         prediction_cube.PredictionCube)
+
+    # In preview mode the model is applied to a subsampled version of the
+    # full resolution stack (not tiled) and outputs are written alongside
+    # full resolution outputs.
+    if previewFactor is not None:
+        tile_size = None
+        predictionCube = None
+        outImageSuffix = '_predict_sm_preview'
+        outStatsSuffix = '_preview'
+    else:
+        outImageSuffix = '_predict_sm'
+        outStatsSuffix = ''
+    if runDates is not None:
+        outStatsSuffix += '_' + '_'.join(sorted(runDates))
+
+    # Check if a single model should be trained using the features from
+    # a window of dates (ending with the last date of the block) and
+    # applied to a block of 'pooled_step_dates' dates
+    try:
+        pooledWindowDates = int(config['default']['pooled_window_dates'])
+        pooledStepDates = int(config['default'].get('pooled_step_dates',
+                                                    pooledWindowDates))
+    except KeyError:
+        pooledWindowDates = None
+    if pooledWindowDates is not None:
+        if runDates is not None:
+            raise Exception('Running individual dates is not supported when '
+                            'training a model for a window of dates')
+        if tile_size is not None:
+            raise Exception('Training a model for a window of dates is not '
+                            'supported when using tiles')
+        # Features are read from the feature store so need one
+        if featureStore is None:
+            featureStore = feature_store.FeatureStore(os.path.join(out_dir,
+                                                                   'FeatureStore'))
+
+    # Check if dates should be prepared in the background while the
+    # model is run for the current date
+    prefetchDates = int(config['default'].get('prefetch_dates', 0))
+    prepareWorkers = int(config['default'].get('prepare_workers', 1))
+
+    # Share the CPU budget between tile workers, background workers,
+    # scikit-learn, GDAL and BLAS
+    cpuAllocation = cpu_budget.set_cpu_budget(config['default'],
+                                              tile_workers=1 if tile_size is None else tile_workers,
+                                              prepare_workers=prepareWorkers if prefetchDates > 0 else 0)
+    if tile_size is not None:
+        tile_workers = cpuAllocation['tile_workers']
+    if prefetchDates > 0:
+        prepareWorkers = cpuAllocation['prepare_workers']
+
     # Set start and end time
     starttimeEpoch = calendar.timegm(starttime)
     endtimeEpoch = calendar.timegm(endtime)
@@ -136,15 +334,6 @@ def run_scaling(outfolder, config_file, debugMode=False):
     timeInterval = 3600*float(timeIntervalHours)       # Average over 'timeInterval'
     predictSpacing = 3600*24*float(predictSpacingDays) # Produce predictions with a 'predictSpacing'
 
-    outStatsFile = os.path.join(outputStatsDIR, 'scaling_function_stats.csv')
-    outStatsHandler = open(outStatsFile,'w')
-    outStats = csv.writer(outStatsHandler)
-    
-    outVarImportanceFile = os.path.join(outputStatsDIR, 'scaling_function_var_importance.csv')
-    outVarImportanceHandler = open(outVarImportanceFile,'w')
-    outVarImportance = csv.writer(outVarImportanceHandler)
-    outVarImportancHeader = False
-
     # Get a list of data layers
     data_layers_list = []
     for section in config.sections():
@@ -165,81 +354,242 @@ def run_scaling(outfolder, config_file, debugMode=False):
         raise ValueError('Each band must have a unique name:\n'
                          '{}\n were provided'.format(', '.join(band_names)))
 
-
-    # Write header
-    outStats.writerow(['Date','nSamples','avgSM_train','stdSM_train','avgSM_predict',
-                       'stdSM_predict','RMSE','Bias','RSq','avgSM_valid','stdSM_valid','AirMOSSDate'])
-    
+    # Get list of dates to run
+    datesEpochList = []
     while starttimeEpoch < endtimeEpoch:
-        endIntervalTimeEpoch = starttimeEpoch + timeInterval
-    
-        startTS = time.gmtime(starttimeEpoch)
-        endTS = time.gmtime(endIntervalTimeEpoch)
-    
+        datesEpochList.append(starttimeEpoch)
+        # Add spacing to start time.
+        starttimeEpoch += predictSpacing
+
+    # Only run selected dates
+    if runDates is not None:
+        datesEpochList = [dateEpoch for dateEpoch in datesEpochList
+                          if time.strftime('%Y%m%d', time.gmtime(dateEpoch)) in runDates]
+
+    # Check if the series for each site should be read once and windows
+    # averaged for all dates using prefix sums, rather than reading the
+    # files for every date (off by default).
+    sensorWindowAggregation = config['default'].getboolean('sensor_window_aggregation', False)
+
+    def loadSensorSeries(extractor, seriesDatesEpochList):
+        """
+        Read the series for each site of an extractor covering a list
+        of dates (if sensor_window_aggregation is set).
+        """
+        if not sensorWindowAggregation or len(seriesDatesEpochList) == 0:
+            return
+        windowAggregator = extractor.loadSeries(min(seriesDatesEpochList),
+                                                max(seriesDatesEpochList) + timeInterval)
+        windowAggregator.precompute(seriesDatesEpochList, [timeInterval])
+
+    # Dates (with stacks) waiting for a pooled model to be trained
+    pooledBlock = []
+    if pooledWindowDates is not None:
+        layerSetHash = featureStore.register_layer_set(data_layers_list,
+                                                       bounding_box, upscaling_res,
+                                                       upscaling_common.UPSCALING_PROJ)
+
+    def prepareDate(dateEpoch):
+        """
+        Extract node data and create stack for a date.
+        """
+        startTS = time.gmtime(dateEpoch)
+        endTS = time.gmtime(dateEpoch + timeInterval)
+        outBaseName = time.strftime('%Y%m%d',startTS)
+
         # Create temp DIR
-        tempDIR = tempfile.mkdtemp()
+        prepared = {}
+        prepared['tempDIR'] = tempfile.mkdtemp()
+        prepared['startTS'] = startTS
+        prepared['data_layers_list'] = copy.deepcopy(data_layers_list)
+        prepared['data_stack'] = None
+        try:
+            # Extract CSV for training and validation nodes
+            prepared['nodeDataCSV'] = os.path.join(prepared['tempDIR'],
+                                                   "{}_node_data.csv".format(outBaseName))
+            # Use node data extracted when the plan was made if available
+            datePlan = plannedDates.get(dateEpoch, {})
+            if os.path.isfile(datePlan.get('sensorCSV', '')):
+                shutil.copy(datePlan['sensorCSV'], prepared['nodeDataCSV'])
+            elif stageCache is not None:
+                stageCache.extract_sensors(trainSensorSource, startTS,
+                                           prepared['nodeDataCSV'], extractNodeData)
+            else:
+                csv_extractor.createCSVFromTxSON(prepared['nodeDataCSV'],startTS,endTS)
+
+            prepared['validDataCSV'] = os.path.join(outputCSVDIR,
+                                                    "{}_valid_data.csv".format(outBaseName))
+            if stageCache is not None:
+                stageCache.extract_sensors(validSensorSource, startTS,
+                                           prepared['validDataCSV'], extractValidData)
+            else:
+                valid_extractor.createCSVFromTxSON(prepared['validDataCSV'],startTS,endTS)
+
+            # Create band stack (if not using tiles)
+            if tile_size is None:
+                prepared['data_stack'] = stack_bands.make_stack(prepared['data_layers_list'],
+                                                                prepared['tempDIR'],
+                                                                startTS, bounding_box=bounding_box,
+                                                                out_res=upscaling_res,
+                                                                warp_cache=warpCache,
+                                                                rolling_climate=rollingClimate,
+                                                                sar_pyramids=sarPyramids,
+                                                                climate_cubes=climateCubes,
+                                                                focal_layers=focalLayers,
+                                                                terrain_layers=terrainLayers,
+                                                                stage_cache=stageCache)
+        except Exception:
+            shutil.rmtree(prepared['tempDIR'])
+            raise
+
+        return prepared
+
+    def cleanupDate(prepared):
+        """
+        Remove temp files for a date
+        """
+        shutil.rmtree(prepared['tempDIR'])
+
+    def prepareError(dateEpoch, err):
+        """
+        Report error preparing a date
+        """
+        if debugMode:
+            raise err
+        else:
+            print("***** {} *****".format(time.strftime('%Y%m%d', time.gmtime(dateEpoch))))
+            print(err)
+
+    def writeDateStats(outBaseName, rfPar, validDataCSV, outSMimage, outSMColimage):
+        """
+        Write out stats for a date.
+        """
+        nonlocal outVarImportancHeader
+
+        # Don't need this for TxSON
+        airmossDateStr = "NA"
+
+        validdata = pandas.read_csv(validDataCSV)
+        validSMs = validdata.sensorData
+        if (len(validSMs) == 0):
+            raise Exception('No valid training data found')
+        avgSMvalid = numpy.nanmean(validSMs)
+        stdSMvalid = numpy.nanstd(validSMs)
+    
+        # Write out stats
+        outRow = [outBaseName,
+                  rfPar['nSamples'],
+                  rfPar['averageSMTrain'],
+                  rfPar['sdSMTrain'],
+                  rfPar['averageSMPredict'],
+                  rfPar['sdSMPredict'],
+                  rfPar['RMSE'],
+                  rfPar['Bias'],
+                  rfPar['RSq'],
+                  avgSMvalid,
+                  stdSMvalid,
+                  airmossDateStr,
+                  rfPar['nTrees']]
+        if previewFactor is not None:
+            outRow.extend(preview.get_preview_stats_row(outSMimage,
+                                                        os.path.join(outputImageDIR,
+                                                                     outBaseName + '_predict_sm.kea')))
+        outStats.writerow(outRow)
+
+        if predictionCube is not None:
+            predictionCube.append_image(outBaseName, outSMimage,
+                                        stats=prediction_cube.get_model_stats(rfPar))
+
+        # Write header for first record
+        if not outVarImportancHeader:
+            outVarImportance.writerow(rfPar['varNames'])
+            outVarImportancHeader = True
+
+        outVarImportance.writerow(rfPar['varImportance'])
+
+        if createColImage:
+            upscaling_utilities.colour_sm_image(outSMimage, outSMColimage,
+                                                max_value=MAX_SM_COL)
+
+    def processDate(dateEpoch, prepared):
+        """
+        Extract pixel values, train and apply Random Forests for a date.
+
+        If a model is being trained for a window of dates pixel values
+        are extracted and the date is added to the current block. The
+        model is trained and applied once the block is full.
+        """
+        startTS = prepared['startTS']
+        tempDIR = prepared['tempDIR']
+        nodeDataCSV = prepared['nodeDataCSV']
+        validDataCSV = prepared['validDataCSV']
+        date_layers_list = prepared['data_layers_list']
         dateStr = time.strftime('%Y%m%d',startTS)
         outBaseName = dateStr
-        
-        # Extract CSV from dB
-        nodeDataCSV = os.path.join(tempDIR, "{}_node_data.csv".format(outBaseName))
+        addedToBlock = False
 
-        nOutRecords = csv_extractor.createCSVFromTxSON(nodeDataCSV,startTS,endTS)
         try:
             print("***** {} *****".format(dateStr))
-            # Create band stack 
-            data_stack = stack_bands.make_stack(data_layers_list, tempDIR,
-                                                startTS, bounding_box=bounding_box, out_res=upscaling_res)
-
-            # Don't need this for TxSON
-            airmossDateStr = "NA"
 
-            # Extract pixel vals
             statscsv = os.path.join(outputCSVDIR, outBaseName + '_sensor_data.csv')
-            extract_image_stats.extract_layer_stats_csv(nodeDataCSV,
-                                                        statscsv,
-                                                        data_layers_list, data_stack)
-            # Run Random Forests
-            outSMimage = os.path.join(outputImageDIR, outBaseName + '_predict_sm.kea')
-            outSMColimage = os.path.join(outputImageDIR, outBaseName + '_predict_sm_col.tif')
-    
-            rfPar = rf_upscaling.run_random_forests(statscsv, data_stack, outSMimage, data_layers_list)
-
-            validDataCSV = os.path.join(outputCSVDIR, "{}_valid_data.csv".format(outBaseName))
-            nValidRecords = valid_extractor.createCSVFromTxSON(validDataCSV,startTS,endTS)
-
-            validdata = pandas.read_csv(validDataCSV)
-            validSMs = validdata.sensorData
-            if (len(validSMs) == 0):
-                raise Exception('No valid training data found')
-            avgSMvalid = numpy.nanmean(validSMs)
-            stdSMvalid = numpy.nanstd(validSMs)
-        
-            # Write out stats
-            outRow = [outBaseName,
-                      rfPar['nSamples'],
-                      rfPar['averageSMTrain'],
-                      rfPar['sdSMTrain'],
-                      rfPar['averageSMPredict'],
-                      rfPar['sdSMPredict'],
-                      rfPar['RMSE'],
-                      rfPar['Bias'],
-                      rfPar['RSq'],
-                      avgSMvalid,
-                      stdSMvalid,
-                      airmossDateStr]
-            outStats.writerow(outRow)
-    
-            # Write header for first record
-            if not outVarImportancHeader:
-                outVarImportance.writerow(rfPar['varNames'])
-                outVarImportancHeader = True
-    
-            outVarImportance.writerow(rfPar['varImportance'])
-    
-            if createColImage:
-                upscaling_utilities.colour_sm_image(outSMimage, outSMColimage,
-                                                    max_value=MAX_SM_COL)
+            outSMimage = os.path.join(outputImageDIR, outBaseName + outImageSuffix + '.kea')
+            outSMColimage = os.path.join(outputImageDIR, outBaseName + outImageSuffix + '_col.tif')
+
+            if tile_size is not None:
+                # Create stacks, extract pixel vals and run Random Forests
+                # for each tile
+                rfPar = tiling.run_tiled_upscaling(nodeDataCSV, statscsv,
+                                                   outSMimage, date_layers_list,
+                                                   tempDIR, startTS,
+                                                   bounding_box=bounding_box,
+                                                   out_res=upscaling_res,
+                                                   tile_size=tile_size,
+                                                   num_workers=tile_workers,
+                                                   feature_store=featureStore,
+                                                   depth=sensorNum,
+                                                   warp_cache=warpCache,
+                                                   rolling_climate=rollingClimate,
+                                                   sar_pyramids=sarPyramids,
+                                                   climate_cubes=climateCubes,
+                                                   focal_layers=focalLayers,
+                                                   terrain_layers=terrainLayers,
+                                                   station_index=stationIndex,
+                                                   n_estimators=nEstimators,
+                                                   max_estimators=maxEstimators,
+                                                   oob_tolerance=oobTolerance,
+                                                   uncertainty=predictUncertainty,
+                                                   quantiles=predictQuantiles)
+            else:
+                data_stack = prepared['data_stack']
+
+                # Extract pixel vals
+                extract_image_stats.extract_layer_stats_csv(nodeDataCSV,
+                                                            statscsv,
+                                                            date_layers_list, data_stack,
+                                                            feature_store=featureStore,
+                                                            sm_date_ts=startTS,
+                                                            depth=sensorNum,
+                                                            station_index=stationIndex,
+                                                            stage_cache=stageCache,
+                                                            bounding_box=bounding_box,
+                                                            out_res=upscaling_res)
+
+                if pooledWindowDates is not None:
+                    # Keep stack until model for block has been trained
+                    pooledBlock.append(prepared)
+                    addedToBlock = True
+                else:
+                    # Run Random Forests
+                    rfPar = rf_upscaling.run_random_forests(statscsv, data_stack, outSMimage, date_layers_list,
+                                                            n_estimators=nEstimators,
+                                                            max_estimators=maxEstimators,
+                                                            oob_tolerance=oobTolerance,
+                                                            uncertainty=predictUncertainty,
+                                                            quantiles=predictQuantiles,
+                                                            preview_factor=previewFactor)
+
+            if not addedToBlock:
+                writeDateStats(outBaseName, rfPar, validDataCSV, outSMimage, outSMColimage)
 
         except Exception as err:
             if debugMode:
@@ -248,11 +598,152 @@ def run_scaling(outfolder, config_file, debugMode=False):
             else:
                 print(err)
 
-        # Remove temp files
-        shutil.rmtree(tempDIR)
+        if addedToBlock:
+            if len(pooledBlock) == pooledStepDates:
+                processPooledBlock()
+        else:
+            # Remove temp files
+            shutil.rmtree(tempDIR)
+
+    def processPooledBlock():
+        """
+        Train a single model using features for a window of dates and
+        apply to the stack for each date in the current block.
+        """
+        blockDatesList = [time.strftime('%Y%m%d', prepared['startTS'])
+                          for prepared in pooledBlock]
+        windowDatesList = pooled_training.get_window_dates(allDatesList,
+                                                           blockDatesList,
+                                                           pooledWindowDates)
+        print("***** Training model for {} to {} *****".format(windowDatesList[0],
+                                                               windowDatesList[-1]))
+        try:
+            rf, rfTrainPar = pooled_training.train_pooled_model(featureStore,
+                                                                layerSetHash,
+                                                                windowDatesList,
+                                                                data_layers_list,
+                                                                station_ids=train_site_ids_list,
+                                                                depth=sensorNum,
+                                                                n_estimators=nEstimators,
+                                                                max_estimators=maxEstimators,
+                                                                oob_tolerance=oobTolerance)
+        except Exception as err:
+            for blockPrepared in pooledBlock:
+                shutil.rmtree(blockPrepared['tempDIR'])
+            del pooledBlock[:]
+            if debugMode:
+                raise
+            else:
+                print(err)
+                return
+
+        no_data_vals = [layer.layer_nodata for layer in data_layers_list]
+
+        for prepared in pooledBlock:
+            outBaseName = time.strftime('%Y%m%d', prepared['startTS'])
+            outSMimage = os.path.join(outputImageDIR, outBaseName + outImageSuffix + '.kea')
+            outSMColimage = os.path.join(outputImageDIR, outBaseName + outImageSuffix + '_col.tif')
+            try:
+                rfPar = dict(rfTrainPar)
+                rfPar['averageSMPredict'], rfPar['sdSMPredict'] = \
+                    rf_upscaling.apply_rf_image(prepared['data_stack'], outSMimage,
+                                                rf, no_data_vals,
+                                                uncertainty=predictUncertainty,
+                                                quantiles=predictQuantiles,
+                                                preview_factor=previewFactor)
+                writeDateStats(outBaseName, rfPar, prepared['validDataCSV'],
+                               outSMimage, outSMColimage)
+            except Exception as err:
+                if debugMode:
+                    for blockPrepared in pooledBlock:
+                        shutil.rmtree(blockPrepared['tempDIR'])
+                    del pooledBlock[:]
+                    raise
+                else:
+                    print(err)
+            shutil.rmtree(prepared['tempDIR'])
+
+        del pooledBlock[:]
+
+    def extractNodeData(startTS, outDataCSV):
+        """
+        Extract training node data for a date to a CSV, returns the
+        number of nodes.
+        """
+        endTS = time.gmtime(calendar.timegm(startTS) + timeInterval)
+        return csv_extractor.createCSVFromTxSON(outDataCSV, startTS, endTS)
+
+    def extractValidData(startTS, outDataCSV):
+        """
+        Extract validation node data for a date to a CSV, returns the
+        number of nodes.
+        """
+        endTS = time.gmtime(calendar.timegm(startTS) + timeInterval)
+        return valid_extractor.createCSVFromTxSON(outDataCSV, startTS, endTS)
+
+    # Check static layers, find dynamic layers and (if writing a plan)
+    # extract node data for each date before any processing, so only
+    # dates which can be run are scheduled.
+    datesTSList = [time.gmtime(dateEpoch) for dateEpoch in datesEpochList]
+    planTrees = maxEstimators if nEstimators == 'adaptive' else nEstimators
+    if planFile is not None:
+        loadSensorSeries(csv_extractor, datesEpochList)
+        plan = run_planner.make_plan(datesTSList, data_layers_list,
+                                     bounding_box=bounding_box,
+                                     out_res=upscaling_res,
+                                     extract_sensors_func=extractNodeData,
+                                     sensor_dir=os.path.splitext(planFile)[0] + '_sensors',
+                                     num_trees=planTrees,
+                                     site_split=siteSplit)
+        run_planner.write_plan(plan, planFile)
+        run_planner.print_plan_summary(plan)
+        print('Written plan to {}'.format(planFile))
+        return
+    elif runPlanFile is None:
+        # (a plan being run was read before sites were split)
+        plan = run_planner.make_plan(datesTSList, data_layers_list,
+                                     bounding_box=bounding_box,
+                                     out_res=upscaling_res,
+                                     num_trees=planTrees)
+    run_planner.print_plan_summary(plan)
+    plannedDates = run_planner.get_run_dates(plan)
+    datesEpochList = [dateEpoch for dateEpoch in datesEpochList
+                      if dateEpoch in plannedDates]
+
+    # Only read series for training nodes for dates where node data
+    # weren't extracted when the plan was made
+    loadSensorSeries(csv_extractor,
+                     [dateEpoch for dateEpoch in datesEpochList
+                      if not os.path.isfile(plannedDates[dateEpoch].get('sensorCSV', ''))])
+    loadSensorSeries(valid_extractor, datesEpochList)
+    allDatesList = [time.strftime('%Y%m%d', time.gmtime(dateEpoch))
+                    for dateEpoch in datesEpochList]
+
+    outStatsFile = os.path.join(outputStatsDIR, 'scaling_function_stats{}.csv'.format(outStatsSuffix))
+    outStatsHandler = open(outStatsFile,'w')
+    outStats = csv.writer(outStatsHandler)
+    
+    outVarImportanceFile = os.path.join(outputStatsDIR, 'scaling_function_var_importance{}.csv'.format(outStatsSuffix))
+    outVarImportanceHandler = open(outVarImportanceFile,'w')
+    outVarImportance = csv.writer(outVarImportanceHandler)
+    outVarImportancHeader = False
 
-        # Add spacing to start time.
-        starttimeEpoch += predictSpacing
+    # Write header
+    outStatsHeader = ['Date','nSamples','avgSM_train','stdSM_train','avgSM_predict',
+                      'stdSM_predict','RMSE','Bias','RSq','avgSM_valid','stdSM_valid','AirMOSSDate','nTrees']
+    if previewFactor is not None:
+        outStatsHeader.extend(preview.PREVIEW_STATS_HEADER)
+    outStats.writerow(outStatsHeader)
+
+    date_pipeline.run_pipelined(datesEpochList, prepareDate, processDate,
+                                max_prefetch=prefetchDates,
+                                num_workers=prepareWorkers,
+                                error_func=prepareError,
+                                cleanup_func=cleanupDate)
+
+    # Train and apply model for any remaining dates
+    if pooledWindowDates is not None and len(pooledBlock) > 0:
+        processPooledBlock()
 
     # Close files
     outStatsHandler.close()
@@ -274,8 +765,25 @@ if __name__ == '__main__':
     parser.add_argument("--debug", action='store_true',
                         help="Run in debug mode (more error messages; default=False).",
                         default=False, required=False)
+    parser.add_argument("--plan", type=str, default=None, required=False,
+                        help="Write plan for run to this file and exit.")
+    parser.add_argument("--run_plan", type=str, default=None, required=False,
+                        help="Run the dates in this plan (created using --plan).")
+    parser.add_argument("--preview", type=float, default=None, required=False,
+                        help="Run a quick-look preview, predicting at the output resolution "
+                             "multiplied by this factor (e.g., 10).")
+    parser.add_argument("--split_seed", type=int, default=None, required=False,
+                        help="Seed for random split into training and validation sites.")
+    parser.add_argument("--dates", type=str, nargs='+', default=None, required=False,
+                        help="Only run these dates (YYYYMMDD).")
+    parser.add_argument("--stage_cache", type=str, default=None, required=False,
+                        help="Share node data, stacks and pixel values with other "
+                             "runs using this directory.")
 
     args = parser.parse_args() 
 
-    run_scaling(args.outfolder, args.configfile, debugMode=args.debug)
+    run_scaling(args.outfolder, args.configfile, debugMode=args.debug,
+                planFile=args.plan, runPlanFile=args.run_plan,
+                previewFactor=args.preview, splitSeed=args.split_seed,
+                runDates=args.dates, stageCacheDir=args.stage_cache)
 
@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Time cubes of gridded climate data (PRISM and ECMWF) on the output grid
+of a config.
+
+PRISM and ECMWF dynamic layers are normally found by searching the layer
+directory for the file for each date, which is then warped to the output
+grid. The grid is the same for every date, so a whole archive can be
+ingested in advance into a single (time, y, x) store with an index of
+dates. A date is then read as a slice of the store, with no search or
+warp, and several dates (e.g., the window for a rolling layer) can be
+read at once.
+
+Each cube uses the following directory structure::
+
+   cubes_dir/<key>/cube.json
+   cubes_dir/<key>/chunks/<time_chunk>.npy
+
+where the key is made from the layer type, directory, resampling method
+and grid. 'cube.json' contains the grid, the size of the time chunks and
+the index of dates (YYYYMMDD for PRISM and YYYYMMDDHH for ECMWF). Each
+chunk is an uncompressed NumPy array of (time chunk, y, x), which is
+memory mapped to read a date. As for prediction_cube the index is
+written after the chunks, so partly ingested dates aren't used. Dates
+which aren't in a cube are read from the archive as normal.
+
+To ingest all PRISM and ECMWF layers (including the daily layers for
+rolling layers) for a config::
+
+   python -m soilscape_upscaling.climate_cube tonzi_airmoss.cfg
+
+Running again adds any new files in the archive.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import argparse
+import configparser
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import numpy
+from osgeo import gdal
+
+from . import dynamic_layers
+from . import layer_providers
+from . import rolling_climate
+from . import upscaling_common
+from . import warp_cache as warp_cache_module
+
+#: Version of cube format
+CUBE_VERSION = 1
+
+#: Number of dates in each chunk
+DEFAULT_TIME_CHUNK = 64
+
+#: Layer types which can be ingested
+CUBE_LAYER_TYPES = ['prism', 'ecmwf']
+
+def is_cube_layer(layer_type):
+    """
+    Check if a layer type can be ingested to a cube.
+    """
+    return any([layer_type.startswith(cube_type) for cube_type in CUBE_LAYER_TYPES])
+
+def get_date_key(layer_type, sm_date_ts):
+    """
+    Get key used to index a date in a cube, from the provider for the
+    layer type (YYYYMMDD for PRISM, YYYYMMDDHH for ECMWF).
+    """
+    return time.strftime(layer_providers.get_provider_class(layer_type).date_format,
+                         sm_date_ts)
+
+def get_archive_files(layer_type, layer_dir):
+    """
+    Get all files in the archive for a layer, from the provider for the
+    layer type.
+
+    Returns dictionary of files with the date key for each.
+    """
+    if not is_cube_layer(layer_type):
+        raise ValueError('Layer type "{}" can not be ingested to a '
+                         'cube'.format(layer_type))
+    return layer_providers.get_provider(layer_type, layer_dir).list_files(refresh=True)
+
+def _get_bounding_box(bounding_box):
+    return [str(v).strip(',') for v in bounding_box]
+
+class ClimateCube(object):
+    """
+    Chunked (time, y, x) store of a climate layer on a grid.
+
+    Requires:
+
+    * cube_dir - directory for cube (created if it doesn't exist)
+    * time_chunk - number of dates in each chunk (new cubes only)
+
+    """
+    def __init__(self, cube_dir, time_chunk=DEFAULT_TIME_CHUNK):
+        self.cube_dir = os.path.abspath(cube_dir)
+        self.chunks_dir = os.path.join(self.cube_dir, 'chunks')
+        self.metadata_file = os.path.join(self.cube_dir, 'cube.json')
+        self._metadata_mtime = None
+        self._date_index = {}
+        self.metadata = {'version' : CUBE_VERSION,
+                         'timeChunk' : int(time_chunk),
+                         'geotransform' : None,
+                         'projection' : None,
+                         'ySize' : None,
+                         'xSize' : None,
+                         'dates' : []}
+        self.reload()
+
+    def reload(self):
+        """
+        Read index if it has been updated (e.g., by another process
+        ingesting new dates).
+        """
+        if not os.path.isfile(self.metadata_file):
+            return
+        metadata_mtime = os.path.getmtime(self.metadata_file)
+        if metadata_mtime == self._metadata_mtime:
+            return
+        with open(self.metadata_file, 'r') as in_f:
+            metadata = json.load(in_f)
+        if metadata.get('version') != CUBE_VERSION:
+            raise Exception('The cube {} was created with a different '
+                            'version'.format(self.cube_dir))
+        self.metadata = metadata
+        self._metadata_mtime = metadata_mtime
+        self._date_index = dict([(date_key, i) for i, date_key
+                                 in enumerate(self.metadata['dates'])])
+
+    def has_dates(self, date_keys):
+        """
+        Check if all dates are in the cube.
+        """
+        if not all([d in self._date_index for d in date_keys]):
+            self.reload()
+        return all([d in self._date_index for d in date_keys])
+
+    def _get_chunk_file(self, time_chunk):
+        return os.path.join(self.chunks_dir, '{}.npy'.format(time_chunk))
+
+    def _write_metadata(self):
+        temp_metadata_file = '{}.{}.tmp'.format(self.metadata_file, os.getpid())
+        with open(temp_metadata_file, 'w') as out_f:
+            json.dump(self.metadata, out_f, indent=1)
+        os.replace(temp_metadata_file, self.metadata_file)
+        self._metadata_mtime = os.path.getmtime(self.metadata_file)
+
+    def add_dates(self, date_keys, data, geotransform, projection):
+        """
+        Add dates to the cube. Dates already in the cube are replaced.
+
+        Requires:
+
+        * date_keys - list of dates
+        * data - array of (dates, y, x)
+        * geotransform - GDAL geotransform of data
+        * projection - projection of data (WKT)
+
+        """
+        data = numpy.asarray(data, dtype=numpy.float32)
+        if data.ndim != 3 or data.shape[0] != len(date_keys):
+            raise ValueError('Expected array of (dates, y, x)')
+
+        if self.metadata['geotransform'] is None:
+            self.metadata['geotransform'] = [float(v) for v in geotransform]
+            self.metadata['projection'] = projection
+            self.metadata['ySize'] = int(data.shape[1])
+            self.metadata['xSize'] = int(data.shape[2])
+        elif data.shape[1] != self.metadata['ySize'] \
+                or data.shape[2] != self.metadata['xSize']:
+            raise ValueError('Grid does not match the grid of the cube {}'
+                             ''.format(self.cube_dir))
+
+        if not os.path.isdir(self.chunks_dir):
+            os.makedirs(self.chunks_dir)
+
+        t_size = self.metadata['timeChunk']
+        dates = self.metadata['dates']
+        time_indices = []
+        for date_key in date_keys:
+            if date_key in self._date_index:
+                time_indices.append(self._date_index[date_key])
+            else:
+                time_indices.append(len(dates))
+                self._date_index[date_key] = len(dates)
+                dates.append(date_key)
+        time_indices = numpy.array(time_indices)
+
+        for time_chunk in numpy.unique(time_indices // t_size):
+            chunk_file = self._get_chunk_file(time_chunk)
+            if os.path.isfile(chunk_file):
+                chunk_data = numpy.load(chunk_file, mmap_mode='r+')
+            else:
+                chunk_data = numpy.lib.format.open_memmap(chunk_file, mode='w+',
+                                                          dtype=numpy.float32,
+                                                          shape=(t_size,
+                                                                 self.metadata['ySize'],
+                                                                 self.metadata['xSize']))
+            in_chunk = numpy.flatnonzero(time_indices // t_size == time_chunk)
+            chunk_data[time_indices[in_chunk] % t_size] = data[in_chunk]
+            chunk_data.flush()
+            chunk_data = None
+
+        self._write_metadata()
+
+    def read_dates(self, date_keys):
+        """
+        Read dates from the cube.
+
+        Returns array of (dates, y, x).
+        """
+        if not self.has_dates(date_keys):
+            missing = [d for d in date_keys if d not in self._date_index]
+            raise KeyError('Dates {} are not in the cube {}'.format(', '.join(missing),
+                                                                    self.cube_dir))
+        t_size = self.metadata['timeChunk']
+        time_indices = numpy.array([self._date_index[d] for d in date_keys], dtype=int)
+        out_data = numpy.zeros((len(date_keys), self.metadata['ySize'],
+                                self.metadata['xSize']), dtype=numpy.float32)
+        for time_chunk in numpy.unique(time_indices // t_size):
+            chunk_data = numpy.load(self._get_chunk_file(time_chunk), mmap_mode='r')
+            in_chunk = numpy.flatnonzero(time_indices // t_size == time_chunk)
+            out_data[in_chunk] = chunk_data[time_indices[in_chunk] % t_size]
+            chunk_data = None
+        return out_data
+
+class ClimateCubes(object):
+    """
+    Cubes for climate layers, one for each layer and grid.
+
+    Safe to use from multiple threads.
+
+    Requires:
+
+    * cubes_dir - directory for cubes (created if it doesn't exist)
+
+    """
+    def __init__(self, cubes_dir):
+        self.cubes_dir = os.path.abspath(cubes_dir)
+        if not os.path.isdir(self.cubes_dir):
+            os.makedirs(self.cubes_dir, exist_ok=True)
+        self._cubes = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'cubes_dir' : self.cubes_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['cubes_dir'])
+
+    def get_cube_key(self, layer_type, layer_dir, bounding_box, resample_method,
+                     out_res=upscaling_common.UPSCALING_RES,
+                     out_proj=upscaling_common.UPSCALING_PROJ):
+        """
+        Get key for the cube of a layer on a grid.
+        """
+        key_json = json.dumps([layer_type, os.path.abspath(layer_dir), resample_method,
+                               _get_bounding_box(bounding_box), float(out_res),
+                               out_proj])
+        return hashlib.md5(key_json.encode()).hexdigest()[:16]
+
+    def get_cube(self, layer_type, layer_dir, bounding_box, resample_method,
+                 out_res=upscaling_common.UPSCALING_RES,
+                 out_proj=upscaling_common.UPSCALING_PROJ, create=False):
+        """
+        Get the cube for a layer on a grid.
+
+        Returns ClimateCube or None if the layer hasn't been ingested
+        (and 'create' is False).
+        """
+        cube_key = self.get_cube_key(layer_type, layer_dir, bounding_box,
+                                     resample_method, out_res, out_proj)
+        with self._lock:
+            if cube_key not in self._cubes:
+                cube_dir = os.path.join(self.cubes_dir, cube_key)
+                if not create and not os.path.isdir(cube_dir):
+                    return None
+                self._cubes[cube_key] = ClimateCube(cube_dir)
+            return self._cubes[cube_key]
+
+    def read_days(self, layer_type, layer_dir, days_ts, bounding_box=None,
+                  resample_method=None, out_res=upscaling_common.UPSCALING_RES,
+                  out_proj=upscaling_common.UPSCALING_PROJ):
+        """
+        Read a layer for several dates at once.
+
+        Returns array of (dates, y, x), geotransform and projection or
+        None if any of the dates aren't in a cube.
+        """
+        if bounding_box is None or not is_cube_layer(layer_type):
+            return None
+        resample_method = dynamic_layers.get_resample_method(layer_type, resample_method)
+        cube = self.get_cube(layer_type, layer_dir, bounding_box, resample_method,
+                             out_res, out_proj)
+        if cube is None:
+            return None
+        date_keys = [get_date_key(layer_type, day_ts) for day_ts in days_ts]
+        if not cube.has_dates(date_keys):
+            return None
+        return (cube.read_dates(date_keys), cube.metadata['geotransform'],
+                cube.metadata['projection'])
+
+    def get_layer(self, layer_type, layer_dir, sm_date_ts, temp_dir,
+                  bounding_box=None, resample_method=None,
+                  out_res=upscaling_common.UPSCALING_RES,
+                  out_proj=upscaling_common.UPSCALING_PROJ):
+        """
+        Get a layer for a date from a cube. Takes the same parameters as
+        dynamic_layers.get_reprojected_dynamic_layer.
+
+        Returns:
+
+        * Path to layer and date of layer (string) or None if the date
+          isn't in a cube
+
+        """
+        cube_data = self.read_days(layer_type, layer_dir, [sm_date_ts], bounding_box,
+                                   resample_method, out_res, out_proj)
+        if cube_data is None:
+            return None
+        out_array, geotransform, projection = cube_data
+
+        out_layer = os.path.join(temp_dir, '{}_subset.{}'.format(layer_type,
+                                                                 dynamic_layers.GDAL_EXT))
+        driver = gdal.GetDriverByName(dynamic_layers.GDAL_FORMAT)
+        out_dataset = driver.Create(out_layer, out_array.shape[2], out_array.shape[1],
+                                    1, gdal.GDT_Float32)
+        out_dataset.SetGeoTransform(geotransform)
+        out_dataset.SetProjection(projection)
+        out_band = out_dataset.GetRasterBand(1)
+        out_band.SetNoDataValue(0)
+        out_band.WriteArray(out_array[0])
+        out_dataset = None
+
+        return out_layer, time.strftime('%Y%m%d', sm_date_ts)
+
+    def ingest(self, layer_type, layer_dir, bounding_box, resample_method=None,
+               out_res=upscaling_common.UPSCALING_RES,
+               out_proj=upscaling_common.UPSCALING_PROJ, start_date=None,
+               end_date=None, warp_cache=None, batch_size=DEFAULT_TIME_CHUNK):
+        """
+        Ingest the archive for a layer into a cube. Dates already in the
+        cube are skipped.
+
+        Requires:
+
+        * layer_type - type of layer (e.g., 'prism_ppt')
+        * layer_dir - directory which contains layer
+        * bounding_box - bounding box of grid
+        * resample_method - method to use for resampling (default is the
+          same as dynamic_layers)
+        * out_res - resolution of grid
+        * out_proj - projection of grid
+        * start_date / end_date - first and last date (YYYYMMDD) to ingest
+        * warp_cache - WarpTransformCache to use (one is created if not
+          provided)
+        * batch_size - number of dates to warp before writing to the cube
+
+        Returns number of dates added.
+        """
+        resample_method = dynamic_layers.get_resample_method(layer_type, resample_method)
+        cube = self.get_cube(layer_type, layer_dir, bounding_box, resample_method,
+                             out_res, out_proj, create=True)
+        if warp_cache is None:
+            warp_cache = warp_cache_module.WarpTransformCache()
+        bounding_box = _get_bounding_box(bounding_box)
+        dst_grid = warp_cache_module.get_target_grid(bounding_box, out_res, out_proj)
+
+        archive_files = get_archive_files(layer_type, layer_dir)
+        new_dates = []
+        for date_key in sorted(archive_files.keys()):
+            if start_date is not None and date_key[:8] < start_date:
+                continue
+            if end_date is not None and date_key[:8] > end_date:
+                continue
+            if not cube.has_dates([date_key]):
+                new_dates.append(date_key)
+
+        print('Ingesting {} dates for {} from {}'.format(len(new_dates), layer_type,
+                                                         layer_dir))
+        temp_dir = tempfile.mkdtemp(prefix='climate_cube_')
+        try:
+            for batch_start in range(0, len(new_dates), batch_size):
+                batch_dates = new_dates[batch_start:batch_start + batch_size]
+                batch_data = numpy.zeros((len(batch_dates), dst_grid['y_size'],
+                                          dst_grid['x_size']), dtype=numpy.float32)
+                for i, date_key in enumerate(batch_dates):
+                    in_file = archive_files[date_key]
+                    if resample_method in warp_cache_module.SUPPORTED_METHODS:
+                        src_grid = warp_cache_module.get_raster_grid(in_file)
+                        transform = warp_cache.get_transform(src_grid, dst_grid,
+                                                             resample_method)
+                        src_dataset = gdal.Open(in_file, gdal.GA_ReadOnly)
+                        src_band = src_dataset.GetRasterBand(1)
+                        src_array = src_band.ReadAsArray(*transform.src_window)
+                        batch_data[i] = transform.apply(src_array,
+                                                        src_nodata=src_band.GetNoDataValue(),
+                                                        dst_nodata=0)
+                        src_dataset = None
+                    else:
+                        temp_layer = os.path.join(temp_dir, 'warped.tif')
+                        gdal_warp_cmd = ['gdalwarp', '-overwrite', '-q',
+                                         '-r', resample_method, '-of', 'GTiff', '-te']
+                        gdal_warp_cmd.extend(bounding_box)
+                        gdal_warp_cmd.extend(['-tr', str(out_res), str(out_res),
+                                              '-dstnodata', '0', '-t_srs', out_proj,
+                                              in_file, temp_layer])
+                        subprocess.check_call(gdal_warp_cmd)
+                        batch_data[i] = gdal.Open(temp_layer).GetRasterBand(1).ReadAsArray()
+                with self._lock:
+                    cube.add_dates(batch_dates, batch_data, dst_grid['geotransform'],
+                                   dst_grid['projection'])
+                print(' Added {} to {}'.format(batch_dates[0], batch_dates[-1]))
+        finally:
+            shutil.rmtree(temp_dir)
+
+        return len(new_dates)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest PRISM and ECMWF archives for '
+                                                 'the layers in a config into cubes')
+    parser.add_argument("configfile", help="Config file")
+    parser.add_argument("--cube_dir", default=None,
+                        help="Directory for cubes (default is 'climate_cube_dir' "
+                             "from config)")
+    parser.add_argument("--start_date", default=None, help="First date (YYYYMMDD)")
+    parser.add_argument("--end_date", default=None, help="Last date (YYYYMMDD)")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.configfile)
+
+    cube_dir = args.cube_dir
+    if cube_dir is None:
+        try:
+            cube_dir = config['default']['climate_cube_dir']
+        except KeyError:
+            raise KeyError('No "climate_cube_dir" in config, pass --cube_dir')
+
+    climate_cubes = ClimateCubes(cube_dir)
+    config_bounding_box = config['default']['bounding_box'].replace(',', ' ').split()
+    config_res = config['default'].get('upscaling_res', upscaling_common.UPSCALING_RES)
+
+    ingest_warp_cache = warp_cache_module.WarpTransformCache()
+    ingested_layers = []
+    for section in config.sections():
+        if not section.startswith('layer'):
+            continue
+        data_layer = upscaling_common.DataLayer(config[section])
+        if data_layer.layer_type != 'dynamic':
+            continue
+        layer_name = data_layer.layer_name
+        # Rolling layers are made from the daily layer
+        rolling_layer = rolling_climate.parse_rolling_layer(layer_name)
+        if rolling_layer is not None:
+            layer_name = rolling_layer[0]
+        if not is_cube_layer(layer_name):
+            continue
+        layer_key = (layer_name, data_layer.layer_dir, data_layer.resample_method)
+        if layer_key in ingested_layers:
+            continue
+        climate_cubes.ingest(layer_name, data_layer.layer_dir, config_bounding_box,
+                             data_layer.resample_method, out_res=config_res,
+                             start_date=args.start_date, end_date=args.end_date,
+                             warp_cache=ingest_warp_cache)
+        ingested_layers.append(layer_key)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Functions to share a budget of CPU cores between the levels of
+parallelism used when upscaling, so running dates and tiles in parallel
+doesn't oversubscribe the machine. The budget is divided between:
+
+* The pool of tile workers (processes).
+* The workers preparing dates in the background (threads which call
+  gdalwarp etc.).
+* The number of jobs used by scikit-learn for each model.
+* The number of threads used by GDAL (GDAL_NUM_THREADS) and the GDAL
+  block cache (GDAL_CACHEMAX) for each process.
+* The number of threads used by BLAS / OpenMP libraries.
+
+The budget is set by 'cpu_budget' in the config file or the
+UPSCALING_CPU_BUDGET environmental variable (see upscaling_common).
+If neither is set the number of workers requested are used, scikit-learn
+uses DEFAULT_RF_N_JOBS and the GDAL and BLAS threads aren't changed.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import os
+
+# Optional - used to limit BLAS threads for libraries which are
+# already loaded
+try:
+    import threadpoolctl
+    HAVE_THREADPOOLCTL = True
+except ImportError:
+    HAVE_THREADPOOLCTL = False
+
+from . import upscaling_common
+
+#: Number of jobs used for scikit-learn if no budget has been set
+DEFAULT_RF_N_JOBS = 4
+
+#: Environmental variables used to set the number of BLAS / OpenMP threads
+BLAS_THREADS_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                         'MKL_NUM_THREADS']
+
+# Allocation currently in use (set by apply_cpu_allocation)
+_current_allocation = None
+
+def get_cpu_budget(config_dict=None):
+    """
+    Get the number of CPU cores available to use.
+
+    Uses 'cpu_budget' from the config (if provided), then
+    UPSCALING_CPU_BUDGET. Returns None if a budget hasn't been set.
+    """
+    cpu_budget = None
+    if config_dict is not None:
+        cpu_budget = upscaling_common.create_from_config(config_dict, 'cpu_budget', int)
+    if cpu_budget is None:
+        cpu_budget = int(upscaling_common.UPSCALING_CPU_BUDGET)
+    if cpu_budget < 1:
+        return None
+    return cpu_budget
+
+def get_gdal_cachemax(config_dict=None):
+    """
+    Get total size of GDAL cache to use, in MB.
+
+    Uses 'gdal_cachemax' from the config (if provided), then
+    UPSCALING_GDAL_CACHEMAX. Returns None if not set.
+    """
+    gdal_cachemax = None
+    if config_dict is not None:
+        gdal_cachemax = upscaling_common.create_from_config(config_dict, 'gdal_cachemax', int)
+    if gdal_cachemax is None:
+        gdal_cachemax = int(upscaling_common.UPSCALING_GDAL_CACHEMAX)
+    if gdal_cachemax < 1:
+        return None
+    return gdal_cachemax
+
+def allocate_cpus(cpu_budget, tile_workers=1, prepare_workers=0,
+                  gdal_cachemax=None):
+    """
+    Divide a budget of CPU cores between the levels of parallelism.
+
+    When dates are prepared in the background each preparation worker
+    gets one core and the remaining cores are used to train and apply
+    the model. These cores are split between the tile workers, with
+    each worker using its share for scikit-learn. BLAS is limited to
+    one thread as it is called within these workers.
+
+    Requires:
+
+    * cpu_budget - total number of cores to use
+    * tile_workers - number of tiles to process in parallel requested
+    * prepare_workers - number of dates to prepare in the background
+      requested (0 if dates aren't prepared in the background)
+    * gdal_cachemax - total GDAL cache (MB) to share between processes
+      running at the same time (optional)
+
+    Returns a dictionary with the number of workers and threads to use
+    for each level.
+
+    """
+    cpu_budget = max(int(cpu_budget), 1)
+
+    tile_workers = max(min(int(tile_workers), cpu_budget), 1)
+
+    if prepare_workers > 0:
+        # Leave at least one core for training and applying the model
+        prepare_workers = max(min(int(prepare_workers), cpu_budget // 2), 1)
+        compute_cpus = max(cpu_budget - prepare_workers, 1)
+    else:
+        prepare_workers = 0
+        compute_cpus = cpu_budget
+
+    rf_n_jobs = max(compute_cpus // tile_workers, 1)
+
+    # GDAL is run by each preparation worker (if used) and each tile
+    # worker. Preparation workers have one core each, otherwise the
+    # budget is split between the tile workers.
+    num_gdal_processes = max(prepare_workers, 1) * tile_workers
+    if prepare_workers > 0:
+        gdal_threads = 1
+    else:
+        gdal_threads = max(cpu_budget // tile_workers, 1)
+
+    if gdal_cachemax is not None:
+        gdal_cachemax = max(int(gdal_cachemax) // num_gdal_processes, 1)
+
+    return {'cpu_budget' : cpu_budget,
+            'tile_workers' : tile_workers,
+            'prepare_workers' : prepare_workers,
+            'rf_n_jobs' : rf_n_jobs,
+            'gdal_threads' : gdal_threads,
+            'gdal_cachemax' : gdal_cachemax,
+            'blas_threads' : 1}
+
+def get_default_allocation(tile_workers=1, prepare_workers=0, gdal_cachemax=None):
+    """
+    Get an allocation which keeps the defaults, for when a budget hasn't
+    been set. The number of workers requested are used, scikit-learn uses
+    DEFAULT_RF_N_JOBS and the GDAL and BLAS threads aren't changed (None).
+    The GDAL cache, if provided, is split between the processes running
+    at the same time as for allocate_cpus.
+    """
+    tile_workers = max(int(tile_workers), 1)
+    prepare_workers = max(int(prepare_workers), 0)
+    if gdal_cachemax is not None:
+        gdal_cachemax = max(int(gdal_cachemax) // (max(prepare_workers, 1) * tile_workers), 1)
+
+    return {'cpu_budget' : None,
+            'tile_workers' : tile_workers,
+            'prepare_workers' : prepare_workers,
+            'rf_n_jobs' : DEFAULT_RF_N_JOBS,
+            'gdal_threads' : None,
+            'gdal_cachemax' : gdal_cachemax,
+            'blas_threads' : None}
+
+def apply_cpu_allocation(allocation):
+    """
+    Apply an allocation from allocate_cpus.
+
+    Sets environmental variables for GDAL and BLAS (inherited by
+    tile workers and external programs such as gdalwarp) and the
+    number of jobs used for scikit-learn. Settings which are None
+    aren't changed.
+    """
+    global _current_allocation
+
+    if allocation['gdal_threads'] is not None:
+        os.environ['GDAL_NUM_THREADS'] = str(allocation['gdal_threads'])
+    if allocation['gdal_cachemax'] is not None:
+        os.environ['GDAL_CACHEMAX'] = str(allocation['gdal_cachemax'])
+
+    if allocation['blas_threads'] is not None:
+        for env_var in BLAS_THREADS_ENV_VARS:
+            os.environ[env_var] = str(allocation['blas_threads'])
+        # Environmental variables are only read when a library is loaded,
+        # so also limit any which have already been loaded.
+        if HAVE_THREADPOOLCTL:
+            threadpoolctl.threadpool_limits(limits=allocation['blas_threads'],
+                                            user_api='blas')
+
+    _current_allocation = allocation
+
+    if allocation['cpu_budget'] is None:
+        return
+
+    print('CPU budget of {} cores: {} tile workers, {} preparation workers, '
+          '{} jobs for model, {} GDAL threads, {} BLAS threads, GDAL cache {}'
+          ''.format(allocation['cpu_budget'], allocation['tile_workers'],
+                    allocation['prepare_workers'], allocation['rf_n_jobs'],
+                    allocation['gdal_threads'], allocation['blas_threads'],
+                    'default' if allocation['gdal_cachemax'] is None
+                    else '{} MB'.format(allocation['gdal_cachemax'])))
+
+def set_cpu_budget(config_dict=None, tile_workers=1, prepare_workers=0):
+    """
+    Get CPU budget from the config / environment, divide between
+    the levels of parallelism and apply. If a budget hasn't been set
+    the defaults are kept (see get_default_allocation).
+
+    Requires:
+
+    * config_dict - dictionary (e.g., '[default]' section of config file)
+    * tile_workers - number of tiles to process in parallel requested
+    * prepare_workers - number of dates to prepare in the background
+      requested (0 if dates aren't prepared in the background)
+
+    Returns allocation dictionary (see allocate_cpus).
+    """
+    cpu_budget = get_cpu_budget(config_dict)
+    if cpu_budget is None:
+        allocation = get_default_allocation(tile_workers=tile_workers,
+                                            prepare_workers=prepare_workers,
+                                            gdal_cachemax=get_gdal_cachemax(config_dict))
+    else:
+        allocation = allocate_cpus(cpu_budget,
+                                   tile_workers=tile_workers,
+                                   prepare_workers=prepare_workers,
+                                   gdal_cachemax=get_gdal_cachemax(config_dict))
+    apply_cpu_allocation(allocation)
+    return allocation
+
+def get_rf_n_jobs():
+    """
+    Get the number of jobs to use for scikit-learn.
+    """
+    if _current_allocation is None:
+        return DEFAULT_RF_N_JOBS
+    return _current_allocation['rf_n_jobs']
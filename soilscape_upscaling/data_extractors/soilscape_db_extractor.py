@@ -13,9 +13,11 @@ licence is available to download with this file.
 import csv
 import os
 import re
-import sqlite3
 import numpy
 
+from . import soilscape_db_tuning
+from . import window_aggregation
+
 # Check for mysql connector, only needed if connecting
 # to MySQL database
 havePyMySQL = False
@@ -41,7 +43,8 @@ class SoilSCAPECreateCSVfromDB(object):
         # Connect to database
         self.useSQLite = False
         if sqliteFile is not None:
-            self.sensordb = sqlite3.connect(sqliteFile)
+            # Only reading so open read-only, with memory mapped I/O
+            self.sensordb = soilscape_db_tuning.connect_read_only(sqliteFile)
             self.useSQLite=True
         else:
             if not havePyMySQL:
@@ -62,6 +65,9 @@ class SoilSCAPECreateCSVfromDB(object):
         self.debugMode = debugMode
         self.calCoeff = self.setInitialCal()
 
+        # Series for each node, if loaded (see loadSeries)
+        self.windowAggregator = None
+
     def setInitialCal(self):
 
         """ Set intial calibration to Decagon (mineral soil) """
@@ -87,6 +93,14 @@ class SoilSCAPECreateCSVfromDB(object):
 
         return calCoeff
 
+    def _getQuery(self, sqlCommand):
+
+        """ Get query with parameter placeholders for the database in use """
+
+        if self.useSQLite:
+            return sqlCommand
+        return sqlCommand.replace('?', '%s')
+
     def getCalibration(self, physicalID):
 
         """ Get node spefific calibration from database.
@@ -101,12 +115,8 @@ class SoilSCAPECreateCSVfromDB(object):
             cursor = self.sensordb.cursor(buffered=True)
 
         # Select calibration coefficients from database
-        sqlCommand = '''SELECT s1CalType, s1Coeff0, s1Coeff1,s1Coeff2,s1Coeff3,
-                        s2Coeff0, s2Coeff1, s2Coeff2, s2Coeff3,
-                        s3Coeff0, s3Coeff1, s3Coeff2, s3Coeff3,
-                        s4Coeff0, s4Coeff1, s4Coeff2, s4Coeff3
-                         FROM Calibration WHERE PhysicalID = {} ORDER BY Version DESC LIMIT 1;'''.format(physicalID)
-        cursor.execute(sqlCommand)
+        cursor.execute(self._getQuery(soilscape_db_tuning.CALIBRATION_QUERY),
+                       (physicalID,))
 
         calData = cursor.fetchall()
 
@@ -190,6 +200,125 @@ class SoilSCAPECreateCSVfromDB(object):
 
         return cal1, cal2, cal3, cal4
 
+    def _getDBTime(self, timeStr):
+
+        """ Get time string in the format used by the database """
+
+        if self.useSQLite:
+            return timeStr
+        timeDB = re.sub('-','',timeStr)
+        timeDB = re.sub(':','',timeDB)
+        timeDB = re.sub(' ','',timeDB)
+        return timeDB
+
+    def loadSeries(self, physicalIDsList, startDateTimeStr, endDateTimeStr):
+        """
+        Read and calibrate the series for the required sensor of each node
+        once, so data can be averaged for any window between
+        startDateTimeStr and endDateTimeStr using prefix sums (see
+        window_aggregation) rather than querying the database for every
+        window.
+
+        The checks made by getOutLine for each window (the first record
+        has three EC-5 sensors and the sensors don't each have a single
+        unmasked record) are made for each window using the time, sensor
+        types and flags of every record, stored with the location as the
+        station information.
+
+        Returns WindowAggregator object, which can also be used by other
+        extractors for the same sensor by setting 'windowAggregator'.
+        """
+        if self.outSensorNum not in [1, 2, 3]:
+            raise Exception("Sensor number not recognised")
+
+        # Measurements at the start and end times aren't selected by the
+        # query so aren't included in windows
+        self.windowAggregator = window_aggregation.WindowAggregator(min_value=0,
+                                                                    max_value=60,
+                                                                    include_start=False)
+        if self.useSQLite:
+            cursor = self.sensordb.cursor()
+        else:
+            cursor = self.sensordb.cursor(buffered=True)
+
+        for physicalID in physicalIDsList:
+            cursor.execute(self._getQuery(soilscape_db_tuning.MEASUREMENTS_QUERY),
+                           (physicalID, self._getDBTime(startDateTimeStr),
+                            self._getDBTime(endDateTimeStr)))
+            outData = cursor.fetchall()
+
+            if len(outData) == 0:
+                if self.debugMode:
+                    print("No data found for Node#{} for selected dates".format(physicalID))
+                continue
+
+            dataNP = numpy.array(outData)
+
+            # Record checks for each record (in time order), so they can
+            # be made for the records within each window
+            unmaskedNP = (dataNP[:,19:22].astype(int) == 0).astype(numpy.int64)
+            unmaskedCounts = numpy.zeros((dataNP.shape[0] + 1, 3), dtype=numpy.int64)
+            numpy.cumsum(unmaskedNP, axis=0, out=unmaskedCounts[1:])
+            recordChecks = {'times' : window_aggregation.to_epoch(dataNP[:,4]),
+                            'hasEC5' : (dataNP[:,40] == 'EC-5') & (dataNP[:,42] == 'EC-5') \
+                                       & (dataNP[:,44] == 'EC-5'),
+                            'unmaskedCounts' : unmaskedCounts}
+
+            # Extract only data with no flags for the required sensor
+            sensorNP = dataNP[dataNP[:,18 + self.outSensorNum].astype(int) == 0]
+            rawNP = sensorNP[:,4 + self.outSensorNum].astype(float)
+
+            # Get site specific calibration coefficients and apply
+            self.getCalibration(physicalID)
+            allCalib = self.calData(**{'raw{}'.format(self.outSensorNum) : rawNP})
+
+            self.windowAggregator.add_station(physicalID,
+                                              window_aggregation.to_epoch(sensorNP[:,4]),
+                                              allCalib[self.outSensorNum - 1],
+                                              station_info={'location' : (dataNP[0][36], dataNP[0][37]),
+                                                            'recordChecks' : recordChecks})
+
+        self.windowAggregator.set_loaded_range(window_aggregation.to_epoch([startDateTimeStr])[0],
+                                               window_aggregation.to_epoch([endDateTimeStr])[0])
+        return self.windowAggregator
+
+    def getOutLineFromSeries(self, physicalID, startTime, endTime):
+        """
+        Average data from series read using loadSeries and return array,
+        to be written out as line to CSV file
+
+        Returns None if the window isn't within the series.
+        """
+        startEpoch, endEpoch = window_aggregation.to_epoch([startTime, endTime])
+        if not self.windowAggregator.covers(startEpoch, endEpoch):
+            return None
+        if not self.windowAggregator.has_station(physicalID):
+            raise Exception("No data found for Node#{} for selected dates".format(physicalID))
+        stationInfo = self.windowAggregator.get_station_info(physicalID)
+
+        # Make the same checks as getOutLine for the records within the
+        # window (the query excludes records at the start and end times)
+        recordChecks = stationInfo['recordChecks']
+        startIndex = numpy.searchsorted(recordChecks['times'], startEpoch, side='right')
+        endIndex = numpy.searchsorted(recordChecks['times'], endEpoch, side='left')
+        if endIndex <= startIndex:
+            raise Exception("No data found for Node#{} for selected dates".format(physicalID))
+        if not recordChecks['hasEC5'][startIndex]:
+            raise Exception("The record for Node #{} does not contain data for three soil moisture sensors".format(physicalID))
+        unmaskedCounts = recordChecks['unmaskedCounts'][endIndex] \
+                         - recordChecks['unmaskedCounts'][startIndex]
+        if numpy.all(unmaskedCounts == 1):
+            raise Exception("No unmasked data found for {}.".format(physicalID))
+
+        # Scale to get in m3/m3
+        outSensorCal = self.windowAggregator.get_mean(physicalID, startEpoch, endEpoch) / 100.0
+
+        if numpy.isnan(outSensorCal):
+            raise Exception("No valid data found for {}.".format(physicalID))
+
+        latitude, longitude = stationInfo['location']
+        return [physicalID, latitude, longitude, outSensorCal]
+
     def getOutLine(self, physicalID, startTime, endTime):
         """
         Read and average data from a range of dates and return array,
@@ -197,34 +326,29 @@ class SoilSCAPECreateCSVfromDB(object):
 
         Measurements are extracted for all sensors but only the required
         sensor is returned.
+
+        If series have been read using loadSeries they are used for
+        windows within them.
         """
 
+        if self.windowAggregator is not None:
+            outLine = self.getOutLineFromSeries(physicalID, startTime, endTime)
+            if outLine is not None:
+                return outLine
+
         if self.useSQLite:
             cursor = self.sensordb.cursor()
         else:
             cursor = self.sensordb.cursor(buffered=True)
 
         smData = {}
-        if self.useSQLite:
-            startTimeDB = startTime
-            endTimeDB = endTime
-        else:
-            startTimeDB = re.sub('-','',startTime)
-            startTimeDB = re.sub(':','',startTimeDB)
-            startTimeDB = re.sub(' ','',startTimeDB)
-            endTimeDB = re.sub('-','',endTime)
-            endTimeDB = re.sub(':','',endTimeDB)
-            endTimeDB = re.sub(' ','',endTimeDB)
-
-        # Select data from table
-        orderStr = "ORDER BY measTStime ASC"
-        sqlCommand = '''SELECT * FROM `Measurements` JOIN `MeasurementControl` ON (Measurements.MeasurementID=MeasurementControl.MeasurementID)
-JOIN `LogicalLocation` ON (Measurements.LogicalID=LogicalLocation.LogicalID)
-JOIN `PhysicalLocation` ON (Measurements.PhysicalID=PhysicalLocation.PhysicalID)
-JOIN `MeasurementScheme` ON (Measurements.MeasurementSchemeID=MeasurementScheme.MeasurementSchemeID)
-WHERE Measurements.PhysicalID=%s AND badData = 0 AND measTStime > '%s' AND measTStime < '%s' '''%(physicalID, startTimeDB, endTimeDB) + orderStr + ';'
-
-        cursor.execute(sqlCommand)
+        startTimeDB = self._getDBTime(startTime)
+        endTimeDB = self._getDBTime(endTime)
+
+        # Select data from table. Values are passed as parameters so the
+        # query text is the same for every node and date.
+        cursor.execute(self._getQuery(soilscape_db_tuning.MEASUREMENTS_QUERY),
+                       (physicalID, startTimeDB, endTimeDB))
         outData = cursor.fetchall()
 
         if len(outData) == 0:
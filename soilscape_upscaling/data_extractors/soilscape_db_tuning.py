@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+"""
+Functions to prepare a SoilSCAPE SQLite database for extracting data
+and to connect to it for fast, read-only access.
+
+* prepare_database - creates indexes on the columns used to select
+  measurements (and join tables) then updates the statistics used by
+  the query planner. Prints 'EXPLAIN QUERY PLAN' for the measurement
+  query before and after.
+* connect_read_only - opens database read-only, with memory mapped
+  I/O and a larger page cache.
+* create_test_database / benchmark_extraction - create a database
+  with the same layout as the SoilSCAPE database with generated data
+  for many nodes over several years, and time extraction before and
+  after preparing it.
+
+Run as a script to prepare a database::
+
+   python -m soilscape_upscaling.data_extractors.soilscape_db_tuning \\
+      prepare soilscape.db
+
+or to run the benchmark::
+
+   python -m soilscape_upscaling.data_extractors.soilscape_db_tuning \\
+      benchmark /tmp/soilscape_test.db --num_nodes 100 --num_years 3
+
+Dan Clewley & Jane Whitcomb
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+"""
+
+import argparse
+import calendar
+import os
+import sqlite3
+import time
+import urllib.request
+
+import numpy
+
+#: Size of memory map to use for read-only connections (bytes)
+MMAP_SIZE = 1024**3
+
+#: Size of page cache to use for read-only connections (KiB)
+CACHE_SIZE_KB = 256 * 1024
+
+#: Query used to extract measurements for a node. Uses '?' for parameters
+#: (SQLite), replace with '%s' for MySQL.
+MEASUREMENTS_QUERY = '''SELECT * FROM `Measurements` JOIN `MeasurementControl` ON (Measurements.MeasurementID=MeasurementControl.MeasurementID)
+JOIN `LogicalLocation` ON (Measurements.LogicalID=LogicalLocation.LogicalID)
+JOIN `PhysicalLocation` ON (Measurements.PhysicalID=PhysicalLocation.PhysicalID)
+JOIN `MeasurementScheme` ON (Measurements.MeasurementSchemeID=MeasurementScheme.MeasurementSchemeID)
+WHERE Measurements.PhysicalID=? AND badData = 0 AND measTStime > ? AND measTStime < ? ORDER BY measTStime ASC;'''
+
+#: Query used to get the calibration for a node.
+CALIBRATION_QUERY = '''SELECT s1CalType, s1Coeff0, s1Coeff1,s1Coeff2,s1Coeff3,
+                        s2Coeff0, s2Coeff1, s2Coeff2, s2Coeff3,
+                        s3Coeff0, s3Coeff1, s3Coeff2, s3Coeff3,
+                        s4Coeff0, s4Coeff1, s4Coeff2, s4Coeff3
+                         FROM Calibration WHERE PhysicalID = ? ORDER BY Version DESC LIMIT 1;'''
+
+#: Indexes to create, as (table, columns). Columns compared for
+#: equality are first, followed by the column used for the time range
+#: so rows are also returned in order and no sort is needed.
+INDEXES = [('Measurements', ['PhysicalID', 'badData', 'measTStime']),
+           ('MeasurementControl', ['MeasurementID']),
+           ('LogicalLocation', ['LogicalID']),
+           ('PhysicalLocation', ['PhysicalID']),
+           ('MeasurementScheme', ['MeasurementSchemeID']),
+           ('Calibration', ['PhysicalID', 'Version'])]
+
+def connect_read_only(sqlite_file, mmap_size=MMAP_SIZE,
+                      cache_size_kb=CACHE_SIZE_KB):
+    """
+    Open SQLite database read-only using memory mapped I/O
+    and a large page cache.
+
+    Returns sqlite3 connection.
+    """
+    if not os.path.isfile(sqlite_file):
+        raise Exception('The database {} does not exist'.format(sqlite_file))
+    db_uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(sqlite_file)))
+    sensordb = sqlite3.connect(db_uri, uri=True)
+    cursor = sensordb.cursor()
+    cursor.execute('PRAGMA mmap_size={:d};'.format(int(mmap_size)))
+    # Negative values are in KiB rather than pages
+    cursor.execute('PRAGMA cache_size=-{:d};'.format(int(cache_size_kb)))
+    cursor.execute('PRAGMA temp_store=MEMORY;')
+    cursor.execute('PRAGMA query_only=1;')
+    cursor.close()
+    return sensordb
+
+def get_schema(sensordb):
+    """
+    Get tables and columns within a database.
+
+    Returns dictionary with the list of columns for each table.
+    """
+    cursor = sensordb.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
+    table_names = [row[0] for row in cursor.fetchall()]
+    schema = {}
+    for table_name in table_names:
+        cursor.execute('PRAGMA table_info(`{}`);'.format(table_name))
+        schema[table_name] = [row[1] for row in cursor.fetchall()]
+    cursor.close()
+    return schema
+
+def _get_indexed_columns(sensordb, table_name):
+    """
+    Get the list of columns for each index on a table (including the
+    primary key).
+    """
+    cursor = sensordb.cursor()
+    indexed_columns = []
+    cursor.execute('PRAGMA table_info(`{}`);'.format(table_name))
+    pk_columns = [(row[5], row[1]) for row in cursor.fetchall() if row[5] > 0]
+    if len(pk_columns) > 0:
+        indexed_columns.append([name for _, name in sorted(pk_columns)])
+    cursor.execute('PRAGMA index_list(`{}`);'.format(table_name))
+    for index_row in cursor.fetchall():
+        cursor.execute('PRAGMA index_info(`{}`);'.format(index_row[1]))
+        indexed_columns.append([row[2] for row in sorted(cursor.fetchall())])
+    cursor.close()
+    return indexed_columns
+
+def get_missing_indexes(sensordb):
+    """
+    Get indexes from INDEXES which are not already covered by an
+    existing index (or primary key) on the table.
+
+    Returns list of (table, columns).
+    """
+    schema = get_schema(sensordb)
+    missing_indexes = []
+    for table_name, columns in INDEXES:
+        if table_name not in schema:
+            print('Table "{}" not found, skipping'.format(table_name))
+            continue
+        if not all([column in schema[table_name] for column in columns]):
+            print('Columns {} not found in "{}", skipping'.format(', '.join(columns),
+                                                                   table_name))
+            continue
+        covered = False
+        for indexed_columns in _get_indexed_columns(sensordb, table_name):
+            if indexed_columns[:len(columns)] == columns:
+                covered = True
+        if not covered:
+            missing_indexes.append((table_name, columns))
+    return missing_indexes
+
+def explain_query_plan(sensordb, sql_command=MEASUREMENTS_QUERY,
+                       parameters=(1, '2000-01-01 00:00:00', '2000-01-02 00:00:00')):
+    """
+    Get output of 'EXPLAIN QUERY PLAN' for a query.
+
+    Returns list of lines describing the plan.
+    """
+    cursor = sensordb.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql_command, parameters)
+    plan_lines = [str(row[-1]) for row in cursor.fetchall()]
+    cursor.close()
+    return plan_lines
+
+def prepare_database(sqlite_file):
+    """
+    Create indexes needed to extract measurements and update
+    statistics used by the query planner.
+
+    Prints the query plan for extracting measurements before and
+    after.
+
+    Returns list of indexes created as (table, columns).
+    """
+    sensordb = sqlite3.connect(sqlite_file)
+    try:
+        print('Query plan before:')
+        for line in explain_query_plan(sensordb):
+            print('   ' + line)
+
+        missing_indexes = get_missing_indexes(sensordb)
+        cursor = sensordb.cursor()
+        for table_name, columns in missing_indexes:
+            index_name = 'idx_{}_{}'.format(table_name, '_'.join(columns))
+            print('Creating index {}'.format(index_name))
+            cursor.execute('CREATE INDEX IF NOT EXISTS `{}` ON `{}` ({});'.format(
+                index_name, table_name, ', '.join(['`{}`'.format(c) for c in columns])))
+        cursor.execute('ANALYZE;')
+        sensordb.commit()
+        cursor.close()
+
+        print('Query plan after:')
+        for line in explain_query_plan(sensordb):
+            print('   ' + line)
+    finally:
+        sensordb.close()
+
+    return missing_indexes
+
+def create_test_database(sqlite_file, num_nodes=50, num_years=2,
+                         interval_minutes=15, start_year=2013, seed=17):
+    """
+    Create a database with the same layout as the SoilSCAPE database
+    (as used by SoilSCAPECreateCSVfromDB) containing generated
+    measurements.
+
+    No indexes are created, other than for primary keys.
+
+    Requires:
+
+    * sqlite_file - output database (overwritten if it exists)
+    * num_nodes - number of nodes (PhysicalIDs start at 1)
+    * num_years - number of years of measurements
+    * interval_minutes - time between measurements
+    * start_year - first year of measurements
+    * seed - seed for random numbers
+
+    Returns list of node IDs.
+    """
+    if os.path.isfile(sqlite_file):
+        os.remove(sqlite_file)
+
+    sensordb = sqlite3.connect(sqlite_file)
+    cursor = sensordb.cursor()
+
+    # Columns are in the order expected by SoilSCAPECreateCSVfromDB
+    # when selecting all columns from the joined tables.
+    cursor.execute('''CREATE TABLE Measurements (MeasurementID INTEGER PRIMARY KEY,
+                      PhysicalID INTEGER, LogicalID INTEGER, MeasurementSchemeID INTEGER,
+                      measTStime TEXT, s1Raw REAL, s2Raw REAL, s3Raw REAL, s4Raw REAL,
+                      battery REAL, temperature REAL, extra1 REAL, extra2 REAL,
+                      extra3 REAL, extra4 REAL, extra5 REAL, extra6 REAL, extra7 REAL,
+                      extra8 REAL, s1Flag INTEGER, s2Flag INTEGER, s3Flag INTEGER,
+                      s4Flag INTEGER, badData INTEGER);''')
+    cursor.execute('''CREATE TABLE MeasurementControl (MeasurementID INTEGER,
+                      insertTime TEXT, source TEXT);''')
+    cursor.execute('''CREATE TABLE LogicalLocation (LogicalID INTEGER, LogicalName TEXT,
+                      SiteID INTEGER, Description TEXT);''')
+    cursor.execute('''CREATE TABLE PhysicalLocation (PhysicalID INTEGER, NodeName TEXT,
+                      SiteName TEXT, InstallDate TEXT, Elevation REAL,
+                      Latitude REAL, Longitude REAL);''')
+    cursor.execute('''CREATE TABLE MeasurementScheme (MeasurementSchemeID INTEGER,
+                      SchemeName TEXT, s1Type TEXT, s1Depth REAL, s2Type TEXT,
+                      s2Depth REAL, s3Type TEXT, s3Depth REAL, s4Type TEXT,
+                      s4Depth REAL);''')
+    cursor.execute('''CREATE TABLE Calibration (PhysicalID INTEGER, Version INTEGER,
+                      s1CalType TEXT, s1Coeff0 REAL, s1Coeff1 REAL, s1Coeff2 REAL, s1Coeff3 REAL,
+                      s2Coeff0 REAL, s2Coeff1 REAL, s2Coeff2 REAL, s2Coeff3 REAL,
+                      s3Coeff0 REAL, s3Coeff1 REAL, s3Coeff2 REAL, s3Coeff3 REAL,
+                      s4Coeff0 REAL, s4Coeff1 REAL, s4Coeff2 REAL, s4Coeff3 REAL);''')
+
+    random_gen = numpy.random.RandomState(seed)
+
+    node_ids = list(range(1, num_nodes + 1))
+    cursor.execute("INSERT INTO MeasurementScheme VALUES (1, 'EC-5 x3', 'EC-5', 5, "
+                   "'EC-5', 15, 'EC-5', 30, 'None', 0);")
+    cursor.execute("INSERT INTO LogicalLocation VALUES (1, 'default', 1, '');")
+    for node_id in node_ids:
+        cursor.execute('INSERT INTO PhysicalLocation VALUES (?, ?, ?, ?, ?, ?, ?);',
+                       (node_id, 'Node{}'.format(node_id), 'Test', '2012-01-01',
+                        100.0, 38.4 + random_gen.rand() * 0.05,
+                        -120.95 + random_gen.rand() * 0.05))
+        cursor.execute('INSERT INTO Calibration VALUES (?, 1, ?, ?, ?, 0, 0, ?, ?, 0, 0, '
+                       '?, ?, 0, 0, -40.1, 0.1279569, 0, 0);',
+                       (node_id, 'linear', -40.1, 0.1279569, -40.1, 0.1279569,
+                        -40.1, 0.1279569))
+
+    start_epoch = calendar.timegm((start_year, 1, 1, 0, 0, 0))
+    end_epoch = calendar.timegm((start_year + num_years, 1, 1, 0, 0, 0))
+    times_epoch = numpy.arange(start_epoch, end_epoch, interval_minutes * 60)
+    times_str = [time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))
+                 for t in times_epoch]
+
+    measurement_id = 0
+    # Insert one time step for all nodes at a time, so measurements for
+    # a node are spread through the table (as when logged).
+    for time_str in times_str:
+        raw_vals = 400 + 150 * random_gen.rand(num_nodes, 3)
+        bad_data = (random_gen.rand(num_nodes) < 0.01).astype(int)
+        rows = []
+        control_rows = []
+        for i, node_id in enumerate(node_ids):
+            measurement_id += 1
+            rows.append((measurement_id, node_id, 1, 1, time_str,
+                         raw_vals[i, 0], raw_vals[i, 1], raw_vals[i, 2], 0,
+                         3.6, 20, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0,
+                         int(bad_data[i])))
+            control_rows.append((measurement_id, time_str, 'generated'))
+        cursor.executemany('INSERT INTO Measurements VALUES ({});'.format(
+            ', '.join(['?'] * 24)), rows)
+        cursor.executemany('INSERT INTO MeasurementControl VALUES (?, ?, ?);',
+                           control_rows)
+
+    sensordb.commit()
+    sensordb.close()
+
+    return node_ids
+
+def _time_extraction(sqlite_file, node_ids, dates_epoch, interval_hours=24):
+    """
+    Time extracting data for all nodes for each date.
+
+    Returns time taken (s) and the number of records extracted.
+    """
+    # Import here to avoid circular import
+    from . import soilscape_db_extractor
+
+    extractor = soilscape_db_extractor.SoilSCAPECreateCSVfromDB(sqlite_file)
+    num_records = 0
+    start_time = time.time()
+    for date_epoch in dates_epoch:
+        start_str = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(date_epoch))
+        end_str = time.strftime('%Y-%m-%d %H:%M:%S',
+                                time.gmtime(date_epoch + interval_hours * 3600))
+        for node_id in node_ids:
+            try:
+                extractor.getOutLine(node_id, start_str, end_str)
+                num_records += 1
+            except Exception:
+                pass
+    elapsed_time = time.time() - start_time
+    extractor.sensordb.close()
+    return elapsed_time, num_records
+
+def benchmark_extraction(sqlite_file, num_nodes=50, num_years=2,
+                         num_dates=10, interval_minutes=15):
+    """
+    Create a test database and time extracting data for a number of
+    dates before and after preparing the database.
+
+    Returns dictionary with the time taken before and after.
+    """
+    print('Creating test database with {} nodes over {} years'.format(num_nodes,
+                                                                      num_years))
+    node_ids = create_test_database(sqlite_file, num_nodes=num_nodes,
+                                    num_years=num_years,
+                                    interval_minutes=interval_minutes)
+    print('Database size: {:.1f} MB'.format(os.path.getsize(sqlite_file) / 1e6))
+
+    start_epoch = calendar.timegm((2013, 1, 1, 0, 0, 0))
+    dates_epoch = numpy.linspace(start_epoch, start_epoch + (num_years * 365 - 2) * 86400,
+                                 num_dates).astype(int)
+
+    time_before, num_before = _time_extraction(sqlite_file, node_ids, dates_epoch)
+    print('Before: extracted {} records in {:.2f} s'.format(num_before, time_before))
+
+    prepare_database(sqlite_file)
+
+    time_after, num_after = _time_extraction(sqlite_file, node_ids, dates_epoch)
+    print('After: extracted {} records in {:.2f} s'.format(num_after, time_after))
+
+    if num_before != num_after:
+        raise Exception('Different number of records extracted before and '
+                        'after preparing database')
+
+    print('Speed up: {:.1f}x'.format(time_before / max(time_after, 1e-9)))
+
+    return {'before' : time_before, 'after' : time_after}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prepare SoilSCAPE SQLite database '
+                                                 'for extracting data or run benchmark')
+    parser.add_argument("command", choices=['prepare', 'explain', 'benchmark'])
+    parser.add_argument("sqlite_file", help="SQLite database")
+    parser.add_argument("--num_nodes", type=int, default=50,
+                        help="Number of nodes for benchmark database")
+    parser.add_argument("--num_years", type=int, default=2,
+                        help="Number of years for benchmark database")
+    parser.add_argument("--num_dates", type=int, default=10,
+                        help="Number of dates to extract for benchmark")
+    args = parser.parse_args()
+
+    if args.command == 'prepare':
+        prepare_database(args.sqlite_file)
+    elif args.command == 'explain':
+        read_only_db = connect_read_only(args.sqlite_file)
+        for plan_line in explain_query_plan(read_only_db):
+            print(plan_line)
+        read_only_db.close()
+    else:
+        benchmark_extraction(args.sqlite_file, num_nodes=args.num_nodes,
+                             num_years=args.num_years, num_dates=args.num_dates)
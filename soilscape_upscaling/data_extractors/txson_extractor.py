@@ -17,6 +17,8 @@ import time
 import numpy
 import pandas
 
+from . import window_aggregation
+
 class SoilSCAPECreateCSVfromTxSON(object):
     """
     TxSON extraction class
@@ -58,6 +60,48 @@ class SoilSCAPECreateCSVfromTxSON(object):
         self.sitelat = sitelat
         self.sitelon = sitelon        
 
+        # Series for each site, if loaded (see loadSeries)
+        self.windowAggregator = None
+
+    def readSiteData(self, siteIDstr):
+        """
+        Read data for a site from file.
+
+        """
+        sitebase = self.loggerID[siteIDstr].replace('-','_')
+        sitefile = self.txsondir+sitebase+'.dat'
+        return pandas.read_csv(sitefile,sep=',\s+', engine='python')
+
+    def loadSeries(self, startsecs, endsecs):
+        """
+        Read the series for each site once, so data can be averaged for
+        any window between startsecs and endsecs using prefix sums
+        (see window_aggregation) rather than reading the file for every
+        window.
+
+        """
+        self.windowAggregator = window_aggregation.WindowAggregator(min_value=0,
+                                                                    max_value=0.50)
+        sensorColumns = {1 : 'VWC_5', 2 : 'VWC_10', 3 : 'VWC_20'}
+        if self.outSensorNum not in sensorColumns:
+            raise Exception("Sensor number not recognised")
+
+        for siteIDstr in self.siteIDsList:
+            try:
+                sitedata = self.readSiteData(siteIDstr)
+            except Exception as err:
+                if self.debugMode:
+                    print(err)
+                continue
+            filesecs = window_aggregation.to_epoch(pandas.to_datetime(sitedata.Date,
+                                                                      format="%m/%d/%y %H:%M"))
+            inWindow = (filesecs >= startsecs) & (filesecs < endsecs)
+            VWCmeas = sitedata[sensorColumns[self.outSensorNum]].to_numpy(dtype=float)
+            self.windowAggregator.add_station(siteIDstr, filesecs[inWindow], VWCmeas[inWindow])
+
+        self.windowAggregator.set_loaded_range(startsecs, endsecs)
+        return self.windowAggregator
+
     def getOutLine(self, siteIDstr, startsecs, endsecs):
         """
         Read and average data from a range of dates and return array,
@@ -69,11 +113,17 @@ class SoilSCAPECreateCSVfromTxSON(object):
         latitude = self.sitelat[siteIDstr]
         longitude = self.sitelon[siteIDstr]
 
+        # Use series read for all windows if available
+        if self.windowAggregator is not None and \
+                self.windowAggregator.has_station(siteIDstr) and \
+                self.windowAggregator.covers(startsecs, endsecs):
+            sensorAvg = self.windowAggregator.get_mean(siteIDstr, startsecs, endsecs)
+            if (numpy.isfinite(sensorAvg) == False):
+                raise Exception("No valid data found for Site {}, sensor {} for selected date".format(siteIDstr,self.outSensorNum))
+            return [siteIDstr, latitude, longitude, sensorAvg]
+
         # Select data from file
-        sitebase = self.loggerID[siteIDstr].replace('-','_')
-        sitefile = self.txsondir+sitebase+'.dat'
-        
-        sitedata = pandas.read_csv(sitefile,sep=',\s+', engine='python')
+        sitedata = self.readSiteData(siteIDstr)
         if len(sitedata) == 0:
             raise Exception("No data found for Site {} (at all, any sensors) for selected date".format(loggerID[siteIDstr]))  
   
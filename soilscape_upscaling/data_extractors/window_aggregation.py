@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Average sensor measurements over time windows using cumulative sums
+(prefix sums) of the series for each station.
+
+The extractors average the measurements within 'time_interval_hours'
+of each date. When windows overlap (e.g., a 72 hour average for every
+day) or several window lengths are used, the same measurements are
+read and averaged many times. Instead the series for each station is
+read once, measurements failing QC (outside the valid range) are
+removed and cumulative sums and counts are calculated. The mean for
+any window is then the difference between the cumulative sums at the
+end and start of the window (found using a binary search) divided by
+the difference in counts, so the means for any number of windows are
+calculated in one vectorised pass for each station.
+
+Dan Clewley & Jane Whitcomb
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import numpy
+import pandas
+
+def to_epoch(times):
+    """
+    Convert a list of times (strings in any format recognised by
+    pandas or datetime objects, as UTC) to seconds since epoch.
+    """
+    times = pandas.to_datetime(pandas.Series(times))
+    return ((times - pandas.Timestamp('1970-01-01')) //
+            pandas.Timedelta(seconds=1)).to_numpy(dtype=numpy.int64)
+
+class WindowAggregator(object):
+    """
+    Cumulative sums and counts of the series for each station, to average
+    measurements over windows.
+
+    Requires:
+
+    * min_value - measurements must be greater than this value (optional)
+    * max_value - measurements must be less than this value (optional)
+    * include_start - if measurements at the start time of a window are
+      included (measurements at the end time are never included)
+
+    """
+    def __init__(self, min_value=None, max_value=None, include_start=True):
+        self.min_value = min_value
+        self.max_value = max_value
+        self.include_start = include_start
+        self.loaded_range = None
+        self._series = {}
+        self._window_means = {}
+
+    def add_station(self, station_id, times_epoch, values, station_info=None):
+        """
+        Add series of measurements for a station. Measurements which are
+        NaN or outside the valid range are removed.
+
+        Requires:
+
+        * station_id - ID of station
+        * times_epoch - time of each measurement (seconds since epoch)
+        * values - value of each measurement
+        * station_info - any other information for the station (e.g.,
+          location), available using get_station_info
+
+        """
+        times_epoch = numpy.asarray(times_epoch, dtype=numpy.int64)
+        values = numpy.asarray(values, dtype=numpy.float64)
+
+        valid = numpy.isfinite(values)
+        if self.min_value is not None:
+            valid &= values > self.min_value
+        if self.max_value is not None:
+            valid &= values < self.max_value
+        times_epoch = times_epoch[valid]
+        values = values[valid]
+
+        sort_order = numpy.argsort(times_epoch, kind='stable')
+        times_epoch = times_epoch[sort_order]
+        values = values[sort_order]
+
+        # Subtract the mean so the difference between cumulative sums
+        # doesn't lose precision for long series
+        offset = values.mean() if values.size > 0 else 0.0
+        cumulative_sum = numpy.zeros(values.size + 1, dtype=numpy.float64)
+        numpy.cumsum(values - offset, out=cumulative_sum[1:])
+
+        self._series[station_id] = {'times' : times_epoch,
+                                    'cumulative_sum' : cumulative_sum,
+                                    'offset' : offset,
+                                    'info' : station_info}
+        self._window_means.pop(station_id, None)
+
+    def has_station(self, station_id):
+        """
+        Check if a series has been added for a station.
+        """
+        return station_id in self._series
+
+    def get_station_info(self, station_id):
+        """
+        Get information provided for a station when it was added.
+        """
+        return self._series[station_id]['info']
+
+    def set_loaded_range(self, start_epoch, end_epoch):
+        """
+        Set the range of times series were read for, so windows outside
+        it can be read from the source instead.
+        """
+        self.loaded_range = (start_epoch, end_epoch)
+
+    def covers(self, start_epoch, end_epoch):
+        """
+        Check if a window is within the range series were read for.
+        """
+        if self.loaded_range is None:
+            return False
+        return start_epoch >= self.loaded_range[0] and end_epoch <= self.loaded_range[1]
+
+    def get_window_stats(self, station_id, start_epochs, end_epochs):
+        """
+        Get mean and number of measurements within windows for a station.
+
+        Requires:
+
+        * station_id - ID of station
+        * start_epochs - array of start time of each window
+        * end_epochs - array of end time of each window
+
+        Returns arrays of mean (NaN if there are no measurements) and count.
+        """
+        series = self._series[station_id]
+        start_side = 'left' if self.include_start else 'right'
+        start_index = numpy.searchsorted(series['times'], start_epochs, side=start_side)
+        end_index = numpy.searchsorted(series['times'], end_epochs, side='left')
+        end_index = numpy.maximum(end_index, start_index)
+
+        count = end_index - start_index
+        window_sum = series['cumulative_sum'][end_index] - series['cumulative_sum'][start_index]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = window_sum / count + series['offset']
+        mean[count == 0] = numpy.nan
+        return mean, count
+
+    def get_window_means(self, start_epochs, window_lengths):
+        """
+        Get the mean for all combinations of window start and length,
+        for all stations.
+
+        Requires:
+
+        * start_epochs - list of start times (seconds since epoch)
+        * window_lengths - list of window lengths (seconds)
+
+        Returns dictionary with an array of means (window length x start
+        time) for each station.
+        """
+        start_epochs = numpy.asarray(start_epochs, dtype=numpy.int64)
+        window_lengths = numpy.asarray(window_lengths, dtype=numpy.int64)
+        starts_2d = numpy.broadcast_to(start_epochs[numpy.newaxis, :],
+                                       (window_lengths.size, start_epochs.size))
+        ends_2d = starts_2d + window_lengths[:, numpy.newaxis]
+
+        window_means = {}
+        for station_id in self._series:
+            mean, _ = self.get_window_stats(station_id, starts_2d.ravel(), ends_2d.ravel())
+            window_means[station_id] = mean.reshape(starts_2d.shape)
+        return window_means
+
+    def precompute(self, start_epochs, window_lengths):
+        """
+        Calculate the mean for all combinations of window start and length
+        for all stations (see get_window_means), so get_mean only needs to
+        look up the value.
+        """
+        window_means = self.get_window_means(start_epochs, window_lengths)
+        for station_id, means in window_means.items():
+            station_means = self._window_means.setdefault(station_id, {})
+            for i, window_length in enumerate(window_lengths):
+                for j, start_epoch in enumerate(start_epochs):
+                    station_means[(int(start_epoch),
+                                   int(start_epoch) + int(window_length))] = means[i, j]
+
+    def get_mean(self, station_id, start_epoch, end_epoch):
+        """
+        Get mean of measurements for a station within a window (NaN if
+        there are no measurements).
+        """
+        try:
+            return self._window_means[station_id][(int(start_epoch), int(end_epoch))]
+        except KeyError:
+            pass
+        mean, _ = self.get_window_stats(station_id, numpy.array([start_epoch]),
+                                        numpy.array([end_epoch]))
+        return mean[0]
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Functions for running a time series of dates as a pipeline, where
+the inputs for the next dates (sensor extraction, dynamic layers and
+stack) are prepared in background workers while the model is trained
+and applied for the current date.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import collections
+from concurrent import futures
+
+def run_pipelined(dates_list, prepare_func, process_func,
+                  max_prefetch=1, num_workers=1,
+                  error_func=None, cleanup_func=None):
+    """
+    Run a list of dates as a pipeline.
+
+    Dates are always processed in order. While a date is being processed
+    up to 'max_prefetch' of the following dates are prepared by a pool
+    of 'num_workers' background threads. Limiting the number of dates
+    which are prepared ahead caps the scratch disk and memory used.
+
+    The preparation step is expected to be mostly I/O and calls to
+    external programs (e.g., gdalwarp) so threads are used.
+
+    Requires:
+
+    * dates_list - list of dates to process
+    * prepare_func - function to prepare inputs, called as
+      prepare_func(date). Must be safe to run in parallel with
+      itself and with process_func.
+    * process_func - function to process prepared inputs, called as
+      process_func(date, prepared) in the calling thread.
+    * max_prefetch - maximum number of dates to prepare ahead of the
+      date being processed. If 0 dates are prepared and processed in
+      turn, without background workers.
+    * num_workers - number of background workers used for preparation.
+    * error_func - function called as error_func(date, err) if
+      preparation fails. If not provided the exception is raised.
+    * cleanup_func - function called as cleanup_func(prepared) for
+      dates which were prepared but not processed (e.g., if an
+      exception is raised).
+
+    Returns a list of the values returned by process_func for each
+    date which was prepared successfully.
+
+    """
+    out_results = []
+
+    # Run serially
+    if max_prefetch < 1:
+        for date in dates_list:
+            try:
+                prepared = prepare_func(date)
+            except Exception as err:
+                if error_func is None:
+                    raise
+                error_func(date, err)
+                continue
+            out_results.append(process_func(date, prepared))
+        return out_results
+
+    pending = collections.deque()
+    dates_iter = iter(dates_list)
+
+    def _submit_next():
+        """ Submit next date for preparation, returns False if
+            there are no more dates. """
+        try:
+            date = next(dates_iter)
+        except StopIteration:
+            return False
+        pending.append((date, executor.submit(prepare_func, date)))
+        return True
+
+    executor = futures.ThreadPoolExecutor(max_workers=max(int(num_workers), 1))
+    try:
+        # Start preparing the first date and those to prefetch
+        for _ in range(max_prefetch + 1):
+            if not _submit_next():
+                break
+
+        while len(pending) > 0:
+            date, prepare_future = pending.popleft()
+            try:
+                prepared = prepare_future.result()
+            except Exception as err:
+                if error_func is None:
+                    raise
+                error_func(date, err)
+                _submit_next()
+                continue
+
+            # Keep the queue full while this date is processed
+            _submit_next()
+            out_results.append(process_func(date, prepared))
+    finally:
+        # Wait for any dates still being prepared and tidy up
+        for date, prepare_future in pending:
+            prepare_future.cancel()
+        for date, prepare_future in pending:
+            if prepare_future.cancelled():
+                continue
+            try:
+                prepared = prepare_future.result()
+            except Exception:
+                continue
+            if cleanup_func is not None:
+                cleanup_func(prepared)
+        executor.shutdown(wait=True)
+
+    return out_results
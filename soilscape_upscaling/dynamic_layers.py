@@ -16,10 +16,14 @@ import glob
 import os
 import subprocess
 
+from . import layer_providers
+from . import rolling_climate as rolling_climate_module
+from . import sar_pyramids as sar_pyramids_module
 from . import upscaling_common
+from . import warp_cache as warp_cache_module
 
 #: Minimum time difference between date and AirMOSS scene
-MIN_TIME_DIFF_AIRBORNE_SAR = 1e10
+MIN_TIME_DIFF_AIRBORNE_SAR = layer_providers.MIN_TIME_DIFF_AIRBORNE_SAR
 
 UPSCALING_PROJ = upscaling_common.UPSCALING_PROJ
 UPSCALING_RES = upscaling_common.UPSCALING_RES
@@ -37,7 +41,9 @@ def get_reprojected_dynamic_layer(layer_type, layer_dir, sm_date_ts, temp_dir,
                                   bounding_box=None,
                                   resample_method=None,
                                   out_res=UPSCALING_RES,
-                                  out_proj=UPSCALING_PROJ):
+                                  out_proj=UPSCALING_PROJ,
+                                  warp_cache=None, rolling_climate=None,
+                                  sar_pyramids=None, climate_cubes=None):
     """
     Gets dynamic layer then subsets and reprojects, optionally cropping to
     bounding box.
@@ -52,26 +58,70 @@ def get_reprojected_dynamic_layer(layer_type, layer_dir, sm_date_ts, temp_dir,
     * resample_method - method to use for resampling
     * out_res - output resolution of data
     * out_proj - output projection of data
+    * warp_cache - WarpTransformCache object to use instead of gdalwarp
+      (optional, requires bounding_box)
+    * rolling_climate - RollingClimate object to use for rolling layers
+      such as 'prism_ppt_api7' (optional, if not provided the accumulator
+      is made from the daily layers in the window for every date)
+    * sar_pyramids - SARPyramids object to use for AirMOSS and UAVSAR
+      layers (optional, if the grid or resampling method isn't compatible
+      the scene is used)
+    * climate_cubes - ClimateCubes object to read PRISM and ECMWF layers
+      from (optional, dates which haven't been ingested are read from
+      layer_dir)
 
     Returns:
 
     * Path to reprojected layer and date of dynamic layer (string)
 
     """
-    if resample_method is None:
-        # Get resampling method for layer type
-        if layer_type.startswith('airmoss') or layer_type.startswith('uavsar'):
-            resample_method = 'average'
-        elif layer_type.startswith('prism'):
-            resample_method = 'bilinear'
-        elif layer_type.startswith('ecmwf'):
-            resample_method = 'cubic'
+    # Layers derived from a window of daily layers
+    if rolling_climate_module.parse_rolling_layer(layer_type) is not None:
+        if rolling_climate is None:
+            rolling_climate = rolling_climate_module.RollingClimate()
+        return rolling_climate.get_layer(layer_type, layer_dir, sm_date_ts, temp_dir,
+                                         bounding_box, resample_method, out_res,
+                                         out_proj, warp_cache=warp_cache,
+                                         climate_cubes=climate_cubes)
+
+    resample_method = get_resample_method(layer_type, resample_method)
+
+    # Read from cube of archive on output grid if available
+    if climate_cubes is not None:
+        cube_layer = climate_cubes.get_layer(layer_type, layer_dir, sm_date_ts, temp_dir,
+                                             bounding_box, resample_method, out_res,
+                                             out_proj)
+        if cube_layer is not None:
+            return cube_layer
+
+    # Use layer on output grid from provider if it has a faster way
+    provider = layer_providers.get_provider(layer_type, layer_dir)
+    if provider is not None:
+        provider_layer = provider.get_reprojected_layer(sm_date_ts, temp_dir, bounding_box,
+                                                        resample_method, out_res, out_proj)
+        if provider_layer is not None:
+            return provider_layer
 
     # Get original file
     orig_layer, file_date = get_dynamic_layer(layer_type, layer_dir, sm_date_ts)
 
-    # Subset using GDAL
+    # Use scene ingested to the output grid, with overviews, if available
+    if sar_pyramids is not None and sar_pyramids_module.is_sar_layer(layer_type):
+        sar_product = sar_pyramids.get_layer(orig_layer, bounding_box, out_res, out_proj,
+                                             resample_method)
+        if sar_product is not None:
+            orig_layer = sar_product
+
     out_layer = os.path.join(temp_dir, '{}_subset.{}'.format(layer_type, GDAL_EXT))
+
+    # Use cached transform if available
+    if warp_cache is not None and bounding_box is not None and \
+            resample_method in warp_cache_module.SUPPORTED_METHODS:
+        warp_cache.warp(orig_layer, out_layer, bounding_box, resample_method,
+                        out_res=out_res, out_proj=out_proj)
+        return out_layer, file_date
+
+    # Subset using GDAL
     gdal_warp_cmd = ['gdalwarp',
                      '-r', resample_method,
                      '-of', GDAL_FORMAT]
@@ -86,9 +136,21 @@ def get_reprojected_dynamic_layer(layer_type, layer_dir, sm_date_ts, temp_dir,
 
     return out_layer, file_date
 
+def get_resample_method(layer_type, resample_method=None):
+    """
+    Get resampling method for layer type from the provider, if not
+    specified.
+    """
+    if resample_method is None:
+        provider_class = layer_providers.get_provider_class(layer_type)
+        if provider_class is not None:
+            resample_method = provider_class.resample_method
+    return resample_method
+
 def get_dynamic_layer(layer_type, layer_dir, sm_date_ts):
     """
-    Gets path to dynamic layer for a given date.
+    Gets path to dynamic layer for a given date, from the provider for
+    the layer type (see layer_providers).
 
     Requires:
 
@@ -101,42 +163,30 @@ def get_dynamic_layer(layer_type, layer_dir, sm_date_ts):
     * Path to layer and date of dynamic layer (string)
 
     """
-    # AirMOSS
-    if layer_type.startswith('airmoss'):
-        polarization = layer_type.split('_')[-1]
-        airmoss_files, file_date = get_closest_airmoss(sm_date_ts,
-                                                       layer_dir)
-        if airmoss_files is None:
-            raise Exception('Could not find dynamic layer "{}"'.format(layer_type))
-        else:
-            return airmoss_files[polarization.upper()], file_date
-    # UAVSAR
-    elif layer_type.startswith('uavsar'):
-        polarization = layer_type.split('_')[-1]
-        uavsar_files, file_date = get_closest_uavsar(sm_date_ts,
-                                                     layer_dir)
-        if uavsar_files is None:
-            raise Exception('Could not find dynamic layer "{}"'.format(layer_type))
-        else:
-            return uavsar_files[polarization.upper()], file_date
-    # PRISM
-    elif layer_type.startswith('prism'):
-        prism_var = layer_type.split('_')[-1]
-        prism_file = get_prism_data(sm_date_ts, layer_dir,
-                                    prism_var)
-        if prism_file is None:
-            raise Exception('Could not find dynamic layer "{}"'.format(layer_type))
-        else:
-            file_date = time.strftime('%Y%m%d', sm_date_ts)
-            return prism_file, file_date
-    # ECMWF
-    elif layer_type.startswith('ecmwf'):
-        ecmwf_file = get_ecmwf_data(sm_date_ts, layer_dir)
-        if ecmwf_file is None:
-            raise Exception('Could not find dynamic layer "{}"'.format(layer_type))
-        else:
-            file_date = time.strftime('%Y%m%d', sm_date_ts)
-            return ecmwf_file, file_date
+    # Rolling layers (e.g., 'prism_ppt_api7') - return daily layer for date
+    rolling_layer = rolling_climate_module.parse_rolling_layer(layer_type)
+    if rolling_layer is not None:
+        return get_dynamic_layer(rolling_layer[0], layer_dir, sm_date_ts)
+    provider = layer_providers.get_provider(layer_type, layer_dir)
+    if provider is None:
+        return None
+    return provider.get_layer(sm_date_ts)
+
+def prefetch_dynamic_layers(data_layers_list, dates_ts):
+    """
+    Let the provider of each dynamic layer prepare layers for the dates
+    which will be run.
+    """
+    for data_layer in data_layers_list:
+        if data_layer.layer_type != 'dynamic':
+            continue
+        layer_type = data_layer.layer_name
+        rolling_layer = rolling_climate_module.parse_rolling_layer(layer_type)
+        if rolling_layer is not None:
+            layer_type = rolling_layer[0]
+        provider = layer_providers.get_provider(layer_type, data_layer.layer_dir)
+        if provider is not None:
+            provider.prefetch(dates_ts)
 
 def get_closest_airmoss(sm_date_ts, airmoss_dir,
                         min_time_diff=MIN_TIME_DIFF_AIRBORNE_SAR):
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Run a matrix of experiments (configs and split seeds) for a site,
+running stages which are the same for more than one experiment once.
+
+Configs for a site are usually only different in a few settings (e.g.,
+the number of training nodes, the model or whether SAR layers are used)
+so most stages are the same. A graph of the stages for each experiment
+is made from the configs:
+
+* sensors - sensor data source and dates
+* stacks - layers, grid and dates
+* features - pixel values for a stack and sensor data
+* model - training and applying the model (one for each experiment)
+
+The first experiment using each unique set of features 'builds' the
+stages it needs which haven't been built by an earlier experiment.
+Experiments only wait for the builders of the stages they use, so
+builders with no stages in common run at the same time. All experiments
+share a stage cache (see stage_cache) so once the builders are finished
+the remaining experiments only train and apply the model.
+
+For example, to run all Tonzi configs::
+
+   cd sites/soilscape_tonzi
+   python -m soilscape_upscaling.experiment_matrix \\
+          --script soilscape_upscaling_tonzi.py --configs configs/*.cfg \\
+          --stage_cache stage_cache --workers 4
+
+or for TxSON (where the output folder is the first argument)::
+
+   cd sites/txson
+   python -m soilscape_upscaling.experiment_matrix \\
+          --script soilscape_upscaling_txson.py --configs configs/*.cfg \\
+          --seeds 1 2 3 4 5 6 7 8 9 10 \\
+          --args "run_{seed} {config} --split_seed {seed}" \\
+          --stage_cache stage_cache --workers 4
+
+Use '--dry_run' to print the stage graph without running.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import argparse
+import configparser
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent import futures
+
+from . import stage_cache
+from . import upscaling_common
+
+#: Keys in the [default] section of a config which define the dates run
+DATE_CONFIG_KEYS = ['starttime', 'endtime', 'predict_spacing_days']
+
+#: Stages shared between experiments, in the order they are run
+SHARED_STAGES = ['sensors', 'stacks', 'features']
+
+def _get_hash(key_items):
+    key_json = json.dumps(key_items, sort_keys=True)
+    return hashlib.md5(key_json.encode()).hexdigest()[:16]
+
+def get_config_layers(config):
+    """
+    Get list of DataLayer objects (including the mask) used by a config,
+    as the site scripts.
+    """
+    data_layers_list = []
+    for section in config.sections():
+        if section.startswith('layer'):
+            data_layer = upscaling_common.DataLayer(config[section])
+            if data_layer.use_layer:
+                data_layers_list.append(data_layer)
+    data_layers_list.append(upscaling_common.DataLayer(config['mask']))
+    return data_layers_list
+
+def get_experiment_stages(config_file, seed=None):
+    """
+    Get the key of each stage for an experiment (config and seed).
+
+    The seed is only used to identify the sensor data if the config
+    randomly splits sites into training and validation ('num_train_sites').
+
+    Returns dictionary with a key for each stage in SHARED_STAGES.
+    """
+    config = configparser.ConfigParser()
+    if len(config.read(config_file)) == 0:
+        raise IOError('Could not read config file {}'.format(config_file))
+
+    dates = [config['default'].get(date_key) for date_key in DATE_CONFIG_KEYS]
+
+    if 'num_train_sites' in config['default']:
+        sensor_source = stage_cache.get_sensor_source(config['default'], split_seed=seed)
+    else:
+        sensor_source = stage_cache.get_sensor_source(config['default'])
+
+    bounding_box = config['default'].get('bounding_box')
+    if bounding_box is not None:
+        bounding_box = bounding_box.replace(',', ' ').split()
+    out_res = config['default'].get('upscaling_res', upscaling_common.UPSCALING_RES)
+    layers_key = stage_cache.get_layers_key(get_config_layers(config),
+                                            bounding_box=bounding_box,
+                                            out_res=out_res,
+                                            out_proj=upscaling_common.UPSCALING_PROJ)
+
+    sensors_key = _get_hash(['sensors', sensor_source, dates])
+    stacks_key = _get_hash(['stacks', layers_key, dates])
+    features_key = _get_hash(['features', sensors_key, stacks_key])
+
+    return {'sensors' : sensors_key,
+            'stacks' : stacks_key,
+            'features' : features_key}
+
+def make_stage_graph(config_files, seeds=None):
+    """
+    Make graph of stages for a matrix of configs and seeds.
+
+    Each experiment is a builder for the stages it is the first to use.
+    Experiments depend on the builders of the other stages they use.
+
+    Returns list of experiments, each a dictionary with the 'config',
+    'seed', key of each stage, the 'builds' (stages built) and
+    'depends' (index of experiments which must be run first).
+    """
+    if seeds is None:
+        seeds = [None]
+
+    experiments = []
+    stage_builders = {}
+    for config_file in config_files:
+        for seed in seeds:
+            experiment = {'config' : config_file,
+                          'seed' : seed,
+                          'builds' : [],
+                          'depends' : set()}
+            experiment.update(get_experiment_stages(config_file, seed))
+            for stage in SHARED_STAGES:
+                stage_key = (stage, experiment[stage])
+                if stage_key in stage_builders:
+                    experiment['depends'].add(stage_builders[stage_key])
+                else:
+                    stage_builders[stage_key] = len(experiments)
+                    experiment['builds'].append(stage)
+            experiments.append(experiment)
+
+    return experiments
+
+def print_stage_graph(experiments):
+    """
+    Print summary of a stage graph.
+    """
+    num_experiments = len(experiments)
+    print('Experiments: {}'.format(num_experiments))
+    for stage in SHARED_STAGES:
+        num_unique = len(set([experiment[stage] for experiment in experiments]))
+        print('  {:<10} {} unique ({} saved)'.format(stage, num_unique,
+                                                     num_experiments - num_unique))
+    print('  {:<10} {}'.format('model', num_experiments))
+    for i, experiment in enumerate(experiments):
+        print('[{}] {} seed={}: builds {}; after {}'.format(i, experiment['config'],
+                                                           experiment['seed'],
+                                                           ', '.join(experiment['builds']) or 'model only',
+                                                           ', '.join([str(d) for d in sorted(experiment['depends'])])
+                                                           or 'none'))
+
+def run_matrix(script, config_files, stage_cache_dir, seeds=None,
+               args_template='{config}', num_workers=1, log_dir=None,
+               debug=False):
+    """
+    Run a matrix of experiments for a site, sharing stages.
+
+    Requires:
+
+    * script - site script to run
+    * config_files - list of config files
+    * stage_cache_dir - directory for stage cache (passed to the script
+      using '--stage_cache')
+    * seeds - list of split seeds (None to run each config once)
+    * args_template - arguments to pass to the script, '{config}' and
+      '{seed}' are replaced with the config file and seed
+    * num_workers - number of experiments to run at the same time
+    * log_dir - directory to write log for each experiment to (default
+      is 'logs' in the stage cache directory)
+    * debug - pass '--debug' to the script
+
+    Returns list of experiments with the return code and time taken for each.
+    """
+    experiments = make_stage_graph(config_files, seeds)
+    print_stage_graph(experiments)
+
+    if log_dir is None:
+        log_dir = os.path.join(stage_cache_dir, 'logs')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    def get_command(i):
+        experiment = experiments[i]
+        command = [sys.executable, script]
+        command.extend(args_template.format(config=experiment['config'],
+                                            seed=experiment['seed']).split())
+        command.extend(['--stage_cache', stage_cache_dir])
+        if debug:
+            command.append('--debug')
+        return command
+
+    def run_experiment(i, command):
+        log_file = os.path.join(log_dir, 'experiment_{:03d}.log'.format(i))
+        start_time = time.time()
+        with open(log_file, 'w') as log_f:
+            return_code = subprocess.call(command, stdout=log_f,
+                                          stderr=subprocess.STDOUT)
+        return return_code, time.time() - start_time, log_file
+
+    remaining = set(range(len(experiments)))
+    finished = set()
+    running = {}
+    with futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
+        while len(remaining) > 0 or len(running) > 0:
+            # Start experiments where all the builders have finished
+            for i in sorted(remaining):
+                if experiments[i]['depends'].issubset(finished):
+                    command = get_command(i)
+                    print('[{}] Running: {}'.format(i, ' '.join(command)))
+                    running[executor.submit(run_experiment, i, command)] = i
+                    remaining.remove(i)
+            done_futures = futures.wait(list(running.keys()),
+                                        return_when=futures.FIRST_COMPLETED)[0]
+            for done_future in done_futures:
+                i = running.pop(done_future)
+                return_code, run_seconds, log_file = done_future.result()
+                experiments[i]['returnCode'] = return_code
+                experiments[i]['seconds'] = run_seconds
+                if return_code != 0:
+                    print('[{}] Failed (see {})'.format(i, log_file))
+                else:
+                    print('[{}] Finished in {:.1f} s'.format(i, run_seconds))
+                # Experiments which depend on a failed builder are still
+                # run, they will build the stage themselves.
+                finished.add(i)
+
+    summary = stage_cache.StageCache(stage_cache_dir).get_summary()
+    print('Stage cache: ' + ', '.join(['{} {} ({:.1f} MB)'.format(stage, summary[stage]['items'],
+                                                                   summary[stage]['sizeMB'])
+                                       for stage in SHARED_STAGES]))
+    return experiments
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a matrix of experiments for a '
+                                                 'site, running shared stages once')
+    parser.add_argument("--script", required=True, help="Site script to run")
+    parser.add_argument("--configs", nargs='+', required=True, help="Config files")
+    parser.add_argument("--seeds", nargs='+', type=int, default=None,
+                        help="Split seeds")
+    parser.add_argument("--args", default='{config}',
+                        help="Arguments for script ({config} and {seed} are replaced)")
+    parser.add_argument("--stage_cache", required=True,
+                        help="Directory for stage cache")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of experiments to run at the same time")
+    parser.add_argument("--log_dir", default=None, help="Directory for logs")
+    parser.add_argument("--debug", action='store_true', default=False,
+                        help="Run site script in debug mode")
+    parser.add_argument("--dry_run", action='store_true', default=False,
+                        help="Print stage graph and exit")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        print_stage_graph(make_stage_graph(args.configs, args.seeds))
+    else:
+        matrix_experiments = run_matrix(args.script, args.configs, args.stage_cache,
+                                        seeds=args.seeds, args_template=args.args,
+                                        num_workers=args.workers, log_dir=args.log_dir,
+                                        debug=args.debug)
+        num_failed = len([e for e in matrix_experiments if e['returnCode'] != 0])
+        if num_failed > 0:
+            print('{} experiments failed'.format(num_failed))
+            sys.exit(1)
@@ -15,6 +15,8 @@ import csv
 import subprocess
 import sys
 
+from .upscaling_common import UPSCALING_RES, UPSCALING_PROJ
+
 def extract_stats_for_point(input_stack, point_lat, point_lon):
     """
     Extracts statistics from an image for a point.
@@ -49,7 +51,11 @@ def extract_stats_for_point(input_stack, point_lat, point_lon):
     return extracted_vals_float
 
 def extract_layer_stats_csv(input_sensor_locations, output_stats_file,
-                            data_layers_list, data_stack):
+                            data_layers_list, data_stack,
+                            feature_store=None, sm_date_ts=None, depth=None,
+                            station_index=None, stage_cache=None,
+                            bounding_box=None, out_res=UPSCALING_RES,
+                            out_proj=UPSCALING_PROJ):
 
     """
     Extract statistics for sensor locations
@@ -64,6 +70,50 @@ def extract_layer_stats_csv(input_sensor_locations, output_stats_file,
     Output CSV will contain the same columns + one column for the extracted values
     from each band.
 
+    If a FeatureStore object is passed in as 'feature_store' the extracted
+    values are also appended to the store for the date 'sm_date_ts'
+    and sensor depth 'depth'. Values are stored for the grid given by
+    'bounding_box', 'out_res' and 'out_proj' (the grid of the whole
+    area if the stack is for a tile).
+
+    If a StationIndex object is passed in as 'station_index' values are
+    read directly from the stack using the pixel for each sensor stored
+    in the index, rather than using 'gdallocationinfo' for each sensor.
+
+    If a StageCache object is passed in as 'stage_cache' and the stack
+    is in the cache, values extracted previously for the same sensor
+    data are used if available.
+
+    """
+    features_key = None
+    if stage_cache is not None:
+        stack_key = stage_cache.get_stack_key_for_file(data_stack)
+        if stack_key is not None:
+            features_key = stage_cache.get_features_key(stack_key, input_sensor_locations,
+                                                        data_layers_list)
+    if features_key is not None and stage_cache.get_features(features_key,
+                                                             output_stats_file):
+        print('Using pixel values from stage cache')
+    else:
+        _extract_layer_stats(input_sensor_locations, output_stats_file,
+                             data_layers_list, data_stack, station_index)
+        if features_key is not None:
+            stage_cache.put_features(features_key, output_stats_file)
+
+    if feature_store is not None:
+        if sm_date_ts is None:
+            raise ValueError('A date is required to add values to the feature store')
+        layer_set_hash = feature_store.register_layer_set(data_layers_list,
+                                                          bounding_box, out_res,
+                                                          out_proj)
+        feature_store.append_stats_csv(layer_set_hash, sm_date_ts,
+                                       output_stats_file, depth=depth)
+
+def _extract_layer_stats(input_sensor_locations, output_stats_file,
+                         data_layers_list, data_stack, station_index=None):
+    """
+    Extract values from each band for sensor locations to a CSV (see
+    extract_layer_stats_csv).
     """
 
     # Get list of band names
@@ -81,11 +131,24 @@ def extract_layer_stats_csv(input_sensor_locations, output_stats_file,
     out_header.extend(band_names)
     out_file_csv.writerow(out_header)
 
-    for line in in_file_csv:
+    in_lines = list(in_file_csv)
+
+    if station_index is not None:
+        all_out_stats = station_index.extract_values(data_stack,
+                                                     [line[0] for line in in_lines],
+                                                     [line[1] for line in in_lines],
+                                                     [line[2] for line in in_lines])
+    else:
+        all_out_stats = None
+
+    for i, line in enumerate(in_lines):
         lattitude = line[1]
         longitude = line[2]
 
-        out_stats = extract_stats_for_point(data_stack, lattitude, longitude)
+        if all_out_stats is not None:
+            out_stats = all_out_stats[i]
+        else:
+            out_stats = extract_stats_for_point(data_stack, lattitude, longitude)
 
         if out_stats is not None:
             outline = line
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Persistent store of training features (the values extracted from each
+layer for each station) so they can be re-used across dates, configs
+and runs without rebuilding stacks.
+
+The store is append-only and columnar. It is partitioned by layer set
+(the layers and the grid they were extracted on) and date using the
+following directory structure::
+
+   store_dir/layers=<layer_set_hash>/layer_set.json
+   store_dir/layers=<layer_set_hash>/date=<YYYYMMDD>/part-<id>.npz
+
+Each part is a NumPy '.npz' file containing one array per column.
+There is one row for each date, station and depth. If a row is written
+more than once the most recently written row is used.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import glob
+import hashlib
+import json
+import os
+import time
+import uuid
+
+import numpy
+import pandas
+
+#: Columns stored for each row, in addition to one column per layer
+KEY_COLUMNS = ['date', 'station_id', 'depth']
+SENSOR_COLUMNS = ['latitude', 'longitude', 'target']
+
+def get_grid(bounding_box=None, out_res=None, out_proj=None):
+    """
+    Get the grid (bounding box, resolution and projection) features are
+    extracted on, in a form which can be written to JSON.
+    """
+    if bounding_box is not None:
+        bounding_box = [float(str(val).strip(',')) for val in bounding_box]
+    if out_res is not None:
+        out_res = float(out_res)
+    if out_proj is not None:
+        out_proj = ' '.join(str(out_proj).split())
+    return {'boundingBox' : bounding_box,
+            'res' : out_res,
+            'proj' : out_proj}
+
+def get_layer_set_hash(data_layers_list, bounding_box=None, out_res=None,
+                       out_proj=None):
+    """
+    Get a hash identifying a set of layers on a grid.
+
+    Uses the name, type, path (static layers), directory (dynamic layers)
+    or source and settings (focal and terrain layers) and no data value of
+    each layer, in order, and the bounding box, resolution and projection
+    of the grid, so features extracted on different grids are kept apart.
+    """
+    layer_set = []
+    for layer in data_layers_list:
+        if layer.layer_type == 'dynamic':
+            layer_source = layer.layer_dir
+        elif layer.layer_type == 'focal':
+            layer_source = [layer.layer_source, layer.layer_path,
+                            layer.focal_statistic, layer.focal_radius]
+        elif layer.layer_type == 'terrain':
+            layer_source = [layer.layer_source, layer.layer_path,
+                            layer.terrain_derivative, layer.terrain_margin]
+        else:
+            layer_source = layer.layer_path
+        layer_set.append([layer.layer_name, layer.layer_type,
+                          layer_source, layer.layer_nodata])
+
+    layer_set_json = json.dumps([layer_set, get_grid(bounding_box, out_res, out_proj)])
+    return hashlib.md5(layer_set_json.encode()).hexdigest()[:16]
+
+def _date_to_str(sm_date):
+    """
+    Convert date (Python time structure or string) to the
+    form YYYYMMDD.
+    """
+    if isinstance(sm_date, time.struct_time):
+        return time.strftime('%Y%m%d', sm_date)
+    return str(sm_date).replace('-', '')[:8]
+
+class FeatureStore(object):
+    """
+    Append-only store of training features.
+
+    Requires:
+
+    * store_dir - directory for the store (created if it doesn't exist)
+
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        if not os.path.isdir(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def _get_layer_set_dir(self, layer_set_hash):
+        return os.path.join(self.store_dir, 'layers={}'.format(layer_set_hash))
+
+    def _get_date_dir(self, layer_set_hash, sm_date):
+        return os.path.join(self._get_layer_set_dir(layer_set_hash),
+                            'date={}'.format(_date_to_str(sm_date)))
+
+    def register_layer_set(self, data_layers_list, bounding_box=None,
+                           out_res=None, out_proj=None):
+        """
+        Record the layers in a layer set and the grid they are extracted on.
+
+        Returns the hash of the layer set.
+        """
+        layer_set_hash = get_layer_set_hash(data_layers_list, bounding_box,
+                                            out_res, out_proj)
+        layer_set_dir = self._get_layer_set_dir(layer_set_hash)
+        layer_set_file = os.path.join(layer_set_dir, 'layer_set.json')
+
+        if not os.path.isfile(layer_set_file):
+            if not os.path.isdir(layer_set_dir):
+                os.makedirs(layer_set_dir, exist_ok=True)
+            layer_set_info = {'layer_names' : [layer.layer_name for layer
+                                               in data_layers_list],
+                              'grid' : get_grid(bounding_box, out_res, out_proj)}
+            temp_file = '{}.{}.tmp'.format(layer_set_file, uuid.uuid4().hex)
+            with open(temp_file, 'w') as out_f:
+                json.dump(layer_set_info, out_f)
+            os.replace(temp_file, layer_set_file)
+
+        return layer_set_hash
+
+    def get_layer_names(self, layer_set_hash):
+        """
+        Get the names of layers within a layer set.
+        """
+        layer_set_file = os.path.join(self._get_layer_set_dir(layer_set_hash),
+                                      'layer_set.json')
+        with open(layer_set_file, 'r') as in_f:
+            return json.load(in_f)['layer_names']
+
+    def list_layer_sets(self):
+        """
+        Get a list of layer set hashes within the store.
+        """
+        layer_set_dirs = glob.glob(os.path.join(self.store_dir, 'layers=*'))
+        return sorted([os.path.basename(d).split('=', 1)[1] for d in layer_set_dirs])
+
+    def list_dates(self, layer_set_hash):
+        """
+        Get a list of dates (YYYYMMDD) with features for a layer set.
+        """
+        date_dirs = glob.glob(os.path.join(self._get_layer_set_dir(layer_set_hash),
+                                           'date=*'))
+        return sorted([os.path.basename(d).split('=', 1)[1] for d in date_dirs
+                       if len(glob.glob(os.path.join(d, 'part-*.npz'))) > 0])
+
+    def append(self, layer_set_hash, sm_date, features_df):
+        """
+        Append features for a date.
+
+        Requires:
+
+        * layer_set_hash - hash of layer set (from register_layer_set)
+        * sm_date - date (Python time structure or YYYYMMDD string)
+        * features_df - pandas data frame with 'station_id', 'depth',
+          'latitude', 'longitude', 'target' columns and a column for
+          each layer.
+
+        Returns path to part written or None if there were no rows.
+        """
+        if features_df.shape[0] == 0:
+            return None
+
+        date_dir = self._get_date_dir(layer_set_hash, sm_date)
+        if not os.path.isdir(date_dir):
+            os.makedirs(date_dir, exist_ok=True)
+
+        columns = {}
+        columns['date'] = numpy.array([_date_to_str(sm_date)] * features_df.shape[0])
+        # Store as fixed width strings so parts can be read without pickle
+        columns['station_id'] = numpy.array(features_df['station_id'].astype(str).tolist(),
+                                            dtype=str)
+        columns['depth'] = features_df['depth'].astype(numpy.int32).values
+        for column in features_df.columns:
+            if column not in columns:
+                columns[column] = features_df[column].astype(numpy.float64).values
+
+        # Name parts so they sort in the order they were written
+        part_name = 'part-{:.6f}-{}.npz'.format(time.time(), uuid.uuid4().hex)
+        out_part = os.path.join(date_dir, part_name)
+
+        # Write to a temporary file then rename so readers never see
+        # a partially written part
+        temp_part = os.path.join(date_dir, '.{}.tmp.npz'.format(uuid.uuid4().hex))
+        numpy.savez(temp_part, **columns)
+        os.replace(temp_part, out_part)
+
+        return out_part
+
+    def append_stats_csv(self, layer_set_hash, sm_date, in_stats_csv, depth=None):
+        """
+        Append features from a CSV created by extract_layer_stats_csv.
+
+        The CSV is assumed to have the station ID, latitude, longitude and
+        soil moisture as the first four columns followed by one column for
+        each layer.
+        """
+        stats_df = pandas.read_csv(in_stats_csv)
+        features_df = stats_df.iloc[:, 4:].copy()
+        features_df.insert(0, 'station_id', stats_df.iloc[:, 0].astype(str))
+        features_df.insert(1, 'depth', 0 if depth is None else int(depth))
+        features_df.insert(2, 'latitude', stats_df.iloc[:, 1])
+        features_df.insert(3, 'longitude', stats_df.iloc[:, 2])
+        features_df.insert(4, 'target', stats_df.iloc[:, 3])
+
+        return self.append(layer_set_hash, sm_date, features_df)
+
+    def read(self, layer_set_hash, dates_list=None, start_date=None,
+             end_date=None, columns=None):
+        """
+        Read features for a layer set.
+
+        Requires:
+
+        * layer_set_hash - hash of layer set
+        * dates_list - list of dates to read (optional)
+        * start_date - first date to read (optional, inclusive)
+        * end_date - last date to read (optional, inclusive)
+        * columns - list of columns to read (optional, default is all)
+
+        Returns a pandas data frame with one row for each date, station
+        and depth.
+        """
+        all_dates = self.list_dates(layer_set_hash)
+        if dates_list is not None:
+            dates_set = set([_date_to_str(d) for d in dates_list])
+            all_dates = [d for d in all_dates if d in dates_set]
+        if start_date is not None:
+            all_dates = [d for d in all_dates if d >= _date_to_str(start_date)]
+        if end_date is not None:
+            all_dates = [d for d in all_dates if d <= _date_to_str(end_date)]
+
+        if columns is not None:
+            columns = KEY_COLUMNS + [c for c in columns if c not in KEY_COLUMNS]
+
+        parts_df = []
+        for date_str in all_dates:
+            part_files = sorted(glob.glob(os.path.join(self._get_date_dir(layer_set_hash,
+                                                                          date_str),
+                                                       'part-*.npz')))
+            for part_file in part_files:
+                with numpy.load(part_file, allow_pickle=False) as part:
+                    read_columns = part.files if columns is None else columns
+                    parts_df.append(pandas.DataFrame({c : part[c] for c in read_columns}))
+
+        if len(parts_df) == 0:
+            if columns is None:
+                columns = KEY_COLUMNS + SENSOR_COLUMNS
+            return pandas.DataFrame(columns=columns)
+
+        features_df = pandas.concat(parts_df, ignore_index=True)
+        # Keep the most recent row for each date, station and depth
+        features_df = features_df.drop_duplicates(subset=KEY_COLUMNS, keep='last')
+
+        return features_df.reset_index(drop=True)
+
+    def write_training_csv(self, layer_set_hash, out_train_csv, **kwargs):
+        """
+        Write features to a CSV in the same format as created by
+        extract_layer_stats_csv, so it can be passed to run_random_forests.
+
+        Takes the same keyword arguments as 'read'.
+        """
+        features_df = self.read(layer_set_hash, **kwargs)
+        layer_names = self.get_layer_names(layer_set_hash)
+
+        out_df = features_df[['station_id', 'latitude', 'longitude', 'target']
+                             + layer_names]
+        out_df = out_df.rename(columns={'target' : 'sensorData'})
+        out_df.to_csv(out_train_csv, index=False)
+
+        return out_df.shape[0]
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Layers of the mean or standard deviation of another layer within a
+neighbourhood (focal statistics), to provide context at scales larger
+than a pixel (e.g., mean elevation within 1 km).
+
+Focal layers are specified in the config like other layers, using
+type 'focal', the name of the layer to use ('source'), the statistic
+('mean' or 'std') and the radius in metres::
+
+   [layer_elevation_mean_1km]
+   name = elevation_mean_1km
+   type = focal
+   source = elevation
+   statistic = mean
+   radius = 1000
+
+A 'path' can be given instead of 'source' to use a raster which isn't
+one of the layers. The source can't be a dynamic layer, as dynamic
+layers are only available for the grid (so the window would be cut at
+the edge) and the statistics would be stored for every date.
+
+The neighbourhood is a square window of (2 x radius / resolution) + 1
+pixels on the output grid. Statistics are calculated using summed-area
+tables of the values, squared values and number of valid pixels, so the
+time taken doesn't depend on the radius. The source is warped to the
+grid extended by the radius so pixels at the edge of the grid (or a
+tile) use the full window. No data pixels are excluded, pixels without
+any valid pixels in the window are set to FOCAL_NODATA.
+
+The mean and standard deviation are calculated together and stored
+for each source (path and no data value), radius and grid, so are only
+calculated once.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import hashlib
+import json
+import os
+import subprocess
+import threading
+
+import numpy
+from osgeo import gdal
+
+from . import feature_store
+from . import upscaling_common
+from . import warp_cache as warp_cache_module
+
+#: Statistics which can be calculated
+FOCAL_STATISTICS = ['mean', 'std']
+
+#: No data value for focal layers
+FOCAL_NODATA = upscaling_common.FOCAL_NODATA
+
+GDAL_FORMAT = upscaling_common.UPSCALING_GDAL_FORMAT
+
+if GDAL_FORMAT == "ENVI":
+    GDAL_EXT = "bsq"
+elif GDAL_FORMAT == "GTiff":
+    GDAL_EXT = "tif"
+else:
+    GDAL_EXT = GDAL_FORMAT.lower()
+
+def get_window_half_width(radius, out_res=upscaling_common.UPSCALING_RES):
+    """
+    Get the number of pixels either side of the centre pixel of the
+    window for a radius (in metres).
+    """
+    half_width = int(round(float(radius) / float(out_res)))
+    if half_width < 1:
+        raise ValueError('Radius of {} m is less than a pixel at {} m '
+                         'resolution'.format(radius, out_res))
+    return half_width
+
+def box_sum(in_array, half_width):
+    """
+    Sum of values within a square window around each pixel, using a
+    summed-area table. The window is cropped at the edge of the array.
+    """
+    num_rows, num_cols = in_array.shape
+    sat = numpy.zeros((num_rows + 1, num_cols + 1), dtype=numpy.float64)
+    numpy.cumsum(in_array, axis=0, dtype=numpy.float64, out=sat[1:, 1:])
+    numpy.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+
+    row_start = numpy.clip(numpy.arange(num_rows) - half_width, 0, num_rows)
+    row_end = numpy.clip(numpy.arange(num_rows) + half_width + 1, 0, num_rows)
+    col_start = numpy.clip(numpy.arange(num_cols) - half_width, 0, num_cols)
+    col_end = numpy.clip(numpy.arange(num_cols) + half_width + 1, 0, num_cols)
+
+    return (sat[numpy.ix_(row_end, col_end)] - sat[numpy.ix_(row_start, col_end)]
+            - sat[numpy.ix_(row_end, col_start)] + sat[numpy.ix_(row_start, col_start)])
+
+def focal_statistics(in_array, half_width, nodata=None):
+    """
+    Calculate the mean and standard deviation within a square window
+    around each pixel, excluding NaN and no data pixels.
+
+    Requires:
+
+    * in_array - 2D array
+    * half_width - number of pixels either side of centre pixel
+    * nodata - no data value (optional)
+
+    Returns arrays of mean and standard deviation (Float32) and the
+    number of valid pixels in each window.
+    """
+    valid = numpy.isfinite(in_array)
+    if nodata is not None:
+        valid &= in_array != nodata
+
+    # Subtract the mean so the sum of squares doesn't lose precision
+    if valid.any():
+        offset = float(in_array[valid].mean())
+    else:
+        offset = 0.0
+    values = numpy.where(valid, in_array - offset, 0).astype(numpy.float64)
+
+    count = box_sum(valid, half_width)
+    values_sum = box_sum(values, half_width)
+    values *= values
+    squares_sum = box_sum(values, half_width)
+
+    has_data = count > 0
+    count[~has_data] = 1
+    mean = values_sum / count
+    variance = numpy.maximum(squares_sum / count - mean * mean, 0)
+
+    out_mean = (mean + offset).astype(numpy.float32)
+    out_std = numpy.sqrt(variance).astype(numpy.float32)
+    out_mean[~has_data] = numpy.nan
+    out_std[~has_data] = numpy.nan
+    count[~has_data] = 0
+    return out_mean, out_std, count
+
+def _write_layer(out_layer, out_array, geotransform, projection):
+    driver = gdal.GetDriverByName(GDAL_FORMAT)
+    out_dataset = driver.Create(out_layer, out_array.shape[1], out_array.shape[0],
+                                1, gdal.GDT_Float32)
+    out_dataset.SetGeoTransform(geotransform)
+    out_dataset.SetProjection(projection)
+    out_band = out_dataset.GetRasterBand(1)
+    out_band.SetNoDataValue(FOCAL_NODATA)
+    out_band.WriteArray(numpy.where(numpy.isnan(out_array), FOCAL_NODATA, out_array))
+    out_dataset = None
+
+class FocalLayers(object):
+    """
+    Focal statistics for layers, stored for each source, radius and grid.
+
+    Safe to use from multiple threads.
+
+    Requires:
+
+    * focal_dir - directory to save layers to
+
+    """
+    def __init__(self, focal_dir):
+        self.focal_dir = focal_dir
+        if not os.path.isdir(self.focal_dir):
+            os.makedirs(self.focal_dir)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'focal_dir' : self.focal_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_layer_key(self, source_path, radius, bounding_box=None,
+                      out_res=upscaling_common.UPSCALING_RES,
+                      out_proj=upscaling_common.UPSCALING_PROJ, source_nodata=None):
+        """
+        Get key for the focal statistics of a source for a radius and grid,
+        from the path and no data value of the source (as in the config)
+        and the grid (see feature_store.get_grid). The size and
+        modification time of the source are included so statistics are
+        calculated again if it changes.
+        """
+        source_stat = os.stat(source_path)
+        key_json = json.dumps([[os.path.abspath(source_path), source_nodata],
+                               [source_stat.st_size, int(source_stat.st_mtime)],
+                               float(radius),
+                               feature_store.get_grid(bounding_box, out_res, out_proj)])
+        return hashlib.md5(key_json.encode()).hexdigest()[:16]
+
+    def get_layer_paths(self, layer_key):
+        """
+        Get paths of mean and standard deviation layers for a key.
+        """
+        return dict([(statistic, os.path.join(self.focal_dir,
+                                              'focal_{}_{}.{}'.format(layer_key, statistic,
+                                                                      GDAL_EXT)))
+                     for statistic in FOCAL_STATISTICS])
+
+    def compute(self, source_path, radius, bounding_box=None,
+                out_res=upscaling_common.UPSCALING_RES,
+                out_proj=upscaling_common.UPSCALING_PROJ, source_nodata=None,
+                overwrite=False):
+        """
+        Calculate the focal mean and standard deviation of a layer on a grid,
+        if they haven't already been calculated.
+
+        Requires:
+
+        * source_path - path to source layer
+        * radius - radius of window in metres
+        * bounding_box - bounding box of grid (if not provided the extent
+          of the source is used)
+        * out_res - output resolution
+        * out_proj - output projection
+        * source_nodata - no data value of source (if not set in file)
+
+        Returns dictionary with path to layer for each statistic.
+        """
+        half_width = get_window_half_width(radius, out_res)
+        layer_key = self.get_layer_key(source_path, radius, bounding_box,
+                                       out_res, out_proj, source_nodata)
+        out_layers = self.get_layer_paths(layer_key)
+
+        with self._lock:
+            if not overwrite and all([os.path.isfile(out_layer)
+                                      for out_layer in out_layers.values()]):
+                return out_layers
+
+            print('Calculating focal statistics within {} m for {}'.format(radius,
+                                                                          source_path))
+            # Warp source to grid extended by the window
+            temp_source = os.path.join(self.focal_dir,
+                                       'temp_focal_{}_{}_source.{}'.format(layer_key,
+                                                                           os.getpid(),
+                                                                           GDAL_EXT))
+            gdalwarp_cmd = ['gdalwarp', '-overwrite', '-q',
+                            '-r', 'average',
+                            '-ot', 'Float32',
+                            '-of', GDAL_FORMAT]
+            if bounding_box is not None:
+                min_x, min_y, max_x, max_y = [float(str(v).strip(',')) for v in bounding_box]
+                pad = half_width * float(out_res)
+                gdalwarp_cmd.extend(['-te'])
+                gdalwarp_cmd.extend(['{:.6f}'.format(v) for v in [min_x - pad, min_y - pad,
+                                                                 max_x + pad, max_y + pad]])
+            if source_nodata is not None:
+                gdalwarp_cmd.extend(['-srcnodata', str(source_nodata)])
+            gdalwarp_cmd.extend(['-dstnodata', 'nan',
+                                 '-t_srs', out_proj,
+                                 '-tr', str(out_res), str(out_res),
+                                 source_path, temp_source])
+            temp_layers = dict([(statistic, '{}.{}.tmp.{}'.format(os.path.splitext(out_layer)[0],
+                                                                  os.getpid(), GDAL_EXT))
+                                for statistic, out_layer in out_layers.items()])
+            try:
+                subprocess.check_call(gdalwarp_cmd)
+
+                source_grid = warp_cache_module.get_raster_grid(temp_source)
+                dataset = gdal.Open(temp_source, gdal.GA_ReadOnly)
+                source_array = dataset.GetRasterBand(1).ReadAsArray()
+                dataset = None
+
+                focal_mean, focal_std, _ = focal_statistics(source_array, half_width)
+
+                geotransform = list(source_grid['geotransform'])
+                if bounding_box is not None:
+                    # Remove padding
+                    window = (slice(half_width, -half_width), slice(half_width, -half_width))
+                    focal_mean = focal_mean[window]
+                    focal_std = focal_std[window]
+                    geotransform[0] += half_width * geotransform[1]
+                    geotransform[3] += half_width * geotransform[5]
+
+                _write_layer(temp_layers['mean'], focal_mean, geotransform,
+                             source_grid['projection'])
+                _write_layer(temp_layers['std'], focal_std, geotransform,
+                             source_grid['projection'])
+                for statistic, out_layer in out_layers.items():
+                    os.replace(temp_layers[statistic], out_layer)
+            finally:
+                for temp_file in [temp_source] + list(temp_layers.values()):
+                    if os.path.isfile(temp_file):
+                        os.remove(temp_file)
+
+        return out_layers
+
+    def get_layer(self, data_layer, data_layers_list, bounding_box=None,
+                  out_res=upscaling_common.UPSCALING_RES,
+                  out_proj=upscaling_common.UPSCALING_PROJ):
+        """
+        Get path to a focal layer for a grid, calculating it if needed.
+
+        Requires:
+
+        * data_layer - DataLayer object for focal layer
+        * data_layers_list - list of DataLayer objects containing the source
+        * bounding_box - bounding box of grid
+        * out_res - output resolution
+        * out_proj - output projection
+
+        """
+        source_path, source_nodata = upscaling_common.get_source_path(data_layer,
+                                                                       data_layers_list)
+        out_layers = self.compute(source_path, data_layer.focal_radius, bounding_box,
+                                  out_res, out_proj, source_nodata)
+        return out_layers[data_layer.focal_statistic]
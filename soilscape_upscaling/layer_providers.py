@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Providers of dynamic layers. Each source of dynamic layers (e.g., PRISM)
+is a class derived from DynamicLayerProvider, registered against the
+start of the layer names it provides (e.g., 'prism'). A provider:
+
+* finds the files available in a directory (find_files), this is done
+  once and the list kept, so finding the layer for a date doesn't need
+  to search the directory
+* finds the file for a date (get_layer)
+* gets the grid of the file for a date (get_native_grid)
+* sets the resampling method to use if one isn't given for a layer
+* can optionally get layers for several dates at once (get_layers),
+  prepare layers for dates in advance (prefetch) or provide layers on
+  the output grid itself (get_reprojected_layer), if it has a faster
+  way than warping the file.
+
+AirMOSS, UAVSAR, PRISM and ECMWF providers are included. Other providers
+can be registered in code (register_provider), in the '[default]'
+section of a config::
+
+   layer_providers = smap=my_providers.smap:SMAPProvider
+                     modis=my_providers.modis:MODISProvider
+
+or by a package using the 'soilscape_upscaling.layer_providers' entry
+point group, where the name is the start of the layer names::
+
+   entry_points={'soilscape_upscaling.layer_providers' :
+                 ['smap = my_providers.smap:SMAPProvider']}
+
+Providers registered later replace those registered earlier for the
+same names, so a package can replace an included provider.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import calendar
+import glob
+import importlib
+import os
+import re
+import threading
+import time
+
+from . import warp_cache as warp_cache_module
+
+#: Entry point group for providers
+ENTRY_POINT_GROUP = 'soilscape_upscaling.layer_providers'
+
+#: Minimum time difference between date and AirMOSS / UAVSAR scene
+MIN_TIME_DIFF_AIRBORNE_SAR = 1e10
+
+class DynamicLayerProvider(object):
+    """
+    Base class for a source of dynamic layers. Subclasses must implement
+    find_files.
+
+    Requires:
+
+    * layer_type - type of layer (e.g., 'prism_ppt')
+    * layer_dir - directory which contains layers
+
+    """
+    #: Resampling method used if not specified for a layer
+    resample_method = 'near'
+
+    #: Format of the key for each date (see get_date_key)
+    date_format = '%Y%m%d'
+
+    def __init__(self, layer_type, layer_dir):
+        self.layer_type = layer_type
+        self.layer_dir = layer_dir
+        self._files = None
+        self._lock = threading.Lock()
+
+    def find_files(self):
+        """
+        Find all files available for the layer.
+
+        Returns dictionary with the file for each date key.
+        """
+        raise NotImplementedError
+
+    def list_files(self, refresh=False):
+        """
+        Get all files available for the layer (found the first time this
+        is called or if 'refresh' is True).
+
+        Returns dictionary with the file for each date key.
+        """
+        with self._lock:
+            if self._files is None or refresh:
+                self._files = self.find_files()
+            return self._files
+
+    def get_date_key(self, sm_date_ts):
+        """
+        Get the key used for a date.
+        """
+        return time.strftime(self.date_format, sm_date_ts)
+
+    def get_layer(self, sm_date_ts):
+        """
+        Get the file for a date. The files are searched again if the
+        date isn't found, in case files have been added.
+
+        Returns:
+
+        * Path to layer and date of layer (string)
+
+        """
+        date_key = self.get_date_key(sm_date_ts)
+        layer_file = self.list_files().get(date_key)
+        if layer_file is None:
+            layer_file = self.list_files(refresh=True).get(date_key)
+        if layer_file is None:
+            raise Exception('Could not find dynamic layer "{}"'.format(self.layer_type))
+        return layer_file, time.strftime('%Y%m%d', sm_date_ts)
+
+    def get_layers(self, dates_ts):
+        """
+        Get the file for several dates.
+
+        Returns list of path to layer and date of layer for each date.
+        """
+        return [self.get_layer(sm_date_ts) for sm_date_ts in dates_ts]
+
+    def get_native_grid(self, sm_date_ts):
+        """
+        Get the grid (see warp_cache.get_raster_grid) of the file for a date.
+        """
+        return warp_cache_module.get_raster_grid(self.get_layer(sm_date_ts)[0])
+
+    def prefetch(self, dates_ts):
+        """
+        Prepare layers for dates which will be run (e.g., download). Does
+        nothing by default.
+        """
+        pass
+
+    def get_reprojected_layer(self, sm_date_ts, temp_dir, bounding_box=None,
+                              resample_method=None, out_res=None, out_proj=None):
+        """
+        Get the layer for a date on the output grid, if the provider has a
+        faster way than warping the file. Takes the same parameters as
+        dynamic_layers.get_reprojected_dynamic_layer.
+
+        Returns path to layer and date of layer or None (the default) to
+        warp the file from get_layer.
+        """
+        return None
+
+class AirborneSARProvider(DynamicLayerProvider):
+    """
+    Base class for airborne SAR (AirMOSS and UAVSAR) where the closest
+    scene to a date is used. The polarisation is the end of the layer
+    type (e.g., 'airmoss_hh').
+    """
+    resample_method = 'average'
+
+    #: Name of source for messages
+    source_name = None
+    #: Pattern to find HH files
+    hh_pattern = None
+    #: String for each polarisation in file names
+    pol_strings = None
+    #: Position of date in file name (split by '_')
+    date_element = None
+
+    def get_scene_files(self, hh_file):
+        """
+        Get files for each polarisation of a scene.
+        """
+        return dict([(pol, hh_file.replace(self.pol_strings['HH'], pol_str))
+                     for pol, pol_str in self.pol_strings.items()])
+
+    def find_files(self):
+        scene_files = {}
+        for hh_file in sorted(glob.glob(os.path.join(self.layer_dir, self.hh_pattern))):
+            scene_date = os.path.basename(hh_file).split('_')[self.date_element]
+            date_key = time.strftime('%Y%m%d', time.strptime(scene_date, '%y%m%d'))
+            # Use first file for each date, as the closest scene search
+            if date_key not in scene_files:
+                scene_files[date_key] = self.get_scene_files(hh_file)
+        return scene_files
+
+    def get_layer(self, sm_date_ts):
+        scene_files = self.list_files()
+        if len(scene_files) == 0:
+            raise Exception('No {} files matching "{}" found '
+                            'in {}'.format(self.source_name, self.hh_pattern,
+                                           self.layer_dir))
+        polarization = self.layer_type.split('_')[-1].upper()
+        sm_date_epoch = calendar.timegm(sm_date_ts)
+
+        min_time_diff = MIN_TIME_DIFF_AIRBORNE_SAR
+        closest_date = None
+        for date_key in sorted(scene_files.keys()):
+            time_diff = abs(calendar.timegm(time.strptime(date_key, '%Y%m%d'))
+                            - sm_date_epoch)
+            if time_diff < min_time_diff:
+                min_time_diff = time_diff
+                closest_date = date_key
+        if closest_date is None:
+            raise Exception('Could not find dynamic layer "{}"'.format(self.layer_type))
+        return scene_files[closest_date][polarization], closest_date
+
+class AirMOSSProvider(AirborneSARProvider):
+    """
+    AirMOSS P-band SAR, as VRT files.
+    """
+    source_name = 'AirMOSS'
+    hh_pattern = '*_hh_*vrt'
+    pol_strings = {'HH' : '_hh_', 'VV' : '_vv_', 'HV' : '_hv_'}
+    date_element = 2
+
+class UAVSARProvider(AirborneSARProvider):
+    """
+    UAVSAR L-band SAR, as KEA files. Dates with fewer than three files
+    are skipped.
+    """
+    source_name = 'UAVSAR'
+    hh_pattern = '*_HHHH_*kea'
+    pol_strings = {'HH' : '_HHHH_', 'VV' : '_VVVV_', 'HV' : '_HVHV_'}
+    date_element = 1
+
+    def find_files(self):
+        scene_files = {}
+        for hh_file in sorted(glob.glob(os.path.join(self.layer_dir, self.hh_pattern))):
+            scene_date = os.path.basename(hh_file).split('_')[self.date_element]
+            num_files = len(glob.glob(os.path.join(self.layer_dir,
+                                                   '*{}*kea'.format(scene_date))))
+            if num_files < 3:
+                continue
+            date_key = time.strftime('%Y%m%d', time.strptime(scene_date, '%y%m%d'))
+            if date_key not in scene_files:
+                scene_files[date_key] = self.get_scene_files(hh_file)
+        return scene_files
+
+class PRISMProvider(DynamicLayerProvider):
+    """
+    PRISM (http://prism.oregonstate.edu/) daily climate data as BIL
+    files. The variable is the end of the layer type (e.g., 'prism_ppt').
+    If there are stable and provisional files for a date the stable
+    file is used.
+    """
+    resample_method = 'bilinear'
+
+    _date_re = re.compile(r'_(\d{8})_bil\.bil$')
+
+    def find_files(self):
+        prism_var = self.layer_type.split('_')[-1]
+        prism_files = glob.glob(os.path.join(self.layer_dir,
+                                             'PRISM_{0}_*_bil.bil'.format(prism_var)))
+        date_files = {}
+        for prism_file in sorted(prism_files, key=lambda f: ('_stable_' not in f, f)):
+            date_match = self._date_re.search(prism_file)
+            if date_match is not None and date_match.group(1) not in date_files:
+                date_files[date_match.group(1)] = prism_file
+        return date_files
+
+class ECMWFProvider(DynamicLayerProvider):
+    """
+    ECMWF hourly climate data, processed to 100 m KEA files.
+    """
+    resample_method = 'cubic'
+    date_format = '%Y%m%d%H'
+
+    _date_re = re.compile(r'(\d{8})_(\d{2})_100m\.kea$')
+
+    def find_files(self):
+        date_files = {}
+        for ecmwf_file in sorted(glob.glob(os.path.join(self.layer_dir, '*_100m.kea'))):
+            date_match = self._date_re.search(ecmwf_file)
+            if date_match is not None:
+                date_files.setdefault(''.join(date_match.groups()), ecmwf_file)
+        return date_files
+
+# Included providers, those from entry points are added when first needed
+_providers = {'airmoss' : AirMOSSProvider,
+              'uavsar' : UAVSARProvider,
+              'prism' : PRISMProvider,
+              'ecmwf' : ECMWFProvider}
+_provider_objects = {}
+_registry_lock = threading.Lock()
+_entry_points_loaded = False
+
+def _load_entry_points():
+    """
+    Register providers from entry points (once).
+    """
+    global _entry_points_loaded
+    if _entry_points_loaded:
+        return
+    _entry_points_loaded = True
+    try:
+        from importlib import metadata
+    except ImportError:
+        return
+    all_entry_points = metadata.entry_points()
+    if hasattr(all_entry_points, 'select'):
+        group_entry_points = all_entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        group_entry_points = all_entry_points.get(ENTRY_POINT_GROUP, [])
+    for entry_point in group_entry_points:
+        _providers[entry_point.name] = entry_point.load()
+
+def register_provider(prefix, provider_class):
+    """
+    Register a provider for layer types starting with 'prefix'. Replaces
+    any provider already registered for 'prefix'.
+    """
+    with _registry_lock:
+        _load_entry_points()
+        _providers[prefix] = provider_class
+        # Remove objects for previous provider
+        for object_key in list(_provider_objects.keys()):
+            if object_key[0].startswith(prefix):
+                del _provider_objects[object_key]
+
+def load_provider_class(provider_spec):
+    """
+    Import a provider class from 'module:Class' (or 'module.Class').
+    """
+    if ':' in provider_spec:
+        module_name, class_name = provider_spec.split(':', 1)
+    else:
+        module_name, class_name = provider_spec.rsplit('.', 1)
+    provider_class = getattr(importlib.import_module(module_name), class_name)
+    if not issubclass(provider_class, DynamicLayerProvider):
+        raise TypeError('{} is not a DynamicLayerProvider'.format(provider_spec))
+    return provider_class
+
+def register_providers_from_config(config_section):
+    """
+    Register providers listed in a config section under 'layer_providers'
+    (as prefix=module:Class, separated by spaces or new lines).
+    """
+    providers_str = config_section.get('layer_providers')
+    if providers_str is None:
+        return
+    for provider_str in providers_str.split():
+        try:
+            prefix, provider_spec = provider_str.split('=', 1)
+        except ValueError:
+            raise ValueError('Expected prefix=module:Class for layer provider, '
+                             'got {}'.format(provider_str))
+        register_provider(prefix, load_provider_class(provider_spec))
+
+def get_provider_class(layer_type):
+    """
+    Get the provider class for a layer type (the longest prefix which
+    matches).
+
+    Returns None if there is no provider for the layer type.
+    """
+    with _registry_lock:
+        _load_entry_points()
+        prefixes = [p for p in _providers.keys() if layer_type.startswith(p)]
+        if len(prefixes) == 0:
+            return None
+        return _providers[max(prefixes, key=len)]
+
+def get_provider(layer_type, layer_dir):
+    """
+    Get the provider for a layer type and directory. The same object is
+    returned each time, so the files are only found once.
+
+    Returns None if there is no provider for the layer type.
+    """
+    provider_class = get_provider_class(layer_type)
+    if provider_class is None:
+        return None
+    object_key = (layer_type, layer_dir, provider_class)
+    with _registry_lock:
+        if object_key not in _provider_objects:
+            _provider_objects[object_key] = provider_class(layer_type, layer_dir)
+        return _provider_objects[object_key]
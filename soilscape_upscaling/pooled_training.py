@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Functions for training a single model using the features extracted
+for a window of dates, which is then applied to the stack for each
+date in the window. Dynamic layers (e.g., PRISM and AirMOSS) remain
+date-specific features as the values for each date are taken from
+the stack for that date.
+
+Features are read from a FeatureStore (see feature_store.py).
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import numpy
+
+from . import rf_upscaling
+
+def get_window_dates(all_dates_list, block_dates_list, window_num_dates):
+    """
+    Get the dates to use for training a model which will be applied
+    to a block of dates.
+
+    The window ends with the last date of the block and contains
+    'window_num_dates' dates (or as many as are available if the block
+    is at the start of the time series). Dates are processed in order
+    so features for all dates in the window have been extracted when
+    the block is complete, and the model doesn't depend on dates which
+    haven't been run yet. If the window is smaller than the block, the
+    block is used.
+
+    Requires:
+
+    * all_dates_list - list of all dates in the run (in order)
+    * block_dates_list - list of dates the model will be applied to
+    * window_num_dates - number of dates to train the model on
+
+    Returns list of dates to train on.
+    """
+    block_start = all_dates_list.index(block_dates_list[0])
+    block_end = all_dates_list.index(block_dates_list[-1]) + 1
+
+    extra_dates = max(window_num_dates - (block_end - block_start), 0)
+    window_start = max(block_start - extra_dates, 0)
+
+    return all_dates_list[window_start:block_end]
+
+def train_pooled_model(feature_store, layer_set_hash, window_dates_list,
+                       data_layers_list, station_ids=None, depth=None,
+                       upscaling_model="RandomForestRegressor",
+                       n_estimators=rf_upscaling.DEFAULT_N_ESTIMATORS,
+                       max_estimators=rf_upscaling.ADAPTIVE_MAX_ESTIMATORS,
+                       oob_tolerance=rf_upscaling.ADAPTIVE_OOB_TOLERANCE):
+    """
+    Train a model using features for all dates within a window.
+
+    Requires:
+
+    * feature_store - FeatureStore object
+    * layer_set_hash - hash of layer set (from FeatureStore.register_layer_set)
+    * window_dates_list - list of dates to train the model on
+    * data_layers_list - list of DataLayers objects
+    * station_ids - list of stations to train on (optional). The store
+      can contain features for other stations (e.g., validation stations
+      or stations used by other runs) so this should normally be set.
+    * depth - depth (sensor number) to train on (optional)
+    * upscaling_model - name of model to use
+    * n_estimators - number of trees or 'adaptive' (see rf_upscaling.train_model)
+    * max_estimators - maximum number of trees if adaptive
+    * oob_tolerance - relative change in out-of-bag RMSE to stop at
+      if adaptive
+
+    Returns trained model and dictionary containing parameters from
+    training (as rf_upscaling.train_model). The dictionary also contains
+    the number of dates with features ('nDates').
+
+    """
+    features = feature_store.read(layer_set_hash, dates_list=window_dates_list)
+
+    # Only use rows for the required stations and depth
+    if station_ids is not None:
+        station_ids = set([str(station_id) for station_id in station_ids])
+        features = features[features['station_id'].astype(str).isin(station_ids)]
+    if depth is not None:
+        features = features[features['depth'] == int(depth)]
+
+    if features.shape[0] == 0:
+        raise Exception('No features found for dates '
+                        '{}'.format(', '.join(window_dates_list)))
+
+    # Put into the same format as a CSV from extract_layer_stats_csv
+    layer_names = [layer.layer_name for layer in data_layers_list]
+    train_data = features[['station_id', 'latitude', 'longitude', 'target']
+                          + layer_names]
+
+    rf, out_parameters_dict = rf_upscaling.train_model_data(train_data,
+                                                            data_layers_list,
+                                                            upscaling_model=upscaling_model,
+                                                            n_estimators=n_estimators,
+                                                            max_estimators=max_estimators,
+                                                            oob_tolerance=oob_tolerance)
+    out_parameters_dict['nDates'] = len(numpy.unique(features['date']))
+
+    return rf, out_parameters_dict
@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Appendable time-series cube of predicted soil moisture. The predicted
+image for each date is appended to a chunked, compressed array with
+(time, y, x) dimensions, so the time series for a pixel or window can
+be read without opening the image for every date.
+
+The cube uses the following directory structure::
+
+   cube_dir/cube.json
+   cube_dir/cube.lock
+   cube_dir/chunks/<time_chunk>.<y_chunk>.<x_chunk>.npz
+   cube_dir/pending/<date>.npy
+
+'cube.json' contains the georeferencing (geotransform and projection),
+the size of the grid and chunks, the dates in the cube, the dates which
+are pending and the stats for each date (e.g., from Random Forests).
+Each chunk is a compressed NumPy '.npz' file containing a single array
+of size (time chunk, y chunk, x chunk). Chunks are square in space and
+contain several dates, so a map for a date and the history for a pixel
+can both be read from a moderate number of chunks.
+
+As a chunk contains several dates it has to be rewritten to add a date.
+To avoid rewriting every chunk for each date, appended dates are saved
+as a single (uncompressed) array in 'pending' and are written to the
+chunks together once there are as many pending dates as dates in a
+chunk (or 'flush' is called). Reads use the pending arrays for these
+dates.
+
+Metadata are written after the chunks or pending array, so if appending
+a date fails the date is not added to the cube. The cube can be used
+from several threads and processes, reads and writes are locked using
+'cube.lock' (where fcntl is available) and the metadata are read again
+once the lock is held.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import numbers
+import os
+import threading
+
+import numpy
+
+# Used to lock cube between processes
+try:
+    import fcntl
+    HAVE_FCNTL = True
+except ImportError:
+    HAVE_FCNTL = False
+
+# Only needed to read images (append_image)
+try:
+    from osgeo import gdal
+    HAVE_GDAL = True
+except ImportError:
+    HAVE_GDAL = False
+
+#: Version of cube format
+CUBE_VERSION = 2
+
+#: Older versions which can be read (version 1 has no pending dates)
+COMPATIBLE_CUBE_VERSIONS = [1, CUBE_VERSION]
+
+#: Number of dates in each chunk
+DEFAULT_TIME_CHUNK = 32
+
+#: Number of rows / columns in each chunk
+DEFAULT_SPACE_CHUNK = 128
+
+#: Value used for pixels with no prediction
+CUBE_NODATA = -9999.0
+
+def get_model_stats(rf_par):
+    """
+    Get the numeric stats from the dictionary returned when running
+    a model (e.g., rf_upscaling.run_random_forests) to store in a cube.
+    """
+    return {name : float(value) for name, value in rf_par.items()
+            if isinstance(value, numbers.Number)}
+
+class PredictionCube(object):
+    """
+    Chunked (time, y, x) store of predictions.
+
+    Requires:
+
+    * cube_dir - directory for cube (created if it doesn't exist)
+    * time_chunk - number of dates in each chunk (new cubes only)
+    * space_chunk - number of rows / columns in each chunk (new cubes only)
+
+    The grid is set by the first image appended. Dates can be appended
+    in any order, appending a date which is already in the cube replaces
+    it.
+
+    """
+    def __init__(self, cube_dir, time_chunk=DEFAULT_TIME_CHUNK,
+                 space_chunk=DEFAULT_SPACE_CHUNK):
+        self.cube_dir = os.path.abspath(cube_dir)
+        self.chunks_dir = os.path.join(self.cube_dir, 'chunks')
+        self.pending_dir = os.path.join(self.cube_dir, 'pending')
+        self.metadata_file = os.path.join(self.cube_dir, 'cube.json')
+        self.lock_file = os.path.join(self.cube_dir, 'cube.lock')
+        self.lock = threading.Lock()
+
+        self.metadata = {'version' : CUBE_VERSION,
+                         'timeChunk' : int(time_chunk),
+                         'spaceChunk' : int(space_chunk),
+                         'nodata' : CUBE_NODATA,
+                         'geotransform' : None,
+                         'projection' : None,
+                         'ySize' : None,
+                         'xSize' : None,
+                         'dates' : [],
+                         'pendingDates' : [],
+                         'stats' : {}}
+        self._read_metadata()
+
+    def _read_metadata(self):
+        """
+        Read metadata for an existing cube.
+        """
+        if not os.path.isfile(self.metadata_file):
+            return
+        with open(self.metadata_file, 'r') as in_f:
+            metadata = json.load(in_f)
+        if metadata.get('version') not in COMPATIBLE_CUBE_VERSIONS:
+            raise Exception('The cube {} was created with a different '
+                            'version'.format(self.cube_dir))
+        metadata['version'] = CUBE_VERSION
+        metadata.setdefault('pendingDates', [])
+        self.metadata = metadata
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive=True):
+        """
+        Lock the cube, against other threads and (where fcntl is
+        available) other processes, and read the metadata again
+        in case another process has changed the cube.
+        """
+        with self.lock:
+            # Don't create a directory to read from
+            if exclusive and not os.path.isdir(self.cube_dir):
+                os.makedirs(self.cube_dir)
+            if not HAVE_FCNTL or not os.path.isdir(self.cube_dir):
+                self._read_metadata()
+                yield
+                return
+            with open(self.lock_file, 'a') as lock_f:
+                fcntl.flock(lock_f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    self._read_metadata()
+                    yield
+                finally:
+                    fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def get_dates(self):
+        """
+        Get list of dates (YYYYMMDD) in the cube, in the order they
+        are stored.
+        """
+        with self._locked(exclusive=False):
+            return list(self.metadata['dates'])
+
+    def get_stats(self, date_str):
+        """
+        Get stats stored for a date.
+        """
+        with self._locked(exclusive=False):
+            return self.metadata['stats'].get(date_str, {})
+
+    def _get_chunk_file(self, time_chunk, y_chunk, x_chunk):
+        return os.path.join(self.chunks_dir,
+                            '{}.{}.{}.npz'.format(time_chunk, y_chunk, x_chunk))
+
+    def _read_chunk(self, time_chunk, y_chunk, x_chunk):
+        """
+        Read chunk, returns array filled with no data if the chunk
+        doesn't exist.
+        """
+        chunk_file = self._get_chunk_file(time_chunk, y_chunk, x_chunk)
+        if os.path.isfile(chunk_file):
+            with numpy.load(chunk_file) as chunk_npz:
+                return chunk_npz['data']
+        t_size = self.metadata['timeChunk']
+        s_size = self.metadata['spaceChunk']
+        return numpy.full((t_size, s_size, s_size), self.metadata['nodata'],
+                          dtype=numpy.float32)
+
+    def _write_chunk(self, time_chunk, y_chunk, x_chunk, chunk_data):
+        chunk_file = self._get_chunk_file(time_chunk, y_chunk, x_chunk)
+        temp_chunk_file = chunk_file + '.tmp.npz'
+        numpy.savez_compressed(temp_chunk_file, data=chunk_data)
+        os.replace(temp_chunk_file, chunk_file)
+
+    def _get_pending_file(self, date_str):
+        return os.path.join(self.pending_dir, '{}.npy'.format(date_str))
+
+    def _write_metadata(self):
+        temp_metadata_file = self.metadata_file + '.tmp'
+        with open(temp_metadata_file, 'w') as out_f:
+            json.dump(self.metadata, out_f, indent=1)
+        os.replace(temp_metadata_file, self.metadata_file)
+
+    def _set_grid(self, geotransform, projection, y_size, x_size):
+        """
+        Set grid for a new cube or check a grid matches the cube.
+        """
+        if self.metadata['geotransform'] is None:
+            self.metadata['geotransform'] = [float(v) for v in geotransform]
+            self.metadata['projection'] = projection
+            self.metadata['ySize'] = int(y_size)
+            self.metadata['xSize'] = int(x_size)
+        elif int(y_size) != self.metadata['ySize'] \
+                or int(x_size) != self.metadata['xSize'] \
+                or not numpy.allclose(geotransform, self.metadata['geotransform']):
+            raise ValueError('Grid does not match the grid of the cube {}'
+                             ''.format(self.cube_dir))
+
+    def append(self, date_str, data, geotransform, projection='', nodata=None,
+               stats=None):
+        """
+        Append (or replace) the prediction for a date.
+
+        Requires:
+
+        * date_str - date as YYYYMMDD
+        * data - 2D array of predictions
+        * geotransform - GDAL geotransform of data
+        * projection - projection of data (WKT)
+        * nodata - no data value of data (converted to the no data value
+          of the cube)
+        * stats - dictionary of stats for date (must be JSON serialisable)
+
+        """
+        data = numpy.asarray(data, dtype=numpy.float32)
+        if data.ndim != 2:
+            raise ValueError('Expected 2D array for prediction')
+
+        with self._locked():
+            self._set_grid(geotransform, projection, data.shape[0], data.shape[1])
+
+            if nodata is not None:
+                data = numpy.where(data == nodata, self.metadata['nodata'], data)
+
+            if not os.path.isdir(self.pending_dir):
+                os.makedirs(self.pending_dir)
+            pending_file = self._get_pending_file(date_str)
+            temp_pending_file = pending_file + '.tmp.npy'
+            numpy.save(temp_pending_file, data)
+            os.replace(temp_pending_file, pending_file)
+
+            if date_str not in self.metadata['dates']:
+                self.metadata['dates'].append(date_str)
+            if date_str not in self.metadata['pendingDates']:
+                self.metadata['pendingDates'].append(date_str)
+            if stats is not None:
+                self.metadata['stats'][date_str] = stats
+            self._write_metadata()
+
+            if len(self.metadata['pendingDates']) >= self.metadata['timeChunk']:
+                self._flush()
+
+    def flush(self):
+        """
+        Write pending dates to the chunks.
+        """
+        with self._locked():
+            self._flush()
+
+    def _flush(self):
+        """
+        Write pending dates to the chunks, each chunk containing a
+        pending date is written once.
+        """
+        pending_dates = list(self.metadata['pendingDates'])
+        if len(pending_dates) == 0:
+            return
+
+        if not os.path.isdir(self.chunks_dir):
+            os.makedirs(self.chunks_dir)
+
+        t_size = self.metadata['timeChunk']
+        s_size = self.metadata['spaceChunk']
+        y_size = self.metadata['ySize']
+        x_size = self.metadata['xSize']
+
+        # Pending dates for each time chunk
+        time_chunk_dates = {}
+        for date_str in pending_dates:
+            time_index = self.metadata['dates'].index(date_str)
+            time_chunk_dates.setdefault(time_index // t_size, []).append(
+                (time_index % t_size, numpy.load(self._get_pending_file(date_str),
+                                                 mmap_mode='r')))
+
+        for time_chunk, chunk_dates in sorted(time_chunk_dates.items()):
+            for y_chunk in range(int(math.ceil(y_size / s_size))):
+                y_start = y_chunk * s_size
+                y_end = min(y_start + s_size, y_size)
+                for x_chunk in range(int(math.ceil(x_size / s_size))):
+                    x_start = x_chunk * s_size
+                    x_end = min(x_start + s_size, x_size)
+
+                    chunk_data = self._read_chunk(time_chunk, y_chunk, x_chunk)
+                    for chunk_time_index, data in chunk_dates:
+                        chunk_data[chunk_time_index, :y_end - y_start, :x_end - x_start] = \
+                            data[y_start:y_end, x_start:x_end]
+                    self._write_chunk(time_chunk, y_chunk, x_chunk, chunk_data)
+        time_chunk_dates = None
+
+        self.metadata['pendingDates'] = []
+        self._write_metadata()
+        for date_str in pending_dates:
+            os.remove(self._get_pending_file(date_str))
+
+    def append_image(self, date_str, in_image, stats=None):
+        """
+        Append (or replace) the prediction for a date from an image
+        (first band).
+        """
+        if not HAVE_GDAL:
+            raise ImportError('Could not import GDAL, needed to read images')
+        dataset = gdal.Open(in_image, gdal.GA_ReadOnly)
+        if dataset is None:
+            raise Exception('Could not open {}'.format(in_image))
+        band = dataset.GetRasterBand(1)
+        self.append(date_str, band.ReadAsArray(), dataset.GetGeoTransform(),
+                    dataset.GetProjection(), nodata=band.GetNoDataValue(),
+                    stats=stats)
+        dataset = None
+
+    def _get_dates_mask(self, start_date=None, end_date=None):
+        dates = numpy.array(self.metadata['dates'])
+        dates_mask = numpy.ones(dates.shape, dtype=bool)
+        if start_date is not None:
+            dates_mask &= dates >= start_date
+        if end_date is not None:
+            dates_mask &= dates <= end_date
+        return dates, dates_mask
+
+    def read_window(self, row, col, num_rows=1, num_cols=1, start_date=None,
+                    end_date=None):
+        """
+        Read the time series for a window. Only the chunks covering the
+        window (and dates) are read.
+
+        Requires:
+
+        * row, col - top left of window (pixels)
+        * num_rows, num_cols - size of window (pixels)
+        * start_date / end_date - first and last date (YYYYMMDD) to read
+
+        Returns list of dates (sorted) and array of size
+        (dates, num_rows, num_cols) with NaN for no data.
+
+        """
+        with self._locked(exclusive=False):
+            return self._read_window(row, col, num_rows, num_cols, start_date, end_date)
+
+    def _read_window(self, row, col, num_rows, num_cols, start_date, end_date):
+        y_size = self.metadata['ySize']
+        x_size = self.metadata['xSize']
+        if y_size is None:
+            raise Exception('The cube {} is empty'.format(self.cube_dir))
+        if row < 0 or col < 0 or row + num_rows > y_size or col + num_cols > x_size:
+            raise ValueError('Window is outside the cube')
+
+        dates, dates_mask = self._get_dates_mask(start_date, end_date)
+        time_indices = numpy.flatnonzero(dates_mask)
+        time_indices = time_indices[numpy.argsort(dates[time_indices])]
+
+        t_size = self.metadata['timeChunk']
+        s_size = self.metadata['spaceChunk']
+
+        out_data = numpy.full((time_indices.size, num_rows, num_cols), numpy.nan,
+                              dtype=numpy.float32)
+
+        for time_chunk in numpy.unique(time_indices // t_size):
+            out_index = numpy.flatnonzero(time_indices // t_size == time_chunk)
+            chunk_time_index = time_indices[out_index] % t_size
+            for y_chunk in range(row // s_size, (row + num_rows - 1) // s_size + 1):
+                for x_chunk in range(col // s_size, (col + num_cols - 1) // s_size + 1):
+                    chunk_file = self._get_chunk_file(time_chunk, y_chunk, x_chunk)
+                    if not os.path.isfile(chunk_file):
+                        continue
+                    chunk_data = self._read_chunk(time_chunk, y_chunk, x_chunk)
+                    # Part of window within chunk
+                    y_start = max(row, y_chunk * s_size)
+                    y_end = min(row + num_rows, (y_chunk + 1) * s_size)
+                    x_start = max(col, x_chunk * s_size)
+                    x_end = min(col + num_cols, (x_chunk + 1) * s_size)
+                    out_data[out_index, y_start - row:y_end - row, x_start - col:x_end - col] = \
+                        chunk_data[chunk_time_index,
+                                   y_start - y_chunk * s_size:y_end - y_chunk * s_size,
+                                   x_start - x_chunk * s_size:x_end - x_chunk * s_size]
+
+        # Pending dates replace the chunks
+        pending_dates = self.metadata['pendingDates']
+        for out_index, time_index in enumerate(time_indices):
+            if dates[time_index] in pending_dates:
+                pending_data = numpy.load(self._get_pending_file(dates[time_index]),
+                                          mmap_mode='r')
+                out_data[out_index] = pending_data[row:row + num_rows, col:col + num_cols]
+                pending_data = None
+
+        out_data[out_data == self.metadata['nodata']] = numpy.nan
+
+        return [str(d) for d in dates[time_indices]], out_data
+
+    def get_pixel(self, x, y):
+        """
+        Get row and column for coordinates (in the projection of the cube).
+        """
+        geotransform = self.metadata['geotransform']
+        if geotransform is None:
+            raise Exception('The cube {} is empty'.format(self.cube_dir))
+        col = int(math.floor((x - geotransform[0]) / geotransform[1]))
+        row = int(math.floor((y - geotransform[3]) / geotransform[5]))
+        return row, col
+
+    def read_pixel_series(self, x, y, start_date=None, end_date=None):
+        """
+        Read the time series for the pixel containing coordinates x, y.
+
+        Returns list of dates and 1D array of predictions.
+        """
+        row, col = self.get_pixel(x, y)
+        dates, out_data = self.read_window(row, col, 1, 1, start_date, end_date)
+        return dates, out_data[:, 0, 0]
+
+    def read_bbox_series(self, bounding_box, start_date=None, end_date=None):
+        """
+        Read the time series for the pixels within a bounding box
+        (min_x, min_y, max_x, max_y).
+
+        Returns list of dates and array of size (dates, rows, cols).
+        """
+        min_x, min_y, max_x, max_y = [float(v) for v in bounding_box]
+        row_start, col_start = self.get_pixel(min_x, max_y)
+        # Exclude pixels which only touch the edge of the box
+        row_end, col_end = self.get_pixel(max_x - abs(self.metadata['geotransform'][1]) * 1e-6,
+                                          min_y + abs(self.metadata['geotransform'][5]) * 1e-6)
+        return self.read_window(row_start, col_start, row_end - row_start + 1,
+                                col_end - col_start + 1, start_date, end_date)
+
+    def read_map(self, date_str):
+        """
+        Read the prediction for a date as a 2D array (NaN for no data).
+        """
+        with self._locked(exclusive=False):
+            if date_str not in self.metadata['dates']:
+                raise KeyError('The date {} is not in the cube'.format(date_str))
+            _, out_data = self._read_window(0, 0, self.metadata['ySize'],
+                                            self.metadata['xSize'], date_str, date_str)
+        return out_data[0]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query time series from a '
+                                                 'prediction cube')
+    parser.add_argument("cube_dir", help="Directory of cube")
+    parser.add_argument("--point", nargs=2, type=float, default=None,
+                        metavar=('X', 'Y'),
+                        help="Print time series for pixel containing point")
+    parser.add_argument("--bbox", nargs=4, type=float, default=None,
+                        metavar=('MIN_X', 'MIN_Y', 'MAX_X', 'MAX_Y'),
+                        help="Print mean time series for bounding box")
+    parser.add_argument("--start_date", default=None, help="First date (YYYYMMDD)")
+    parser.add_argument("--end_date", default=None, help="Last date (YYYYMMDD)")
+    parser.add_argument("--flush", default=False, action='store_true',
+                        help="Write pending dates to the chunks")
+    args = parser.parse_args()
+
+    cube = PredictionCube(args.cube_dir)
+
+    if args.flush:
+        cube.flush()
+
+    if args.point is not None:
+        out_dates, out_series = cube.read_pixel_series(args.point[0], args.point[1],
+                                                       args.start_date, args.end_date)
+    elif args.bbox is not None:
+        out_dates, out_window = cube.read_bbox_series(args.bbox, args.start_date,
+                                                      args.end_date)
+        out_series = numpy.array([numpy.nanmean(w) if numpy.isfinite(w).any()
+                                  else numpy.nan for w in out_window])
+    else:
+        out_dates = cube.get_dates()
+        out_series = None
+        print('{} dates, {} x {} pixels'.format(len(out_dates), cube.metadata['xSize'],
+                                                cube.metadata['ySize']))
+
+    if out_series is not None:
+        print('date,value')
+        for out_date, out_value in zip(out_dates, out_series):
+            print('{},{}'.format(out_date, out_value))
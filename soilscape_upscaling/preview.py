@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Functions for a quick-look preview of upscaling at a coarser resolution.
+
+In preview mode the model is trained as for a full resolution run, using
+pixel values extracted from the full resolution stack, and is then applied
+to a subsampled version of the stack at a multiple of the output
+resolution (reading from overviews where they are available). With a
+factor of 10 there are 100 times fewer pixels to predict. If a full
+resolution prediction already exists for a date the preview is compared
+against it (after averaging the full resolution prediction to the preview
+grid) to report the error of the approximation.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+
+import numpy
+from osgeo import gdal
+
+#: Columns added to the stats CSV when running in preview mode
+PREVIEW_STATS_HEADER = ['avgSM_full', 'stdSM_full', 'RMSE_preview_full',
+                        'Bias_preview_full']
+
+def get_preview_image_name(out_image):
+    """
+    Get name of preview image for an output image
+    (e.g., 20130101_predict_sm.kea -> 20130101_predict_sm_preview.kea).
+    """
+    out_base, out_ext = os.path.splitext(out_image)
+    return out_base + '_preview' + out_ext
+
+def subsample_stack(in_data_stack, out_vrt, preview_factor):
+    """
+    Create a VRT which subsamples a stack by a factor (nearest
+    neighbour, using overviews if available).
+    """
+    if float(preview_factor) < 1:
+        raise ValueError('Preview factor must be at least 1')
+    out_percent = '{:g}%'.format(100.0 / float(preview_factor))
+    subprocess.check_call(['gdal_translate', '-q', '-of', 'VRT',
+                           '-r', 'nearest',
+                           '-outsize', out_percent, out_percent,
+                           in_data_stack, out_vrt])
+    return out_vrt
+
+def _read_prediction(in_image):
+    """
+    Read first band of prediction, setting pixels with no prediction
+    (0) to NaN.
+    """
+    dataset = gdal.Open(in_image, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise IOError('Could not open {}'.format(in_image))
+    data = dataset.GetRasterBand(1).ReadAsArray().astype(numpy.float64)
+    geotransform = dataset.GetGeoTransform()
+    x_size = dataset.RasterXSize
+    y_size = dataset.RasterYSize
+    projection = dataset.GetProjection()
+    dataset = None
+    data[data == 0] = numpy.nan
+    return data, geotransform, x_size, y_size, projection
+
+def compare_with_full(preview_image, full_image):
+    """
+    Compare a preview with the full resolution prediction.
+
+    The full resolution prediction is averaged to the grid of the
+    preview before comparing.
+
+    Returns dictionary with the mean and standard deviation of the
+    full resolution prediction and the RMSE and bias of the preview.
+    """
+    preview_data, geotransform, x_size, y_size, projection = _read_prediction(preview_image)
+
+    min_x = geotransform[0]
+    max_y = geotransform[3]
+    max_x = min_x + geotransform[1] * x_size
+    min_y = max_y + geotransform[5] * y_size
+
+    temp_dir = tempfile.mkdtemp(prefix='soilscape_preview')
+    try:
+        full_avg_vrt = os.path.join(temp_dir, 'full_average.vrt')
+        subprocess.check_call(['gdalwarp', '-q', '-of', 'VRT',
+                               '-r', 'average', '-srcnodata', '0',
+                               '-dstnodata', '0', '-b', '1',
+                               '-t_srs', projection,
+                               '-te', repr(min_x), repr(min_y), repr(max_x), repr(max_y),
+                               '-ts', str(x_size), str(y_size),
+                               full_image, full_avg_vrt])
+        full_avg_data = _read_prediction(full_avg_vrt)[0]
+    finally:
+        shutil.rmtree(temp_dir)
+
+    full_data = _read_prediction(full_image)[0]
+
+    diff = preview_data - full_avg_data
+    diff = diff[numpy.isfinite(diff)]
+
+    if diff.size == 0:
+        rmse = numpy.nan
+        bias = numpy.nan
+    else:
+        rmse = numpy.sqrt((diff**2).mean())
+        bias = diff.mean()
+
+    return {'averageSMFull' : numpy.nanmean(full_data),
+            'sdSMFull' : numpy.nanstd(full_data),
+            'RMSEPreview' : rmse,
+            'BiasPreview' : bias}
+
+def get_preview_stats_row(preview_image, full_image):
+    """
+    Get values to add to the stats CSV for a preview, comparing with the
+    full resolution prediction if it exists ('NA' if it doesn't).
+    """
+    if not os.path.isfile(full_image):
+        return ['NA'] * len(PREVIEW_STATS_HEADER)
+
+    preview_error = compare_with_full(preview_image, full_image)
+    print('Preview compared to full resolution: RMSE = {:.4f}, Bias = {:.4f} '
+          '(full mean = {:.4f}, sd = {:.4f})'.format(preview_error['RMSEPreview'],
+                                                     preview_error['BiasPreview'],
+                                                     preview_error['averageSMFull'],
+                                                     preview_error['sdSMFull']))
+    return [preview_error['averageSMFull'],
+            preview_error['sdSMFull'],
+            preview_error['RMSEPreview'],
+            preview_error['BiasPreview']]
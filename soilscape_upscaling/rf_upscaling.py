@@ -12,6 +12,10 @@ licence is available to download with this file.
 
 """
 
+import os
+import shutil
+import tempfile
+
 import pandas
 import numpy
 from sklearn.ensemble import RandomForestRegressor
@@ -19,72 +23,241 @@ from sklearn import linear_model
 from rios import applier
 from rios import cuiprogress
 
+from . import cpu_budget
+from . import preview
+from . import stack_bands
 from . import upscaling_utilities
 
 # Value to change nodata pixels to.
 NAN_NODATA_VALUE = -9999
 
-def array2table(in_array):
+# Number of trees to use for Random Forests
+DEFAULT_N_ESTIMATORS = 300
+
+# Settings for adaptive forest size (n_estimators='adaptive').
+# Trees are added in steps until the change in out-of-bag RMSE is
+# below a tolerance for several steps in a row or the maximum number
+# of trees is reached.
+ADAPTIVE_START_ESTIMATORS = 50
+ADAPTIVE_STEP_ESTIMATORS = 25
+ADAPTIVE_MAX_ESTIMATORS = 500
+# Relative change in OOB RMSE between steps
+ADAPTIVE_OOB_TOLERANCE = 0.005
+# Number of steps in a row the change needs to be below the tolerance
+# for, so a single noisy step doesn't stop adding trees
+ADAPTIVE_CONVERGED_STEPS = 3
+
+# Maximum number of pixels to hold the prediction from every tree for
+# when calculating quantiles. Memory needed is
+# UNCERTAINTY_CHUNK_PIXELS x number of trees x 4 bytes (e.g., 38 MB
+# for 300 trees).
+UNCERTAINTY_CHUNK_PIXELS = 32768
+
+def array2table(in_array, dtype=numpy.float32):
     """
     Takes multi-band image (represented as a 3-dimensional
     array and flattens to a table with bands as separate columns
 
+    The table is C-contiguous and 'dtype' (Float32 by default, the same
+    as the stack, which is also the type used by scikit-learn trees)
+    so it can be passed to the model without another copy.
+
     To revert use::
 
-        out_table.reshape((num_bands,num_lines, nPixels))
+        out_table.T.reshape((num_bands,num_lines, nPixels))
 
     """
     num_bands = in_array.shape[0]
-    num_lines = in_array.shape[1]
-    num_pixels = in_array.shape[2]
 
-    # Set up output table
-    out_table = numpy.zeros((num_lines*num_pixels, num_bands))
+    return numpy.ascontiguousarray(in_array.reshape((num_bands, -1)).T,
+                                   dtype=dtype)
 
-    for j in range(num_lines):
-        for i in range(num_pixels):
-            out_table[(j*num_pixels) + i] = in_array[:, j, i]
+def get_quantiles(quantiles_str):
+    """
+    Get list of quantiles from a string (e.g., '0.05 0.95').
+    Returns None if the string is empty or None.
+    """
+    if quantiles_str is None or quantiles_str.strip() == '':
+        return None
+    quantiles = [float(q) for q in quantiles_str.replace(',', ' ').split()]
+    for quantile in quantiles:
+        if quantile < 0 or quantile > 1:
+            raise ValueError('Quantiles must be between 0 and 1, '
+                             'got {}'.format(quantile))
+    return quantiles
+
+def get_uncertainty_band_names(quantiles=None):
+    """
+    Get names of bands in the output image when uncertainty is
+    calculated.
+    """
+    band_names = ['predict_sm', 'predict_sm_sd']
+    if quantiles is not None:
+        band_names.extend(['predict_sm_q{:g}'.format(q * 100) for q in quantiles])
+    return band_names
+
+def _calc_tree_quantiles(tree_predictions, quantiles, out_quantiles):
+    """
+    Calculate quantiles of the predictions from each tree (trees x pixels)
+    using linear interpolation, the same as numpy.quantile. The
+    predictions are partially sorted in place, rather than copied as
+    numpy.quantile does, so only the array of predictions is held.
+    """
+    num_trees = tree_predictions.shape[0]
+    positions = numpy.asarray(quantiles, dtype=numpy.float64) * (num_trees - 1)
+    lower = numpy.floor(positions).astype(numpy.intp)
+    upper = numpy.minimum(lower + 1, num_trees - 1)
+    tree_predictions.partition(numpy.unique(numpy.concatenate([lower, upper])),
+                               axis=0)
+    for i, position in enumerate(positions):
+        lower_predict = tree_predictions[lower[i]]
+        out_quantiles[i] = lower_predict + (position - lower[i]) * \
+            (tree_predictions[upper[i]] - lower_predict)
+
+def predict_forest_uncertainty(rf, X, quantiles=None,
+                               chunk_pixels=UNCERTAINTY_CHUNK_PIXELS):
+    """
+    Predict using a Random Forest and calculate the spread of the
+    predictions from each tree.
 
-    return out_table
+    The mean and variance are accumulated one tree at a time, so only
+    the prediction from a single tree is held for all pixels. If
+    quantiles are requested pixels are processed in chunks of
+    'chunk_pixels', holding the prediction from every tree for a
+    chunk, and the quantiles are calculated without copying these
+    predictions. The memory needed is therefore bounded by::
+
+       num_pixels x (4 x (num_features + num_quantiles) + 56) bytes
+          + min(chunk_pixels, num_pixels) x num_trees x 4 bytes
+
+    (the second term only if quantiles are requested), compared to
+    num_pixels x num_trees x 4 bytes to hold every prediction.
+
+    Requires:
+
+    * rf - fitted RandomForestRegressor
+    * X - array of features (pixels x features)
+    * quantiles - list of quantiles (0 - 1) to calculate (optional)
+    * chunk_pixels - maximum number of pixels to calculate quantiles for
+      at once
+
+    Returns mean (same as rf.predict), standard deviation across trees and
+    an array of quantiles (quantiles x pixels, or None).
 
-def _rios_apply_rf_image(info, inputs, outputs, otherargs):
     """
-    Applies Random Forests to an image (called from RIOS applier)
+    # Convert once rather than for every tree
+    X = numpy.ascontiguousarray(X, dtype=numpy.float32)
+    num_pixels = X.shape[0]
+
+    if quantiles is not None:
+        out_quantiles = numpy.zeros((len(quantiles), num_pixels), dtype=numpy.float32)
+        chunk_pixels = max(int(chunk_pixels), 1)
+    else:
+        out_quantiles = None
+        chunk_pixels = max(num_pixels, 1)
+
+    mean = numpy.zeros(num_pixels, dtype=numpy.float64)
+    m2 = numpy.zeros(num_pixels, dtype=numpy.float64)
+
+    for start in range(0, num_pixels, chunk_pixels):
+        end = min(start + chunk_pixels, num_pixels)
+        if quantiles is not None:
+            tree_predictions = numpy.zeros((len(rf.estimators_), end - start),
+                                           dtype=numpy.float32)
+        chunk_mean = mean[start:end]
+        chunk_m2 = m2[start:end]
+        # Welford's algorithm
+        for i, tree in enumerate(rf.estimators_):
+            tree_predict = tree.predict(X[start:end], check_input=False)
+            delta = tree_predict - chunk_mean
+            chunk_mean += delta / (i + 1)
+            chunk_m2 += delta * (tree_predict - chunk_mean)
+            if quantiles is not None:
+                tree_predictions[i] = tree_predict
+        if quantiles is not None:
+            _calc_tree_quantiles(tree_predictions, quantiles,
+                                 out_quantiles[:, start:end])
+            del tree_predictions
+
+    sd = numpy.sqrt(m2 / max(len(rf.estimators_), 1))
+
+    return mean, sd, out_quantiles
+
+def predict_block(in_array, rf, nodata_vals_list, uncertainty=False,
+                  quantiles=None):
+    """
+    Apply a model to a block of the stack (bands x lines x pixels, with the
+    mask as the last band).
+
+    The features are kept as Float32 (the type of the stack) throughout,
+    scikit-learn trees use Float32 so the predictions are the same as
+    for a Float64 table.
+
+    Returns the output block (Float32, prediction and any uncertainty bands
+    x lines x pixels) and an array of the predicted values (excluding
+    no data).
     """
+    num_lines = in_array.shape[1]
+    num_pixels = in_array.shape[2]
 
-    # Flatten array to table
-    test_data = array2table(inputs.inimage[0:, ...])
+    # Flatten features (all bands except the mask) to table
+    test_data = array2table(in_array[:-1])
+    mask_data = in_array[-1].ravel()
 
     test_data[numpy.isnan(test_data)] = NAN_NODATA_VALUE
 
-    predict_sm = otherargs.rf.predict(test_data[:, :-1])
+    if uncertainty:
+        predict_sm, predict_sd, predict_quantiles = \
+            predict_forest_uncertainty(rf, test_data, quantiles=quantiles)
+        uncertainty_bands = [predict_sd]
+        if predict_quantiles is not None:
+            uncertainty_bands.extend(list(predict_quantiles))
+    else:
+        predict_sm = rf.predict(test_data)
+        uncertainty_bands = []
 
     # Mask out no data values for each band.
     # last band is mask
-    for i, nodata_val in enumerate(otherargs.nodata_vals_list):
+    no_data = numpy.isnan(mask_data)
+    for i, nodata_val in enumerate(nodata_vals_list):
+        if i < test_data.shape[1]:
+            band_data = test_data[:, i]
+        else:
+            band_data = mask_data
         if nodata_val is not None:
-            predict_sm = numpy.where(test_data[:, i] == nodata_val,
-                                     0, predict_sm)
+            no_data |= band_data == band_data.dtype.type(nodata_val)
         # Check for no data value we've set
-        predict_sm = numpy.where(test_data[:, i] == NAN_NODATA_VALUE,
-                                 0, predict_sm)
+        no_data |= band_data == NAN_NODATA_VALUE
 
-    # Reshape
-    out_predict_sm = predict_sm.reshape((1, inputs.inimage.shape[1], inputs.inimage.shape[2]))
+    out_predict_sm = numpy.zeros((1 + len(uncertainty_bands), num_lines * num_pixels),
+                                 dtype=numpy.float32)
+    out_predict_sm[0] = predict_sm
+    out_predict_sm[0, no_data] = 0
+    # Mask uncertainty in the same way as the prediction
+    for i, band in enumerate(uncertainty_bands):
+        out_predict_sm[i + 1] = numpy.where(out_predict_sm[0] == 0, 0, band)
 
-    out_predict_sm = out_predict_sm.astype(numpy.float32)
+    # Predicted SM values (removing zero values)
+    predict_sm = out_predict_sm[0].compress(out_predict_sm[0] != 0)
 
-    # Save back to image
-    outputs.outimage = out_predict_sm
+    return out_predict_sm.reshape((1 + len(uncertainty_bands), num_lines,
+                                   num_pixels)), predict_sm
+
+def _rios_apply_rf_image(info, inputs, outputs, otherargs):
+    """
+    Applies Random Forests to an image (called from RIOS applier)
+    """
+    outputs.outimage, predict_sm = predict_block(inputs.inimage, otherargs.rf,
+                                                 otherargs.nodata_vals_list,
+                                                 uncertainty=otherargs.uncertainty,
+                                                 quantiles=otherargs.quantiles)
 
     # Save out predicted SM values
-    predict_sm = predict_sm.compress(predict_sm != 0) # Remove zero values
-    if otherargs.predict_sm is None:
-        otherargs.predict_sm = predict_sm
-    else:
-        otherargs.predict_sm = numpy.append(otherargs.predict_sm, predict_sm)
+    otherargs.predict_sm.append(predict_sm)
 
-def apply_rf_image(in_data_stack, out_image, rf_model, nodata_vals):
+def apply_rf_image(in_data_stack, out_image, rf_model, nodata_vals,
+                   return_count=False, uncertainty=False, quantiles=None,
+                   preview_factor=None):
     """
     Apply Random Forests model generated by scikit-learn
     to an input data stack and output image
@@ -95,11 +268,31 @@ def apply_rf_image(in_data_stack, out_image, rf_model, nodata_vals):
     * out_image - output image
     * rf_model - model produced by scikit-learn
     * nodata_vals - array with a no-data value for each band
+    * return_count - also return the number of predicted pixels
+    * uncertainty - also write the standard deviation of the predictions
+      from each tree as a second band (Random Forests only)
+    * quantiles - list of quantiles (0 - 1) of the predictions from each
+      tree to write as additional bands if uncertainty is True
+      (e.g., [0.05, 0.95])
+    * preview_factor - subsample the stack by this factor (using overviews
+      if available) and apply to the reduced grid, for a quick-look preview
 
     Returns the mean and standard deviation of the output (predicted)
-    image.
+    image (and the number of predicted pixels if return_count is True).
 
     """
+    if uncertainty and not hasattr(rf_model, 'estimators_'):
+        print('Uncertainty can only be calculated for Random Forests, '
+              'only writing prediction')
+        uncertainty = False
+
+    preview_dir = None
+    if preview_factor is not None:
+        preview_dir = tempfile.mkdtemp(prefix='soilscape_preview')
+        in_data_stack = preview.subsample_stack(in_data_stack,
+                                                os.path.join(preview_dir, 'preview_stack.vrt'),
+                                                preview_factor)
+
     # Apply to image
     infiles = applier.FilenameAssociations()
     infiles.inimage = in_data_stack
@@ -109,43 +302,165 @@ def apply_rf_image(in_data_stack, out_image, rf_model, nodata_vals):
 
     otherargs = applier.OtherInputs()
     otherargs.rf = rf_model
-    otherargs.predict_sm = None # Array to store output SM
+    otherargs.predict_sm = [] # Arrays of output SM for each block
     # Pass in list of no data values for each layer
     otherargs.nodata_vals_list = nodata_vals
+    otherargs.uncertainty = uncertainty
+    otherargs.quantiles = quantiles
     controls = applier.ApplierControls()
     controls.setOutputDriverName(upscaling_utilities.get_gdal_format(out_image))
     controls.setCalcStats(False)
     controls.progress = cuiprogress.CUIProgressBar()
-    applier.apply(_rios_apply_rf_image, infiles, outfiles,
-                  otherargs, controls=controls)
+    try:
+        applier.apply(_rios_apply_rf_image, infiles, outfiles,
+                      otherargs, controls=controls)
+    finally:
+        if preview_dir is not None:
+            shutil.rmtree(preview_dir)
+
+    if uncertainty:
+        stack_bands.set_band_names(out_image, get_uncertainty_band_names(quantiles))
+
+    if len(otherargs.predict_sm) > 0:
+        predict_sm = numpy.concatenate(otherargs.predict_sm)
+    else:
+        predict_sm = numpy.zeros(0, dtype=numpy.float32)
 
-    average_sm_predict = otherargs.predict_sm.mean()
-    sd_sm_predict = otherargs.predict_sm.std()
+    if predict_sm.size == 0:
+        average_sm_predict = numpy.nan
+        sd_sm_predict = numpy.nan
+        num_predict = 0
+    else:
+        # Accumulate in Float64 as for the previous Float64 predictions
+        average_sm_predict = predict_sm.mean(dtype=numpy.float64)
+        sd_sm_predict = predict_sm.std(dtype=numpy.float64)
+        num_predict = predict_sm.size
 
+    if return_count:
+        return average_sm_predict, sd_sm_predict, num_predict
     return average_sm_predict, sd_sm_predict
 
-def run_random_forests(in_train_csv, in_data_stack, out_image, data_layers_list,
-                       train_data_col=3, upscaling_model="RandomForestRegressor"):
+def get_n_estimators(n_estimators_str):
     """
-    Train random forests using a text file and apply to an image.
+    Get number of trees from a string (e.g., from a config file).
+
+    Returns 'adaptive' or an integer.
+    """
+    if str(n_estimators_str).strip().lower() == 'adaptive':
+        return 'adaptive'
+    try:
+        return int(n_estimators_str)
+    except ValueError:
+        raise ValueError('Expected integer or "adaptive" for number of trees'
+                         ', got {}'.format(n_estimators_str))
+
+def _get_oob_rmse(rf, y_train):
+    """
+    Get out-of-bag RMSE for a fitted Random Forest
+    """
+    return numpy.sqrt(((rf.oob_prediction_ - y_train)**2).mean())
+
+def fit_adaptive_forest(rf, X_train, y_train,
+                        max_estimators=ADAPTIVE_MAX_ESTIMATORS,
+                        oob_tolerance=ADAPTIVE_OOB_TOLERANCE,
+                        start_estimators=ADAPTIVE_START_ESTIMATORS,
+                        step_estimators=ADAPTIVE_STEP_ESTIMATORS,
+                        converged_steps=ADAPTIVE_CONVERGED_STEPS):
+    """
+    Fit Random Forest, adding trees until the out-of-bag RMSE
+    has converged.
+
+    Trees are added in steps of 'step_estimators' (using warm_start so
+    existing trees are kept). Stops when the relative change in OOB RMSE
+    from the previous step has been less than 'oob_tolerance' for
+    'converged_steps' steps in a row or there are 'max_estimators' trees.
+
+    Requires:
+
+    * rf - RandomForestRegressor with oob_score=True
+    * X_train - array of variables
+    * y_train - array of training data
+    * max_estimators - maximum number of trees
+    * oob_tolerance - relative change in OOB RMSE to stop at
+    * start_estimators - number of trees in first step
+    * step_estimators - number of trees to add in each step
+    * converged_steps - number of steps in a row the change needs to be
+      less than 'oob_tolerance' for
+
+    Returns fitted Random Forest.
+    """
+    n_estimators = min(start_estimators, max_estimators)
+    rf.set_params(n_estimators=n_estimators, warm_start=True)
+    rf.fit(X_train, y_train)
+    prev_rmse = _get_oob_rmse(rf, y_train)
+    num_converged = 0
+
+    while n_estimators < max_estimators:
+        n_estimators = min(n_estimators + step_estimators, max_estimators)
+        rf.set_params(n_estimators=n_estimators)
+        rf.fit(X_train, y_train)
+        rmse = _get_oob_rmse(rf, y_train)
+        if prev_rmse == 0 or abs(prev_rmse - rmse) / prev_rmse < oob_tolerance:
+            num_converged += 1
+        else:
+            num_converged = 0
+        if num_converged >= converged_steps:
+            break
+        prev_rmse = rmse
+
+    rf.set_params(warm_start=False)
+
+    return rf
+
+def train_model(in_train_csv, data_layers_list, train_data_col=3,
+                upscaling_model="RandomForestRegressor",
+                n_estimators=DEFAULT_N_ESTIMATORS,
+                max_estimators=ADAPTIVE_MAX_ESTIMATORS,
+                oob_tolerance=ADAPTIVE_OOB_TOLERANCE):
+    """
+    Train model using a text file.
 
     Requires:
 
     * in_train_csv - CSV containing extracted values for each band
-    * in_data_stack - stack of all layers
-    * out_image - output image
     * data_layers_list - list of DataLayers objects
     * train_data_col - colum containing training data (default = 3)
-
-    Returns dictionary containing parameters from Random Forests and average
-    soil moisture.
+    * upscaling_model - name of model to use
+    * n_estimators - number of trees for Random Forests or 'adaptive'
+      to add trees until the out-of-bag RMSE converges.
+    * max_estimators - maximum number of trees if adaptive
+    * oob_tolerance - relative change in out-of-bag RMSE to stop
+      adding trees at if adaptive
+
+    Returns trained model and dictionary containing parameters from
+    training.
     """
 
-    out_parameters_dict = {}
-
     # Import Data
     data = pandas.read_csv(in_train_csv)
 
+    return train_model_data(data, data_layers_list,
+                            train_data_col=train_data_col,
+                            upscaling_model=upscaling_model,
+                            n_estimators=n_estimators,
+                            max_estimators=max_estimators,
+                            oob_tolerance=oob_tolerance)
+
+def train_model_data(data, data_layers_list, train_data_col=3,
+                     upscaling_model="RandomForestRegressor",
+                     n_estimators=DEFAULT_N_ESTIMATORS,
+                     max_estimators=ADAPTIVE_MAX_ESTIMATORS,
+                     oob_tolerance=ADAPTIVE_OOB_TOLERANCE):
+    """
+    Train model using a pandas data frame with the same columns
+    as the CSV used by train_model.
+
+    Returns trained model and dictionary containing parameters from
+    training.
+    """
+
+    out_parameters_dict = {}
+
     # Get list of band names
     band_names = [layer.layer_name for layer in data_layers_list]
 
@@ -155,74 +470,120 @@ def run_random_forests(in_train_csv, in_data_stack, out_image, data_layers_list,
     # Last column is training data
     var_names.append(data.columns[train_data_col])
 
-    # Set up array to pass to sk-learn
-    X_train = []
-
-    for var in var_names:
-        X_train.append(data[var])
-
-    # Convert to NumPy array
-    X_train = numpy.array(X_train)
-    X_train = X_train.transpose()
-
-    # Remove non-finite values
-    X_train = X_train[numpy.isfinite(X_train).all(axis=1)]
-
-    # Remove areas with no training data
-    X_train = X_train[X_train[:, -1] != 0]
+    # Set up arrays to pass to sk-learn. Variables are Float32, the same
+    # as the stack the model is applied to (and the type used by the
+    # trees), Linear Regression uses Float64.
+    if upscaling_model == "LinearRegression":
+        x_dtype = numpy.float64
+    else:
+        x_dtype = numpy.float32
+    X_train = numpy.column_stack([data[var].to_numpy(dtype=x_dtype)
+                                  for var in var_names[:-1]])
+    y_train = data[var_names[-1]].to_numpy(dtype=numpy.float64)
 
-    # Split into variables (X) and class (y)
-    y_train = X_train[:, -1]
-    X_train = X_train[:,0:-1]
+    # Remove non-finite values and areas with no training data
+    valid = numpy.isfinite(X_train).all(axis=1) & numpy.isfinite(y_train) \
+            & (y_train != 0)
+    X_train = X_train[valid]
+    y_train = y_train[valid]
 
     if y_train.shape[0] == 0:
         raise Exception('No valid training data found')
 
     # Train Random Forest
     if upscaling_model == "RandomForestRegressor":
-        rf = RandomForestRegressor(n_estimators=300, max_features=3, oob_score=True,
-                                   verbose=0, n_jobs=4, random_state=17)
+        if n_estimators == 'adaptive':
+            initial_n_estimators = ADAPTIVE_START_ESTIMATORS
+        else:
+            initial_n_estimators = int(n_estimators)
+        rf = RandomForestRegressor(n_estimators=initial_n_estimators,
+                                   max_features=3, oob_score=True,
+                                   verbose=0, n_jobs=cpu_budget.get_rf_n_jobs(),
+                                   random_state=17)
     elif upscaling_model == "LinearRegression":
         rf = linear_model.LinearRegression()
     else:
         raise NotImplementedError("The model '' is not recognised or available"
                                   "".format(upscaling_model))
     # Fit RF
-    rf.fit(X_train, y_train)
+    if upscaling_model == "RandomForestRegressor" and n_estimators == 'adaptive':
+        rf = fit_adaptive_forest(rf, X_train, y_train,
+                                 max_estimators=max_estimators,
+                                 oob_tolerance=oob_tolerance)
+    else:
+        rf.fit(X_train, y_train)
 
     r_sqr = rf.score(X_train, y_train)
     if upscaling_model == "RandomForestRegressor":
-        rmse = numpy.sqrt(((rf.oob_prediction_ - y_train)**2).mean())
+        rmse = _get_oob_rmse(rf, y_train)
         bias = (rf.oob_prediction_ - y_train).mean()
         var_importance = rf.feature_importances_
+        num_trees = len(rf.estimators_)
     else:
         rmse = numpy.nan
         bias = numpy.nan
         var_importance = []
-
-    # Save random forest variables
-    num_samples = y_train.shape[0]
-    average_sm_train = y_train.mean()
-    sd_sm_train = y_train.std()
-
-    no_data_vals = [layer.layer_nodata for layer in data_layers_list]
-    average_sm_predict, sd_sm_predict = apply_rf_image(in_data_stack,
-                                                       out_image, rf,
-                                                       no_data_vals)
+        num_trees = 0
 
     # Save parameters to output dictionary
     out_parameters_dict['varNames'] = var_names[:-1]
-    out_parameters_dict['averageSMTrain'] = average_sm_train
-    out_parameters_dict['sdSMTrain'] = sd_sm_train
+    out_parameters_dict['averageSMTrain'] = y_train.mean()
+    out_parameters_dict['sdSMTrain'] = y_train.std()
 
-    out_parameters_dict['nSamples'] = num_samples
+    out_parameters_dict['nSamples'] = y_train.shape[0]
     out_parameters_dict['varImportance'] = var_importance
     out_parameters_dict['RMSE'] = rmse
     out_parameters_dict['Bias'] = bias
     out_parameters_dict['RSq'] = r_sqr
+    out_parameters_dict['nTrees'] = num_trees
+
+    return rf, out_parameters_dict
+
+def run_random_forests(in_train_csv, in_data_stack, out_image, data_layers_list,
+                       train_data_col=3, upscaling_model="RandomForestRegressor",
+                       n_estimators=DEFAULT_N_ESTIMATORS,
+                       max_estimators=ADAPTIVE_MAX_ESTIMATORS,
+                       oob_tolerance=ADAPTIVE_OOB_TOLERANCE,
+                       uncertainty=False, quantiles=None, preview_factor=None):
+    """
+    Train random forests using a text file and apply to an image.
+
+    Requires:
+
+    * in_train_csv - CSV containing extracted values for each band
+    * in_data_stack - stack of all layers
+    * out_image - output image
+    * data_layers_list - list of DataLayers objects
+    * train_data_col - colum containing training data (default = 3)
+    * n_estimators - number of trees or 'adaptive' (see train_model)
+    * max_estimators - maximum number of trees if adaptive
+    * oob_tolerance - relative change in out-of-bag RMSE to stop at
+      if adaptive
+    * uncertainty - also write uncertainty bands (see apply_rf_image)
+    * quantiles - quantiles to write if uncertainty is True
+    * preview_factor - apply to the stack subsampled by this factor
+      (see apply_rf_image), the model is still trained on 'in_train_csv'
+
+    Returns dictionary containing parameters from Random Forests and average
+    soil moisture.
+    """
+
+    rf, out_parameters_dict = train_model(in_train_csv, data_layers_list,
+                                          train_data_col=train_data_col,
+                                          upscaling_model=upscaling_model,
+                                          n_estimators=n_estimators,
+                                          max_estimators=max_estimators,
+                                          oob_tolerance=oob_tolerance)
+
+    no_data_vals = [layer.layer_nodata for layer in data_layers_list]
+    average_sm_predict, sd_sm_predict = apply_rf_image(in_data_stack,
+                                                       out_image, rf,
+                                                       no_data_vals,
+                                                       uncertainty=uncertainty,
+                                                       quantiles=quantiles,
+                                                       preview_factor=preview_factor)
 
     out_parameters_dict['averageSMPredict'] = average_sm_predict
     out_parameters_dict['sdSMPredict'] = sd_sm_predict
 
     return out_parameters_dict
-
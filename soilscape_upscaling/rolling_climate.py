@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Dynamic layers derived from a window of daily climate data (e.g.,
+antecedent precipitation), updated incrementally as each date is run.
+
+A rolling layer is named as the daily layer followed by the method and
+window length in days:
+
+* sum - sum over the window (e.g., 'prism_ppt_sum7')
+* mean - mean over the window (e.g., 'prism_tmean_mean30')
+* api - antecedent precipitation index, where the previous value decays
+  by exp(-1 / window) each day before the new day is added
+  (e.g., 'prism_ppt_api7')
+
+An accumulator on the output grid is kept for each layer. For 'sum' and
+'mean' the warped daily arrays for the window are kept in a ring buffer
+so the day leaving the window is subtracted without reading it again.
+When run for consecutive dates only the daily file for the new date is
+read, whatever the window length. If there is a gap since the last date
+the missing days are read. For large gaps (or if dates are run out of
+order) the accumulator is rebuilt from the days in the window, or
+API_SPINUP_WINDOWS windows for 'api'.
+
+The accumulators can be saved to a directory so they are kept between
+runs.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import calendar
+import hashlib
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy
+from numpy.lib import format as npy_format
+from osgeo import gdal
+
+from . import dynamic_layers
+from . import upscaling_common
+
+#: Methods for rolling layers
+ROLLING_METHODS = ['sum', 'mean', 'api']
+
+#: Number of windows used to start an antecedent precipitation index
+API_SPINUP_WINDOWS = 5
+
+SECONDS_PER_DAY = 86400
+
+_ROLLING_LAYER_RE = re.compile(r'^(.+)_({})(\d+)$'.format('|'.join(ROLLING_METHODS)))
+
+def parse_rolling_layer(layer_type):
+    """
+    Split the name of a rolling layer (e.g., 'prism_ppt_api7') into the
+    daily layer, method and window in days.
+
+    Returns None if the layer isn't a rolling layer.
+    """
+    rolling_match = _ROLLING_LAYER_RE.match(layer_type)
+    if rolling_match is None:
+        return None
+    daily_layer, method, window = rolling_match.groups()
+    window = int(window)
+    if window < 1:
+        raise ValueError('The window for "{}" must be at least 1 day'.format(layer_type))
+    return daily_layer, method, window
+
+def get_api_decay(window):
+    """
+    Get the daily decay for an antecedent precipitation index with
+    an e-folding time of 'window' days.
+    """
+    return math.exp(-1.0 / float(window))
+
+def get_spinup_days(method, window):
+    """
+    Get the number of days read to build the accumulator for a rolling
+    layer from the start (the window, or API_SPINUP_WINDOWS windows for
+    'api').
+    """
+    if method == 'api':
+        return window * API_SPINUP_WINDOWS
+    return window
+
+def get_spinup_dates(layer_type, sm_date_ts):
+    """
+    Get the dates of the daily layers read to build the accumulator for a
+    rolling layer from the start, up to and including 'sm_date_ts'.
+
+    Returns list of dates (Python time structure).
+    """
+    _, method, window = parse_rolling_layer(layer_type)
+    day_number = _get_day_number(sm_date_ts)
+    first_day = day_number - get_spinup_days(method, window) + 1
+    return [_get_day_ts(day) for day in range(first_day, day_number + 1)]
+
+def _get_day_number(sm_date_ts):
+    day_ts = time.strptime(time.strftime('%Y%m%d', sm_date_ts), '%Y%m%d')
+    return calendar.timegm(day_ts) // SECONDS_PER_DAY
+
+def _get_day_ts(day_number):
+    return time.gmtime(day_number * SECONDS_PER_DAY)
+
+class RollingClimate(object):
+    """
+    Accumulators for rolling climate layers.
+
+    Safe to use from multiple threads.
+
+    Requires:
+
+    * state_dir - directory to save accumulators to (if None they are
+      only kept in memory)
+
+    """
+    def __init__(self, state_dir=None):
+        self.state_dir = state_dir
+        if self.state_dir is not None and not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Only pass the state directory when copied to another process
+        return {'state_dir' : self.state_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['state_dir'])
+
+    def _get_state_files(self, state_key):
+        base_name = os.path.join(self.state_dir, 'rolling_{}'.format(state_key))
+        return base_name + '.json', base_name + '_acc.npy', base_name + '_ring.npy'
+
+    def _load_state(self, state_key):
+        if state_key in self._states:
+            return self._states[state_key]
+        if self.state_dir is None:
+            return None
+        state_json, acc_file, ring_file = self._get_state_files(state_key)
+        if not os.path.isfile(state_json):
+            return None
+        with open(state_json, 'r') as in_f:
+            state = json.load(in_f)
+        # Accumulator wasn't saved after the last update
+        if state['updating']:
+            return None
+        state['acc'] = numpy.load(acc_file)
+        if os.path.isfile(ring_file):
+            state['ring'] = npy_format.open_memmap(ring_file, mode='r+')
+        else:
+            state['ring'] = None
+        self._states[state_key] = state
+        return state
+
+    def _save_state(self, state_key, state, updating=False):
+        self._states[state_key] = state
+        if self.state_dir is None:
+            return
+        state_json, acc_file, _ = self._get_state_files(state_key)
+        state['updating'] = updating
+        if not updating:
+            if state['ring'] is not None:
+                state['ring'].flush()
+            temp_acc = '{}.{}.tmp.npy'.format(acc_file, os.getpid())
+            numpy.save(temp_acc, state['acc'])
+            os.replace(temp_acc, acc_file)
+        json_state = dict([(k, v) for k, v in state.items() if k not in ['acc', 'ring']])
+        temp_json = '{}.{}.tmp'.format(state_json, os.getpid())
+        with open(temp_json, 'w') as out_f:
+            json.dump(json_state, out_f)
+        os.replace(temp_json, state_json)
+
+    def _new_state(self, state_key, method, window, day_array, geotransform,
+                   projection):
+        state = {'method' : method,
+                 'window' : window,
+                 'lastDay' : None,
+                 'slotDays' : [None] * window,
+                 'geotransform' : list(geotransform),
+                 'projection' : projection,
+                 'updating' : False,
+                 'acc' : numpy.zeros(day_array.shape, dtype=numpy.float64),
+                 'ring' : None}
+        if method != 'api':
+            ring_shape = (window,) + day_array.shape
+            if self.state_dir is None:
+                state['ring'] = numpy.zeros(ring_shape, dtype=numpy.float32)
+            else:
+                ring_file = self._get_state_files(state_key)[2]
+                state['ring'] = npy_format.open_memmap(ring_file, mode='w+',
+                                                       dtype=numpy.float32,
+                                                       shape=ring_shape)
+        return state
+
+    def _add_day(self, state, day_number, day_array):
+        """
+        Update accumulator with the array for the next day.
+        """
+        if state['method'] == 'api':
+            state['acc'] *= get_api_decay(state['window'])
+            state['acc'] += day_array
+        else:
+            slot = day_number % state['window']
+            # Remove day leaving the window
+            if state['slotDays'][slot] is not None:
+                state['acc'] -= state['ring'][slot]
+            state['ring'][slot] = day_array
+            state['acc'] += state['ring'][slot]
+            state['slotDays'][slot] = day_number
+            # Sum ring buffer once it has wrapped so rounding errors
+            # from adding and subtracting don't build up
+            if slot == state['window'] - 1:
+                valid = [s for s, d in enumerate(state['slotDays']) if d is not None]
+                state['acc'] = state['ring'][valid].sum(axis=0, dtype=numpy.float64)
+        state['lastDay'] = day_number
+
+    def get_layer(self, layer_type, layer_dir, sm_date_ts, temp_dir,
+                  bounding_box=None, resample_method=None,
+                  out_res=upscaling_common.UPSCALING_RES,
+                  out_proj=upscaling_common.UPSCALING_PROJ,
+                  warp_cache=None, climate_cubes=None):
+        """
+        Get a rolling layer for a date, reading the daily layers needed to
+        update the accumulator. Takes the same parameters as
+        dynamic_layers.get_reprojected_dynamic_layer.
+
+        If 'climate_cubes' is passed and all the daily layers needed are
+        in a cube they are read at once.
+
+        Returns:
+
+        * Path to layer and date of layer (string)
+
+        """
+        daily_layer, method, window = parse_rolling_layer(layer_type)
+        day_number = _get_day_number(sm_date_ts)
+        spinup_days = get_spinup_days(method, window)
+
+        state_key = hashlib.md5(json.dumps([layer_type, layer_dir, resample_method,
+                                            bounding_box, float(out_res),
+                                            out_proj]).encode()).hexdigest()[:16]
+
+        out_layer = os.path.join(temp_dir, '{}_subset.{}'.format(layer_type,
+                                                                 dynamic_layers.GDAL_EXT))
+
+        with self._lock:
+            state = self._load_state(state_key)
+            if state is not None and (state['lastDay'] is None or
+                                      state['lastDay'] > day_number or
+                                      day_number - state['lastDay'] > spinup_days):
+                state = None
+            if state is None:
+                first_day = day_number - spinup_days + 1
+            else:
+                first_day = state['lastDay'] + 1
+
+            if first_day <= day_number:
+                if state is not None:
+                    self._save_state(state_key, state, updating=True)
+                read_days = list(range(first_day, day_number + 1))
+                cube_data = None
+                if climate_cubes is not None:
+                    cube_data = climate_cubes.read_days(daily_layer, layer_dir,
+                                                        [_get_day_ts(d) for d in read_days],
+                                                        bounding_box, resample_method,
+                                                        out_res, out_proj)
+                if cube_data is not None:
+                    day_arrays, cube_geotransform, cube_projection = cube_data
+                    if state is None:
+                        state = self._new_state(state_key, method, window, day_arrays[0],
+                                                cube_geotransform, cube_projection)
+                    for read_day, day_array in zip(read_days, day_arrays):
+                        self._add_day(state, read_day, day_array)
+                    read_days = []
+                day_dir = tempfile.mkdtemp(prefix='rolling_', dir=temp_dir)
+                try:
+                    for read_day in read_days:
+                        day_layer, _ = \
+                            dynamic_layers.get_reprojected_dynamic_layer(daily_layer,
+                                                                         layer_dir,
+                                                                         _get_day_ts(read_day),
+                                                                         day_dir,
+                                                                         bounding_box,
+                                                                         resample_method,
+                                                                         out_res, out_proj,
+                                                                         warp_cache=warp_cache,
+                                                                         climate_cubes=climate_cubes)
+                        day_dataset = gdal.Open(day_layer, gdal.GA_ReadOnly)
+                        day_array = day_dataset.GetRasterBand(1).ReadAsArray().astype(numpy.float32)
+                        if state is None:
+                            state = self._new_state(state_key, method, window, day_array,
+                                                    day_dataset.GetGeoTransform(),
+                                                    day_dataset.GetProjection())
+                        day_dataset = None
+                        self._add_day(state, read_day, day_array)
+                finally:
+                    shutil.rmtree(day_dir)
+                self._save_state(state_key, state)
+
+            if method == 'mean':
+                num_days = len([d for d in state['slotDays'] if d is not None])
+                out_array = state['acc'] / float(num_days)
+            else:
+                out_array = state['acc']
+
+            geotransform = state['geotransform']
+            projection = state['projection']
+
+        driver = gdal.GetDriverByName(dynamic_layers.GDAL_FORMAT)
+        out_dataset = driver.Create(out_layer, out_array.shape[1], out_array.shape[0],
+                                    1, gdal.GDT_Float32)
+        out_dataset.SetGeoTransform(geotransform)
+        out_dataset.SetProjection(projection)
+        out_dataset.GetRasterBand(1).WriteArray(out_array.astype(numpy.float32))
+        out_dataset = None
+
+        return out_layer, time.strftime('%Y%m%d', sm_date_ts)
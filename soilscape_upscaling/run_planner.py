@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Functions to plan a run before any processing starts. For each date the
+dynamic layers are resolved and (optionally) the sensor data extracted,
+so dates which would fail are found before time is spent on other dates.
+Static layers are checked once for the whole run and an estimate of
+the disk space and processing needed is made.
+
+The plan can be written to a JSON file, checked, and then passed back to
+a site script which will only run the dates which can succeed.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import calendar
+import json
+import os
+import time
+
+from . import dynamic_layers
+from . import rolling_climate
+from . import tiling
+from . import upscaling_common
+
+# Bytes per pixel for each layer in the stack (Float32)
+STACK_BYTES_PER_PIXEL = 4
+
+#: Version of plan file format
+PLAN_VERSION = 2
+
+def check_static_layers(data_layers_list):
+    """
+    Check static layers (and the mask) exist, and the source of each
+    focal and terrain layer (which can't be dynamic for focal layers).
+
+    Returns a list of problems found (empty if there are none).
+    """
+    problems = []
+    layer_names = [layer.layer_name for layer in data_layers_list]
+    layer_types = dict([(layer.layer_name, layer.layer_type) for layer in data_layers_list])
+    for layer in data_layers_list:
+        if layer.layer_type == 'dynamic':
+            continue
+        if layer.layer_type in upscaling_common.DERIVED_LAYER_TYPES and \
+                layer.layer_source is not None:
+            if layer.layer_source not in layer_names:
+                problems.append('The source "{}" of {} layer "{}" is not one of the '
+                                'layers'.format(layer.layer_source, layer.layer_type,
+                                                layer.layer_name))
+            elif layer.layer_type == 'focal' and \
+                    layer_types[layer.layer_source] == 'dynamic':
+                problems.append('The source "{}" of focal layer "{}" can not be a dynamic '
+                                'layer'.format(layer.layer_source, layer.layer_name))
+            continue
+        if layer.layer_path is None:
+            problems.append('No path provided for layer "{}"'.format(layer.layer_name))
+        elif not os.path.isfile(layer.layer_path):
+            problems.append('The file "{}" for layer "{}" does not '
+                            'exist'.format(layer.layer_path, layer.layer_name))
+    return problems
+
+def _find_dynamic_layer(layer, sm_date_ts):
+    """
+    Find the file for a dynamic layer for a date.
+
+    Returns path and date of layer, or None and the problem found.
+    """
+    try:
+        layer_out = dynamic_layers.get_dynamic_layer(layer.layer_name, layer.layer_dir,
+                                                     sm_date_ts)
+    except Exception as err:
+        return None, str(err)
+    if layer_out is None or layer_out[0] is None:
+        return None, 'type not recognised'
+    layer_path, layer_date = layer_out
+    if not os.path.isfile(layer_path):
+        return None, 'file "{}" does not exist'.format(layer_path)
+    return layer_path, layer_date
+
+def resolve_dynamic_layers(data_layers_list, sm_date_ts):
+    """
+    Find the file for each dynamic layer for a date.
+
+    For rolling layers (see rolling_climate) the daily layer is found for
+    every day read to build the layer from the start (the window, or
+    rolling_climate.API_SPINUP_WINDOWS windows for 'api'), as the layers
+    for earlier dates may not have been run.
+
+    Returns a dictionary with the path and date of each layer, and a
+    list of problems found (empty if all layers were found).
+    """
+    resolved = {}
+    problems = []
+    for layer in data_layers_list:
+        if layer.layer_type != 'dynamic':
+            continue
+        layer_path, layer_date = _find_dynamic_layer(layer, sm_date_ts)
+        if layer_path is None:
+            problems.append('Dynamic layer "{}": {}'.format(layer.layer_name, layer_date))
+            continue
+        if rolling_climate.parse_rolling_layer(layer.layer_name) is not None:
+            spinup_dates = rolling_climate.get_spinup_dates(layer.layer_name, sm_date_ts)
+            missing_dates = [time.strftime('%Y%m%d', day_ts) for day_ts in spinup_dates
+                             if _find_dynamic_layer(layer, day_ts)[0] is None]
+            if len(missing_dates) > 0:
+                problems.append('Dynamic layer "{}": no daily layer for {} of the {} days '
+                                'needed ({})'.format(layer.layer_name, len(missing_dates),
+                                                     len(spinup_dates),
+                                                     ', '.join(missing_dates)))
+                continue
+        resolved[layer.layer_name] = {'path' : layer_path,
+                                      'date' : layer_date}
+    return resolved, problems
+
+def estimate_date_cost(data_layers_list, bounding_box=None,
+                       out_res=upscaling_common.UPSCALING_RES, num_trees=300):
+    """
+    Estimate the disk space and processing needed for a date.
+
+    Requires:
+
+    * data_layers_list - list of DataLayer objects
+    * bounding_box - bounding box of output (if None no estimate is made)
+    * out_res - output resolution
+    * num_trees - number of trees in the model
+
+    Returns dictionary with the number of pixels, the scratch space
+    (MB) needed for the stack and reprojected dynamic layers, the size
+    of the output image (MB) and the number of pixel-tree evaluations
+    needed to apply the model.
+    """
+    if bounding_box is None:
+        return None
+
+    min_x, min_y, max_x, max_y = tiling.parse_bounding_box(bounding_box)
+    num_pixels = int((max_x - min_x) / float(out_res) + 0.5) * \
+                 int((max_y - min_y) / float(out_res) + 0.5)
+
+    num_layers = len(data_layers_list)
+    num_dynamic = len([l for l in data_layers_list if l.layer_type == 'dynamic'])
+
+    return {'numPixels' : num_pixels,
+            'scratchMB' : num_pixels * (num_layers + num_dynamic)
+                          * STACK_BYTES_PER_PIXEL / 1e6,
+            'outputMB' : num_pixels * STACK_BYTES_PER_PIXEL / 1e6,
+            'pixelTrees' : num_pixels * num_trees}
+
+def make_plan(dates_ts_list, data_layers_list, bounding_box=None,
+              out_res=upscaling_common.UPSCALING_RES,
+              extract_sensors_func=None, sensor_dir=None, min_sensors=1,
+              num_trees=300, site_split=None):
+    """
+    Make a plan for a list of dates.
+
+    Requires:
+
+    * dates_ts_list - list of dates (Python time structure)
+    * data_layers_list - list of DataLayer objects
+    * bounding_box - bounding box of output (for estimates)
+    * out_res - output resolution (for estimates)
+    * extract_sensors_func - function to extract sensor data for a date,
+      called as extract_sensors_func(date_ts, out_csv) and returning the
+      number of sensors. If None sensor coverage isn't checked.
+    * sensor_dir - directory to save sensor data to (required if
+      extract_sensors_func is provided)
+    * min_sensors - minimum number of sensors needed to run a date
+    * num_trees - number of trees in the model (for estimates)
+    * site_split - dictionary with the split of sites into training and
+      validation sites used to extract sensor data (see get_site_split)
+      so the same split is used when the plan is run
+
+    Returns plan as a dictionary.
+    """
+    static_problems = check_static_layers(data_layers_list)
+
+    date_cost = estimate_date_cost(data_layers_list, bounding_box,
+                                   out_res, num_trees)
+
+    if extract_sensors_func is not None and not os.path.isdir(sensor_dir):
+        os.makedirs(sensor_dir)
+
+    dates_plan = []
+    for date_ts in dates_ts_list:
+        date_str = time.strftime('%Y%m%d', date_ts)
+        date_plan = {'date' : date_str,
+                     'epoch' : calendar.timegm(date_ts),
+                     'problems' : list(static_problems)}
+
+        date_plan['dynamicLayers'], dynamic_problems = \
+            resolve_dynamic_layers(data_layers_list, date_ts)
+        date_plan['problems'].extend(dynamic_problems)
+
+        # Only extract sensor data if the date can be run
+        if extract_sensors_func is not None and len(date_plan['problems']) == 0:
+            sensor_csv = os.path.join(sensor_dir,
+                                      '{}_sensor_data.csv'.format(date_str))
+            try:
+                num_sensors = extract_sensors_func(date_ts, sensor_csv)
+            except Exception as err:
+                num_sensors = 0
+                date_plan['problems'].append('Could not extract sensor '
+                                             'data: {}'.format(err))
+            date_plan['sensorCSV'] = os.path.abspath(sensor_csv)
+            date_plan['numSensors'] = num_sensors
+            if num_sensors < min_sensors:
+                date_plan['problems'].append('{} sensors found, at least {} are '
+                                             'needed'.format(num_sensors, min_sensors))
+
+        date_plan['run'] = len(date_plan['problems']) == 0
+        dates_plan.append(date_plan)
+
+    num_run = len([d for d in dates_plan if d['run']])
+
+    # Let providers prepare dynamic layers for the dates which will be run
+    dynamic_layers.prefetch_dynamic_layers(data_layers_list,
+                                           [time.gmtime(d['epoch']) for d in dates_plan
+                                            if d['run']])
+
+    plan = {'version' : PLAN_VERSION,
+            'created' : time.strftime('%Y-%m-%d %H:%M:%S'),
+            'staticProblems' : static_problems,
+            'dateCost' : date_cost,
+            'numDates' : len(dates_plan),
+            'numRun' : num_run,
+            'dates' : dates_plan}
+    if site_split is not None:
+        plan['siteSplit'] = site_split
+
+    if date_cost is not None:
+        plan['totalCost'] = {'outputMB' : date_cost['outputMB'] * num_run,
+                             'pixelTrees' : date_cost['pixelTrees'] * num_run}
+    return plan
+
+def print_plan_summary(plan):
+    """
+    Print summary of a plan.
+    """
+    for problem in plan['staticProblems']:
+        print('Static layer problem: {}'.format(problem))
+    for date_plan in plan['dates']:
+        if not date_plan['run']:
+            # Don't repeat problems with static layers for every date
+            date_problems = [problem for problem in date_plan['problems']
+                             if problem not in plan['staticProblems']]
+            if len(date_problems) == 0:
+                date_problems = ['problems with static layers']
+            print('Skipping {}: {}'.format(date_plan['date'],
+                                           '; '.join(date_problems)))
+    print('Planned {} of {} dates'.format(plan['numRun'], plan['numDates']))
+    if plan['dateCost'] is not None:
+        print('Each date: {} pixels, {:.1f} MB scratch, {:.1f} MB output, '
+              '{:.3g} pixel-tree evaluations'.format(plan['dateCost']['numPixels'],
+                                                     plan['dateCost']['scratchMB'],
+                                                     plan['dateCost']['outputMB'],
+                                                     plan['dateCost']['pixelTrees']))
+        print('All dates: {:.1f} MB output, {:.3g} pixel-tree '
+              'evaluations'.format(plan['totalCost']['outputMB'],
+                                   plan['totalCost']['pixelTrees']))
+
+def write_plan(plan, out_plan_file):
+    """
+    Write plan to a JSON file.
+    """
+    with open(out_plan_file, 'w') as out_f:
+        json.dump(plan, out_f, indent=2)
+
+def read_plan(in_plan_file):
+    """
+    Read plan from a JSON file.
+    """
+    with open(in_plan_file, 'r') as in_f:
+        plan = json.load(in_f)
+    if plan.get('version') != PLAN_VERSION:
+        raise Exception('The plan {} was created with a different version '
+                        'and needs to be created again'.format(in_plan_file))
+    return plan
+
+def get_site_split(plan):
+    """
+    Get the split of sites into training and validation sites a plan was
+    made with, as a dictionary with 'seed', 'trainSiteIDs' and
+    'validationSiteIDs'. Returns None if the plan doesn't have a split.
+    """
+    return plan.get('siteSplit')
+
+def get_run_dates(plan):
+    """
+    Get dictionary of dates to run from a plan, keyed by time since
+    epoch (seconds).
+    """
+    return {date_plan['epoch'] : date_plan for date_plan in plan['dates']
+            if date_plan['run']}
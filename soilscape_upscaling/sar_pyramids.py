@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Ingest airborne SAR scenes (AirMOSS and UAVSAR) to products aligned to
+the output grid, with overviews, so they only need to be averaged from
+the full resolution scene once.
+
+The closest scene is used for each date, so the same scene is selected
+for many consecutive dates and would otherwise be averaged (using
+'gdalwarp -r average') from full resolution for every date. Each scene
+is instead warped once to the bounding box and resolution of a config
+(the base resolution), using the resampling method of the layer, and
+for 'average' decimated overviews are built by averaging. When a layer
+is needed at the base resolution the product for the same resampling
+method is read in place of the scene. For 'average' products are also
+used for a multiple of the base resolution (e.g., for a config with a
+coarser resolution), the average of aligned base pixels is the average of the original
+pixels (apart from differences in no data), so outputs match warping
+from the scene.
+
+Products are named using the path, size and modification time of the
+scene, the resampling method and the grid, so a product is made again
+if a scene is replaced.
+
+Scenes are ingested the first time they are used, or all scenes for the
+SAR layers in a config can be ingested in advance::
+
+   python -m soilscape_upscaling.sar_pyramids tonzi_airmoss.cfg
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import argparse
+import configparser
+import hashlib
+import json
+import os
+import subprocess
+import threading
+
+from . import layer_providers
+from . import upscaling_common
+
+#: Overview levels to build for each product
+DEFAULT_OVERVIEW_LEVELS = [2, 4, 8, 16]
+
+#: Layer types which are ingested
+SAR_LAYER_TYPES = ['airmoss', 'uavsar']
+
+#: Resampling method used if not specified for a layer
+DEFAULT_RESAMPLE_METHOD = 'average'
+
+#: Resampling methods for which overviews are built, products for other
+#: methods are only used at the base resolution
+OVERVIEW_METHODS = ['average']
+
+GDAL_FORMAT = upscaling_common.UPSCALING_GDAL_FORMAT
+
+if GDAL_FORMAT == "ENVI":
+    GDAL_EXT = "bsq"
+elif GDAL_FORMAT == "GTiff":
+    GDAL_EXT = "tif"
+else:
+    GDAL_EXT = GDAL_FORMAT.lower()
+
+def is_sar_layer(layer_type):
+    """
+    Check if a layer type is an airborne SAR layer.
+    """
+    return any([layer_type.startswith(sar_type) for sar_type in SAR_LAYER_TYPES])
+
+def get_sar_scenes(layer_type, layer_dir):
+    """
+    Get list of all scenes (for all polarisations) for a SAR layer,
+    from the provider for the layer type.
+    """
+    if not is_sar_layer(layer_type):
+        raise ValueError('Layer type "{}" is not a SAR layer'.format(layer_type))
+    scene_files = layer_providers.get_provider(layer_type, layer_dir).list_files(refresh=True)
+    scenes_list = []
+    for date_key in sorted(scene_files.keys()):
+        for pol in ['HH', 'VV', 'HV']:
+            if os.path.isfile(scene_files[date_key][pol]):
+                scenes_list.append(scene_files[date_key][pol])
+    return scenes_list
+
+class SARPyramids(object):
+    """
+    Products for airborne SAR scenes aligned to a grid, with overviews.
+
+    Safe to use from multiple threads.
+
+    Requires:
+
+    * pyramid_dir - directory to save products to
+    * bounding_box - bounding box of grid
+    * base_res - resolution of products
+    * out_proj - projection of products
+    * overview_levels - list of overview levels to build
+
+    """
+    def __init__(self, pyramid_dir, bounding_box,
+                 base_res=upscaling_common.UPSCALING_RES,
+                 out_proj=upscaling_common.UPSCALING_PROJ,
+                 overview_levels=None):
+        self.pyramid_dir = pyramid_dir
+        self.bounding_box = [str(v).strip(',') for v in bounding_box]
+        self.base_res = float(base_res)
+        self.out_proj = out_proj
+        if overview_levels is None:
+            overview_levels = DEFAULT_OVERVIEW_LEVELS
+        self.overview_levels = overview_levels
+        if not os.path.isdir(self.pyramid_dir):
+            os.makedirs(self.pyramid_dir)
+        self._grid_key = hashlib.md5(json.dumps([self.bounding_box, self.base_res,
+                                                 self.out_proj]).encode()).hexdigest()[:16]
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'pyramid_dir' : self.pyramid_dir,
+                'bounding_box' : self.bounding_box,
+                'base_res' : self.base_res,
+                'out_proj' : self.out_proj,
+                'overview_levels' : self.overview_levels}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_product_path(self, in_scene, resample_method=DEFAULT_RESAMPLE_METHOD):
+        """
+        Get path of product for a scene and resampling method.
+        """
+        scene_name = os.path.splitext(os.path.basename(in_scene))[0]
+        scene_stat = os.stat(in_scene)
+        source_key = hashlib.md5(json.dumps([os.path.realpath(in_scene),
+                                             scene_stat.st_size,
+                                             scene_stat.st_mtime_ns]).encode()).hexdigest()[:8]
+        return os.path.join(self.pyramid_dir,
+                            '{}_{}_{}_{}.{}'.format(scene_name, resample_method,
+                                                    source_key, self._grid_key,
+                                                    GDAL_EXT))
+
+    def is_compatible(self, bounding_box=None, out_res=upscaling_common.UPSCALING_RES,
+                      out_proj=upscaling_common.UPSCALING_PROJ,
+                      resample_method=DEFAULT_RESAMPLE_METHOD):
+        """
+        Check if products can be used for a grid. The projection must be the
+        same, the resolution the base resolution (or a multiple of it for
+        methods with overviews) and the bounding box within the products
+        and aligned to their pixels.
+        """
+        if bounding_box is None or resample_method is None or \
+                out_proj != self.out_proj:
+            return False
+        res_factor = float(out_res) / self.base_res
+        if res_factor < 1 or abs(res_factor - round(res_factor)) > 1e-6:
+            return False
+        if round(res_factor) != 1 and resample_method not in OVERVIEW_METHODS:
+            return False
+        min_x, min_y, max_x, max_y = [float(str(v).strip(',')) for v in bounding_box]
+        base_min_x, base_min_y, base_max_x, base_max_y = [float(v) for v in self.bounding_box]
+        if min_x < base_min_x or min_y < base_min_y or \
+                max_x > base_max_x or max_y > base_max_y:
+            return False
+        for offset in [min_x - base_min_x, base_max_y - max_y]:
+            pixel_offset = offset / self.base_res
+            if abs(pixel_offset - round(pixel_offset)) > 1e-6:
+                return False
+        return True
+
+    def ingest(self, in_scene, resample_method=DEFAULT_RESAMPLE_METHOD,
+               overwrite=False):
+        """
+        Warp a scene to the grid and build overviews (for 'average').
+
+        Returns path to product.
+        """
+        out_product = self.get_product_path(in_scene, resample_method)
+        with self._lock:
+            if os.path.isfile(out_product) and not overwrite:
+                return out_product
+
+            print('Ingesting {} ({})'.format(in_scene, resample_method))
+            # Write to temporary file so partly ingested scenes aren't used
+            temp_product = '{}.{}.tmp.{}'.format(os.path.splitext(out_product)[0],
+                                                 os.getpid(), GDAL_EXT)
+            gdalwarp_cmd = ['gdalwarp', '-overwrite', '-q',
+                            '-r', resample_method,
+                            '-ot', 'Float32',
+                            '-of', GDAL_FORMAT,
+                            '-te']
+            gdalwarp_cmd.extend(self.bounding_box)
+            gdalwarp_cmd.extend(['-tr', str(self.base_res), str(self.base_res),
+                                 '-dstnodata', '0',
+                                 '-t_srs', self.out_proj,
+                                 in_scene, temp_product])
+            try:
+                subprocess.check_call(gdalwarp_cmd)
+                if len(self.overview_levels) > 0 and \
+                        resample_method in OVERVIEW_METHODS:
+                    gdaladdo_cmd = ['gdaladdo', '-q', '-r', resample_method, temp_product]
+                    gdaladdo_cmd.extend([str(level) for level in self.overview_levels])
+                    subprocess.check_call(gdaladdo_cmd)
+                os.replace(temp_product, out_product)
+            finally:
+                if os.path.isfile(temp_product):
+                    os.remove(temp_product)
+
+        return out_product
+
+    def get_layer(self, in_scene, bounding_box=None,
+                  out_res=upscaling_common.UPSCALING_RES,
+                  out_proj=upscaling_common.UPSCALING_PROJ,
+                  resample_method=DEFAULT_RESAMPLE_METHOD):
+        """
+        Get product to use in place of a scene for a grid and resampling
+        method, ingesting the scene if it hasn't been ingested.
+
+        Returns path to product or None if the grid isn't compatible.
+        """
+        if not self.is_compatible(bounding_box, out_res, out_proj, resample_method):
+            return None
+        return self.ingest(in_scene, resample_method)
+
+    def ingest_layer(self, layer_type, layer_dir, resample_method=None,
+                     overwrite=False):
+        """
+        Ingest all scenes for a SAR layer. If the resampling method isn't
+        specified the default for the layer type is used.
+
+        Returns list of products.
+        """
+        if resample_method is None:
+            provider_class = layer_providers.get_provider_class(layer_type)
+            resample_method = getattr(provider_class, 'resample_method',
+                                      DEFAULT_RESAMPLE_METHOD)
+        return [self.ingest(in_scene, resample_method, overwrite=overwrite)
+                for in_scene in get_sar_scenes(layer_type, layer_dir)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingest airborne SAR scenes for the '
+                                                 'layers in a config')
+    parser.add_argument("configfile", help="Config file")
+    parser.add_argument("--pyramid_dir", default=None,
+                        help="Directory for products (default is 'sar_pyramid_dir' "
+                             "from config)")
+    parser.add_argument("--overwrite", action='store_true', default=False,
+                        help="Ingest scenes which have already been ingested")
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read(args.configfile)
+
+    pyramid_dir = args.pyramid_dir
+    if pyramid_dir is None:
+        try:
+            pyramid_dir = config['default']['sar_pyramid_dir']
+        except KeyError:
+            raise KeyError('No "sar_pyramid_dir" in config, pass --pyramid_dir')
+
+    sar_pyramids = SARPyramids(pyramid_dir,
+                               config['default']['bounding_box'].replace(',', ' ').split(),
+                               base_res=config['default'].get('upscaling_res',
+                                                              upscaling_common.UPSCALING_RES))
+
+    ingested_dirs = []
+    for section in config.sections():
+        if not section.startswith('layer'):
+            continue
+        data_layer = upscaling_common.DataLayer(config[section])
+        if data_layer.layer_type != 'dynamic' or not is_sar_layer(data_layer.layer_name):
+            continue
+        # All polarisations are ingested for each directory
+        if (data_layer.layer_dir, data_layer.resample_method) in ingested_dirs:
+            continue
+        products = sar_pyramids.ingest_layer(data_layer.layer_name, data_layer.layer_dir,
+                                             resample_method=data_layer.resample_method,
+                                             overwrite=args.overwrite)
+        print('Ingested {} scenes from {}'.format(len(products), data_layer.layer_dir))
+        ingested_dirs.append((data_layer.layer_dir, data_layer.resample_method))
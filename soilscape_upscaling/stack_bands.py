@@ -11,12 +11,18 @@ licence is available to download with this file.
 
 """
 
+import copy
 import os
 import subprocess
 import time
 from osgeo import gdal
+from osgeo import osr
 from . import dynamic_layers
+from . import focal_layers as focal_layers_module
+from . import stage_cache as stage_cache_module
+from . import terrain_layers as terrain_layers_module
 from . import upscaling_common
+from . import warp_cache as warp_cache_module
 
 UPSCALING_PROJ = upscaling_common.UPSCALING_PROJ
 UPSCALING_RES = upscaling_common.UPSCALING_RES
@@ -58,14 +64,193 @@ def set_band_names(input_image, band_names_list, print_names=False):
 
     dataset = None
 
+def is_on_grid(in_raster, dst_grid):
+    """
+    Check if a raster is already on a target grid (see
+    warp_cache.get_target_grid), so it can be used without warping.
+    The projection and pixel size must be the same, the pixels aligned
+    and the raster must cover the target grid.
+    """
+    layer_grid = warp_cache_module.get_raster_grid(in_raster)
+    layer_gt = layer_grid['geotransform']
+    dst_gt = dst_grid['geotransform']
+    pixel_tol = 1e-6
+
+    if layer_gt[2] != 0 or layer_gt[4] != 0:
+        return False
+    if abs(layer_gt[1] - dst_gt[1]) > pixel_tol * abs(dst_gt[1]) or \
+            abs(layer_gt[5] - dst_gt[5]) > pixel_tol * abs(dst_gt[5]):
+        return False
+
+    col_offset = (dst_gt[0] - layer_gt[0]) / dst_gt[1]
+    row_offset = (dst_gt[3] - layer_gt[3]) / dst_gt[5]
+    if abs(col_offset - round(col_offset)) > pixel_tol or \
+            abs(row_offset - round(row_offset)) > pixel_tol:
+        return False
+    col_offset = int(round(col_offset))
+    row_offset = int(round(row_offset))
+    if col_offset < 0 or row_offset < 0 or \
+            col_offset + dst_grid['x_size'] > layer_grid['x_size'] or \
+            row_offset + dst_grid['y_size'] > layer_grid['y_size']:
+        return False
+
+    layer_srs = osr.SpatialReference()
+    layer_srs.ImportFromWkt(layer_grid['projection'])
+    dst_srs = osr.SpatialReference()
+    dst_srs.ImportFromWkt(dst_grid['projection'])
+    if layer_srs.IsSame(dst_srs):
+        return True
+
+    # The same projection can be defined differently (e.g., the Proj4
+    # string for UPSCALING_PROJ is kept in the WKT but not when written
+    # to GeoTIFF), so check the corners of the grid are the same in both
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        layer_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        dst_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(dst_srs, layer_srs)
+    min_x = dst_gt[0]
+    max_y = dst_gt[3]
+    max_x = min_x + dst_gt[1] * dst_grid['x_size']
+    min_y = max_y + dst_gt[5] * dst_grid['y_size']
+    corners = [(min_x, max_y), (max_x, max_y), (max_x, min_y), (min_x, min_y)]
+    for (dst_x, dst_y), layer_point in zip(corners, transform.TransformPoints(corners)):
+        if abs(layer_point[0] - dst_x) > pixel_tol * abs(dst_gt[1]) or \
+                abs(layer_point[1] - dst_y) > pixel_tol * abs(dst_gt[5]):
+            return False
+    return True
+
+def get_stack_grid(layer_paths, bounding_box=None, out_res=UPSCALING_RES,
+                   out_proj=UPSCALING_PROJ):
+    """
+    Get the output grid for a stack. If no bounding box is provided the
+    grid of the first layer is used, if it has the output projection and
+    resolution.
+
+    Returns grid as a dictionary (see warp_cache.get_target_grid) or
+    None if the grid isn't known without warping.
+    """
+    if bounding_box is not None:
+        return warp_cache_module.get_target_grid(bounding_box, out_res, out_proj)
+    layer_grid = warp_cache_module.get_raster_grid(layer_paths[0])
+    min_x = layer_grid['geotransform'][0]
+    max_y = layer_grid['geotransform'][3]
+    max_x = min_x + layer_grid['geotransform'][1] * layer_grid['x_size']
+    min_y = max_y + layer_grid['geotransform'][5] * layer_grid['y_size']
+    dst_grid = warp_cache_module.get_target_grid([min_x, min_y, max_x, max_y],
+                                                 out_res, out_proj)
+    if not is_on_grid(layer_paths[0], dst_grid):
+        return None
+    return dst_grid
+
+def warp_static_layers(data_layers_list, out_dir, bounding_box,
+                       out_res=UPSCALING_RES, out_proj=UPSCALING_PROJ):
+    """
+    Warp static layers (and the mask) to the output grid so they can
+    be reused when making the stack for many dates.
+
+    Layers which have already been warped to 'out_dir' are not
+    warped again.
+
+    Requires:
+
+    * data_layers_list - list of DataLayer objects
+    * out_dir - directory to save warped layers to
+    * bounding_box - bounding box of output grid
+    * out_res - output resolution
+    * out_proj - output projection
+
+    Returns a copy of data_layers_list with the path of static layers
+    changed to the warped layers. Focal and terrain layers with a static
+    source are changed to use the original source, so they can use data
+    beyond the grid.
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    out_layers_list = copy.deepcopy(data_layers_list)
+
+    static_paths = dict([(layer.layer_name, layer.layer_path) for layer in data_layers_list
+                         if layer.layer_type in ['static', 'mask']])
+    for data_layer in out_layers_list:
+        if data_layer.layer_type in upscaling_common.DERIVED_LAYER_TYPES and \
+                data_layer.layer_source in static_paths:
+            data_layer.layer_path = static_paths[data_layer.layer_source]
+            data_layer.layer_source = None
+
+    for data_layer in out_layers_list:
+        if data_layer.layer_type == 'dynamic' or \
+                data_layer.layer_type in upscaling_common.DERIVED_LAYER_TYPES:
+            continue
+        out_raster = os.path.join(out_dir, 'static_{}.{}'.format(data_layer.layer_name,
+                                                                 GDAL_EXT))
+        if not os.path.isfile(out_raster):
+            # Write to temporary file so partly warped layers aren't used
+            temp_raster = os.path.join(out_dir, 'temp_static_{}.{}'.format(data_layer.layer_name,
+                                                                           GDAL_EXT))
+            gdalwarp_cmd = ['gdalwarp', '-overwrite',
+                            '-ot', 'Float32',
+                            '-of', GDAL_FORMAT]
+            gdalwarp_cmd.extend(['-te'])
+            gdalwarp_cmd.extend(bounding_box)
+            gdalwarp_cmd.extend(['-t_srs', out_proj,
+                                 '-tr', str(out_res), str(out_res),
+                                 data_layer.layer_path, temp_raster])
+            subprocess.check_call(gdalwarp_cmd)
+            os.rename(temp_raster, out_raster)
+        data_layer.layer_path = out_raster
+
+    return out_layers_list
+
 def make_stack(data_layers_list, out_dir, sm_date_ts=None,
                bounding_box=None, out_res=UPSCALING_RES,
-               out_proj=UPSCALING_PROJ):
+               out_proj=UPSCALING_PROJ, warp_cache=None, stage_cache=None,
+               rolling_climate=None, sar_pyramids=None,
+               climate_cubes=None, focal_layers=None, terrain_layers=None,
+               full_bounding_box=None):
     """
     Makes a stack of all bands to be used in the upscaling.
 
     Takes a list of DataLayer objects
+
+    If a WarpTransformCache object is passed in as 'warp_cache' it is used
+    to reproject dynamic layers, so the mapping between grids is only
+    calculated once rather than for every date.
+
+    If a RollingClimate object is passed in as 'rolling_climate' it is
+    used for layers derived from a window of daily layers (e.g.,
+    'prism_ppt_api7').
+
+    If a SARPyramids object is passed in as 'sar_pyramids' AirMOSS and
+    UAVSAR layers are read from scenes ingested to the output grid.
+
+    If a ClimateCubes object is passed in as 'climate_cubes' PRISM and
+    ECMWF layers are read from the cube for the output grid, if the date
+    has been ingested.
+
+    If a FocalLayers object is passed in as 'focal_layers' focal layers
+    (see focal_layers) calculated previously for the grid are used,
+    otherwise they are calculated in 'out_dir'.
+
+    If a TerrainLayers object is passed in as 'terrain_layers' terrain
+    layers (see terrain_layers) calculated previously for the grid are
+    used, otherwise they are calculated in 'out_dir'. If 'bounding_box' is
+    a tile of a larger area, given as 'full_bounding_box', flow
+    accumulation and topographic wetness index are calculated for the
+    full area and the window for the tile is used.
+
+    If a StageCache object is passed in as 'stage_cache' a stack made
+    previously with the same layers, date and grid is used if available,
+    otherwise the stack is moved into the cache once it has been made.
+    Returns the path of the stack in the cache.
     """
+    stack_key = None
+    if stage_cache is not None:
+        stack_key = stage_cache_module.get_stack_key(data_layers_list, sm_date_ts,
+                                                     bounding_box, out_res, out_proj)
+        cache_stack = stage_cache.get_stack(stack_key, data_layers_list)
+        if cache_stack is not None:
+            print('Using stack from stage cache')
+            return cache_stack
 
     out_vrt = os.path.join(out_dir, 'upscaling_layers_stack.vrt')
     out_raster = os.path.join(out_dir, 'upscaling_layers_stack_ease.{}'.format(GDAL_EXT))
@@ -83,7 +268,11 @@ def make_stack(data_layers_list, out_dir, sm_date_ts=None,
                                                                  bounding_box,
                                                                  data_layer.resample_method,
                                                                  out_res,
-                                                                 out_proj)
+                                                                 out_proj,
+                                                                 warp_cache=warp_cache,
+                                                                 rolling_climate=rolling_climate,
+                                                                 sar_pyramids=sar_pyramids,
+                                                                 climate_cubes=climate_cubes)
             data_layer.layer_path = dynamic_path
             data_layer.layer_date = time.strptime(dynamic_date, '%Y%m%d')
 
@@ -91,6 +280,38 @@ def make_stack(data_layers_list, out_dir, sm_date_ts=None,
     band_names = [layer.layer_name for layer in data_layers_list]
     layer_paths = [layer.layer_path for layer in data_layers_list]
 
+    # Get focal and terrain layers (after dynamic layers, which can be a
+    # source). The path of the layer isn't changed as it can be the source.
+    for i, data_layer in enumerate(data_layers_list):
+        if data_layer.layer_type == 'focal':
+            if focal_layers is None:
+                focal_layers = focal_layers_module.FocalLayers(out_dir)
+            layer_paths[i] = focal_layers.get_layer(data_layer, data_layers_list,
+                                                    bounding_box, out_res, out_proj)
+        elif data_layer.layer_type == 'terrain':
+            if terrain_layers is None:
+                terrain_layers = terrain_layers_module.TerrainLayers(out_dir)
+            layer_paths[i] = terrain_layers.get_layer(data_layer, data_layers_list,
+                                                      bounding_box, out_res, out_proj,
+                                                      full_bounding_box)
+
+    # Check which layers are already on the output grid (e.g., warped
+    # static layers and dynamic layers) so they don't need warping again
+    dst_grid = get_stack_grid(layer_paths, bounding_box, out_res, out_proj)
+    if dst_grid is not None:
+        on_grid = [is_on_grid(layer_path, dst_grid) for layer_path in layer_paths]
+        # If only some layers aren't on the grid warp them separately,
+        # if none are warp the stack as before
+        if bounding_box is None and not all(on_grid):
+            dst_grid = None
+        elif not any(on_grid):
+            dst_grid = None
+
+    if dst_grid is not None:
+        return _make_stack_on_grid(data_layers_list, layer_paths, on_grid, dst_grid,
+                                   out_dir, out_res, out_proj, stage_cache,
+                                   stack_key)
+
     # Create VRT stack of all input layers
     vrt_cmd = ['gdalbuildvrt', '-separate', out_vrt]
     vrt_cmd.extend(layer_paths)
@@ -119,5 +340,81 @@ def make_stack(data_layers_list, out_dir, sm_date_ts=None,
 
     set_band_names(out_raster, band_names)
 
+    if stage_cache is not None:
+        out_raster = stage_cache.put_stack(stack_key, out_raster, data_layers_list)
+
     return out_raster
 
+def _make_stack_on_grid(data_layers_list, layer_paths, on_grid, dst_grid, out_dir,
+                        out_res=UPSCALING_RES, out_proj=UPSCALING_PROJ,
+                        stage_cache=None, stack_key=None):
+    """
+    Make a stack where layers are on the output grid. Layers which aren't
+    are warped separately, then all layers are combined as a VRT using a
+    window of each layer, rather than warping the stack.
+
+    If a stage cache is used the VRT is copied to GDAL_FORMAT (without
+    resampling) as the stack is moved into the cache and the layers
+    may be deleted.
+    """
+    band_names = [layer.layer_name for layer in data_layers_list]
+    layer_paths = list(layer_paths)
+
+    min_x = dst_grid['geotransform'][0]
+    max_y = dst_grid['geotransform'][3]
+    max_x = min_x + dst_grid['geotransform'][1] * dst_grid['x_size']
+    min_y = max_y + dst_grid['geotransform'][5] * dst_grid['y_size']
+    grid_bounding_box = ['{:.6f}'.format(v) for v in [min_x, min_y, max_x, max_y]]
+
+    for i, layer_path in enumerate(layer_paths):
+        if on_grid[i]:
+            continue
+        print('Warping {} to output grid'.format(band_names[i]))
+        warped_layer = os.path.join(out_dir, 'on_grid_{}.{}'.format(band_names[i],
+                                                                    GDAL_EXT))
+        gdalwarp_cmd = ['gdalwarp', '-overwrite',
+                        '-ot', 'Float32',
+                        '-of', GDAL_FORMAT]
+        gdalwarp_cmd.extend(['-te'])
+        gdalwarp_cmd.extend(grid_bounding_box)
+        gdalwarp_cmd.extend(['-t_srs', out_proj,
+                             '-tr', str(out_res), str(out_res),
+                             layer_path, warped_layer])
+        subprocess.check_call(gdalwarp_cmd)
+        layer_paths[i] = warped_layer
+
+    # Window of each layer for the grid
+    out_vrt = os.path.join(out_dir, 'upscaling_layers_stack.vrt')
+    vrt_cmd = ['gdalbuildvrt', '-overwrite', '-separate', '-te']
+    vrt_cmd.extend(grid_bounding_box)
+    vrt_cmd.extend(['-tr', str(out_res), str(out_res), out_vrt])
+    vrt_cmd.extend(layer_paths)
+    subprocess.check_call(vrt_cmd)
+
+    # Set data type to be the same as a warped stack
+    if stage_cache is None:
+        out_raster = os.path.join(out_dir, 'upscaling_layers_stack_ease.vrt')
+        translate_format = 'VRT'
+    else:
+        out_raster = os.path.join(out_dir, 'upscaling_layers_stack_ease.{}'.format(GDAL_EXT))
+        translate_format = GDAL_FORMAT
+    translate_cmd = ['gdal_translate', '-q',
+                     '-ot', 'Float32',
+                     '-of', translate_format,
+                     out_vrt, out_raster]
+    subprocess.check_call(translate_cmd)
+
+    set_band_names(out_raster, band_names)
+
+    # Set no data value from config for layers without one
+    dataset = gdal.Open(out_raster, gdal.GA_Update)
+    for i, data_layer in enumerate(data_layers_list):
+        band = dataset.GetRasterBand(i + 1)
+        if band.GetNoDataValue() is None and data_layer.layer_nodata is not None:
+            band.SetNoDataValue(data_layer.layer_nodata)
+    dataset = None
+
+    if stage_cache is not None:
+        out_raster = stage_cache.put_stack(stack_key, out_raster, data_layers_list)
+
+    return out_raster
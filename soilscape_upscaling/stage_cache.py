@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Cache of the outputs of the stages run for each date which don't depend
+on the model: sensor extraction, stacking (including warping dynamic
+layers) and extracting pixel values for each sensor (feature tables).
+
+Configs for a site are often only different in the model or in a few
+settings, so the same stages are run many times. Each output is stored
+under a key made from the inputs to the stage, so any run (of any
+config) with the same inputs uses the stored output rather than
+running the stage again:
+
+* sensors - sensor data source (from the config) and date
+* stacks - layers (name, type, path or directory, no data value and
+  resampling method), date, bounding box, resolution and projection
+* features - stack key, contents of the sensor data CSV and layer names
+
+The cache is not cleared automatically. If input layers or sensor data
+are changed (but the paths are the same) the cache should be deleted.
+Outputs are written to a temporary file and then moved into place so a
+cache can be shared between processes.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+
+from . import feature_store
+
+#: Keys in the [default] section of a config which define the sensor data
+SENSOR_CONFIG_KEYS = ['sqlite_db', 'sensor_data_dir', 'sensor_data', 'sensor_ids',
+                      'site_ids', 'num_train_sites', 'num_val_sites',
+                      'sensor_number', 'time_interval_hours']
+
+def _get_hash(key_items):
+    key_json = json.dumps(key_items, sort_keys=True)
+    return hashlib.md5(key_json.encode()).hexdigest()[:16]
+
+def _date_to_str(sm_date_ts):
+    if sm_date_ts is None:
+        return None
+    return time.strftime('%Y%m%d', sm_date_ts)
+
+def get_sensor_source(config_section, **kwargs):
+    """
+    Get a dictionary describing the source of sensor data for a config,
+    from the keys in SENSOR_CONFIG_KEYS. Any keyword arguments are added
+    (e.g., the list of sites actually used if these are randomly selected).
+    """
+    sensor_source = {}
+    for config_key in SENSOR_CONFIG_KEYS:
+        if config_key in config_section:
+            sensor_source[config_key] = ' '.join(config_section[config_key].split())
+    for source_key, source_value in kwargs.items():
+        if isinstance(source_value, (list, tuple)) or hasattr(source_value, 'tolist'):
+            source_value = [str(v) for v in source_value]
+        sensor_source[source_key] = source_value
+    return sensor_source
+
+def get_sensor_key(sensor_source, sm_date_ts=None):
+    """
+    Get key for sensor data extracted for a date.
+    """
+    return _get_hash(['sensors', sensor_source, _date_to_str(sm_date_ts)])
+
+def get_layers_key(data_layers_list, bounding_box=None, out_res=None,
+                   out_proj=None):
+    """
+    Get key for a set of layers on an output grid (excluding the date).
+    """
+    return _get_hash(['layers', feature_store.get_layer_set_hash(data_layers_list),
+                      [layer.resample_method for layer in data_layers_list],
+                      [_date_to_str(layer.layer_date) for layer in data_layers_list],
+                      None if bounding_box is None else [str(v) for v in bounding_box],
+                      None if out_res is None else float(out_res),
+                      out_proj])
+
+def get_stack_key(data_layers_list, sm_date_ts=None, bounding_box=None,
+                  out_res=None, out_proj=None):
+    """
+    Get key for a stack made for a date.
+    """
+    return _get_hash(['stack', get_layers_key(data_layers_list, bounding_box,
+                                              out_res, out_proj),
+                      _date_to_str(sm_date_ts)])
+
+def _get_file_hash(in_file):
+    file_hash = hashlib.md5()
+    with open(in_file, 'rb') as in_f:
+        for file_chunk in iter(lambda: in_f.read(1024 * 1024), b''):
+            file_hash.update(file_chunk)
+    return file_hash.hexdigest()
+
+class StageCache(object):
+    """
+    Cache of sensor data, stacks and feature tables.
+
+    Requires:
+
+    * cache_dir - directory for the cache (created if it doesn't exist)
+
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+        for stage in ['sensors', 'stacks', 'features']:
+            stage_dir = os.path.join(self.cache_dir, stage)
+            if not os.path.isdir(stage_dir):
+                os.makedirs(stage_dir, exist_ok=True)
+
+    def _get_file(self, stage, key, ext):
+        return os.path.join(self.cache_dir, stage, '{}.{}'.format(key, ext))
+
+    def _write_json(self, out_file, out_dict):
+        temp_file = '{}.{}.tmp'.format(out_file, uuid.uuid4().hex)
+        with open(temp_file, 'w') as out_f:
+            json.dump(out_dict, out_f)
+        os.replace(temp_file, out_file)
+
+    def _copy_in(self, in_file, out_file):
+        temp_file = '{}.{}.tmp'.format(out_file, uuid.uuid4().hex)
+        shutil.copy(in_file, temp_file)
+        os.replace(temp_file, out_file)
+
+    def extract_sensors(self, sensor_source, sm_date_ts, out_csv, extract_func):
+        """
+        Extract sensor data for a date to a CSV, using data already in
+        the cache if available.
+
+        Requires:
+
+        * sensor_source - dictionary describing sensor data (see get_sensor_source)
+        * sm_date_ts - date (Python time structure)
+        * out_csv - CSV to write sensor data to
+        * extract_func - function to extract sensor data, called as
+          extract_func(sm_date_ts, out_csv) and returning the number of
+          sensors (as for run_planner.make_plan)
+
+        Returns the number of sensors.
+        """
+        sensor_key = get_sensor_key(sensor_source, sm_date_ts)
+        cache_csv = self._get_file('sensors', sensor_key, 'csv')
+        cache_json = self._get_file('sensors', sensor_key, 'json')
+
+        if os.path.isfile(cache_json) and os.path.isfile(cache_csv):
+            with open(cache_json, 'r') as in_f:
+                sensor_info = json.load(in_f)
+            shutil.copy(cache_csv, out_csv)
+            return sensor_info['numSensors']
+
+        num_sensors = extract_func(sm_date_ts, out_csv)
+        if os.path.isfile(out_csv):
+            self._copy_in(out_csv, cache_csv)
+            self._write_json(cache_json, {'numSensors' : num_sensors})
+        return num_sensors
+
+    def get_stack(self, stack_key, data_layers_list):
+        """
+        Get a stack from the cache. The date of each dynamic layer used
+        in the stack is set in 'data_layers_list'.
+
+        Returns path to stack or None if it isn't in the cache.
+        """
+        cache_json = self._get_file('stacks', stack_key, 'json')
+        if not os.path.isfile(cache_json):
+            return None
+        with open(cache_json, 'r') as in_f:
+            stack_info = json.load(in_f)
+        cache_stack = os.path.join(self.cache_dir, 'stacks', stack_info['file'])
+        if not os.path.isfile(cache_stack):
+            return None
+
+        for data_layer in data_layers_list:
+            layer_date = stack_info['layerDates'].get(data_layer.layer_name)
+            if data_layer.layer_type == 'dynamic' and layer_date is not None:
+                data_layer.layer_date = time.strptime(layer_date, '%Y%m%d')
+        return cache_stack
+
+    def put_stack(self, stack_key, in_stack, data_layers_list):
+        """
+        Move a stack into the cache, recording the date of each
+        dynamic layer.
+
+        Returns the path of the stack in the cache.
+        """
+        stack_ext = os.path.splitext(in_stack)[1]
+        cache_stack = self._get_file('stacks', stack_key, stack_ext.lstrip('.'))
+        temp_stack = '{}.{}.tmp{}'.format(cache_stack, uuid.uuid4().hex, stack_ext)
+        shutil.move(in_stack, temp_stack)
+        os.replace(temp_stack, cache_stack)
+
+        layer_dates = {}
+        for data_layer in data_layers_list:
+            layer_dates[data_layer.layer_name] = _date_to_str(data_layer.layer_date)
+        self._write_json(self._get_file('stacks', stack_key, 'json'),
+                         {'file' : os.path.basename(cache_stack),
+                          'layerDates' : layer_dates})
+        return cache_stack
+
+    def get_stack_key_for_file(self, in_stack):
+        """
+        Get the key for a stack in the cache from the path.
+
+        Returns None if the stack isn't in the cache.
+        """
+        in_stack = os.path.abspath(in_stack)
+        if os.path.dirname(in_stack) != os.path.join(self.cache_dir, 'stacks'):
+            return None
+        return os.path.splitext(os.path.basename(in_stack))[0]
+
+    def get_features_key(self, stack_key, in_sensor_csv, data_layers_list):
+        """
+        Get key for the feature table for a stack and sensor data.
+        """
+        return _get_hash(['features', stack_key, _get_file_hash(in_sensor_csv),
+                          [layer.layer_name for layer in data_layers_list]])
+
+    def get_features(self, features_key, out_stats_csv):
+        """
+        Copy a feature table from the cache to 'out_stats_csv'.
+
+        Returns True if the table was in the cache.
+        """
+        cache_csv = self._get_file('features', features_key, 'csv')
+        if not os.path.isfile(cache_csv):
+            return False
+        shutil.copy(cache_csv, out_stats_csv)
+        return True
+
+    def put_features(self, features_key, in_stats_csv):
+        """
+        Copy a feature table into the cache.
+        """
+        self._copy_in(in_stats_csv, self._get_file('features', features_key, 'csv'))
+
+    def get_summary(self):
+        """
+        Get the number of items and size (MB) of each stage in the cache.
+        """
+        summary = {}
+        for stage, ext in [('sensors', '.csv'), ('stacks', '.json'), ('features', '.csv')]:
+            stage_dir = os.path.join(self.cache_dir, stage)
+            stage_files = [f for f in os.listdir(stage_dir) if not f.endswith('.tmp')]
+            summary[stage] = {'items' : len([f for f in stage_files if f.endswith(ext)]),
+                              'sizeMB' : sum([os.path.getsize(os.path.join(stage_dir, f))
+                                              for f in stage_files]) / 1e6}
+        return summary
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Index of the pixel (row and column) containing each station for a stack.
+
+Stations and the grid of the stack (geotransform, projection and size)
+are the same for every date in a run, and across runs, so the pixel for
+each station only needs to be found once. The locations of all new
+stations are transformed from WGS84 together, after which values can be
+read directly from the stack rather than calling 'gdallocationinfo'
+for every station and date.
+
+The index is held in memory and can optionally be saved to a directory
+(one JSON file for each grid) so it can be used by later runs.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+import numpy
+from osgeo import gdal
+from osgeo import osr
+
+from . import warp_cache
+
+def get_grid_key(grid):
+    """
+    Get key identifying a grid (as returned by warp_cache.get_raster_grid).
+    """
+    grid_json = json.dumps([[round(v, 6) for v in grid['geotransform']],
+                            grid['projection'],
+                            grid['x_size'], grid['y_size']])
+    return hashlib.md5(grid_json.encode()).hexdigest()[:16]
+
+def get_station_key(station_id, latitude, longitude):
+    """
+    Get key for a station, from the ID and location.
+    """
+    return '{}|{:.8f}|{:.8f}'.format(station_id, float(latitude), float(longitude))
+
+def get_station_pixels(grid, latitudes, longitudes):
+    """
+    Get the pixel (row, column) containing each station within a grid.
+    Follows the same convention as 'gdallocationinfo -geoloc -wgs84'.
+
+    Requires:
+
+    * grid - grid as returned by warp_cache.get_raster_grid
+    * latitudes - array of latitudes (WGS84)
+    * longitudes - array of longitudes (WGS84)
+
+    Returns arrays of rows and columns (which may be outside the grid).
+
+    """
+    latitudes = numpy.asarray(latitudes, dtype=float)
+    longitudes = numpy.asarray(longitudes, dtype=float)
+    if latitudes.size == 0:
+        return numpy.array([], dtype=int), numpy.array([], dtype=int)
+
+    wgs84_srs = osr.SpatialReference()
+    wgs84_srs.ImportFromEPSG(4326)
+    grid_srs = osr.SpatialReference()
+    grid_srs.ImportFromWkt(grid['projection'])
+    # Use longitude, latitude order with GDAL 3
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        wgs84_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        grid_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    transform = osr.CoordinateTransformation(wgs84_srs, grid_srs)
+    lon_lat = numpy.column_stack((longitudes, latitudes))
+    grid_coords = numpy.array(transform.TransformPoints(lon_lat.tolist()))
+
+    geotransform = grid['geotransform']
+    det = geotransform[1] * geotransform[5] - geotransform[2] * geotransform[4]
+    if det == 0:
+        raise ValueError('Geotransform can not be inverted')
+    x_offset = grid_coords[:, 0] - geotransform[0]
+    y_offset = grid_coords[:, 1] - geotransform[3]
+    cols = (geotransform[5] * x_offset - geotransform[2] * y_offset) / det
+    rows = (-geotransform[4] * x_offset + geotransform[1] * y_offset) / det
+
+    return numpy.floor(rows).astype(int), numpy.floor(cols).astype(int)
+
+class StationIndex(object):
+    """
+    Index of the pixel containing each station, for each grid used.
+
+    Safe to use from multiple threads.
+    """
+    def __init__(self, index_dir=None):
+        self.index_dir = index_dir
+        if self.index_dir is not None and not os.path.isdir(self.index_dir):
+            os.makedirs(self.index_dir)
+        self._grid_indexes = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Only pass the index directory when copied to another process
+        return {'index_dir' : self.index_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['index_dir'])
+
+    def _get_index_file(self, grid_key):
+        if self.index_dir is None:
+            return None
+        return os.path.join(self.index_dir, 'stations_{}.json'.format(grid_key))
+
+    def get_pixels(self, grid, station_ids, latitudes, longitudes):
+        """
+        Get the pixel (row, column) containing each station within
+        a grid, finding the pixel for stations not in the index.
+
+        Returns arrays of rows and columns.
+        """
+        grid_key = get_grid_key(grid)
+        station_keys = [get_station_key(station_id, latitude, longitude)
+                        for station_id, latitude, longitude
+                        in zip(station_ids, latitudes, longitudes)]
+
+        with self._lock:
+            grid_index = self._grid_indexes.get(grid_key)
+            index_file = self._get_index_file(grid_key)
+            if grid_index is None:
+                if index_file is not None and os.path.isfile(index_file):
+                    with open(index_file, 'r') as in_f:
+                        grid_index = json.load(in_f)
+                else:
+                    grid_index = {}
+                self._grid_indexes[grid_key] = grid_index
+
+            new_stations = [i for i, station_key in enumerate(station_keys)
+                            if station_key not in grid_index]
+            if len(new_stations) > 0:
+                new_rows, new_cols = get_station_pixels(grid,
+                                                        [float(latitudes[i]) for i in new_stations],
+                                                        [float(longitudes[i]) for i in new_stations])
+                for i, row, col in zip(new_stations, new_rows, new_cols):
+                    grid_index[station_keys[i]] = [int(row), int(col)]
+                if index_file is not None:
+                    temp_index_file = '{}.{}.tmp'.format(index_file, os.getpid())
+                    with open(temp_index_file, 'w') as out_f:
+                        json.dump(grid_index, out_f)
+                    os.replace(temp_index_file, index_file)
+
+            rows = numpy.array([grid_index[key][0] for key in station_keys], dtype=int)
+            cols = numpy.array([grid_index[key][1] for key in station_keys], dtype=int)
+
+        return rows, cols
+
+    def extract_values(self, input_stack, station_ids, latitudes, longitudes):
+        """
+        Extract the value of each band for each station.
+
+        Requires:
+
+        * input_stack - stack of all images to extract values from
+        * station_ids - list of station IDs
+        * latitudes - list of latitudes (WGS84)
+        * longitudes - list of longitudes (WGS84)
+
+        Returns list with the extracted values for each station
+        (as extract_image_stats.extract_stats_for_point) or None
+        if the station is outside the stack.
+
+        """
+        grid = warp_cache.get_raster_grid(input_stack)
+        rows, cols = self.get_pixels(grid, station_ids, latitudes, longitudes)
+
+        dataset = gdal.Open(input_stack, gdal.GA_ReadOnly)
+        if dataset is None:
+            raise IOError('Could not open {}'.format(input_stack))
+
+        out_values = []
+        for row, col in zip(rows, cols):
+            if row < 0 or col < 0 or row >= grid['y_size'] or col >= grid['x_size']:
+                out_values.append(None)
+            else:
+                pixel_vals = dataset.ReadAsArray(int(col), int(row), 1, 1)
+                out_values.append([float(val) for val in numpy.ravel(pixel_vals)])
+        dataset = None
+
+        return out_values
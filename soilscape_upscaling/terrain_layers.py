@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Terrain derivatives (slope, aspect, flow accumulation and topographic
+wetness index) calculated from a DEM on the output grid, rather than
+being calculated separately for each bounding box and resolution.
+
+Terrain layers are specified in the config like other layers, using the
+name of the DEM layer ('source') and the derivative ('derive')::
+
+   [layer_slope]
+   name = slope
+   source = elevation
+   derive = slope
+
+A 'path' can be given instead of 'source' to use a DEM which isn't one
+of the layers. The derivatives are:
+
+* slope - slope in degrees (Horn's method)
+* aspect - direction of slope in degrees clockwise from north (0 for
+  flat pixels)
+* flow_accum - number of pixels which flow through each pixel (including
+  the pixel), using D8 flow directions on the DEM with depressions
+  filled (Priority-Flood + epsilon)
+* twi - topographic wetness index, ln(a / tan(slope)), where a is the
+  upslope area per unit contour length from flow_accum
+
+The DEM is warped to the output grid extended by one pixel so slope and
+aspect don't have edge effects. Flow accumulation only includes area
+within the grid, so for catchments which extend beyond it a 'margin'
+(in metres) can be given, which the grid is extended by.
+
+Slope and aspect are calculated in blocks of rows, so large DEMs don't
+need to be read in one go. Flow accumulation depends on the whole
+catchment so is calculated for the full grid. When the grid is a tile
+of a larger area (see tiling) flow accumulation and topographic wetness
+index are calculated once for the full area, and each tile reads its
+window, so catchments aren't cut at tile edges.
+
+Layers are stored for each DEM (path, size and modification time),
+derivative and grid, so are only calculated once.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import hashlib
+import heapq
+import json
+import math
+import os
+import subprocess
+import threading
+
+import numpy
+from osgeo import gdal
+
+from . import upscaling_common
+from . import warp_cache as warp_cache_module
+
+#: No data value for terrain layers
+TERRAIN_NODATA = upscaling_common.TERRAIN_NODATA
+
+#: Number of rows to calculate slope and aspect for at once
+TERRAIN_BLOCK_ROWS = 1024
+
+#: Minimum slope (as tan(slope)) used for topographic wetness index
+TWI_MIN_TAN_SLOPE = 0.001
+
+#: Derivatives which depend on the whole catchment, so are calculated
+#: for the full area rather than each tile
+CATCHMENT_DERIVATIVES = ['flow_accum', 'twi']
+
+GDAL_FORMAT = upscaling_common.UPSCALING_GDAL_FORMAT
+
+if GDAL_FORMAT == "ENVI":
+    GDAL_EXT = "bsq"
+elif GDAL_FORMAT == "GTiff":
+    GDAL_EXT = "tif"
+else:
+    GDAL_EXT = GDAL_FORMAT.lower()
+
+#: Offsets (rows, columns) of the eight neighbours of a pixel
+D8_OFFSETS = [(-1, -1), (-1, 0), (-1, 1), (0, -1),
+              (0, 1), (1, -1), (1, 0), (1, 1)]
+
+def _get_horn_gradient(dem_block, pixel_size):
+    """
+    Get gradient towards east and north for the centre of each 3 x 3
+    window using Horn's method. The output is one pixel smaller than
+    the input on each side.
+    """
+    z_a = dem_block[:-2, :-2]
+    z_b = dem_block[:-2, 1:-1]
+    z_c = dem_block[:-2, 2:]
+    z_d = dem_block[1:-1, :-2]
+    z_f = dem_block[1:-1, 2:]
+    z_g = dem_block[2:, :-2]
+    z_h = dem_block[2:, 1:-1]
+    z_i = dem_block[2:, 2:]
+    dz_east = ((z_c + 2 * z_f + z_i) - (z_a + 2 * z_d + z_g)) / (8 * pixel_size)
+    dz_north = ((z_a + 2 * z_b + z_c) - (z_g + 2 * z_h + z_i)) / (8 * pixel_size)
+    return dz_east, dz_north
+
+def calc_slope(dem_block, pixel_size):
+    """
+    Calculate slope in degrees for a block of a DEM (which includes a
+    one pixel border).
+    """
+    dz_east, dz_north = _get_horn_gradient(dem_block, pixel_size)
+    return numpy.degrees(numpy.arctan(numpy.hypot(dz_east, dz_north)))
+
+def calc_aspect(dem_block, pixel_size):
+    """
+    Calculate aspect in degrees clockwise from north for a block of a DEM
+    (which includes a one pixel border). Flat pixels are set to 0.
+    """
+    dz_east, dz_north = _get_horn_gradient(dem_block, pixel_size)
+    aspect = numpy.degrees(numpy.arctan2(-dz_east, -dz_north)) % 360
+    aspect[(dz_east == 0) & (dz_north == 0)] = 0
+    return aspect
+
+def fill_depressions(dem):
+    """
+    Fill depressions in a DEM so every pixel drains to the edge of the
+    DEM (or a no data pixel), using Priority-Flood + epsilon (Barnes et
+    al., 2014). Flats are given a small gradient so they drain.
+
+    No data pixels (NaN) are left as NaN.
+    """
+    num_rows, num_cols = dem.shape
+    filled = dem.astype(numpy.float64).ravel()
+    is_nan = numpy.isnan(filled)
+
+    # Start from pixels on the edge or next to no data
+    edge = numpy.zeros(dem.shape, dtype=bool)
+    edge[0, :] = edge[-1, :] = edge[:, 0] = edge[:, -1] = True
+    nan_2d = is_nan.reshape(dem.shape)
+    padded_nan = numpy.pad(nan_2d, 1, mode='constant', constant_values=False)
+    for row_offset, col_offset in D8_OFFSETS:
+        edge |= padded_nan[1 + row_offset:1 + row_offset + num_rows,
+                           1 + col_offset:1 + col_offset + num_cols]
+    edge = edge.ravel() & ~is_nan
+
+    closed = (is_nan | edge).tolist()
+    filled_list = filled.tolist()
+    queue = [(filled_list[i], i) for i in numpy.flatnonzero(edge).tolist()]
+    heapq.heapify(queue)
+
+    while queue:
+        elevation, pixel = heapq.heappop(queue)
+        row, col = divmod(pixel, num_cols)
+        for row_offset, col_offset in D8_OFFSETS:
+            n_row = row + row_offset
+            n_col = col + col_offset
+            if n_row < 0 or n_row >= num_rows or n_col < 0 or n_col >= num_cols:
+                continue
+            neighbour = n_row * num_cols + n_col
+            if closed[neighbour]:
+                continue
+            closed[neighbour] = True
+            min_elevation = math.nextafter(elevation, math.inf)
+            if filled_list[neighbour] < min_elevation:
+                filled_list[neighbour] = min_elevation
+            heapq.heappush(queue, (filled_list[neighbour], neighbour))
+
+    return numpy.array(filled_list, dtype=numpy.float64).reshape(dem.shape)
+
+def get_d8_receivers(dem):
+    """
+    Get the index (of the flattened DEM) of the neighbour each pixel
+    drains to, using the steepest drop. Pixels on the edge or next to
+    no data drain out of the DEM if they don't have a lower neighbour
+    and are given -1.
+
+    The drop is calculated per pixel rather than per metre, so the very
+    small differences from filling flats at 0 m aren't lost.
+    """
+    num_rows, num_cols = dem.shape
+    padded = numpy.pad(dem, 1, mode='constant', constant_values=numpy.nan)
+    max_drop = numpy.zeros(dem.shape, dtype=numpy.float64)
+    receivers = numpy.full(dem.shape, -1, dtype=numpy.int64)
+    row_index, col_index = numpy.indices(dem.shape)
+
+    for row_offset, col_offset in D8_OFFSETS:
+        neighbour = padded[1 + row_offset:1 + row_offset + num_rows,
+                           1 + col_offset:1 + col_offset + num_cols]
+        distance = math.hypot(row_offset, col_offset)
+        drop = (dem - neighbour) / distance
+        steeper = drop > max_drop
+        max_drop[steeper] = drop[steeper]
+        receivers[steeper] = ((row_index[steeper] + row_offset) * num_cols
+                              + col_index[steeper] + col_offset)
+
+    receivers[numpy.isnan(dem)] = -1
+    return receivers.ravel()
+
+def accumulate_flow(receivers, valid):
+    """
+    Calculate the number of pixels which flow through each pixel (including
+    the pixel) from D8 receivers. Pixels are processed in order from the
+    top of each catchment, all pixels without any remaining upslope
+    pixels at once.
+    """
+    accumulation = valid.astype(numpy.float64)
+    has_receiver = receivers >= 0
+    in_degree = numpy.bincount(receivers[has_receiver], minlength=receivers.size)
+
+    current = numpy.flatnonzero((in_degree == 0) & has_receiver)
+    while current.size > 0:
+        current_receivers = receivers[current]
+        numpy.add.at(accumulation, current_receivers, accumulation[current])
+        numpy.subtract.at(in_degree, current_receivers, 1)
+        current = numpy.unique(current_receivers[in_degree[current_receivers] == 0])
+        current = current[receivers[current] >= 0]
+
+    return accumulation
+
+def calc_flow_accumulation(dem):
+    """
+    Calculate flow accumulation (number of pixels) for a DEM, filling
+    depressions first. No data pixels are NaN.
+    """
+    valid = ~numpy.isnan(dem).ravel()
+    filled = fill_depressions(dem)
+    receivers = get_d8_receivers(filled)
+    accumulation = accumulate_flow(receivers, valid).reshape(dem.shape)
+    accumulation[~valid.reshape(dem.shape)] = numpy.nan
+    return accumulation
+
+def calc_twi(flow_accumulation, slope, pixel_size):
+    """
+    Calculate topographic wetness index from flow accumulation (pixels)
+    and slope (degrees).
+    """
+    specific_area = flow_accumulation * pixel_size
+    tan_slope = numpy.maximum(numpy.tan(numpy.radians(slope)), TWI_MIN_TAN_SLOPE)
+    return numpy.log(specific_area / tan_slope)
+
+def _read_rows(band, first_row, last_row):
+    """
+    Read rows from a band, with a one pixel border (repeating the edge
+    pixels of the band where needed).
+    """
+    num_rows = band.YSize
+    read_first = max(first_row - 1, 0)
+    read_last = min(last_row + 1, num_rows)
+    block = band.ReadAsArray(0, read_first, band.XSize,
+                             read_last - read_first).astype(numpy.float64)
+    return numpy.pad(block, ((read_first - (first_row - 1), (last_row + 1) - read_last),
+                             (1, 1)), mode='edge')
+
+def _create_layer(out_layer, x_size, y_size, geotransform, projection):
+    driver = gdal.GetDriverByName(GDAL_FORMAT)
+    out_dataset = driver.Create(out_layer, x_size, y_size, 1, gdal.GDT_Float32)
+    out_dataset.SetGeoTransform(geotransform)
+    out_dataset.SetProjection(projection)
+    out_dataset.GetRasterBand(1).SetNoDataValue(TERRAIN_NODATA)
+    return out_dataset
+
+def _write_rows(out_dataset, out_array, first_row):
+    out_array = numpy.where(numpy.isnan(out_array), TERRAIN_NODATA, out_array)
+    out_dataset.GetRasterBand(1).WriteArray(out_array.astype(numpy.float32), 0, first_row)
+
+class TerrainLayers(object):
+    """
+    Terrain derivatives of DEMs, stored for each DEM, derivative and grid.
+
+    Safe to use from multiple threads.
+
+    Requires:
+
+    * terrain_dir - directory to save layers to
+
+    """
+    def __init__(self, terrain_dir):
+        self.terrain_dir = terrain_dir
+        if not os.path.isdir(self.terrain_dir):
+            os.makedirs(self.terrain_dir)
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        return {'terrain_dir' : self.terrain_dir}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def get_dem_fingerprint(self, dem_path):
+        """
+        Get fingerprint for a DEM from the path, size and modification time
+        so layers are calculated again if it changes.
+        """
+        dem_stat = os.stat(dem_path)
+        return [os.path.abspath(dem_path), dem_stat.st_size, int(dem_stat.st_mtime)]
+
+    def get_layer_path(self, dem_path, derivative, bounding_box=None,
+                       out_res=upscaling_common.UPSCALING_RES,
+                       out_proj=upscaling_common.UPSCALING_PROJ, margin=0,
+                       dem_nodata=None):
+        """
+        Get path of layer for a derivative of a DEM on a grid.
+        """
+        # Slope and aspect don't depend on the margin
+        if derivative in ['slope', 'aspect']:
+            margin = 0
+        key_json = json.dumps([self.get_dem_fingerprint(dem_path), derivative,
+                               None if bounding_box is None else
+                               ['{:.6f}'.format(float(str(v).strip(','))) for v in bounding_box],
+                               float(out_res), out_proj, float(margin), dem_nodata])
+        layer_key = hashlib.md5(key_json.encode()).hexdigest()[:16]
+        return os.path.join(self.terrain_dir, 'terrain_{}_{}.{}'.format(layer_key, derivative,
+                                                                         GDAL_EXT))
+
+    def _warp_dem(self, dem_path, out_dem, bounding_box, out_res, out_proj,
+                  pad_pixels, dem_nodata):
+        """
+        Warp DEM to grid extended by 'pad_pixels'.
+        """
+        gdalwarp_cmd = ['gdalwarp', '-overwrite', '-q',
+                        '-r', 'bilinear',
+                        '-ot', 'Float32',
+                        '-of', GDAL_FORMAT]
+        if bounding_box is not None:
+            min_x, min_y, max_x, max_y = [float(str(v).strip(',')) for v in bounding_box]
+            pad = pad_pixels * float(out_res)
+            gdalwarp_cmd.extend(['-te'])
+            gdalwarp_cmd.extend(['{:.6f}'.format(v) for v in [min_x - pad, min_y - pad,
+                                                             max_x + pad, max_y + pad]])
+        if dem_nodata is not None:
+            gdalwarp_cmd.extend(['-srcnodata', str(dem_nodata)])
+        gdalwarp_cmd.extend(['-dstnodata', 'nan',
+                             '-t_srs', out_proj,
+                             '-tr', str(out_res), str(out_res),
+                             dem_path, out_dem])
+        subprocess.check_call(gdalwarp_cmd)
+
+    def compute(self, dem_path, derivative, bounding_box=None,
+                out_res=upscaling_common.UPSCALING_RES,
+                out_proj=upscaling_common.UPSCALING_PROJ, margin=0,
+                dem_nodata=None, overwrite=False):
+        """
+        Calculate a terrain derivative of a DEM on a grid, if it hasn't
+        already been calculated.
+
+        Requires:
+
+        * dem_path - path to DEM
+        * derivative - 'slope', 'aspect', 'flow_accum' or 'twi'
+        * bounding_box - bounding box of grid (if not provided the extent
+          of the DEM is used)
+        * out_res - output resolution
+        * out_proj - output projection
+        * margin - distance (m) to extend the grid by for flow accumulation
+        * dem_nodata - no data value of DEM (if not set in file)
+
+        Returns path to layer.
+        """
+        if derivative not in upscaling_common.TERRAIN_DERIVATIVES:
+            raise ValueError('Unknown terrain derivative "{}"'.format(derivative))
+        out_layer = self.get_layer_path(dem_path, derivative, bounding_box, out_res,
+                                        out_proj, margin, dem_nodata)
+        with self._lock:
+            if os.path.isfile(out_layer) and not overwrite:
+                return out_layer
+
+            print('Calculating {} from {}'.format(derivative, dem_path))
+            out_res = float(out_res)
+            temp_layer = '{}.{}.tmp.{}'.format(os.path.splitext(out_layer)[0],
+                                               os.getpid(), GDAL_EXT)
+            temp_dem = '{}.{}.dem.tmp.{}'.format(os.path.splitext(out_layer)[0],
+                                                 os.getpid(), GDAL_EXT)
+            try:
+                if derivative in ['slope', 'aspect']:
+                    self._compute_local(dem_path, derivative, temp_dem, temp_layer,
+                                        bounding_box, out_res, out_proj, dem_nodata)
+                elif derivative == 'flow_accum':
+                    self._compute_flow_accum(dem_path, temp_dem, temp_layer,
+                                             bounding_box, out_res, out_proj, margin,
+                                             dem_nodata)
+                else:
+                    self._compute_twi(dem_path, temp_layer, bounding_box, out_res,
+                                      out_proj, margin, dem_nodata)
+                os.replace(temp_layer, out_layer)
+            finally:
+                for temp_file in [temp_dem, temp_layer]:
+                    if os.path.isfile(temp_file):
+                        os.remove(temp_file)
+
+        return out_layer
+
+    def _compute_local(self, dem_path, derivative, temp_dem, out_layer,
+                       bounding_box, out_res, out_proj, dem_nodata):
+        """
+        Calculate slope or aspect in blocks of rows.
+        """
+        pad_pixels = 0 if bounding_box is None else 1
+        self._warp_dem(dem_path, temp_dem, bounding_box, out_res, out_proj,
+                       pad_pixels, dem_nodata)
+        dem_grid = warp_cache_module.get_raster_grid(temp_dem)
+        dem_dataset = gdal.Open(temp_dem, gdal.GA_ReadOnly)
+        dem_band = dem_dataset.GetRasterBand(1)
+
+        geotransform = list(dem_grid['geotransform'])
+        geotransform[0] += pad_pixels * geotransform[1]
+        geotransform[3] += pad_pixels * geotransform[5]
+        x_size = dem_grid['x_size'] - 2 * pad_pixels
+        y_size = dem_grid['y_size'] - 2 * pad_pixels
+        out_dataset = _create_layer(out_layer, x_size, y_size, geotransform,
+                                    dem_grid['projection'])
+
+        if derivative == 'slope':
+            calc_function = calc_slope
+        else:
+            calc_function = calc_aspect
+
+        for first_row in range(0, y_size, TERRAIN_BLOCK_ROWS):
+            last_row = min(first_row + TERRAIN_BLOCK_ROWS, y_size)
+            dem_block = _read_rows(dem_band, first_row + pad_pixels,
+                                   last_row + pad_pixels)
+            out_block = calc_function(dem_block, out_res)
+            if pad_pixels > 0:
+                out_block = out_block[:, pad_pixels:-pad_pixels]
+            _write_rows(out_dataset, out_block, first_row)
+
+        out_dataset = None
+        dem_dataset = None
+
+    def _compute_flow_accum(self, dem_path, temp_dem, out_layer, bounding_box,
+                            out_res, out_proj, margin, dem_nodata):
+        """
+        Calculate flow accumulation for the grid extended by the margin.
+        """
+        if bounding_box is None:
+            pad_pixels = 0
+        else:
+            pad_pixels = int(math.ceil(float(margin) / out_res))
+        self._warp_dem(dem_path, temp_dem, bounding_box, out_res, out_proj,
+                       pad_pixels, dem_nodata)
+        dem_grid = warp_cache_module.get_raster_grid(temp_dem)
+        dem_dataset = gdal.Open(temp_dem, gdal.GA_ReadOnly)
+        dem = dem_dataset.GetRasterBand(1).ReadAsArray().astype(numpy.float64)
+        dem_dataset = None
+
+        accumulation = calc_flow_accumulation(dem)
+
+        geotransform = list(dem_grid['geotransform'])
+        if pad_pixels > 0:
+            accumulation = accumulation[pad_pixels:-pad_pixels, pad_pixels:-pad_pixels]
+            geotransform[0] += pad_pixels * geotransform[1]
+            geotransform[3] += pad_pixels * geotransform[5]
+        out_dataset = _create_layer(out_layer, accumulation.shape[1], accumulation.shape[0],
+                                    geotransform, dem_grid['projection'])
+        _write_rows(out_dataset, accumulation, 0)
+        out_dataset = None
+
+    def _compute_twi(self, dem_path, out_layer, bounding_box, out_res, out_proj,
+                     margin, dem_nodata):
+        """
+        Calculate topographic wetness index from slope and flow accumulation
+        (calculating these if needed).
+        """
+        slope_layer = self.compute(dem_path, 'slope', bounding_box, out_res, out_proj,
+                                   margin, dem_nodata)
+        accum_layer = self.compute(dem_path, 'flow_accum', bounding_box, out_res,
+                                   out_proj, margin, dem_nodata)
+        slope_grid = warp_cache_module.get_raster_grid(slope_layer)
+        slope_dataset = gdal.Open(slope_layer, gdal.GA_ReadOnly)
+        accum_dataset = gdal.Open(accum_layer, gdal.GA_ReadOnly)
+        out_dataset = _create_layer(out_layer, slope_grid['x_size'], slope_grid['y_size'],
+                                    slope_grid['geotransform'], slope_grid['projection'])
+
+        for first_row in range(0, slope_grid['y_size'], TERRAIN_BLOCK_ROWS):
+            num_rows = min(TERRAIN_BLOCK_ROWS, slope_grid['y_size'] - first_row)
+            slope = slope_dataset.GetRasterBand(1).ReadAsArray(0, first_row,
+                                                               slope_grid['x_size'],
+                                                               num_rows).astype(numpy.float64)
+            accumulation = accum_dataset.GetRasterBand(1).ReadAsArray(0, first_row,
+                                                                      slope_grid['x_size'],
+                                                                      num_rows).astype(numpy.float64)
+            no_data = (slope == TERRAIN_NODATA) | (accumulation == TERRAIN_NODATA)
+            twi = calc_twi(accumulation, slope, out_res)
+            twi[no_data] = numpy.nan
+            _write_rows(out_dataset, twi, first_row)
+
+        out_dataset = None
+        slope_dataset = None
+        accum_dataset = None
+
+    def get_layer(self, data_layer, data_layers_list, bounding_box=None,
+                  out_res=upscaling_common.UPSCALING_RES,
+                  out_proj=upscaling_common.UPSCALING_PROJ,
+                  full_bounding_box=None):
+        """
+        Get path to a terrain layer for a grid, calculating it if needed.
+
+        Requires:
+
+        * data_layer - DataLayer object for terrain layer
+        * data_layers_list - list of DataLayer objects containing the source
+        * bounding_box - bounding box of grid
+        * out_res - output resolution
+        * out_proj - output projection
+        * full_bounding_box - bounding box of the full area if the grid is
+          a tile (see tiling.get_tile_bounding_boxes). Flow accumulation
+          and topographic wetness index are calculated for the full area
+          and the layer covers the full area rather than the tile.
+
+        """
+        dem_path, dem_nodata = upscaling_common.get_source_path(data_layer,
+                                                                data_layers_list)
+        if full_bounding_box is not None and \
+                data_layer.terrain_derivative in CATCHMENT_DERIVATIVES:
+            bounding_box = full_bounding_box
+        return self.compute(dem_path, data_layer.terrain_derivative, bounding_box,
+                            out_res, out_proj, data_layer.terrain_margin, dem_nodata)
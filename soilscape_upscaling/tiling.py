@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Functions for running upscaling over large domains by splitting
+the bounding box into aligned tiles. Stacks are built and the model
+applied to each tile in parallel, the model is trained once using
+stations from all tiles and the tile outputs are mosaicked.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import copy
+import csv
+import math
+import multiprocessing
+import os
+import shutil
+import subprocess
+
+import numpy
+import pandas
+from osgeo import osr
+
+from . import extract_image_stats
+from . import rf_upscaling
+from . import stack_bands
+from . import terrain_layers as terrain_layers_module
+from . import upscaling_common
+from . import upscaling_utilities
+
+UPSCALING_PROJ = upscaling_common.UPSCALING_PROJ
+UPSCALING_RES = upscaling_common.UPSCALING_RES
+
+#: Default size of tiles (in pixels)
+DEFAULT_TILE_SIZE = 2000
+
+def parse_bounding_box(bounding_box):
+    """
+    Convert bounding box (list of strings as read from config file)
+    to a list of floats [min_x, min_y, max_x, max_y].
+
+    Any commas separating values are removed.
+    """
+    bounding_box_vals = [float(str(val).strip(',')) for val in bounding_box]
+    if len(bounding_box_vals) != 4:
+        raise ValueError('Expected four values for bounding box, got '
+                         '{}'.format(len(bounding_box_vals)))
+    return bounding_box_vals
+
+def get_tile_bounding_boxes(bounding_box, out_res=UPSCALING_RES,
+                            tile_size=DEFAULT_TILE_SIZE):
+    """
+    Split a bounding box into tiles aligned to the output grid.
+
+    The grid follows the convention used by gdalwarp when both '-te'
+    and '-tr' are given: pixels start at the minimum x and maximum y
+    coordinate of the bounding box and the number of pixels is rounded
+    to the nearest whole pixel.
+
+    Requires:
+
+    * bounding_box - bounding box (min_x min_y max_x max_y)
+    * out_res - output resolution
+    * tile_size - size of each tile (in pixels)
+
+    Returns:
+
+    * List of bounding boxes, one for each tile, as lists of strings
+      which can be passed to make_stack.
+
+    """
+    min_x, min_y, max_x, max_y = parse_bounding_box(bounding_box)
+    out_res = float(out_res)
+    tile_size = int(tile_size)
+
+    num_cols = int((max_x - min_x) / out_res + 0.5)
+    num_rows = int((max_y - min_y) / out_res + 0.5)
+
+    tile_bounding_boxes = []
+
+    for row_start in range(0, num_rows, tile_size):
+        row_end = min(row_start + tile_size, num_rows)
+        for col_start in range(0, num_cols, tile_size):
+            col_end = min(col_start + tile_size, num_cols)
+            tile_bounding_box = [min_x + col_start * out_res,
+                                 max_y - row_end * out_res,
+                                 min_x + col_end * out_res,
+                                 max_y - row_start * out_res]
+            tile_bounding_boxes.append([repr(val) for val in tile_bounding_box])
+
+    return tile_bounding_boxes
+
+def _get_sensor_proj_coords(in_sensor_csv, out_proj=UPSCALING_PROJ):
+    """
+    Get coordinates of sensors in the output projection.
+
+    Returns two arrays containing the x and y coordinates
+    of each line in the sensor CSV.
+    """
+    sensor_data = pandas.read_csv(in_sensor_csv)
+
+    wgs84_srs = osr.SpatialReference()
+    wgs84_srs.ImportFromEPSG(4326)
+    out_srs = osr.SpatialReference()
+    out_srs.ImportFromProj4(out_proj)
+    # Use longitude, latitude order with GDAL 3
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        wgs84_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        out_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    transform = osr.CoordinateTransformation(wgs84_srs, out_srs)
+
+    lon_lat = numpy.column_stack((sensor_data.iloc[:, 2].astype(float),
+                                  sensor_data.iloc[:, 1].astype(float)))
+    if lon_lat.shape[0] == 0:
+        return numpy.array([]), numpy.array([])
+
+    out_coords = numpy.array(transform.TransformPoints(lon_lat.tolist()))
+
+    return out_coords[:, 0], out_coords[:, 1]
+
+def _subset_sensor_csv(in_sensor_csv, out_sensor_csv, sensor_x, sensor_y,
+                       tile_bounding_box):
+    """
+    Write out sensors within a tile to a new CSV.
+
+    Returns number of sensors within the tile.
+    """
+    min_x, min_y, max_x, max_y = parse_bounding_box(tile_bounding_box)
+
+    in_tile = (sensor_x >= min_x) & (sensor_x < max_x) & \
+              (sensor_y > min_y) & (sensor_y <= max_y)
+
+    num_out_records = 0
+
+    with open(in_sensor_csv, 'r') as in_f, open(out_sensor_csv, 'w') as out_f:
+        in_csv = csv.reader(in_f)
+        out_csv = csv.writer(out_f)
+        out_csv.writerow(next(in_csv))
+        for line, line_in_tile in zip(in_csv, in_tile):
+            if line_in_tile:
+                out_csv.writerow(line)
+                num_out_records += 1
+
+    return num_out_records
+
+def _make_tile_stack(tile_args):
+    """
+    Create stack for a tile and extract values for sensors within the tile.
+    (called from multiprocessing pool)
+
+    Returns path to stack, path to extracted stats (None if there
+    are no sensors within the tile) and a list of dates for each layer.
+    """
+    (data_layers_list, tile_dir, in_sensor_csv, sensor_x, sensor_y,
+     sm_date_ts, bounding_box, tile_bounding_box, out_res, out_proj,
+     feature_store, depth, warp_cache, station_index, rolling_climate,
+     sar_pyramids, climate_cubes, focal_layers, terrain_layers) = tile_args
+
+    if not os.path.isdir(tile_dir):
+        os.makedirs(tile_dir)
+
+    data_stack = stack_bands.make_stack(data_layers_list, tile_dir,
+                                        sm_date_ts,
+                                        bounding_box=tile_bounding_box,
+                                        out_res=out_res, out_proj=out_proj,
+                                        warp_cache=warp_cache,
+                                        rolling_climate=rolling_climate,
+                                        sar_pyramids=sar_pyramids,
+                                        climate_cubes=climate_cubes,
+                                        focal_layers=focal_layers,
+                                        terrain_layers=terrain_layers,
+                                        full_bounding_box=bounding_box)
+
+    tile_sensor_csv = os.path.join(tile_dir, 'tile_sensor_data.csv')
+    tile_stats_csv = os.path.join(tile_dir, 'tile_sensor_layer_data.csv')
+    num_sensors = _subset_sensor_csv(in_sensor_csv, tile_sensor_csv,
+                                     sensor_x, sensor_y, tile_bounding_box)
+    if num_sensors > 0:
+        extract_image_stats.extract_layer_stats_csv(tile_sensor_csv,
+                                                    tile_stats_csv,
+                                                    data_layers_list, data_stack,
+                                                    feature_store=feature_store,
+                                                    sm_date_ts=sm_date_ts,
+                                                    depth=depth,
+                                                    station_index=station_index,
+                                                    bounding_box=bounding_box,
+                                                    out_res=out_res,
+                                                    out_proj=out_proj)
+    else:
+        tile_stats_csv = None
+
+    layer_dates = [layer.layer_date for layer in data_layers_list]
+
+    return data_stack, tile_stats_csv, layer_dates
+
+def _compute_catchment_layers(data_layers_list, terrain_layers, bounding_box,
+                              out_res=UPSCALING_RES, out_proj=UPSCALING_PROJ):
+    """
+    Calculate terrain layers which depend on the whole catchment (flow
+    accumulation and topographic wetness index) for the full bounding box,
+    so they are calculated once rather than by each tile. Layers with a
+    dynamic source are calculated for the full bounding box by the tiles, once
+the layer for the date is known.
+    """
+    layer_types = dict([(layer.layer_name, layer.layer_type) for layer in data_layers_list])
+    for data_layer in data_layers_list:
+        if data_layer.layer_type != 'terrain' or \
+                data_layer.terrain_derivative not in terrain_layers_module.CATCHMENT_DERIVATIVES:
+            continue
+        if layer_types.get(data_layer.layer_source) == 'dynamic':
+            continue
+        terrain_layers.get_layer(data_layer, data_layers_list, bounding_box,
+                                 out_res, out_proj)
+
+def _apply_rf_tile(tile_args):
+    """
+    Apply model to the stack for a tile (called from multiprocessing pool)
+
+    Returns mean, standard deviation and number of predicted pixels.
+    """
+    tile_stack, tile_out_image, rf_model, nodata_vals, tile_dir, \
+        uncertainty, quantiles = tile_args
+
+    tile_stats = rf_upscaling.apply_rf_image(tile_stack, tile_out_image,
+                                             rf_model, nodata_vals,
+                                             return_count=True,
+                                             uncertainty=uncertainty,
+                                             quantiles=quantiles)
+    # Remove stack for tile once it has been used to save disk space
+    shutil.rmtree(tile_dir)
+
+    return tile_stats
+
+def mosaic_tiles(tile_images_list, out_image):
+    """
+    Stitch tiles into a single image.
+
+    If the output image has the extension '.vrt' a virtual mosaic is
+    created and the tile images must be kept. Otherwise the mosaic is
+    written out to a single image.
+    """
+    if os.path.splitext(out_image)[-1].lower() == '.vrt':
+        subprocess.check_call(['gdalbuildvrt', out_image] + tile_images_list)
+    else:
+        out_vrt = os.path.splitext(out_image)[0] + '_tiles.vrt'
+        subprocess.check_call(['gdalbuildvrt', out_vrt] + tile_images_list)
+        subprocess.check_call(['gdal_translate',
+                               '-of', upscaling_utilities.get_gdal_format(out_image),
+                               out_vrt, out_image])
+        os.remove(out_vrt)
+
+def combine_tile_stats(tile_stats_list):
+    """
+    Combine the mean and standard deviation for each tile
+    to get the mean and standard deviation for all tiles.
+
+    Takes a list of (mean, standard deviation, count) for each tile.
+    """
+    tile_stats = numpy.array([stats for stats in tile_stats_list if stats[2] > 0],
+                             dtype=float)
+    if tile_stats.shape[0] == 0:
+        return numpy.nan, numpy.nan
+
+    tile_mean = tile_stats[:, 0]
+    tile_sd = tile_stats[:, 1]
+    tile_count = tile_stats[:, 2]
+
+    total_count = tile_count.sum()
+    average = (tile_count * tile_mean).sum() / total_count
+    variance = (tile_count * (tile_sd**2 + tile_mean**2)).sum() / total_count \
+               - average**2
+
+    return average, math.sqrt(max(variance, 0))
+
+def run_tiled_upscaling(in_sensor_csv, out_train_csv, out_image,
+                        data_layers_list, out_dir, sm_date_ts=None,
+                        bounding_box=None, out_res=UPSCALING_RES,
+                        out_proj=UPSCALING_PROJ,
+                        tile_size=DEFAULT_TILE_SIZE, num_workers=1,
+                        upscaling_model="RandomForestRegressor",
+                        feature_store=None, depth=None, warp_cache=None,
+                        n_estimators=rf_upscaling.DEFAULT_N_ESTIMATORS,
+                        max_estimators=rf_upscaling.ADAPTIVE_MAX_ESTIMATORS,
+                        oob_tolerance=rf_upscaling.ADAPTIVE_OOB_TOLERANCE,
+                        uncertainty=False, quantiles=None, station_index=None,
+                        rolling_climate=None, sar_pyramids=None,
+                        climate_cubes=None, focal_layers=None,
+                        terrain_layers=None):
+    """
+    Run upscaling splitting the bounding box into tiles.
+
+    A stack is made for each tile and values extracted for sensors
+    within it. The model is trained once using the extracted values
+    for all tiles and then applied to each tile. Output tiles are
+    mosaicked to create the output image.
+
+    Requires:
+
+    * in_sensor_csv - CSV with sensor locations and measurements
+    * out_train_csv - CSV to write extracted values for each band to
+    * out_image - output image. If a '.vrt' extension is used the
+      tiles are written to a '_tiles' directory alongside it.
+    * data_layers_list - list of DataLayer objects
+    * out_dir - directory to save tiles to (e.g., temp directory)
+    * sm_date_ts - date of soil moisture - Python time stamp format
+    * bounding_box - bounding box to tile (required)
+    * out_res - output resolution
+    * out_proj - output projection
+    * tile_size - size of each tile (in pixels)
+    * num_workers - number of tiles to process in parallel
+    * upscaling_model - name of model to use
+    * feature_store - FeatureStore to add extracted values to (optional)
+    * depth - sensor depth to record in the feature store
+    * warp_cache - WarpTransformCache to use for dynamic layers (optional)
+    * n_estimators - number of trees or 'adaptive' (see rf_upscaling.train_model)
+    * max_estimators - maximum number of trees if adaptive
+    * oob_tolerance - relative change in out-of-bag RMSE to stop at
+      if adaptive
+    * uncertainty - also write uncertainty bands (see rf_upscaling.apply_rf_image)
+    * quantiles - quantiles to write if uncertainty is True
+    * station_index - StationIndex to use to extract values for sensors
+      (optional)
+    * rolling_climate - RollingClimate to use for rolling layers (optional)
+    * sar_pyramids - SARPyramids to use for AirMOSS and UAVSAR layers (optional)
+    * climate_cubes - ClimateCubes to read PRISM and ECMWF layers from (optional)
+    * focal_layers - FocalLayers to store focal layers for each tile (optional)
+    * terrain_layers - TerrainLayers to store terrain layers (optional). Flow
+      accumulation and topographic wetness index are calculated for the
+      full bounding box and each tile uses its window.
+
+    Returns dictionary containing parameters from Random Forests and average
+    soil moisture (as run_random_forests).
+
+    """
+    if bounding_box is None:
+        raise ValueError('A bounding box is required to split into tiles')
+
+    tile_bounding_boxes = get_tile_bounding_boxes(bounding_box, out_res,
+                                                  tile_size)
+    print('Processing {} tiles using {} workers'.format(len(tile_bounding_boxes),
+                                                        num_workers))
+
+    sensor_x, sensor_y = _get_sensor_proj_coords(in_sensor_csv, out_proj)
+
+    # Terrain layers for the full bounding box are shared by all tiles,
+    # so must be kept in a directory which isn't removed with the tiles
+    if terrain_layers is None and \
+            any([layer.layer_type == 'terrain' for layer in data_layers_list]):
+        terrain_layers = terrain_layers_module.TerrainLayers(os.path.join(out_dir,
+                                                                          'terrain_layers'))
+    if terrain_layers is not None:
+        _compute_catchment_layers(data_layers_list, terrain_layers, bounding_box,
+                                  out_res, out_proj)
+
+    tile_dirs = [os.path.join(out_dir, 'tile_{:04d}'.format(i))
+                 for i in range(len(tile_bounding_boxes))]
+
+    if os.path.splitext(out_image)[-1].lower() == '.vrt':
+        tile_images_dir = os.path.splitext(out_image)[0] + '_tiles'
+    else:
+        tile_images_dir = os.path.join(out_dir, 'predict_tiles')
+    if not os.path.isdir(tile_images_dir):
+        os.makedirs(tile_images_dir)
+
+    out_image_base, out_image_ext = os.path.splitext(os.path.basename(out_image))
+    if out_image_ext.lower() == '.vrt':
+        out_image_ext = '.kea'
+    tile_images = [os.path.join(tile_images_dir,
+                                '{}_tile_{:04d}{}'.format(out_image_base, i,
+                                                          out_image_ext))
+                   for i in range(len(tile_bounding_boxes))]
+
+    stack_args = [(copy.deepcopy(data_layers_list), tile_dir, in_sensor_csv,
+                   sensor_x, sensor_y, sm_date_ts, bounding_box,
+                   tile_bounding_box, out_res, out_proj, feature_store, depth, warp_cache,
+                   station_index, rolling_climate, sar_pyramids, climate_cubes,
+                   focal_layers, terrain_layers)
+                  for tile_dir, tile_bounding_box in zip(tile_dirs,
+                                                         tile_bounding_boxes)]
+
+    pool = multiprocessing.Pool(int(num_workers))
+    try:
+        # 1. Create stacks and extract values for sensors
+        stack_out = pool.map(_make_tile_stack, stack_args)
+
+        # Dynamic layers are the same for all tiles so take
+        # date from the first tile.
+        for layer, layer_date in zip(data_layers_list, stack_out[0][2]):
+            layer.layer_date = layer_date
+
+        # 2. Combine extracted values for all tiles and train model
+        tile_stats_csvs = [out[1] for out in stack_out if out[1] is not None]
+        if len(tile_stats_csvs) == 0:
+            raise Exception('No sensors were found within any tile')
+        train_data = pandas.concat([pandas.read_csv(tile_stats_csv)
+                                    for tile_stats_csv in tile_stats_csvs])
+        train_data.to_csv(out_train_csv, index=False)
+
+        rf, out_parameters_dict = rf_upscaling.train_model(out_train_csv,
+                                                           data_layers_list,
+                                                           upscaling_model=upscaling_model,
+                                                           n_estimators=n_estimators,
+                                                           max_estimators=max_estimators,
+                                                           oob_tolerance=oob_tolerance)
+
+        # 3. Apply to each tile
+        nodata_vals = [layer.layer_nodata for layer in data_layers_list]
+        apply_args = [(out[0], tile_image, rf, nodata_vals, tile_dir,
+                       uncertainty, quantiles)
+                      for out, tile_image, tile_dir in zip(stack_out,
+                                                           tile_images,
+                                                           tile_dirs)]
+        tile_stats_list = pool.map(_apply_rf_tile, apply_args)
+    finally:
+        pool.close()
+        pool.join()
+
+    # 4. Mosaic tiles
+    mosaic_tiles(tile_images, out_image)
+    if uncertainty and hasattr(rf, 'estimators_'):
+        stack_bands.set_band_names(out_image,
+                                   rf_upscaling.get_uncertainty_band_names(quantiles))
+
+    average_sm_predict, sd_sm_predict = combine_tile_stats(tile_stats_list)
+    out_parameters_dict['averageSMPredict'] = average_sm_predict
+    out_parameters_dict['sdSMPredict'] = sd_sm_predict
+
+    return out_parameters_dict
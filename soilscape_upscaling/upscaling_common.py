@@ -23,6 +23,12 @@ UPSCALING_RES = 100
 #: GDAL format to use
 UPSCALING_GDAL_FORMAT = "KEA"
 
+#: Number of CPU cores to use (0 if no budget is set), see cpu_budget
+UPSCALING_CPU_BUDGET = 0
+
+#: Total size of GDAL cache in MB (0 to use GDAL default), see cpu_budget
+UPSCALING_GDAL_CACHEMAX = 0
+
 # go through all variables and check if they should be overwritten
 # by an environmental variable of the same name.
 for env_var in dir():
@@ -40,6 +46,18 @@ for env_var in dir():
         if env_var_value is not None:
             locals()[env_var] = env_var_value
 
+#: No data value for focal layers (see focal_layers)
+FOCAL_NODATA = -9999.0
+
+#: No data value for terrain layers (see terrain_layers)
+TERRAIN_NODATA = -9999.0
+
+#: Layer types calculated from another layer ('source')
+DERIVED_LAYER_TYPES = ['focal', 'terrain']
+
+#: Terrain derivatives which can be calculated
+TERRAIN_DERIVATIVES = ['slope', 'aspect', 'flow_accum', 'twi']
+
 class DataLayer (object):
     """
     Class to store information for each data layer.
@@ -48,12 +66,19 @@ class DataLayer (object):
 
     Has the following attributes.
 
-    * layer_type - type of layer (static, dynamic or mask)
+    * layer_type - type of layer (static, dynamic, focal, terrain or mask)
     * layer_name - name of layer
     * layer_path - path to layer
     * layer_dir - directory containing layers (for dynamic layers)
     * layer_nodata - no data value
     * layer_date - date for layer
+    * layer_source - name of layer to calculate layer from (for focal and
+      terrain layers, if no path is provided)
+    * focal_statistic - statistic to calculate (for focal layers)
+    * focal_radius - radius of window in metres (for focal layers)
+    * terrain_derivative - derivative to calculate (for terrain layers)
+    * terrain_margin - distance in metres outside the grid to include
+      when calculating flow accumulation (for terrain layers)
     """
     def __init__(self, layer_dict):
 
@@ -62,11 +87,15 @@ class DataLayer (object):
             self.layer_name = layer_dict['name']
         except KeyError:
             raise KeyError('Must provide name')
-        # Check if static (default), dynamic or mask
+        # Check if static (default), dynamic or mask. Layers with
+        # 'derive' are terrain layers
         try:
             self.layer_type = layer_dict['type']
         except KeyError:
-            self.layer_type = 'static'
+            if 'derive' in layer_dict:
+                self.layer_type = 'terrain'
+            else:
+                self.layer_type = 'static'
         # Check mask layer is called 'mask'
         if self.layer_type == 'mask' and self.layer_name != 'mask':
             raise Exception('Mask layer must be named "mask"')
@@ -87,11 +116,58 @@ class DataLayer (object):
                 raise KeyError('Must provide dir for dynamic layers if no path is provided')
             else:
                 self.layer_dir = None
+        # Get source for layers calculated from another layer
+        self.layer_source = None
+        if self.layer_type in DERIVED_LAYER_TYPES:
+            self.layer_source = layer_dict.get('source')
+            if self.layer_source is None and self.layer_path is None:
+                raise KeyError('Must provide source or path for {} '
+                               'layers'.format(self.layer_type))
+        # Get statistic and radius for focal layers
+        self.focal_statistic = None
+        self.focal_radius = None
+        if self.layer_type == 'focal':
+            try:
+                self.focal_statistic = layer_dict['statistic']
+            except KeyError:
+                self.focal_statistic = 'mean'
+            if self.focal_statistic not in ['mean', 'std']:
+                raise ValueError('Statistic for focal layers must be "mean" or "std", '
+                                 'got {}'.format(self.focal_statistic))
+            try:
+                self.focal_radius = float(layer_dict['radius'])
+            except KeyError:
+                raise KeyError('Must provide radius for focal layers')
+            except ValueError:
+                raise ValueError('Expected float for radius, got '
+                                 '{}'.format(layer_dict['radius']))
+        # Get derivative and margin for terrain layers
+        self.terrain_derivative = None
+        self.terrain_margin = None
+        if self.layer_type == 'terrain':
+            try:
+                self.terrain_derivative = layer_dict['derive']
+            except KeyError:
+                raise KeyError('Must provide derive for terrain layers')
+            if self.terrain_derivative not in TERRAIN_DERIVATIVES:
+                raise ValueError('Expected one of {} for derive, got '
+                                 '{}'.format(', '.join(TERRAIN_DERIVATIVES),
+                                             self.terrain_derivative))
+            try:
+                self.terrain_margin = float(layer_dict.get('margin', 0))
+            except ValueError:
+                raise ValueError('Expected float for margin, got '
+                                 '{}'.format(layer_dict['margin']))
        # Get nodata value
         try:
             self.layer_nodata = float(layer_dict['nodata'])
         except KeyError:
-            self.layer_nodata = None
+            if self.layer_type == 'focal':
+                self.layer_nodata = FOCAL_NODATA
+            elif self.layer_type == 'terrain':
+                self.layer_nodata = TERRAIN_NODATA
+            else:
+                self.layer_nodata = None
         except ValueError:
             raise ValueError('Expected float for nodata value '
                              ', got {}'.format(layer_dict['nodata']))
@@ -120,3 +196,53 @@ class DataLayer (object):
         except KeyError:
             self.resample_method = None
 
+
+def get_source_path(data_layer, data_layers_list):
+    """
+    Get path to the source of a layer calculated from another layer (focal
+    and terrain layers), from the path of the layer named in 'source' or
+    the path of the layer. Dynamic layers must have been found for the
+    date (as in make_stack). The source of focal layers can't be a dynamic
+    layer, as the layer for each date is only available for the grid so
+    pixels at the edge wouldn't use the full window.
+
+    Returns path and no data value of source.
+    """
+    if data_layer.layer_source is None:
+        return data_layer.layer_path, None
+    for source_layer in data_layers_list:
+        if source_layer.layer_name == data_layer.layer_source:
+            if source_layer.layer_type in DERIVED_LAYER_TYPES:
+                raise ValueError('The source of {} layer "{}" can not be a {} '
+                                 'layer'.format(data_layer.layer_type, data_layer.layer_name,
+                                                source_layer.layer_type))
+            if data_layer.layer_type == 'focal' and source_layer.layer_type == 'dynamic':
+                raise ValueError('The source of focal layer "{}" can not be a dynamic '
+                                 'layer'.format(data_layer.layer_name))
+            if source_layer.layer_path is None:
+                raise Exception('No path for source "{}" of layer '
+                                '"{}"'.format(source_layer.layer_name,
+                                              data_layer.layer_name))
+            return source_layer.layer_path, source_layer.layer_nodata
+    raise KeyError('Could not find source layer "{}" for layer "{}"'
+                   ''.format(data_layer.layer_source, data_layer.layer_name))
+
+def create_from_config(config_dict, config_key, create_func, *args, **kwargs):
+    """
+    Create an object for an optional setting in a config (e.g., a store
+    from the directory given by 'feature_store_dir').
+
+    Requires:
+
+    * config_dict - dictionary (e.g., '[default]' section of config file)
+    * config_key - key of optional setting
+    * create_func - function (or class) called with the value of the
+      setting followed by any other arguments
+
+    Returns the object or None if the setting isn't in the config.
+    """
+    try:
+        config_value = config_dict[config_key]
+    except KeyError:
+        return None
+    return create_func(config_value, *args, **kwargs)
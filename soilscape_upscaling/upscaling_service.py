@@ -0,0 +1,811 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Long-running upscaling service. Keeps layer sets, static layers warped
+to the output grid, cached warp transforms and trained models in memory
+between requests, so a new date can be upscaled without the start-up
+cost of running a site script.
+
+Requests are submitted as JSON over HTTP (on localhost) or a Unix
+socket and are run by a job queue with a limit on the number of jobs
+running at the same time. The following actions are available:
+
+* upscale - extract values for sensors from the stack for a date,
+  train a model and apply it. Sensor data are read from a CSV or, for
+  configs using the SoilSCAPE database ('sensor_ids'), extracted from
+  the database using an extractor kept open by each worker.
+* predict - apply a model previously trained by 'upscale' to the stack
+  for a date and bounding box.
+* ping - returns the request, used to check the service is running.
+
+Start the service using::
+
+   python -m soilscape_upscaling.upscaling_service serve \\
+      --work_dir /tmp/upscaling_service --port 8750 --max_jobs 2
+
+and submit jobs using::
+
+   python -m soilscape_upscaling.upscaling_service submit \\
+      --port 8750 --action upscale --config tonzi.cfg \\
+      --date 2015-06-01 --out_image predict_sm_20150601.kea --wait
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import argparse
+import calendar
+import collections
+import configparser
+import copy
+import hashlib
+import http.client
+import http.server
+import json
+import os
+import queue
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import uuid
+
+from . import extract_image_stats
+from . import feature_store
+from . import layer_providers
+from . import rf_upscaling
+from . import stack_bands
+from . import rolling_climate
+from . import station_index
+from . import tiling
+from . import upscaling_common
+from . import warp_cache as warp_cache_module
+from .data_extractors import soilscape_db_extractor
+
+#: Default port to listen on
+DEFAULT_PORT = 8750
+
+#: Number of trained models to keep in memory
+DEFAULT_MAX_MODELS = 50
+
+#: Maximum number of jobs waiting to run
+DEFAULT_MAX_QUEUED_JOBS = 100
+
+#: Number of finished jobs to keep the status of
+MAX_FINISHED_JOBS = 1000
+
+ACTIONS = ['upscale', 'predict', 'ping']
+
+#: Formats accepted for dates in requests, the first is used for
+#: dates passed to jobs
+DATE_FORMATS = ['%Y-%m-%d', '%Y%m%d']
+
+def read_layer_set(config_file):
+    """
+    Read the layers from a config file (the same format as used
+    by the site scripts).
+
+    Returns list of DataLayer objects (mask last) and the '[default]'
+    section of the config as a dictionary.
+    """
+    if not os.path.isfile(config_file):
+        raise Exception('The config file {} does not exist, '
+                        'please check path'.format(config_file))
+
+    config = configparser.ConfigParser()
+    config.read(config_file)
+
+    data_layers_list = []
+    for section in config.sections():
+        if section.startswith('layer'):
+            data_layer = upscaling_common.DataLayer(config[section])
+            if data_layer.use_layer:
+                data_layers_list.append(data_layer)
+    data_layers_list.append(upscaling_common.DataLayer(config['mask']))
+
+    try:
+        default_dict = dict(config['default'])
+    except KeyError:
+        default_dict = {}
+
+    layer_providers.register_providers_from_config(default_dict)
+
+    return data_layers_list, default_dict
+
+class UpscalingService(object):
+    """
+    Service which runs upscaling jobs, keeping inputs and models
+    in memory between jobs.
+
+    Requires:
+
+    * work_dir - directory for warped static layers and temporary files
+    * max_jobs - maximum number of jobs to run at the same time
+    * max_queued_jobs - maximum number of jobs waiting to run
+    * max_models - number of trained models to keep in memory
+    * warp_cache_dir - directory to save warp transforms to (optional)
+
+    """
+    def __init__(self, work_dir, max_jobs=1,
+                 max_queued_jobs=DEFAULT_MAX_QUEUED_JOBS,
+                 max_models=DEFAULT_MAX_MODELS, warp_cache_dir=None):
+        self.work_dir = os.path.abspath(work_dir)
+        if not os.path.isdir(self.work_dir):
+            os.makedirs(self.work_dir)
+
+        self.max_models = max_models
+        self.warp_cache = warp_cache_module.WarpTransformCache(warp_cache_dir)
+        # Pixel for each station is kept for the life of the service
+        self.station_index = station_index.StationIndex()
+
+        self.actions = {'upscale' : self._run_upscale,
+                        'predict' : self._run_predict,
+                        'ping' : self._run_ping}
+
+        self._lock = threading.Lock()
+        # Layer sets, keyed by config file
+        self._layer_sets = {}
+        # Static layers warped to grid, keyed by layer set and grid
+        self._static_layers = {}
+        # Locks for grids being warped, removed once no jobs are using them
+        self._static_locks = {}
+        # Accumulators for rolling climate layers, keyed by layer set so
+        # each config is a stream of dates, and requests for consecutive
+        # dates only read one day
+        self._rolling_climates = {}
+        # Database extractors for the worker thread, kept open between jobs
+        self._worker_data = threading.local()
+        # Trained models, keyed by layer set and date
+        self._models = collections.OrderedDict()
+
+        self._jobs = collections.OrderedDict()
+        self._job_queue = queue.Queue(maxsize=max_queued_jobs)
+        self._workers = []
+        for _ in range(max(int(max_jobs), 1)):
+            worker = threading.Thread(target=self._worker)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _worker(self):
+        """
+        Take jobs from the queue and run them.
+        """
+        while True:
+            job_id = self._job_queue.get()
+            if job_id is None:
+                break
+            with self._lock:
+                job = self._jobs[job_id]
+                job['status'] = 'running'
+                job['started'] = time.time()
+            try:
+                result = self.actions[job['request']['action']](job['request'])
+                with self._lock:
+                    job['result'] = result
+                    job['status'] = 'finished'
+            except Exception as err:
+                with self._lock:
+                    job['error'] = '{}: {}'.format(type(err).__name__, err)
+                    job['status'] = 'failed'
+            finally:
+                with self._lock:
+                    job['finished'] = time.time()
+                print('Job {} {} in {:.1f} s'.format(job_id, job['status'],
+                                                     job['finished'] - job['started']))
+                self._job_queue.task_done()
+        for extractor in getattr(self._worker_data, 'extractors', {}).values():
+            extractor.sensordb.close()
+
+    def submit(self, request):
+        """
+        Submit a job. The request is a dictionary which must contain
+        'action' and the keys needed for that action.
+
+        Returns the ID of the job.
+        """
+        try:
+            action = request['action']
+        except KeyError:
+            raise KeyError('Must provide action')
+        if action not in self.actions:
+            raise ValueError('The action "{}" is not recognised, expected one '
+                             'of: {}'.format(action, ', '.join(self.actions)))
+        request = dict(request)
+        if action != 'ping':
+            for key in ['config', 'date']:
+                if key not in request:
+                    raise KeyError('Must provide {} for {}'.format(key, action))
+            # Use the same format for all dates so models trained for a
+            # date are found whichever format is used
+            for key in ['date', 'model_date']:
+                if key in request:
+                    request[key] = time.strftime(DATE_FORMATS[0],
+                                                 self._get_date_ts(request[key]))
+
+        job_id = uuid.uuid4().hex
+        job = {'id' : job_id,
+               'request' : request,
+               'status' : 'queued',
+               'submitted' : time.time(),
+               'started' : None,
+               'finished' : None,
+               'result' : None,
+               'error' : None}
+        with self._lock:
+            self._jobs[job_id] = job
+            self._remove_old_jobs()
+        try:
+            self._job_queue.put_nowait(job_id)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job_id]
+            raise Exception('Job queue is full, try again later')
+        return job_id
+
+    def _remove_old_jobs(self):
+        """
+        Remove the oldest finished jobs if there are too many.
+        """
+        finished_ids = [job_id for job_id, job in self._jobs.items()
+                        if job['status'] in ['finished', 'failed']]
+        for job_id in finished_ids[:max(len(finished_ids) - MAX_FINISHED_JOBS, 0)]:
+            del self._jobs[job_id]
+
+    def get_job(self, job_id):
+        """
+        Get status of a job as a dictionary.
+        """
+        with self._lock:
+            try:
+                return copy.deepcopy(self._jobs[job_id])
+            except KeyError:
+                raise KeyError('No job with ID {}'.format(job_id))
+
+    def get_status(self):
+        """
+        Get status of the service as a dictionary.
+        """
+        with self._lock:
+            num_jobs = collections.Counter([job['status'] for job
+                                            in self._jobs.values()])
+            return {'jobs' : dict(num_jobs),
+                    'workers' : len(self._workers),
+                    'layer_sets' : len(self._layer_sets),
+                    'static_grids' : len(self._static_layers),
+                    'models' : [list(key) for key in self._models.keys()]}
+
+    def shutdown(self):
+        """
+        Stop workers once jobs in the queue have finished.
+        """
+        for _ in self._workers:
+            self._job_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    @staticmethod
+    def _get_date_ts(date_str):
+        for date_format in DATE_FORMATS:
+            try:
+                return time.strptime(str(date_str), date_format)
+            except ValueError:
+                pass
+        raise ValueError('Expected date in the format YYYY-MM-DD or YYYYMMDD, '
+                         'got {}'.format(date_str))
+
+    def _get_layer_set(self, config_file):
+        """
+        Get layers for a config file, re-reading the file if it
+        has changed.
+        """
+        config_file = os.path.abspath(config_file)
+        config_mtime = os.path.getmtime(config_file)
+        with self._lock:
+            try:
+                layer_set = self._layer_sets[config_file]
+                if layer_set['mtime'] == config_mtime:
+                    return layer_set
+            except KeyError:
+                pass
+
+        data_layers_list, default_dict = read_layer_set(config_file)
+        layer_set = {'mtime' : config_mtime,
+                     'layers' : data_layers_list,
+                     'default' : default_dict,
+                     'hash' : feature_store.get_layer_set_hash(data_layers_list)}
+        with self._lock:
+            self._layer_sets[config_file] = layer_set
+        return layer_set
+
+    def _get_grid(self, request, layer_set):
+        """
+        Get bounding box, resolution and projection for a request, using
+        values from the config if they aren't in the request.
+        """
+        try:
+            bounding_box = request['bounding_box']
+        except KeyError:
+            try:
+                bounding_box = layer_set['default']['bounding_box'].split()
+            except KeyError:
+                raise KeyError('Must provide bounding_box in request or config')
+        bounding_box = [repr(val) for val in tiling.parse_bounding_box(bounding_box)]
+
+        out_res = request.get('res', layer_set['default'].get('upscaling_res',
+                                                              upscaling_common.UPSCALING_RES))
+        out_proj = request.get('proj', layer_set['default'].get('upscaling_proj',
+                                                                upscaling_common.UPSCALING_PROJ))
+        return bounding_box, float(out_res), out_proj
+
+    def _get_static_layers(self, layer_set, bounding_box, out_res, out_proj):
+        """
+        Get layers with the static layers warped to the output grid,
+        warping them the first time a grid is used.
+        """
+        grid_key = (layer_set['hash'], tuple(bounding_box), out_res, out_proj)
+        with self._lock:
+            try:
+                return copy.deepcopy(self._static_layers[grid_key])
+            except KeyError:
+                pass
+            static_lock = self._static_locks.setdefault(grid_key,
+                                                        {'lock' : threading.Lock(),
+                                                         'jobs' : 0})
+            static_lock['jobs'] += 1
+        try:
+            # Only warp once if two jobs for the same grid arrive together
+            with static_lock['lock']:
+                with self._lock:
+                    try:
+                        return copy.deepcopy(self._static_layers[grid_key])
+                    except KeyError:
+                        pass
+                grid_hash = hashlib.md5(json.dumps(grid_key).encode()).hexdigest()[:16]
+                grid_dir = os.path.join(self.work_dir, 'static', grid_hash)
+                static_layers_list = stack_bands.warp_static_layers(layer_set['layers'],
+                                                                    grid_dir,
+                                                                    bounding_box,
+                                                                    out_res, out_proj)
+                with self._lock:
+                    self._static_layers[grid_key] = static_layers_list
+                return copy.deepcopy(static_layers_list)
+        finally:
+            with self._lock:
+                static_lock['jobs'] -= 1
+                if static_lock['jobs'] == 0:
+                    del self._static_locks[grid_key]
+
+    def _get_rolling_climate(self, layer_set):
+        """
+        Get accumulators for rolling climate layers for a layer set.
+        """
+        with self._lock:
+            return self._rolling_climates.setdefault(layer_set['hash'],
+                                                     rolling_climate.RollingClimate())
+
+    def _get_extractor(self, layer_set):
+        """
+        Get extractor for the SoilSCAPE database in a config, for the worker
+        thread. Extractors are kept open between jobs (SQLite connections
+        can only be used by the thread which opened them).
+        """
+        default_dict = layer_set['default']
+        extractor_key = (default_dict.get('sqlite_db'),
+                         int(default_dict.get('sensor_number', 1)))
+        if not hasattr(self._worker_data, 'extractors'):
+            self._worker_data.extractors = {}
+        try:
+            return self._worker_data.extractors[extractor_key]
+        except KeyError:
+            pass
+        extractor = soilscape_db_extractor.SoilSCAPECreateCSVfromDB(
+            extractor_key[0], outSensorNum=extractor_key[1])
+        self._worker_data.extractors[extractor_key] = extractor
+        return extractor
+
+    def _extract_sensor_data(self, request, layer_set, out_csv):
+        """
+        Extract sensor data for the date in a request from the SoilSCAPE
+        database to a CSV, averaged over 'time_interval_hours' from the
+        start of the date as in the site scripts.
+
+        Returns the number of sensors extracted.
+        """
+        default_dict = layer_set['default']
+        try:
+            physical_ids_list = default_dict['sensor_ids'].split()
+        except KeyError:
+            raise KeyError('Must provide sensor_csv for upscale, or sensor_ids in the '
+                           'config to extract from the SoilSCAPE database')
+        time_interval = 3600 * float(default_dict.get('time_interval_hours', 24))
+        start_epoch = calendar.timegm(self._get_date_ts(request['date']))
+        start_time = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(start_epoch))
+        end_time = time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.gmtime(start_epoch + time_interval))
+        extractor = self._get_extractor(layer_set)
+        return extractor.createCSVFromDB(physical_ids_list, out_csv, start_time, end_time)
+
+    def _make_stack(self, request, temp_dir):
+        """
+        Make stack for the date and grid in a request.
+
+        Returns layer set, list of layers and path to stack.
+        """
+        layer_set = self._get_layer_set(request['config'])
+        bounding_box, out_res, out_proj = self._get_grid(request, layer_set)
+        data_layers_list = self._get_static_layers(layer_set, bounding_box,
+                                                   out_res, out_proj)
+        data_stack = stack_bands.make_stack(data_layers_list, temp_dir,
+                                            self._get_date_ts(request['date']),
+                                            bounding_box=bounding_box,
+                                            out_res=out_res, out_proj=out_proj,
+                                            warp_cache=self.warp_cache,
+                                            rolling_climate=self._get_rolling_climate(layer_set))
+        return layer_set, data_layers_list, data_stack
+
+    def _get_out_image(self, request, layer_set):
+        try:
+            return request['out_image']
+        except KeyError:
+            out_dir = os.path.join(self.work_dir, 'outputs', layer_set['hash'])
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            return os.path.join(out_dir, '{}_predict_sm.kea'.format(request['date'].replace('-', '')))
+
+    def _add_model(self, model_key, rf, out_parameters_dict):
+        with self._lock:
+            self._models[model_key] = (rf, out_parameters_dict)
+            self._models.move_to_end(model_key)
+            while len(self._models) > self.max_models:
+                self._models.popitem(last=False)
+
+    def _get_model(self, model_key):
+        with self._lock:
+            try:
+                rf, out_parameters_dict = self._models[model_key]
+            except KeyError:
+                raise KeyError('No model has been trained for layer set {} and '
+                               'date {}'.format(*model_key))
+            self._models.move_to_end(model_key)
+            return rf, dict(out_parameters_dict)
+
+    @staticmethod
+    def _get_json_parameters(out_parameters_dict):
+        """
+        Convert parameters from training to types which can be
+        written as JSON.
+        """
+        out_json_dict = {}
+        for key, value in out_parameters_dict.items():
+            if hasattr(value, 'tolist'):
+                value = value.tolist()
+            elif isinstance(value, list):
+                value = [v.tolist() if hasattr(v, 'tolist') else v for v in value]
+            out_json_dict[key] = value
+        return out_json_dict
+
+    def _run_upscale(self, request):
+        """
+        Extract values for sensors, train model and apply.
+
+        Request requires 'config' and 'date'. 'sensor_csv' (in the format
+        used by extract_layer_stats_csv) is required unless the config
+        uses the SoilSCAPE database, in which case the sensor data are
+        extracted from it. 'bounding_box', 'res', 'proj' and 'out_image'
+        are optional.
+        """
+        temp_dir = tempfile.mkdtemp(prefix='upscale_', dir=self.work_dir)
+        try:
+            layer_set, data_layers_list, data_stack = self._make_stack(request, temp_dir)
+            try:
+                sensor_csv = request['sensor_csv']
+            except KeyError:
+                sensor_csv = os.path.join(temp_dir, 'sensor_db_data.csv')
+                if self._extract_sensor_data(request, layer_set, sensor_csv) == 0:
+                    raise Exception('No sensor data found for {}'.format(request['date']))
+            stats_csv = os.path.join(temp_dir, 'sensor_data.csv')
+            extract_image_stats.extract_layer_stats_csv(sensor_csv, stats_csv,
+                                                        data_layers_list, data_stack,
+                                                        station_index=self.station_index)
+            default_dict = layer_set['default']
+            n_estimators = rf_upscaling.get_n_estimators(
+                request.get('rf_n_estimators',
+                            default_dict.get('rf_n_estimators',
+                                             rf_upscaling.DEFAULT_N_ESTIMATORS)))
+            rf, out_parameters_dict = rf_upscaling.train_model(
+                stats_csv, data_layers_list,
+                upscaling_model=default_dict.get('upscaling_model',
+                                                 'RandomForestRegressor'),
+                n_estimators=n_estimators)
+            self._add_model((layer_set['hash'], request['date']), rf,
+                            out_parameters_dict)
+
+            out_image = self._get_out_image(request, layer_set)
+            no_data_vals = [layer.layer_nodata for layer in data_layers_list]
+            out_parameters_dict['averageSMPredict'], out_parameters_dict['sdSMPredict'] = \
+                rf_upscaling.apply_rf_image(data_stack, out_image, rf, no_data_vals)
+        finally:
+            shutil.rmtree(temp_dir)
+
+        out_parameters_dict['outImage'] = out_image
+        return self._get_json_parameters(out_parameters_dict)
+
+    def _run_predict(self, request):
+        """
+        Apply a model trained by a previous 'upscale' job.
+
+        Request requires 'config' and 'date'. 'model_date' (the date the
+        model was trained for, default is 'date'), 'bounding_box', 'res',
+        'proj' and 'out_image' are optional.
+        """
+        layer_set = self._get_layer_set(request['config'])
+        model_date = request.get('model_date', request['date'])
+        rf, out_parameters_dict = self._get_model((layer_set['hash'], model_date))
+
+        temp_dir = tempfile.mkdtemp(prefix='predict_', dir=self.work_dir)
+        try:
+            layer_set, data_layers_list, data_stack = self._make_stack(request, temp_dir)
+            out_image = self._get_out_image(request, layer_set)
+            no_data_vals = [layer.layer_nodata for layer in data_layers_list]
+            out_parameters_dict['averageSMPredict'], out_parameters_dict['sdSMPredict'] = \
+                rf_upscaling.apply_rf_image(data_stack, out_image, rf, no_data_vals)
+        finally:
+            shutil.rmtree(temp_dir)
+
+        out_parameters_dict['outImage'] = out_image
+        out_parameters_dict['modelDate'] = model_date
+        return self._get_json_parameters(out_parameters_dict)
+
+    @staticmethod
+    def _run_ping(request):
+        """
+        Return the request, used to check the service.
+        """
+        return {'request' : request}
+
+class _ServiceRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    HTTP interface to UpscalingService.
+
+    * POST /jobs - submit job (JSON request), returns job ID
+    * GET /jobs/<job_id> - get status of job
+    * GET /status - get status of service
+    """
+    def address_string(self):
+        # Unix sockets don't have a client address
+        if isinstance(self.client_address, tuple) and len(self.client_address) > 0:
+            return str(self.client_address[0])
+        return 'local'
+
+    def _send_json(self, status_code, out_dict):
+        out_body = json.dumps(out_dict).encode()
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out_body)))
+        self.end_headers()
+        self.wfile.write(out_body)
+
+    def do_GET(self):
+        service = self.server.upscaling_service
+        path_parts = self.path.strip('/').split('/')
+        if path_parts == ['status']:
+            self._send_json(200, service.get_status())
+        elif len(path_parts) == 2 and path_parts[0] == 'jobs':
+            try:
+                self._send_json(200, service.get_job(path_parts[1]))
+            except KeyError as err:
+                self._send_json(404, {'error' : str(err)})
+        else:
+            self._send_json(404, {'error' : 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        service = self.server.upscaling_service
+        if self.path.strip('/') != 'jobs':
+            self._send_json(404, {'error' : 'Unknown path {}'.format(self.path)})
+            return
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(content_length).decode())
+            job_id = service.submit(request)
+        except (KeyError, ValueError) as err:
+            self._send_json(400, {'error' : str(err)})
+            return
+        except Exception as err:
+            self._send_json(503, {'error' : str(err)})
+            return
+        self._send_json(202, {'id' : job_id})
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class _ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                               socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def make_server(service, port=DEFAULT_PORT, socket_path=None, host='127.0.0.1'):
+    """
+    Make HTTP server for a service, call 'serve_forever' to start.
+
+    Requires:
+
+    * service - UpscalingService object
+    * port - port to listen on (localhost only)
+    * socket_path - path of Unix socket to listen on instead of port
+
+    """
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _ThreadingUnixHTTPServer(socket_path, _ServiceRequestHandler)
+        print('Listening on {}'.format(socket_path))
+    else:
+        server = _ThreadingHTTPServer((host, port), _ServiceRequestHandler)
+        print('Listening on http://{}:{}'.format(host, server.server_address[1]))
+    server.upscaling_service = service
+    return server
+
+def serve(service, port=DEFAULT_PORT, socket_path=None, host='127.0.0.1'):
+    """
+    Run HTTP interface to service until interrupted.
+
+    Requires:
+
+    * service - UpscalingService object
+    * port - port to listen on (localhost only)
+    * socket_path - path of Unix socket to listen on instead of port
+
+    """
+    server = make_server(service, port, socket_path, host)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket.
+    """
+    def __init__(self, socket_path, timeout=60):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+class UpscalingClient(object):
+    """
+    Client for the upscaling service.
+
+    Requires:
+
+    * port - port service is listening on (localhost)
+    * socket_path - path to Unix socket service is listening on
+      (used instead of port)
+
+    """
+    def __init__(self, port=DEFAULT_PORT, socket_path=None, host='127.0.0.1'):
+        self.port = port
+        self.socket_path = socket_path
+        self.host = host
+
+    def _request(self, method, path, request=None):
+        if self.socket_path is not None:
+            connection = _UnixHTTPConnection(self.socket_path)
+        else:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            headers = {}
+            body = None
+            if request is not None:
+                body = json.dumps(request).encode()
+                headers['Content-Type'] = 'application/json'
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            out_dict = json.loads(response.read().decode())
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise Exception('Request failed ({}): {}'.format(response.status,
+                                                             out_dict.get('error')))
+        return out_dict
+
+    def submit(self, request):
+        """
+        Submit a job, returns job ID.
+        """
+        return self._request('POST', '/jobs', request)['id']
+
+    def get_job(self, job_id):
+        """
+        Get status of a job.
+        """
+        return self._request('GET', '/jobs/{}'.format(job_id))
+
+    def get_status(self):
+        """
+        Get status of the service.
+        """
+        return self._request('GET', '/status')
+
+    def wait(self, job_id, poll_interval=0.5, timeout=None):
+        """
+        Wait for a job to finish.
+
+        Returns the job status.
+        """
+        start_time = time.time()
+        while True:
+            job = self.get_job(job_id)
+            if job['status'] in ['finished', 'failed']:
+                return job
+            if timeout is not None and time.time() - start_time > timeout:
+                raise Exception('Timed out waiting for job {}'.format(job_id))
+            time.sleep(poll_interval)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run upscaling as a service '
+                                                 'or submit jobs to the service')
+    parser.add_argument("command", choices=['serve', 'submit', 'status'])
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="Port to listen on / connect to (localhost)")
+    parser.add_argument("--socket", default=None,
+                        help="Unix socket to use instead of a port")
+    parser.add_argument("--work_dir", default=None,
+                        help="Working directory for service")
+    parser.add_argument("--max_jobs", type=int, default=1,
+                        help="Maximum number of jobs to run at once")
+    parser.add_argument("--warp_cache_dir", default=None,
+                        help="Directory to save warp transforms to")
+    parser.add_argument("--action", choices=ACTIONS, default='upscale')
+    parser.add_argument("--config", help="Config file defining layers")
+    parser.add_argument("--date", help="Date (YYYY-MM-DD or YYYYMMDD)")
+    parser.add_argument("--model_date", default=None,
+                        help="Date model was trained for (predict only)")
+    parser.add_argument("--sensor_csv", default=None,
+                        help="CSV with sensor locations and soil moisture "
+                             "(default is to extract from the database in "
+                             "the config)")
+    parser.add_argument("--bounding_box", nargs=4, default=None)
+    parser.add_argument("--out_image", default=None)
+    parser.add_argument("--wait", action='store_true', default=False,
+                        help="Wait for job to finish")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        if args.work_dir is None:
+            raise Exception('Must provide --work_dir')
+        serve(UpscalingService(args.work_dir, max_jobs=args.max_jobs,
+                               warp_cache_dir=args.warp_cache_dir),
+              port=args.port, socket_path=args.socket)
+    else:
+        client = UpscalingClient(port=args.port, socket_path=args.socket)
+        if args.command == 'status':
+            print(json.dumps(client.get_status(), indent=2))
+        else:
+            job_request = {'action' : args.action}
+            for key in ['config', 'date', 'model_date', 'sensor_csv',
+                        'bounding_box', 'out_image']:
+                if getattr(args, key) is not None:
+                    job_request[key] = getattr(args, key)
+            # Service may be running in a different directory
+            for key in ['config', 'sensor_csv', 'out_image']:
+                if key in job_request:
+                    job_request[key] = os.path.abspath(job_request[key])
+            submitted_id = client.submit(job_request)
+            print('Submitted job {}'.format(submitted_id))
+            if args.wait:
+                print(json.dumps(client.wait(submitted_id), indent=2))
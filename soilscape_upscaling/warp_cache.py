@@ -0,0 +1,673 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Resampling engine which caches the mapping between a source and target
+grid. Dynamic layers such as daily PRISM data share the same source grid
+for every date and the target grid is fixed for a config so the source
+pixels and weights used for each target pixel only need to be calculated
+once for each (source grid, target grid, resampling method). They are
+stored as index and weight arrays and applied to each new date as a
+vectorized gather and weighted sum.
+
+The mapping is separable in source pixel coordinates so for each target
+pixel the indices and weights are stored separately for the x (column)
+and y (row) direction, the weight for a source pixel is the product of
+the two. Kernels follow the conventions used by gdalwarp, including
+widening the kernel by the scale factor when downsampling (by more than
+5 %), writing no data where the source pixel containing the centre of a
+target pixel is no data and falling back to bilinear for cubic where the
+4 x 4 source window is partly outside the image or contains no data. Use
+'compare_with_gdalwarp' to check results for a layer against gdalwarp.
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import subprocess
+import tempfile
+import threading
+
+import numpy
+from osgeo import gdal
+from osgeo import osr
+
+from . import upscaling_common
+
+UPSCALING_PROJ = upscaling_common.UPSCALING_PROJ
+UPSCALING_RES = upscaling_common.UPSCALING_RES
+GDAL_FORMAT = upscaling_common.UPSCALING_GDAL_FORMAT
+
+#: Kernel radius (in source pixels) for each interpolating resampling method
+KERNEL_RADIUS = {'bilinear' : 1,
+                 'cubic' : 2,
+                 'cubicspline' : 2,
+                 'lanczos' : 3}
+
+#: Resampling methods supported by the cache, others use gdalwarp
+SUPPORTED_METHODS = ['near', 'average'] + sorted(KERNEL_RADIUS.keys())
+
+#: Number of target rows to transform at once
+TRANSFORM_BLOCK_ROWS = 256
+
+#: Kernels are only widened for scale factors below this (as gdalwarp)
+MIN_UNSCALED_KERNEL_SCALE = 0.95
+
+#: Added to source pixel coordinates before rounding down, so target
+#: pixels on a boundary between source pixels use the same one as gdalwarp
+PIXEL_EPSILON = 1e-10
+
+#: Version of transforms, included in the key so cached transforms
+#: are recalculated when the way they are calculated changes
+TRANSFORM_VERSION = 2
+
+def _kernel_weights(method, dist):
+    """
+    Get weights for a resampling kernel given the distance (in pixels)
+    from the centre.
+    """
+    abs_dist = numpy.abs(dist)
+    if method == 'bilinear':
+        return numpy.maximum(1 - abs_dist, 0)
+    elif method == 'cubic':
+        # Keys cubic convolution with a = -0.5 (as GDAL)
+        return numpy.where(abs_dist <= 1,
+                           1.5 * abs_dist**3 - 2.5 * abs_dist**2 + 1,
+                           numpy.where(abs_dist < 2,
+                                       -0.5 * abs_dist**3 + 2.5 * abs_dist**2
+                                       - 4 * abs_dist + 2, 0))
+    elif method == 'cubicspline':
+        # Cubic B-spline
+        return numpy.where(abs_dist < 1,
+                           (4 - 6 * abs_dist**2 + 3 * abs_dist**3) / 6.0,
+                           numpy.where(abs_dist < 2, (2 - abs_dist)**3 / 6.0, 0))
+    elif method == 'lanczos':
+        return numpy.where(abs_dist < 3,
+                           numpy.sinc(dist) * numpy.sinc(dist / 3.0), 0)
+    else:
+        raise ValueError('Kernel not available for "{}"'.format(method))
+
+def _invert_geotransform(geotransform):
+    """
+    Invert an affine geotransform.
+    """
+    det = geotransform[1] * geotransform[5] - geotransform[2] * geotransform[4]
+    if det == 0:
+        raise ValueError('Geotransform can not be inverted')
+    inv_1 = geotransform[5] / det
+    inv_2 = -geotransform[2] / det
+    inv_4 = -geotransform[4] / det
+    inv_5 = geotransform[1] / det
+    inv_0 = -geotransform[0] * inv_1 - geotransform[3] * inv_2
+    inv_3 = -geotransform[0] * inv_4 - geotransform[3] * inv_5
+    return (inv_0, inv_1, inv_2, inv_3, inv_4, inv_5)
+
+def _get_srs(projection):
+    """
+    Get osr.SpatialReference from WKT or Proj4 string.
+    """
+    srs = osr.SpatialReference()
+    if projection.strip().startswith('+'):
+        srs.ImportFromProj4(projection)
+    else:
+        srs.ImportFromWkt(projection)
+    if hasattr(osr, 'OAMS_TRADITIONAL_GIS_ORDER'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+def get_raster_grid(in_raster):
+    """
+    Get grid for a raster as a dictionary with the geotransform,
+    projection (WKT) and size.
+    """
+    dataset = gdal.Open(in_raster, gdal.GA_ReadOnly)
+    if dataset is None:
+        raise IOError('Could not open {}'.format(in_raster))
+    grid = {'geotransform' : list(dataset.GetGeoTransform()),
+            'projection' : dataset.GetProjection(),
+            'x_size' : dataset.RasterXSize,
+            'y_size' : dataset.RasterYSize}
+    dataset = None
+    return grid
+
+def get_target_grid(bounding_box, out_res=UPSCALING_RES, out_proj=UPSCALING_PROJ):
+    """
+    Get target grid for a bounding box, using the same convention
+    as gdalwarp with '-te' and '-tr'.
+    """
+    min_x, min_y, max_x, max_y = [float(str(val).strip(',')) for val in bounding_box]
+    out_res = float(out_res)
+    x_size = int((max_x - min_x) / out_res + 0.5)
+    y_size = int((max_y - min_y) / out_res + 0.5)
+    return {'geotransform' : [min_x, out_res, 0.0, max_y, 0.0, -out_res],
+            'projection' : _get_srs(out_proj).ExportToWkt(),
+            'x_size' : x_size,
+            'y_size' : y_size}
+
+def get_transform_key(src_grid, dst_grid, resample_method):
+    """
+    Get key to identify a transform.
+    """
+    key_json = json.dumps([TRANSFORM_VERSION, src_grid, dst_grid, resample_method],
+                          sort_keys=True)
+    return hashlib.md5(key_json.encode()).hexdigest()
+
+def _get_src_pixel_coords(src_grid, dst_grid):
+    """
+    Get the location of the centre of each target pixel in
+    source pixel coordinates.
+    """
+    src_srs = _get_srs(src_grid['projection'])
+    dst_srs = _get_srs(dst_grid['projection'])
+    same_srs = bool(src_srs.IsSame(dst_srs))
+    transform = osr.CoordinateTransformation(dst_srs, src_srs)
+
+    dst_gt = dst_grid['geotransform']
+    inv_src_gt = _invert_geotransform(src_grid['geotransform'])
+
+    src_px = numpy.zeros((dst_grid['y_size'], dst_grid['x_size']), dtype=numpy.float64)
+    src_py = numpy.zeros_like(src_px)
+
+    cols = numpy.arange(dst_grid['x_size']) + 0.5
+
+    for row_start in range(0, dst_grid['y_size'], TRANSFORM_BLOCK_ROWS):
+        row_end = min(row_start + TRANSFORM_BLOCK_ROWS, dst_grid['y_size'])
+        rows = numpy.arange(row_start, row_end) + 0.5
+        col_grid, row_grid = numpy.meshgrid(cols, rows)
+        dst_x = dst_gt[0] + col_grid * dst_gt[1] + row_grid * dst_gt[2]
+        dst_y = dst_gt[3] + col_grid * dst_gt[4] + row_grid * dst_gt[5]
+
+        if same_srs:
+            src_x = dst_x
+            src_y = dst_y
+        else:
+            points = numpy.column_stack((dst_x.ravel(), dst_y.ravel()))
+            src_points = numpy.array(transform.TransformPoints(points.tolist()))
+            src_x = src_points[:, 0].reshape(dst_x.shape)
+            src_y = src_points[:, 1].reshape(dst_y.shape)
+
+        src_px[row_start:row_end] = inv_src_gt[0] + src_x * inv_src_gt[1] \
+                                    + src_y * inv_src_gt[2]
+        src_py[row_start:row_end] = inv_src_gt[3] + src_x * inv_src_gt[4] \
+                                    + src_y * inv_src_gt[5]
+
+    return src_px, src_py
+
+def _get_pixel_ratio(src_coords, axis):
+    """
+    Get number of source pixels for each target pixel
+    along an axis.
+    """
+    if src_coords.shape[axis] < 2:
+        return numpy.ones_like(src_coords)
+    return numpy.abs(numpy.gradient(src_coords, axis=axis))
+
+def _get_kernel_scale(pixel_ratio):
+    """
+    Get scale factor for an interpolating kernel along an axis. Less than
+    1 when downsampling, but as gdalwarp the kernel is not widened for
+    small changes in resolution.
+    """
+    if pixel_ratio.size == 0:
+        return 1.0
+    scale = min(1.0, 1.0 / max(float(numpy.nanmedian(pixel_ratio)), 1e-6))
+    if scale >= MIN_UNSCALED_KERNEL_SCALE:
+        scale = 1.0
+    return scale
+
+def _get_axis_taps(src_coord, pixel_ratio, resample_method, scale=1.0):
+    """
+    Get source indices and weights for one axis. The pixel ratio is
+    used for 'average' and the scale factor for interpolating kernels.
+
+    Returns index and weight arrays of shape (num_pixels, num_taps).
+    Indices may be outside the source image, use '_clip_taps' to
+    remove them.
+    """
+    if resample_method == 'near':
+        indices = numpy.floor(src_coord + PIXEL_EPSILON).astype(numpy.int64)
+        indices = indices[:, numpy.newaxis]
+        weights = numpy.ones(indices.shape, dtype=numpy.float64)
+
+    elif resample_method == 'average':
+        # Weight source pixels by their overlap with the target pixel
+        half_width = numpy.maximum(pixel_ratio, 1e-6) / 2.0
+        lower = src_coord - half_width
+        upper = src_coord + half_width
+        first = numpy.floor(lower).astype(numpy.int64)
+        num_taps = int(numpy.ceil(numpy.nanmax(pixel_ratio))) + 1
+        indices = first[:, numpy.newaxis] + numpy.arange(num_taps)[numpy.newaxis, :]
+        weights = numpy.minimum(indices + 1, upper[:, numpy.newaxis]) \
+                  - numpy.maximum(indices, lower[:, numpy.newaxis])
+        weights = numpy.maximum(weights, 0)
+
+    else:
+        # Interpolating kernel, widened by the scale factor when
+        # downsampling
+        radius = int(math.ceil(KERNEL_RADIUS[resample_method] / scale))
+        centre = src_coord - 0.5
+        base = numpy.floor(centre).astype(numpy.int64)
+        offsets = numpy.arange(-radius + 1, radius + 1)
+        indices = base[:, numpy.newaxis] + offsets[numpy.newaxis, :]
+        dist = (indices - centre[:, numpy.newaxis]) * scale
+        weights = _kernel_weights(resample_method, dist)
+
+    return indices, weights
+
+def _clip_taps(indices, weights, src_size):
+    """
+    Clip source indices for one axis to the source image, taps
+    outside are given a weight of 0.
+    """
+    outside = (indices < 0) | (indices >= src_size)
+    weights = numpy.where(outside, 0, weights)
+    indices = numpy.clip(indices, 0, src_size - 1)
+    return indices, weights
+
+def _get_bad_values(values, src_nodata):
+    """
+    Get source values which are no data or NaN.
+    """
+    bad_values = ~numpy.isfinite(values)
+    if src_nodata is not None:
+        bad_values |= values == src_nodata
+    return bad_values
+
+def _sum_taps(src_array, src_nodata, x_indices, x_weights, y_indices, y_weights):
+    """
+    Get weighted sum of source values for each target pixel, excluding
+    bad values.
+
+    Returns the weighted sum, sum of weights and whether any of the
+    source pixels for a target pixel were bad.
+    """
+    num_valid = x_indices.shape[0]
+    out_sum = numpy.zeros(num_valid, dtype=numpy.float64)
+    weight_sum = numpy.zeros(num_valid, dtype=numpy.float64)
+    any_bad = numpy.zeros(num_valid, dtype=bool)
+
+    for y_tap in range(y_indices.shape[1]):
+        rows = y_indices[:, y_tap]
+        row_weights = y_weights[:, y_tap]
+        for x_tap in range(x_indices.shape[1]):
+            values = src_array[rows, x_indices[:, x_tap]].astype(numpy.float64)
+            weights = row_weights * x_weights[:, x_tap]
+            bad_values = _get_bad_values(values, src_nodata)
+            weights = numpy.where(bad_values, 0, weights)
+            out_sum += numpy.where(bad_values, 0, values) * weights
+            weight_sum += weights
+            any_bad |= bad_values
+
+    return out_sum, weight_sum, any_bad
+
+#: Arrays of a WarpTransform which are only needed for some methods
+OPTIONAL_ARRAYS = ['x_coords', 'y_coords', 'cubic_fallback']
+
+class WarpTransform(object):
+    """
+    Mapping from a source grid to a target grid for a resampling method.
+
+    Has the following attributes:
+
+    * dst_grid - target grid
+    * src_window - window of source image used (x_off, y_off, x_size, y_size)
+    * valid - boolean array of target pixels with a source pixel
+    * x_indices / x_weights - source columns and weights for each valid pixel
+    * y_indices / y_weights - source rows and weights for each valid pixel
+    * x_coords / y_coords - location of each valid pixel in the source
+      window, for interpolating kernels (None otherwise)
+    * cubic_fallback - valid pixels using bilinear as the 4 x 4 window
+      for cubic is partly outside the source image (None unless cubic
+      without downsampling)
+
+    """
+    def __init__(self, dst_grid, src_window, valid, x_indices, x_weights,
+                 y_indices, y_weights, x_coords=None, y_coords=None,
+                 cubic_fallback=None):
+        self.dst_grid = dst_grid
+        self.src_window = src_window
+        self.valid = valid
+        self.x_indices = x_indices
+        self.x_weights = x_weights
+        self.y_indices = y_indices
+        self.y_weights = y_weights
+        self.x_coords = x_coords
+        self.y_coords = y_coords
+        self.cubic_fallback = cubic_fallback
+
+    @classmethod
+    def compute(cls, src_grid, dst_grid, resample_method):
+        """
+        Calculate transform from source to target grid.
+        """
+        if resample_method not in SUPPORTED_METHODS:
+            raise ValueError('Resampling method "{}" is not supported, options '
+                             'are {}'.format(resample_method,
+                                             ', '.join(SUPPORTED_METHODS)))
+
+        src_px, src_py = _get_src_pixel_coords(src_grid, dst_grid)
+
+        # Target pixels with centre within source image
+        valid = numpy.isfinite(src_px) & numpy.isfinite(src_py) & \
+                (src_px >= 0) & (src_px < src_grid['x_size']) & \
+                (src_py >= 0) & (src_py < src_grid['y_size'])
+
+        x_ratio = _get_pixel_ratio(src_px, axis=1)[valid]
+        y_ratio = _get_pixel_ratio(src_py, axis=0)[valid]
+        src_px = src_px[valid]
+        src_py = src_py[valid]
+
+        x_scale = y_scale = 1.0
+        if resample_method in KERNEL_RADIUS:
+            x_scale = _get_kernel_scale(x_ratio)
+            y_scale = _get_kernel_scale(y_ratio)
+
+        x_indices, x_weights = _get_axis_taps(src_px, x_ratio, resample_method,
+                                              scale=x_scale)
+        y_indices, y_weights = _get_axis_taps(src_py, y_ratio, resample_method,
+                                              scale=y_scale)
+
+        # Without downsampling gdalwarp uses bilinear for cubic where
+        # the 4 x 4 window is not within the source image
+        cubic_fallback = None
+        if resample_method == 'cubic' and x_scale == 1.0 and y_scale == 1.0:
+            cubic_fallback = (x_indices.min(axis=1) < 0) | \
+                             (x_indices.max(axis=1) >= src_grid['x_size']) | \
+                             (y_indices.min(axis=1) < 0) | \
+                             (y_indices.max(axis=1) >= src_grid['y_size'])
+
+        x_indices, x_weights = _clip_taps(x_indices, x_weights, src_grid['x_size'])
+        y_indices, y_weights = _clip_taps(y_indices, y_weights, src_grid['y_size'])
+
+        # Only need to read part of source image covering target
+        if x_indices.size > 0:
+            x_off = int(x_indices.min())
+            y_off = int(y_indices.min())
+            src_window = [x_off, y_off,
+                          int(x_indices.max()) - x_off + 1,
+                          int(y_indices.max()) - y_off + 1]
+            x_indices -= x_off
+            y_indices -= y_off
+        else:
+            src_window = [0, 0, 1, 1]
+
+        x_coords = y_coords = None
+        if resample_method in KERNEL_RADIUS:
+            x_coords = src_px - src_window[0]
+            y_coords = src_py - src_window[1]
+
+        return cls(dst_grid, src_window, valid,
+                   x_indices.astype(numpy.int32), x_weights.astype(numpy.float32),
+                   y_indices.astype(numpy.int32), y_weights.astype(numpy.float32),
+                   x_coords, y_coords, cubic_fallback)
+
+    def save(self, out_file):
+        """
+        Save transform to a '.npz' file.
+        """
+        temp_file = '{}.{}.tmp.npz'.format(out_file, os.getpid())
+        optional_arrays = {}
+        for name in OPTIONAL_ARRAYS:
+            if getattr(self, name) is not None:
+                optional_arrays[name] = getattr(self, name)
+        numpy.savez(temp_file,
+                    dst_grid=numpy.array(json.dumps(self.dst_grid)),
+                    src_window=numpy.array(self.src_window, dtype=numpy.int64),
+                    valid=numpy.packbits(self.valid.ravel()),
+                    x_indices=self.x_indices, x_weights=self.x_weights,
+                    y_indices=self.y_indices, y_weights=self.y_weights,
+                    **optional_arrays)
+        os.replace(temp_file, out_file)
+
+    @classmethod
+    def load(cls, in_file):
+        """
+        Load transform from a '.npz' file.
+        """
+        with numpy.load(in_file, allow_pickle=False) as transform_data:
+            dst_grid = json.loads(str(transform_data['dst_grid']))
+            num_pixels = dst_grid['x_size'] * dst_grid['y_size']
+            valid = numpy.unpackbits(transform_data['valid'])[:num_pixels]
+            valid = valid.astype(bool).reshape((dst_grid['y_size'],
+                                                dst_grid['x_size']))
+            optional_arrays = {}
+            for name in OPTIONAL_ARRAYS:
+                if name in transform_data.files:
+                    optional_arrays[name] = transform_data[name]
+            return cls(dst_grid, list(transform_data['src_window']), valid,
+                       transform_data['x_indices'], transform_data['x_weights'],
+                       transform_data['y_indices'], transform_data['y_weights'],
+                       **optional_arrays)
+
+    def apply(self, src_array, src_nodata=None, dst_nodata=0):
+        """
+        Apply transform to an array read from the source window.
+
+        Source pixels which are no data or NaN are excluded and the
+        weights of the remaining pixels renormalised. For interpolating
+        kernels target pixels are no data where the source pixel
+        containing their centre is no data.
+
+        Returns array on target grid.
+        """
+        out_sum, weight_sum, any_bad = _sum_taps(src_array, src_nodata,
+                                                 self.x_indices, self.x_weights,
+                                                 self.y_indices, self.y_weights)
+
+        if self.cubic_fallback is not None:
+            fallback = self.cubic_fallback | any_bad
+            if fallback.any():
+                x_indices, x_weights = _get_axis_taps(self.x_coords[fallback], None,
+                                                      'bilinear')
+                y_indices, y_weights = _get_axis_taps(self.y_coords[fallback], None,
+                                                      'bilinear')
+                x_indices, x_weights = _clip_taps(x_indices, x_weights,
+                                                  src_array.shape[1])
+                y_indices, y_weights = _clip_taps(y_indices, y_weights,
+                                                  src_array.shape[0])
+                out_sum[fallback], weight_sum[fallback], _ = \
+                    _sum_taps(src_array, src_nodata, x_indices, x_weights,
+                              y_indices, y_weights)
+
+        has_weight = weight_sum > 1e-10
+        if self.x_coords is not None:
+            centre_rows = numpy.floor(self.y_coords + PIXEL_EPSILON).astype(numpy.int64)
+            centre_rows = numpy.minimum(centre_rows, src_array.shape[0] - 1)
+            centre_cols = numpy.floor(self.x_coords + PIXEL_EPSILON).astype(numpy.int64)
+            centre_cols = numpy.minimum(centre_cols, src_array.shape[1] - 1)
+            centre_values = src_array[centre_rows, centre_cols]
+            has_weight &= ~_get_bad_values(centre_values, src_nodata)
+
+        out_array = numpy.full(self.valid.shape, dst_nodata, dtype=numpy.float64)
+        valid_values = numpy.full(self.x_indices.shape[0], dst_nodata,
+                                  dtype=numpy.float64)
+        valid_values[has_weight] = out_sum[has_weight] / weight_sum[has_weight]
+        out_array[self.valid] = valid_values
+
+        return out_array
+
+class WarpTransformCache(object):
+    """
+    Cache of WarpTransform objects, held in memory and optionally
+    saved to a directory so they can be used by later runs.
+
+    Safe to use from multiple threads.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if self.cache_dir is not None and not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        self._transforms = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # Only pass the cache directory when copied to another process
+        return {'cache_dir' : self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state['cache_dir'])
+
+    def get_transform(self, src_grid, dst_grid, resample_method):
+        """
+        Get transform, calculating if not in the cache.
+        """
+        transform_key = get_transform_key(src_grid, dst_grid, resample_method)
+
+        with self._lock:
+            if transform_key in self._transforms:
+                return self._transforms[transform_key]
+
+            cache_file = None
+            if self.cache_dir is not None:
+                cache_file = os.path.join(self.cache_dir,
+                                          'warp_{}.npz'.format(transform_key))
+            if cache_file is not None and os.path.isfile(cache_file):
+                transform = WarpTransform.load(cache_file)
+            else:
+                transform = WarpTransform.compute(src_grid, dst_grid, resample_method)
+                if cache_file is not None:
+                    transform.save(cache_file)
+
+            self._transforms[transform_key] = transform
+
+        return transform
+
+    def warp(self, in_raster, out_raster, bounding_box, resample_method,
+             out_res=UPSCALING_RES, out_proj=UPSCALING_PROJ, dst_nodata=0,
+             out_format=GDAL_FORMAT):
+        """
+        Warp the first band of a raster to the grid defined by a bounding box,
+        resolution and projection. Equivalent to::
+
+            gdalwarp -r resample_method -te bounding_box -tr out_res out_res
+                     -t_srs out_proj -dstnodata dst_nodata in_raster out_raster
+
+        """
+        src_grid = get_raster_grid(in_raster)
+        dst_grid = get_target_grid(bounding_box, out_res, out_proj)
+        transform = self.get_transform(src_grid, dst_grid, resample_method)
+
+        src_dataset = gdal.Open(in_raster, gdal.GA_ReadOnly)
+        src_band = src_dataset.GetRasterBand(1)
+        src_nodata = src_band.GetNoDataValue()
+        src_array = src_band.ReadAsArray(*transform.src_window)
+        data_type = src_band.DataType
+        src_dataset = None
+
+        out_array = transform.apply(src_array, src_nodata=src_nodata,
+                                    dst_nodata=dst_nodata)
+
+        driver = gdal.GetDriverByName(out_format)
+        out_dataset = driver.Create(out_raster, dst_grid['x_size'],
+                                    dst_grid['y_size'], 1, data_type)
+        out_dataset.SetGeoTransform(dst_grid['geotransform'])
+        out_dataset.SetProjection(dst_grid['projection'])
+        out_band = out_dataset.GetRasterBand(1)
+        out_band.SetNoDataValue(dst_nodata)
+        out_band.WriteArray(out_array)
+        out_dataset = None
+
+        return out_raster
+
+def compare_with_gdalwarp(in_raster, bounding_box, out_res=UPSCALING_RES,
+                          out_proj=UPSCALING_PROJ, methods=None, out_dir=None,
+                          error_threshold=None):
+    """
+    Compare the results of WarpTransformCache to gdalwarp
+    for a raster.
+
+    Requires:
+
+    * in_raster - input raster
+    * bounding_box - bounding box of target grid
+    * out_res - resolution of target grid
+    * out_proj - projection of target grid
+    * methods - list of methods to compare (default is near, bilinear,
+      cubic and average)
+    * out_dir - directory for temporary files
+    * error_threshold - error threshold passed to gdalwarp ('-et') when
+      reprojecting. By default gdalwarp approximates the transformation
+      with an error of up to 0.125 pixels, set to 0 to compare against
+      the exact transformation used for the cache.
+
+    Returns a dictionary with the maximum absolute difference, root mean
+    square difference and number of pixels which are valid in only one
+    image for each method.
+
+    """
+    if methods is None:
+        methods = ['near', 'bilinear', 'cubic', 'average']
+
+    temp_dir = tempfile.mkdtemp(dir=out_dir)
+    cache = WarpTransformCache()
+
+    out_stats = {}
+
+    for method in methods:
+        gdalwarp_out = os.path.join(temp_dir, 'gdalwarp_{}.tif'.format(method))
+        cache_out = os.path.join(temp_dir, 'cache_{}.tif'.format(method))
+
+        gdal_warp_cmd = ['gdalwarp', '-overwrite', '-q', '-of', 'GTiff',
+                         '-r', method, '-te']
+        gdal_warp_cmd.extend([str(val).strip(',') for val in bounding_box])
+        gdal_warp_cmd.extend(['-tr', str(out_res), str(out_res),
+                              '-dstnodata', '0', '-t_srs', out_proj])
+        if error_threshold is not None:
+            gdal_warp_cmd.extend(['-et', str(error_threshold)])
+        gdal_warp_cmd.extend([in_raster, gdalwarp_out])
+        subprocess.check_call(gdal_warp_cmd)
+
+        cache.warp(in_raster, cache_out, bounding_box, method, out_res=out_res,
+                   out_proj=out_proj, out_format='GTiff')
+
+        gdalwarp_array = gdal.Open(gdalwarp_out).ReadAsArray().astype(numpy.float64)
+        cache_array = gdal.Open(cache_out).ReadAsArray().astype(numpy.float64)
+
+        both_valid = (gdalwarp_array != 0) & (cache_array != 0)
+        diff = gdalwarp_array[both_valid] - cache_array[both_valid]
+
+        out_stats[method] = {'max_abs_diff' : float(numpy.abs(diff).max()) if diff.size else 0.0,
+                             'rms_diff' : float(numpy.sqrt((diff**2).mean())) if diff.size else 0.0,
+                             'num_mismatched_valid' : int(((gdalwarp_array != 0)
+                                                           != (cache_array != 0)).sum())}
+        os.remove(gdalwarp_out)
+        os.remove(cache_out)
+
+    os.rmdir(temp_dir)
+
+    return out_stats
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Compare cached warp transforms "
+                                                 "against gdalwarp for a raster")
+    parser.add_argument("inraster", type=str, help="Input raster")
+    parser.add_argument("--bounding_box", type=str, nargs=4, required=True,
+                        help="Bounding box of target grid (min_x min_y max_x max_y)")
+    parser.add_argument("--res", type=float, default=UPSCALING_RES,
+                        help="Resolution of target grid")
+    parser.add_argument("--methods", type=str, nargs='+',
+                        default=['near', 'bilinear', 'cubic', 'average'],
+                        help="Resampling methods to compare")
+    parser.add_argument("--error_threshold", type=float, default=None,
+                        help="Error threshold for gdalwarp (use 0 for the "
+                             "exact transformation)")
+    args = parser.parse_args()
+
+    comparison = compare_with_gdalwarp(args.inraster, args.bounding_box,
+                                       out_res=args.res, methods=args.methods,
+                                       error_threshold=args.error_threshold)
+    for method, method_stats in comparison.items():
+        print('{}: max abs diff = {:.6g}, RMS diff = {:.6g}, '
+              'pixels valid in only one = {}'.format(method,
+                                                     method_stats['max_abs_diff'],
+                                                     method_stats['rms_diff'],
+                                                     method_stats['num_mismatched_valid']))
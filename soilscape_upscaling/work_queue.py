@@ -0,0 +1,574 @@
+#!/usr/bin/env python
+"""
+SoilSCAPE Random Forests upscaling code.
+
+Dan Clewley & Jane Whitcomb
+
+Queue of work units shared between any number of workers, on one or
+more machines, so runs of the site scripts can be distributed.
+
+A coordinator adds work units to a queue, stored as an SQLite database.
+Each unit is a run of a site script for a config file, split seed
+(used to select training and validation sites) and, optionally, a
+single date. Workers claim a unit, run it and record the result. A
+claimed unit has a lease which the worker renews while the unit is
+running. If a worker stops (e.g., the node fails) the lease expires and
+the unit is claimed by another worker, up to a maximum number of
+attempts. If a worker can't renew the lease (e.g., it was delayed and
+the unit has been claimed by another worker) the run of the unit is
+stopped, rather than continuing alongside the run by the other worker.
+
+For multiple machines the database must be on storage shared between
+them (e.g., NFS). SQLite's default (rollback journal) locking is used
+rather than write-ahead logging, as the latter doesn't work on network
+file systems. Each transaction is short so contention is low.
+
+To add units for 10 splits of each TxSON config, one unit per date::
+
+   cd sites/txson
+   python -m soilscape_upscaling.work_queue submit queue.db \\
+          --script soilscape_upscaling_txson.py --configs configs/*.cfg \\
+          --seeds 1 2 3 4 5 6 7 8 9 10 --per_date \\
+          --args "run_{seed} {config} --split_seed {seed}"
+
+Then start workers on each machine (as many as required)::
+
+   python -m soilscape_upscaling.work_queue work queue.db --log_dir logs
+
+And check progress using::
+
+   python -m soilscape_upscaling.work_queue status queue.db
+
+When run for individual dates the site scripts write stats for each
+date to a separate file, these can be combined using::
+
+   python -m soilscape_upscaling.work_queue merge_stats run_1/Stats
+
+This file is licensed under the GPL v3 Licence. A copy of this
+licence is available to download with this file.
+
+"""
+
+import argparse
+import calendar
+import configparser
+import glob
+import json
+import os
+import signal
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+#: Time (seconds) a worker holds a unit for before it must renew the lease
+DEFAULT_LEASE_SECONDS = 600
+
+#: Number of times a unit is attempted before it is marked as failed
+DEFAULT_MAX_ATTEMPTS = 3
+
+#: Time (seconds) to wait between checking for new units
+DEFAULT_POLL_SECONDS = 10
+
+#: Time (seconds) to wait for a lock on the database
+DB_TIMEOUT_SECONDS = 120
+
+#: Time (seconds) to wait for a unit to exit once it has been terminated,
+#: before it is killed
+TERMINATE_TIMEOUT_SECONDS = 30
+
+def get_config_dates(config_file):
+    """
+    Get list of dates (YYYYMMDD) to run for a config, using 'starttime',
+    'endtime' and 'predict_spacing_days' as the site scripts.
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    try:
+        starttime = time.strptime(config['default']['starttime'], '%Y-%m-%d %H:%M:%S')
+        endtime = time.strptime(config['default']['endtime'], '%Y-%m-%d %H:%M:%S')
+        predict_spacing = 3600 * 24 * float(config['default']['predict_spacing_days'])
+    except KeyError:
+        raise KeyError('The config {} must contain "starttime", "endtime" and '
+                       '"predict_spacing_days" to run each date '
+                       'separately'.format(config_file))
+
+    starttime_epoch = calendar.timegm(starttime)
+    endtime_epoch = calendar.timegm(endtime)
+
+    dates_list = []
+    while starttime_epoch < endtime_epoch:
+        dates_list.append(time.strftime('%Y%m%d', time.gmtime(starttime_epoch)))
+        starttime_epoch += predict_spacing
+    return dates_list
+
+def get_worker_id():
+    """
+    Get ID for a worker, using the host name and process ID.
+    """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+class WorkQueue(object):
+    """
+    Queue of work units stored in an SQLite database.
+
+    Each method opens a new connection so a WorkQueue can be used from
+    multiple threads.
+
+    Requires:
+
+    * queue_file - SQLite database (created if it doesn't exist)
+    * max_attempts - number of times to attempt a unit before marking
+      as failed
+
+    """
+    def __init__(self, queue_file, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.queue_file = os.path.abspath(queue_file)
+        self.max_attempts = max_attempts
+        with self._connect() as queue_db:
+            queue_db.execute('''CREATE TABLE IF NOT EXISTS units (
+                                unit_id INTEGER PRIMARY KEY,
+                                config TEXT NOT NULL,
+                                seed INTEGER,
+                                date TEXT,
+                                command TEXT NOT NULL,
+                                cwd TEXT NOT NULL,
+                                status TEXT NOT NULL DEFAULT 'pending',
+                                attempts INTEGER NOT NULL DEFAULT 0,
+                                worker TEXT,
+                                lease_expires REAL,
+                                result TEXT,
+                                updated REAL,
+                                UNIQUE (config, seed, date))''')
+            queue_db.execute('''CREATE INDEX IF NOT EXISTS idx_units_status
+                                ON units (status, lease_expires)''')
+            # SQLite treats NULLs as distinct in UNIQUE constraints, so
+            # units without a seed or date also need an index where
+            # these are replaced with values which can be compared
+            try:
+                queue_db.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_units_key
+                                    ON units (config, COALESCE(seed, -1),
+                                              COALESCE(date, ''))''')
+            except sqlite3.IntegrityError:
+                raise Exception('The queue {} contains duplicate units, create the '
+                                'queue again'.format(self.queue_file))
+
+    def _connect(self):
+        # isolation_level=None so transactions are started explicitly
+        queue_db = sqlite3.connect(self.queue_file, timeout=DB_TIMEOUT_SECONDS,
+                                   isolation_level=None)
+        queue_db.row_factory = sqlite3.Row
+        return _Connection(queue_db)
+
+    def add_units(self, units_list):
+        """
+        Add units to the queue. Units already in the queue (same config,
+        seed and date) are not added again.
+
+        Each unit is a dictionary with 'config', 'seed', 'date' (None
+        for all dates), 'command' (list of arguments) and 'cwd'.
+
+        Returns the number of units added.
+        """
+        num_added = 0
+        with self._connect() as queue_db:
+            queue_db.execute('BEGIN IMMEDIATE')
+            for unit in units_list:
+                cursor = queue_db.execute('''INSERT OR IGNORE INTO units
+                                             (config, seed, date, command, cwd, updated)
+                                             VALUES (?, ?, ?, ?, ?, ?)''',
+                                          (unit['config'], unit['seed'], unit['date'],
+                                           json.dumps(unit['command']), unit['cwd'],
+                                           time.time()))
+                num_added += cursor.rowcount
+            queue_db.execute('COMMIT')
+        return num_added
+
+    def claim(self, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Claim the next pending unit, or a running unit where the lease
+        has expired.
+
+        Returns unit as dictionary or None if there are no units available.
+        """
+        now = time.time()
+        with self._connect() as queue_db:
+            queue_db.execute('BEGIN IMMEDIATE')
+            # Units which ran out of attempts while their lease expired
+            queue_db.execute('''UPDATE units SET status = 'failed', updated = ?
+                                WHERE status = 'running' AND lease_expires < ?
+                                AND attempts >= ?''', (now, now, self.max_attempts))
+            row = queue_db.execute('''SELECT * FROM units
+                                      WHERE status = 'pending'
+                                      OR (status = 'running' AND lease_expires < ?)
+                                      ORDER BY attempts, unit_id LIMIT 1''',
+                                   (now,)).fetchone()
+            if row is None:
+                queue_db.execute('COMMIT')
+                return None
+            queue_db.execute('''UPDATE units SET status = 'running',
+                                attempts = attempts + 1, worker = ?,
+                                lease_expires = ?, updated = ?
+                                WHERE unit_id = ?''',
+                             (worker_id, now + lease_seconds, now, row['unit_id']))
+            queue_db.execute('COMMIT')
+
+        unit = dict(row)
+        unit['command'] = json.loads(unit['command'])
+        unit['attempts'] += 1
+        return unit
+
+    def renew(self, unit_id, worker_id, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """
+        Renew the lease on a unit.
+
+        Returns False if the unit is no longer held by the worker.
+        """
+        with self._connect() as queue_db:
+            cursor = queue_db.execute('''UPDATE units SET lease_expires = ?
+                                         WHERE unit_id = ? AND worker = ?
+                                         AND status = 'running' ''',
+                                      (time.time() + lease_seconds, unit_id, worker_id))
+            return cursor.rowcount == 1
+
+    def finish(self, unit_id, worker_id, success, result=None):
+        """
+        Record the result of a unit. Failed units are returned to the queue
+        unless they have reached the maximum number of attempts.
+
+        Returns False if the unit is no longer held by the worker (e.g.,
+        because the lease expired and it has been claimed by another worker),
+        in which case the result is not recorded.
+        """
+        with self._connect() as queue_db:
+            queue_db.execute('BEGIN IMMEDIATE')
+            row = queue_db.execute('''SELECT attempts FROM units WHERE unit_id = ?
+                                      AND worker = ? AND status = 'running' ''',
+                                   (unit_id, worker_id)).fetchone()
+            if row is None:
+                queue_db.execute('COMMIT')
+                return False
+            if success:
+                status = 'done'
+            elif row['attempts'] >= self.max_attempts:
+                status = 'failed'
+            else:
+                status = 'pending'
+            queue_db.execute('''UPDATE units SET status = ?, result = ?,
+                                lease_expires = NULL, updated = ?
+                                WHERE unit_id = ?''',
+                             (status, json.dumps(result), time.time(), unit_id))
+            queue_db.execute('COMMIT')
+        return True
+
+    def reset_failed(self):
+        """
+        Return failed units to the queue, with the number of attempts reset.
+
+        Returns the number of units reset.
+        """
+        with self._connect() as queue_db:
+            cursor = queue_db.execute('''UPDATE units SET status = 'pending',
+                                         attempts = 0, updated = ?
+                                         WHERE status = 'failed' ''', (time.time(),))
+            return cursor.rowcount
+
+    def get_counts(self):
+        """
+        Get the number of units with each status.
+        """
+        counts = {'pending' : 0, 'running' : 0, 'done' : 0, 'failed' : 0}
+        with self._connect() as queue_db:
+            for row in queue_db.execute('SELECT status, COUNT(*) AS n FROM units '
+                                        'GROUP BY status'):
+                counts[row['status']] = row['n']
+        return counts
+
+    def get_units(self, status=None):
+        """
+        Get list of units (optionally with a status).
+        """
+        with self._connect() as queue_db:
+            if status is None:
+                rows = queue_db.execute('SELECT * FROM units ORDER BY unit_id').fetchall()
+            else:
+                rows = queue_db.execute('SELECT * FROM units WHERE status = ? '
+                                        'ORDER BY unit_id', (status,)).fetchall()
+        return [dict(row) for row in rows]
+
+class _Connection(object):
+    """
+    Context manager which closes an SQLite connection (sqlite3 connections
+    only commit / rollback when used as context managers).
+    """
+    def __init__(self, queue_db):
+        self.queue_db = queue_db
+
+    def __enter__(self):
+        return self.queue_db
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.queue_db.in_transaction:
+            self.queue_db.execute('ROLLBACK')
+        self.queue_db.close()
+
+def make_units(script, config_files, seeds=None, per_date=False,
+               args_template='{config}', cwd=None):
+    """
+    Make list of work units for running a site script.
+
+    Requires:
+
+    * script - site script to run
+    * config_files - list of config files
+    * seeds - list of split seeds (None for a single unit per config / date)
+    * per_date - make a unit for each date, rather than each config and seed
+    * args_template - arguments to pass to the script, '{config}' and
+      '{seed}' are replaced with the config file and seed
+    * cwd - directory to run script in (default is current directory)
+
+    Returns list of units to pass to WorkQueue.add_units.
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+    if seeds is None:
+        seeds = [None]
+
+    units_list = []
+    for config_file in config_files:
+        if per_date:
+            dates_list = get_config_dates(os.path.join(cwd, config_file))
+        else:
+            dates_list = [None]
+        for seed in seeds:
+            script_args = args_template.format(config=config_file, seed=seed).split()
+            for date_str in dates_list:
+                command = [script] + script_args
+                if date_str is not None:
+                    command.extend(['--dates', date_str])
+                units_list.append({'config' : config_file,
+                                   'seed' : seed,
+                                   'date' : date_str,
+                                   'command' : command,
+                                   'cwd' : cwd})
+    return units_list
+
+def _stop_process(process, timeout=TERMINATE_TIMEOUT_SECONDS):
+    """
+    Stop the process for a unit and any processes it started (e.g., a pool
+    of workers), which are in the same process group. The process is
+    terminated and then killed if it hasn't exited after 'timeout' seconds.
+    """
+    for stop_signal in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, stop_signal)
+        except OSError:
+            # Already exited
+            pass
+        try:
+            process.wait(timeout)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+    process.wait()
+
+def run_worker(queue_file, log_dir=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+               poll_seconds=DEFAULT_POLL_SECONDS, wait=False,
+               max_attempts=DEFAULT_MAX_ATTEMPTS, worker_id=None):
+    """
+    Claim and run units until the queue is empty.
+
+    Each unit is run using the same Python interpreter as the worker,
+    with the output written to a log file. The lease on a unit is renewed
+    while it is running, if it can't be renewed the unit is stopped.
+
+    Requires:
+
+    * queue_file - SQLite database of queue
+    * log_dir - directory to write log for each unit to (default is
+      'logs' next to the queue)
+    * lease_seconds - length of lease on each unit
+    * poll_seconds - time to wait between checking for units
+    * wait - if True keep waiting for new units once the queue is empty,
+      rather than exiting once there are no pending or running units
+    * max_attempts - number of attempts before a unit is marked as failed
+    * worker_id - ID of worker (default is host name and process ID)
+
+    Returns number of units run.
+    """
+    work_queue = WorkQueue(queue_file, max_attempts=max_attempts)
+    if worker_id is None:
+        worker_id = get_worker_id()
+    if log_dir is None:
+        log_dir = os.path.join(os.path.dirname(work_queue.queue_file), 'logs')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    num_run = 0
+    while True:
+        unit = work_queue.claim(worker_id, lease_seconds)
+        if unit is None:
+            counts = work_queue.get_counts()
+            if not wait and counts['pending'] == 0 and counts['running'] == 0:
+                break
+            # Wait for new units or leases to expire
+            time.sleep(poll_seconds)
+            continue
+
+        print('[{}] Running unit {} (attempt {}): {}'.format(worker_id, unit['unit_id'],
+                                                             unit['attempts'],
+                                                             ' '.join(unit['command'])))
+        log_file = os.path.join(log_dir, 'unit_{:06d}_attempt_{}.log'.format(unit['unit_id'],
+                                                                              unit['attempts']))
+        lost_lease = threading.Event()
+        finished = threading.Event()
+
+        def renew_lease(process):
+            while not finished.wait(lease_seconds / 3.0):
+                if not work_queue.renew(unit['unit_id'], worker_id, lease_seconds):
+                    # Stop the unit now, as it can be claimed by another worker
+                    lost_lease.set()
+                    _stop_process(process)
+                    return
+
+        start_time = time.time()
+        try:
+            with open(log_file, 'w') as log_f:
+                # Start in a new process group so processes started by
+                # the unit are also stopped if the lease is lost
+                process = subprocess.Popen([sys.executable] + unit['command'],
+                                           cwd=unit['cwd'], stdout=log_f,
+                                           stderr=subprocess.STDOUT,
+                                           start_new_session=True)
+                renew_thread = threading.Thread(target=renew_lease, args=(process,))
+                renew_thread.daemon = True
+                renew_thread.start()
+                try:
+                    return_code = process.wait()
+                except BaseException:
+                    # e.g., worker interrupted
+                    _stop_process(process)
+                    raise
+                finally:
+                    finished.set()
+                    renew_thread.join()
+        except OSError as err:
+            print(err)
+            return_code = -1
+
+        result = {'returnCode' : return_code,
+                  'log' : log_file,
+                  'worker' : worker_id,
+                  'seconds' : time.time() - start_time}
+        recorded = work_queue.finish(unit['unit_id'], worker_id,
+                                     return_code == 0, result)
+        if lost_lease.is_set() or not recorded:
+            print('[{}] Lost lease on unit {}, stopped and result not '
+                  'recorded'.format(worker_id, unit['unit_id']))
+        elif return_code != 0:
+            print('[{}] Unit {} failed (see {})'.format(worker_id, unit['unit_id'],
+                                                        log_file))
+        num_run += 1
+
+    return num_run
+
+def merge_stats(stats_dir, stats_name='scaling_function_stats'):
+    """
+    Combine stats written for individual dates ('<stats_name>_YYYYMMDD.csv')
+    into a single file ('<stats_name>.csv'), sorted by date.
+
+    Returns path to merged file.
+    """
+    date_files = sorted(glob.glob(os.path.join(stats_dir, '{}_[0-9]*.csv'.format(stats_name))))
+    if len(date_files) == 0:
+        raise Exception('No stats for individual dates found in {}'.format(stats_dir))
+
+    out_file = os.path.join(stats_dir, '{}.csv'.format(stats_name))
+    header = None
+    rows = []
+    for date_file in date_files:
+        with open(date_file, 'r') as in_f:
+            lines = in_f.read().splitlines()
+        if len(lines) == 0:
+            continue
+        if header is None:
+            header = lines[0]
+        rows.extend([line for line in lines[1:] if line.strip() != ''])
+
+    with open(out_file, 'w') as out_f:
+        out_f.write(header + '\n')
+        for row in sorted(rows):
+            out_f.write(row + '\n')
+
+    return out_file
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Distribute runs of the site '
+                                                 'scripts using a shared queue')
+    subparsers = parser.add_subparsers(dest='command')
+
+    submit_parser = subparsers.add_parser('submit', help='Add units to queue')
+    submit_parser.add_argument("queue_file", help="SQLite database of queue")
+    submit_parser.add_argument("--script", required=True, help="Site script to run")
+    submit_parser.add_argument("--configs", nargs='+', required=True,
+                               help="Config files")
+    submit_parser.add_argument("--seeds", nargs='+', type=int, default=None,
+                               help="Split seeds")
+    submit_parser.add_argument("--per_date", action='store_true', default=False,
+                               help="Add a unit for each date")
+    submit_parser.add_argument("--args", default='{config}',
+                               help="Arguments for script ({config} and {seed} "
+                                    "are replaced)")
+
+    work_parser = subparsers.add_parser('work', help='Run units from queue')
+    work_parser.add_argument("queue_file", help="SQLite database of queue")
+    work_parser.add_argument("--log_dir", default=None, help="Directory for logs")
+    work_parser.add_argument("--lease", type=float, default=DEFAULT_LEASE_SECONDS,
+                             help="Lease on each unit (seconds)")
+    work_parser.add_argument("--poll", type=float, default=DEFAULT_POLL_SECONDS,
+                             help="Time between checking for units (seconds)")
+    work_parser.add_argument("--max_attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                             help="Number of attempts before a unit fails")
+    work_parser.add_argument("--wait", action='store_true', default=False,
+                             help="Keep waiting for new units when queue is empty")
+
+    status_parser = subparsers.add_parser('status', help='Print status of queue')
+    status_parser.add_argument("queue_file", help="SQLite database of queue")
+    status_parser.add_argument("--failed", action='store_true', default=False,
+                               help="List failed units")
+    status_parser.add_argument("--reset_failed", action='store_true', default=False,
+                               help="Return failed units to the queue")
+
+    merge_parser = subparsers.add_parser('merge_stats',
+                                         help='Combine stats for individual dates')
+    merge_parser.add_argument("stats_dirs", nargs='+', help="Stats directories")
+
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        queue = WorkQueue(args.queue_file)
+        units = make_units(args.script, args.configs, seeds=args.seeds,
+                           per_date=args.per_date, args_template=args.args)
+        print('Added {} of {} units'.format(queue.add_units(units), len(units)))
+    elif args.command == 'work':
+        num_units = run_worker(args.queue_file, log_dir=args.log_dir,
+                               lease_seconds=args.lease, poll_seconds=args.poll,
+                               wait=args.wait, max_attempts=args.max_attempts)
+        print('Ran {} units'.format(num_units))
+    elif args.command == 'status':
+        queue = WorkQueue(args.queue_file)
+        if args.reset_failed:
+            print('Reset {} failed units'.format(queue.reset_failed()))
+        print(', '.join(['{}: {}'.format(status, count)
+                         for status, count in queue.get_counts().items()]))
+        if args.failed:
+            for failed_unit in queue.get_units('failed'):
+                print('{unit_id}: {config} seed={seed} date={date} '
+                      '{result}'.format(**failed_unit))
+    elif args.command == 'merge_stats':
+        for merge_stats_dir in args.stats_dirs:
+            print('Written {}'.format(merge_stats(merge_stats_dir)))
+    else:
+        parser.print_help()
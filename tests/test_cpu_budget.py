@@ -0,0 +1,49 @@
+"""
+Tests for cpu_budget
+"""
+
+import os
+
+import pytest
+
+from soilscape_upscaling import cpu_budget
+from soilscape_upscaling import upscaling_common
+
+ENV_VARS = ['GDAL_NUM_THREADS', 'GDAL_CACHEMAX'] + cpu_budget.BLAS_THREADS_ENV_VARS
+
+@pytest.fixture
+def clean_env(monkeypatch):
+    for env_var in ENV_VARS:
+        monkeypatch.delenv(env_var, raising=False)
+    monkeypatch.setattr(upscaling_common, 'UPSCALING_CPU_BUDGET', 0)
+    monkeypatch.setattr(upscaling_common, 'UPSCALING_GDAL_CACHEMAX', 0)
+    monkeypatch.setattr(cpu_budget, 'HAVE_THREADPOOLCTL', False)
+    monkeypatch.setattr(cpu_budget, '_current_allocation', None)
+
+def test_no_budget_keeps_defaults(clean_env):
+    allocation = cpu_budget.set_cpu_budget({}, tile_workers=6, prepare_workers=2)
+    assert allocation['tile_workers'] == 6
+    assert allocation['prepare_workers'] == 2
+    assert cpu_budget.get_rf_n_jobs() == cpu_budget.DEFAULT_RF_N_JOBS
+    for env_var in ENV_VARS:
+        assert env_var not in os.environ
+
+def test_no_budget_with_gdal_cachemax(clean_env):
+    cpu_budget.set_cpu_budget({'gdal_cachemax' : '1024'}, tile_workers=4)
+    assert os.environ['GDAL_CACHEMAX'] == '256'
+    assert 'GDAL_NUM_THREADS' not in os.environ
+    assert cpu_budget.get_rf_n_jobs() == cpu_budget.DEFAULT_RF_N_JOBS
+
+@pytest.mark.parametrize('config_dict,env_budget', [({'cpu_budget' : '8'}, 0),
+                                                    ({}, '8')])
+def test_budget_applied(clean_env, monkeypatch, config_dict, env_budget):
+    monkeypatch.setattr(upscaling_common, 'UPSCALING_CPU_BUDGET', env_budget)
+    allocation = cpu_budget.set_cpu_budget(config_dict, tile_workers=2,
+                                           prepare_workers=2)
+    assert allocation['cpu_budget'] == 8
+    assert allocation['tile_workers'] == 2
+    assert allocation['prepare_workers'] == 2
+    assert cpu_budget.get_rf_n_jobs() == 3
+    assert os.environ['GDAL_NUM_THREADS'] == '1'
+    for env_var in cpu_budget.BLAS_THREADS_ENV_VARS:
+        assert os.environ[env_var] == '1'
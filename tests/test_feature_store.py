@@ -0,0 +1,47 @@
+"""
+Tests for feature_store
+"""
+
+import pandas
+
+from soilscape_upscaling import feature_store
+from soilscape_upscaling import upscaling_common
+
+BOUNDING_BOX = ['-9552162.102', '3674308.402', '-9513582.102', '3714088.402']
+
+def _get_layers():
+    return [upscaling_common.DataLayer({'name' : 'elevation',
+                                        'path' : 'elevation.kea'})]
+
+def _make_features(target):
+    return pandas.DataFrame({'station_id' : ['1', '2'], 'depth' : 5,
+                             'latitude' : 30.0, 'longitude' : -97.0,
+                             'target' : target, 'elevation' : [100.0, 200.0]})
+
+def test_grid_in_layer_set_hash():
+    layer_set_hash = feature_store.get_layer_set_hash(_get_layers(), BOUNDING_BOX,
+                                                      '100', upscaling_common.UPSCALING_PROJ)
+    # Same grid given as numbers
+    assert layer_set_hash == feature_store.get_layer_set_hash(
+        _get_layers(), [float(v) for v in BOUNDING_BOX], 100,
+        upscaling_common.UPSCALING_PROJ)
+
+    other_grids = [(BOUNDING_BOX[:3] + ['3724088.402'], 100, upscaling_common.UPSCALING_PROJ),
+                   (BOUNDING_BOX, 30, upscaling_common.UPSCALING_PROJ),
+                   (BOUNDING_BOX, 100, '+proj=utm +zone=14 +datum=WGS84 +units=m')]
+    other_hashes = [feature_store.get_layer_set_hash(_get_layers(), *grid)
+                    for grid in other_grids]
+    assert len(set([layer_set_hash] + other_hashes)) == len(other_grids) + 1
+
+def test_grids_stored_separately(tmp_path):
+    store = feature_store.FeatureStore(str(tmp_path))
+    hash_100 = store.register_layer_set(_get_layers(), BOUNDING_BOX, 100,
+                                        upscaling_common.UPSCALING_PROJ)
+    hash_30 = store.register_layer_set(_get_layers(), BOUNDING_BOX, 30,
+                                       upscaling_common.UPSCALING_PROJ)
+    store.append(hash_100, '20160101', _make_features(0.2))
+    store.append(hash_30, '20160101', _make_features(0.4))
+
+    assert sorted(store.list_layer_sets()) == sorted([hash_100, hash_30])
+    assert store.read(hash_100)['target'].tolist() == [0.2, 0.2]
+    assert store.read(hash_30)['target'].tolist() == [0.4, 0.4]
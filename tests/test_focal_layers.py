@@ -0,0 +1,42 @@
+"""
+Tests for focal_layers
+"""
+
+import pytest
+
+from soilscape_upscaling import upscaling_common
+
+def _get_layers(source_type):
+    source_dict = {'name' : 'source', 'type' : source_type, 'path' : 'source.kea'}
+    return [upscaling_common.DataLayer(source_dict),
+            upscaling_common.DataLayer({'name' : 'source_mean_1km', 'type' : 'focal',
+                                        'source' : 'source', 'radius' : '1000'})]
+
+def test_dynamic_source_rejected():
+    data_layers_list = _get_layers('static')
+    assert upscaling_common.get_source_path(data_layers_list[1],
+                                            data_layers_list) == ('source.kea', None)
+
+    data_layers_list = _get_layers('dynamic')
+    with pytest.raises(ValueError):
+        upscaling_common.get_source_path(data_layers_list[1], data_layers_list)
+
+def test_layer_key_uses_grid(tmp_path):
+    focal_layers = pytest.importorskip('soilscape_upscaling.focal_layers')
+    source_path = str(tmp_path / 'source.kea')
+    with open(source_path, 'w') as out_f:
+        out_f.write('source')
+    store = focal_layers.FocalLayers(str(tmp_path / 'focal'))
+    bounding_box = ['-9552162.102', '3674308.402', '-9513582.102', '3714088.402']
+
+    layer_key = store.get_layer_key(source_path, 1000, bounding_box, '100',
+                                    upscaling_common.UPSCALING_PROJ)
+    # Same grid given as numbers, with different spacing in the projection
+    assert layer_key == store.get_layer_key(source_path, 1000.0,
+                                            [float(v) for v in bounding_box], 100,
+                                            '  ' + upscaling_common.UPSCALING_PROJ)
+    assert layer_key != store.get_layer_key(source_path, 1000, bounding_box, 30,
+                                            upscaling_common.UPSCALING_PROJ)
+    assert layer_key != store.get_layer_key(source_path, 1000, bounding_box, 100,
+                                            upscaling_common.UPSCALING_PROJ,
+                                            source_nodata=0)
@@ -0,0 +1,60 @@
+"""
+Tests for pooled_training
+"""
+
+import numpy
+import pandas
+import pytest
+
+pytest.importorskip('rios')
+
+from soilscape_upscaling import feature_store
+from soilscape_upscaling import pooled_training
+from soilscape_upscaling import upscaling_common
+
+DATES = ['201601{:02}'.format(d) for d in range(1, 11)]
+
+def test_window_does_not_extend_past_block():
+    for block_end in range(1, len(DATES) + 1):
+        block = DATES[max(block_end - 3, 0):block_end]
+        window = pooled_training.get_window_dates(DATES, block, 7)
+        assert window[-1] == block[-1]
+        assert window == DATES[max(block_end - 7, 0):block_end]
+
+def test_window_smaller_than_block():
+    window = pooled_training.get_window_dates(DATES, DATES[2:6], 2)
+    assert window == DATES[2:6]
+
+def _make_features(station_ids, depth, target):
+    features = pandas.DataFrame({'station_id' : station_ids})
+    features['depth'] = depth
+    features['latitude'] = 30.0
+    features['longitude'] = -97.0
+    features['target'] = target
+    features['elevation'] = numpy.arange(len(station_ids), dtype=float)
+    features['mask'] = 1.0
+    return features
+
+def test_only_training_stations_used(tmp_path):
+    data_layers_list = [upscaling_common.DataLayer({'name' : 'elevation',
+                                                    'path' : 'elevation.kea'}),
+                        upscaling_common.DataLayer({'name' : 'mask', 'type' : 'mask',
+                                                    'path' : 'mask.kea'})]
+    store = feature_store.FeatureStore(str(tmp_path))
+    layer_set_hash = store.register_layer_set(data_layers_list)
+
+    train_ids = ['1', '2', '3', '4']
+    for date_str in DATES[:3]:
+        store.append(layer_set_hash, date_str, _make_features(train_ids, 1, 0.2))
+        # Validation stations, other depths and stations from other runs
+        # sharing the store
+        store.append(layer_set_hash, date_str, _make_features(['5', '6'], 1, 0.4))
+        store.append(layer_set_hash, date_str, _make_features(train_ids, 2, 0.4))
+
+    rf, parameters = pooled_training.train_pooled_model(store, layer_set_hash,
+                                                        DATES[:3], data_layers_list,
+                                                        station_ids=train_ids,
+                                                        depth=1, n_estimators=10)
+    assert parameters['nSamples'] == len(train_ids) * 3
+    assert parameters['nDates'] == 3
+    assert parameters['averageSMTrain'] == pytest.approx(0.2)
@@ -0,0 +1,94 @@
+"""
+Tests for prediction_cube
+"""
+
+import multiprocessing
+
+import numpy
+import pytest
+
+from soilscape_upscaling import prediction_cube
+
+GEOTRANSFORM = [500000, 30, 0, 4250000, 0, -30]
+
+def _make_data(date_index, y_size=10, x_size=9):
+    rows, cols = numpy.mgrid[0:y_size, 0:x_size]
+    return (date_index * 1000 + rows * 10 + cols).astype(numpy.float32)
+
+def _date_str(date_index):
+    return '2016{:02d}{:02d}'.format(date_index // 28 + 1, date_index % 28 + 1)
+
+def test_append_read(tmp_path):
+    cube = prediction_cube.PredictionCube(str(tmp_path / 'cube'), time_chunk=4,
+                                          space_chunk=4)
+    # Enough dates for one flushed chunk and some pending dates
+    for date_index in range(6):
+        data = _make_data(date_index)
+        data[0, 0] = -1
+        cube.append(_date_str(date_index), data, GEOTRANSFORM, nodata=-1,
+                    stats={'r2' : 0.5})
+    assert cube.metadata['pendingDates'] == [_date_str(4), _date_str(5)]
+
+    # Replace a date which is in the chunks
+    cube.append(_date_str(1), _make_data(10), GEOTRANSFORM)
+
+    cube = prediction_cube.PredictionCube(str(tmp_path / 'cube'))
+    for date_index, data_index in [(0, 0), (1, 10), (4, 4), (5, 5)]:
+        expected = _make_data(data_index)
+        if data_index != 10:
+            expected[0, 0] = numpy.nan
+        numpy.testing.assert_array_equal(cube.read_map(_date_str(date_index)), expected)
+
+    dates, out_data = cube.read_window(3, 2, 5, 6)
+    assert dates == [_date_str(i) for i in range(6)]
+    assert out_data.shape == (6, 5, 6)
+    numpy.testing.assert_array_equal(out_data[5], _make_data(5)[3:8, 2:8])
+    assert cube.get_stats(_date_str(5)) == {'r2' : 0.5}
+
+    cube.flush()
+    assert cube.metadata['pendingDates'] == []
+    assert not (tmp_path / 'cube' / 'pending' / '{}.npy'.format(_date_str(5))).exists()
+    numpy.testing.assert_array_equal(cube.read_window(3, 2, 5, 6)[1], out_data)
+
+def test_chunks_written_once_per_time_chunk(tmp_path, monkeypatch):
+    cube = prediction_cube.PredictionCube(str(tmp_path / 'cube'), time_chunk=4,
+                                          space_chunk=4)
+    written_chunks = []
+    write_chunk = cube._write_chunk
+    def _count_write_chunk(time_chunk, y_chunk, x_chunk, chunk_data):
+        written_chunks.append((time_chunk, y_chunk, x_chunk))
+        write_chunk(time_chunk, y_chunk, x_chunk, chunk_data)
+    monkeypatch.setattr(cube, '_write_chunk', _count_write_chunk)
+
+    for date_index in range(8):
+        cube.append(_date_str(date_index), _make_data(date_index), GEOTRANSFORM)
+
+    # 3 x 3 spatial chunks for each of 2 time chunks
+    assert len(written_chunks) == 18
+    assert len(set(written_chunks)) == 18
+
+def _append_dates(cube_dir, date_indices):
+    cube = prediction_cube.PredictionCube(cube_dir, time_chunk=4, space_chunk=4)
+    for date_index in date_indices:
+        cube.append(_date_str(date_index), _make_data(date_index), GEOTRANSFORM,
+                    stats={'index' : date_index})
+
+@pytest.mark.skipif(not prediction_cube.HAVE_FCNTL, reason='fcntl not available')
+def test_append_from_several_processes(tmp_path):
+    cube_dir = str(tmp_path / 'cube')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_append_dates,
+                                 args=(cube_dir, range(start, 40, 4)))
+                 for start in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    cube = prediction_cube.PredictionCube(cube_dir)
+    assert sorted(cube.get_dates()) == [_date_str(i) for i in range(40)]
+    for date_index in range(40):
+        numpy.testing.assert_array_equal(cube.read_map(_date_str(date_index)),
+                                         _make_data(date_index))
+        assert cube.get_stats(_date_str(date_index)) == {'index' : date_index}
@@ -0,0 +1,133 @@
+"""
+Tests for rf_upscaling
+"""
+
+import tracemalloc
+
+import numpy
+import pytest
+from sklearn.ensemble import RandomForestRegressor
+
+pytest.importorskip('rios')
+
+from soilscape_upscaling import rf_upscaling
+
+def _fit_forest(num_features, num_trees, seed=0):
+    rng = numpy.random.default_rng(seed)
+    X_train = rng.random((2000, num_features)).astype(numpy.float32)
+    y_train = X_train.sum(axis=1) + rng.normal(0, 0.1, X_train.shape[0])
+    rf = RandomForestRegressor(n_estimators=num_trees, max_features=1,
+                               max_depth=10, random_state=seed, n_jobs=1)
+    return rf.fit(X_train, y_train)
+
+def _get_memory_bound(num_pixels, num_features, num_trees, num_quantiles,
+                      chunk_pixels=rf_upscaling.UNCERTAINTY_CHUNK_PIXELS):
+    # Bound given in the docstring of predict_forest_uncertainty
+    bound = num_pixels * (4 * (num_features + num_quantiles) + 56)
+    if num_quantiles > 0:
+        bound += min(chunk_pixels, num_pixels) * num_trees * 4
+    return bound
+
+@pytest.mark.parametrize('num_pixels,num_trees,quantiles,dtype',
+                         [(100000, 300, [0.05, 0.5, 0.95], numpy.float32),
+                          (100000, 50, None, numpy.float64),
+                          (40000, 100, [0.1, 0.9], numpy.float64),
+                          (5000, 100, [0.5], numpy.float32)])
+def test_uncertainty_memory_bound(num_pixels, num_trees, quantiles, dtype):
+    num_features = 6
+    rf = _fit_forest(num_features, num_trees)
+    X = numpy.random.default_rng(1).random((num_pixels, num_features)).astype(dtype)
+
+    tracemalloc.start()
+    try:
+        rf_upscaling.predict_forest_uncertainty(rf, X, quantiles=quantiles)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    num_quantiles = 0 if quantiles is None else len(quantiles)
+    assert peak <= _get_memory_bound(num_pixels, num_features, num_trees,
+                                     num_quantiles)
+
+@pytest.mark.parametrize('chunk_pixels', [rf_upscaling.UNCERTAINTY_CHUNK_PIXELS, 777])
+def test_uncertainty_matches_all_trees(chunk_pixels):
+    quantiles = [0, 0.05, 0.5, 0.95, 1]
+    rf = _fit_forest(4, 60)
+    X = numpy.random.default_rng(2).random((5000, 4)).astype(numpy.float32)
+
+    mean, sd, out_quantiles = rf_upscaling.predict_forest_uncertainty(rf, X,
+                                                                      quantiles=quantiles,
+                                                                      chunk_pixels=chunk_pixels)
+
+    all_predictions = numpy.stack([tree.predict(X) for tree in rf.estimators_])
+    numpy.testing.assert_allclose(mean, all_predictions.mean(axis=0), atol=1e-12)
+    numpy.testing.assert_allclose(mean, rf.predict(X), atol=1e-12)
+    numpy.testing.assert_allclose(sd, all_predictions.std(axis=0), atol=1e-12)
+    # Tree predictions are held as Float32 for quantiles
+    numpy.testing.assert_allclose(out_quantiles,
+                                  numpy.quantile(all_predictions, quantiles, axis=0),
+                                  atol=1e-6)
+
+def _predict_block_float64(in_array, rf, nodata_vals_list):
+    # Reference using a Float64 table (as before predict_block)
+    num_bands = in_array.shape[0]
+    test_data = numpy.zeros((in_array.shape[1] * in_array.shape[2], num_bands))
+    test_data[:] = in_array.reshape((num_bands, -1)).T
+    test_data[numpy.isnan(test_data)] = rf_upscaling.NAN_NODATA_VALUE
+    predict_sm = rf.predict(test_data[:, :-1])
+    for i, nodata_val in enumerate(nodata_vals_list):
+        if nodata_val is not None:
+            predict_sm = numpy.where(test_data[:, i] == nodata_val, 0, predict_sm)
+        predict_sm = numpy.where(test_data[:, i] == rf_upscaling.NAN_NODATA_VALUE,
+                                 0, predict_sm)
+    return predict_sm.reshape(in_array.shape[1:])
+
+def test_predict_block_matches_float64():
+    num_features = 8
+    rng = numpy.random.default_rng(3)
+    X_train = rng.random((2000, num_features)).astype(numpy.float32)
+    y_train = 0.05 + 0.4 * X_train.mean(axis=1)
+    rf = RandomForestRegressor(n_estimators=50, random_state=0, n_jobs=1)
+    rf.fit(X_train, y_train)
+
+    block = rng.random((num_features + 1, 256, 256)).astype(numpy.float32)
+    block[-1] = 1
+    block[0, :10] = numpy.nan
+    block[1, 20:30] = 2
+    block[-1, 40:50] = 0
+    nodata_vals_list = [None, 2, None, None, None, None, None, None, 0]
+
+    tracemalloc.start()
+    try:
+        out_block, _ = rf_upscaling.predict_block(block, rf, nodata_vals_list)
+        peak_float32 = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    tracemalloc.start()
+    try:
+        ref_block = _predict_block_float64(block, rf, nodata_vals_list)
+        peak_float64 = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    numpy.testing.assert_array_equal(out_block[0] == 0, ref_block == 0)
+    assert (out_block[0] == 0).sum() == 30 * 256
+    # Predictions (< 0.5) only differ by rounding to Float32
+    assert numpy.abs(out_block[0] - ref_block).max() <= 1.5e-8
+    assert peak_float32 < 0.7 * peak_float64
+
+def test_adaptive_forest_ignores_single_converged_step(monkeypatch):
+    # OOB RMSE for each step. The change from 50 to 75 trees is below the
+    # tolerance by chance, then the changes to 150, 175 and 200 trees are.
+    oob_rmse_list = [1.0, 0.999, 0.9, 0.85, 0.849, 0.8489, 0.8488, 0.5]
+    monkeypatch.setattr(rf_upscaling, '_get_oob_rmse',
+                        lambda rf, y_train: oob_rmse_list[len(rf.estimators_) // 25 - 2])
+
+    rng = numpy.random.default_rng(0)
+    X_train = rng.random((200, 3))
+    y_train = X_train.sum(axis=1)
+    rf = RandomForestRegressor(max_depth=2, random_state=0, n_jobs=1)
+    rf = rf_upscaling.fit_adaptive_forest(rf, X_train, y_train, oob_tolerance=0.005)
+    assert len(rf.estimators_) == 200
+    assert not rf.warm_start
@@ -0,0 +1,73 @@
+"""
+Tests for run_planner
+"""
+
+import json
+import time
+
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('rios')
+
+from soilscape_upscaling import run_planner
+from soilscape_upscaling import upscaling_common
+
+def test_site_split_saved_in_plan(tmp_path):
+    site_split = {'seed' : None,
+                  'trainSiteIDs' : ['1', '4', '7'],
+                  'validationSiteIDs' : ['2', '9']}
+    dates_ts_list = [time.strptime('20160101', '%Y%m%d')]
+    plan = run_planner.make_plan(dates_ts_list, [], site_split=site_split)
+
+    plan_file = str(tmp_path / 'plan.json')
+    run_planner.write_plan(plan, plan_file)
+    assert run_planner.get_site_split(run_planner.read_plan(plan_file)) == site_split
+
+def test_plan_without_site_split(tmp_path):
+    plan = run_planner.make_plan([time.strptime('20160101', '%Y%m%d')], [])
+    assert run_planner.get_site_split(plan) is None
+
+def test_old_plan_rejected(tmp_path):
+    plan_file = str(tmp_path / 'plan.json')
+    with open(plan_file, 'w') as out_f:
+        json.dump({'version' : run_planner.PLAN_VERSION - 1, 'dates' : []}, out_f)
+    with pytest.raises(Exception):
+        run_planner.read_plan(plan_file)
+
+def test_dynamic_focal_source_reported(tmp_path):
+    data_layers_list = [upscaling_common.DataLayer({'name' : 'smap', 'type' : 'dynamic',
+                                                    'dir' : str(tmp_path)}),
+                        upscaling_common.DataLayer({'name' : 'smap_mean_10km', 'type' : 'focal',
+                                                    'source' : 'smap', 'radius' : '10000'})]
+    problems = run_planner.check_static_layers(data_layers_list)
+    assert len(problems) == 1
+    assert 'dynamic' in problems[0]
+
+def test_rolling_layer_days_checked(tmp_path, monkeypatch):
+    missing_dates = ['20160102', '20160105']
+    def get_dynamic_layer(layer_type, layer_dir, sm_date_ts):
+        date_str = time.strftime('%Y%m%d', sm_date_ts)
+        layer_path = tmp_path / 'prism_ppt_{}.tif'.format(date_str)
+        if date_str not in missing_dates:
+            layer_path.write_text('')
+        return str(layer_path), date_str
+    monkeypatch.setattr(run_planner.dynamic_layers, 'get_dynamic_layer',
+                        get_dynamic_layer)
+
+    sm_date_ts = time.strptime('20160110', '%Y%m%d')
+    # 'api' layers are built from API_SPINUP_WINDOWS windows
+    api_layer = upscaling_common.DataLayer({'name' : 'prism_ppt_api2', 'type' : 'dynamic',
+                                            'dir' : str(tmp_path)})
+    resolved, problems = run_planner.resolve_dynamic_layers([api_layer], sm_date_ts)
+    assert resolved == {}
+    assert len(problems) == 1
+    assert '2 of the 10 days' in problems[0]
+    assert ', '.join(missing_dates) in problems[0]
+
+    # 'sum' layers only need the window
+    sum_layer = upscaling_common.DataLayer({'name' : 'prism_ppt_sum3', 'type' : 'dynamic',
+                                            'dir' : str(tmp_path)})
+    resolved, problems = run_planner.resolve_dynamic_layers([sum_layer], sm_date_ts)
+    assert problems == []
+    assert resolved['prism_ppt_sum3']['date'] == '20160110'
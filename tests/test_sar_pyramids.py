@@ -0,0 +1,54 @@
+"""
+Tests for sar_pyramids
+"""
+
+import os
+
+import pytest
+
+pytest.importorskip('osgeo')
+
+from soilscape_upscaling import sar_pyramids
+
+BOUNDING_BOX = ['-9552100', '3674300', '-9513500', '3714000']
+
+def _make_scene(scene_file, content=b'scene'):
+    with open(scene_file, 'wb') as out_f:
+        out_f.write(content)
+    return scene_file
+
+def test_product_path_keys(tmp_path):
+    pyramids = sar_pyramids.SARPyramids(str(tmp_path / 'pyramids'), BOUNDING_BOX)
+    in_scene = _make_scene(str(tmp_path / 'scene.tif'))
+
+    average_product = pyramids.get_product_path(in_scene, 'average')
+    assert pyramids.get_product_path(in_scene, 'average') == average_product
+    assert pyramids.get_product_path(in_scene, 'bilinear') != average_product
+
+    # Replacing the scene gives a new product
+    os.utime(in_scene, ns=(0, 0))
+    replaced_product = pyramids.get_product_path(in_scene, 'average')
+    assert replaced_product != average_product
+    _make_scene(in_scene, b'replaced scene')
+    os.utime(in_scene, ns=(0, 0))
+    assert pyramids.get_product_path(in_scene, 'average') != replaced_product
+
+    # Scenes with the same name in another directory
+    os.makedirs(str(tmp_path / 'other'))
+    other_scene = _make_scene(str(tmp_path / 'other' / 'scene.tif'), b'scene')
+    assert pyramids.get_product_path(other_scene, 'average') != \
+        pyramids.get_product_path(in_scene, 'average')
+
+def test_compatible_methods(tmp_path):
+    pyramids = sar_pyramids.SARPyramids(str(tmp_path / 'pyramids'), BOUNDING_BOX,
+                                        base_res=100)
+    assert pyramids.is_compatible(BOUNDING_BOX, 100, resample_method='average')
+    assert pyramids.is_compatible(BOUNDING_BOX, 100, resample_method='bilinear')
+    # Only overviews built by averaging are used
+    assert pyramids.is_compatible(BOUNDING_BOX, 200, resample_method='average')
+    assert not pyramids.is_compatible(BOUNDING_BOX, 200, resample_method='bilinear')
+    assert not pyramids.is_compatible(BOUNDING_BOX, 100, resample_method=None)
+
+    in_scene = _make_scene(str(tmp_path / 'scene.tif'))
+    assert pyramids.get_layer(in_scene, BOUNDING_BOX, 200,
+                              resample_method='near') is None
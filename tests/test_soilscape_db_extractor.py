@@ -0,0 +1,65 @@
+"""
+Tests for soilscape_db_extractor
+"""
+
+import sqlite3
+
+import pytest
+
+from soilscape_upscaling.data_extractors import soilscape_db_extractor
+from soilscape_upscaling.data_extractors import soilscape_db_tuning
+
+DAYS = ['2013-01-{:02d}'.format(day) for day in range(2, 8)]
+
+def _get_out_line(extractor, node_id, start_time, end_time):
+    try:
+        return extractor.getOutLine(node_id, start_time, end_time)
+    except Exception as err:
+        return str(err)
+
+def test_series_checks_match_query(tmp_path):
+    sqlite_file = str(tmp_path / 'soilscape.db')
+    node_ids = soilscape_db_tuning.create_test_database(sqlite_file, num_nodes=4,
+                                                        num_years=1,
+                                                        interval_minutes=180)
+    sensordb = sqlite3.connect(sqlite_file)
+    cursor = sensordb.cursor()
+    # Node 2 has a single unmasked record for all sensors on the 3rd
+    cursor.execute("UPDATE Measurements SET s1Flag = 1, s2Flag = 1, s3Flag = 1 "
+                   "WHERE PhysicalID = 2 AND measTStime > '2013-01-03 00:00:00' "
+                   "AND measTStime < '2013-01-03 21:00:00';")
+    # Node 3 has a different sensor for the first record on the 5th
+    cursor.execute("INSERT INTO MeasurementScheme VALUES (2, 'Other', 'Other', 5, "
+                   "'EC-5', 15, 'EC-5', 30, 'None', 0);")
+    cursor.execute("UPDATE Measurements SET MeasurementSchemeID = 2 "
+                   "WHERE PhysicalID = 3 AND measTStime = '2013-01-05 03:00:00';")
+    # Node 4 has no records on the 6th
+    cursor.execute("DELETE FROM Measurements WHERE PhysicalID = 4 "
+                   "AND measTStime > '2013-01-06 00:00:00' "
+                   "AND measTStime < '2013-01-07 00:00:00';")
+    sensordb.commit()
+    sensordb.close()
+
+    query_extractor = soilscape_db_extractor.SoilSCAPECreateCSVfromDB(sqlite_file)
+    series_extractor = soilscape_db_extractor.SoilSCAPECreateCSVfromDB(sqlite_file)
+    series_extractor.loadSeries(node_ids, '2013-01-01 00:00:00', '2013-01-10 00:00:00')
+
+    for start_day, end_day in zip(DAYS[:-1], DAYS[1:]):
+        start_time = start_day + ' 00:00:00'
+        end_time = end_day + ' 00:00:00'
+        for node_id in node_ids:
+            expected = _get_out_line(query_extractor, node_id, start_time, end_time)
+            out_line = _get_out_line(series_extractor, node_id, start_time, end_time)
+            if isinstance(expected, str):
+                assert out_line == expected
+            else:
+                assert out_line[:3] == expected[:3]
+                assert out_line[3] == pytest.approx(expected[3])
+
+    assert 'unmasked' in _get_out_line(series_extractor, 2, '2013-01-03 00:00:00',
+                                       '2013-01-04 00:00:00')
+    assert 'three soil moisture sensors' in _get_out_line(series_extractor, 3,
+                                                          '2013-01-05 00:00:00',
+                                                          '2013-01-06 00:00:00')
+    assert 'No data found' in _get_out_line(series_extractor, 4, '2013-01-06 00:00:00',
+                                            '2013-01-07 00:00:00')
@@ -0,0 +1,170 @@
+"""
+Tests for stack_bands
+"""
+
+import os
+import shutil
+
+import numpy
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from soilscape_upscaling import stack_bands
+from soilscape_upscaling import stage_cache
+from soilscape_upscaling import upscaling_common
+from soilscape_upscaling import warp_cache
+
+RES = 100
+BOUNDING_BOX = ['0.0', '0.0', '800.0', '1000.0']
+CONFIG_NODATA = -999
+
+UTM_PROJ = '+proj=utm +zone=14 +datum=WGS84 +units=m +no_defs'
+
+pytestmark = pytest.mark.skipif(shutil.which('gdalwarp') is None,
+                                reason='gdalwarp not available')
+
+needs_vrt_tools = pytest.mark.skipif(shutil.which('gdalbuildvrt') is None or
+                                     shutil.which('gdal_translate') is None,
+                                     reason='gdalbuildvrt or gdal_translate not available')
+
+def _make_raster(out_raster, data, geotransform, projection=upscaling_common.UPSCALING_PROJ,
+                 nodata=None):
+    y_size, x_size = data.shape
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(out_raster, x_size, y_size, 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(warp_cache._get_srs(projection).ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(data.astype(numpy.float32))
+    dataset = None
+    return out_raster
+
+def _make_on_grid_layer(out_raster, margin_pixels=2):
+    """
+    Make a layer on the grid of BOUNDING_BOX, covering a larger area.
+    No no data value is set.
+    """
+    x_size = 8 + 2 * margin_pixels
+    y_size = 10 + 2 * margin_pixels
+    data = numpy.arange(x_size * y_size).reshape(y_size, x_size)
+    geotransform = [-margin_pixels * RES, RES, 0, 1000 + margin_pixels * RES, 0, -RES]
+    _make_raster(out_raster, data, geotransform)
+    return data[margin_pixels:-margin_pixels, margin_pixels:-margin_pixels]
+
+def _make_fine_layer(out_raster):
+    """
+    Make a layer with half the pixel size of the grid. Values are
+    constant within each grid pixel so the warped values are known.
+    """
+    rows, cols = numpy.mgrid[0:12, 0:10]
+    coarse = 1000 + 10 * rows + cols
+    data = numpy.repeat(numpy.repeat(coarse, 2, axis=0), 2, axis=1)
+    geotransform = [-RES, RES / 2.0, 0, 1000 + RES, 0, -RES / 2.0]
+    _make_raster(out_raster, data, geotransform, nodata=-1)
+    return coarse[1:-1, 1:-1]
+
+def _make_layers(tmp_path):
+    on_grid_data = _make_on_grid_layer(str(tmp_path / 'on_grid.tif'))
+    fine_data = _make_fine_layer(str(tmp_path / 'fine.tif'))
+    data_layers_list = [upscaling_common.DataLayer({'name' : 'on_grid',
+                                                    'path' : str(tmp_path / 'on_grid.tif'),
+                                                    'nodata' : str(CONFIG_NODATA)}),
+                        upscaling_common.DataLayer({'name' : 'fine',
+                                                    'path' : str(tmp_path / 'fine.tif'),
+                                                    'nodata' : str(CONFIG_NODATA)})]
+    return data_layers_list, [on_grid_data, fine_data]
+
+def _read_stack(in_stack):
+    dataset = gdal.Open(in_stack, gdal.GA_ReadOnly)
+    bands = [dataset.GetRasterBand(i + 1) for i in range(dataset.RasterCount)]
+    stack_info = {'driver' : dataset.GetDriver().ShortName,
+                  'geotransform' : dataset.GetGeoTransform(),
+                  'names' : [band.GetDescription() for band in bands],
+                  'nodata' : [band.GetNoDataValue() for band in bands],
+                  'data' : [band.ReadAsArray() for band in bands]}
+    dataset = None
+    return stack_info
+
+def test_is_on_grid(tmp_path):
+    dst_grid = warp_cache.get_target_grid(BOUNDING_BOX, RES, upscaling_common.UPSCALING_PROJ)
+    on_grid_layer = str(tmp_path / 'on_grid.tif')
+    _make_on_grid_layer(on_grid_layer)
+    assert stack_bands.is_on_grid(on_grid_layer, dst_grid)
+
+    # A window of the grid is also on the grid
+    window_grid = warp_cache.get_target_grid(['-200.0', '-200.0', '0.0', '1200.0'], RES,
+                                             upscaling_common.UPSCALING_PROJ)
+    assert stack_bands.is_on_grid(on_grid_layer, window_grid)
+
+    # Doesn't cover the grid
+    large_grid = warp_cache.get_target_grid(['-300.0', '0.0', '800.0', '1000.0'], RES,
+                                            upscaling_common.UPSCALING_PROJ)
+    assert not stack_bands.is_on_grid(on_grid_layer, large_grid)
+
+    # Different pixel size
+    fine_layer = str(tmp_path / 'fine.tif')
+    _make_fine_layer(fine_layer)
+    assert not stack_bands.is_on_grid(fine_layer, dst_grid)
+
+    # Pixels not aligned
+    data = numpy.zeros((14, 12))
+    shifted_layer = _make_raster(str(tmp_path / 'shifted.tif'), data,
+                                 [-250, RES, 0, 1150, 0, -RES])
+    assert not stack_bands.is_on_grid(shifted_layer, dst_grid)
+
+    # Different projection
+    utm_layer = _make_raster(str(tmp_path / 'utm.tif'), data,
+                             [-200, RES, 0, 1200, 0, -RES], projection=UTM_PROJ)
+    assert not stack_bands.is_on_grid(utm_layer, dst_grid)
+
+@needs_vrt_tools
+def test_make_stack_on_grid(tmp_path):
+    data_layers_list, expected_data = _make_layers(tmp_path)
+    out_dir = tmp_path / 'stack'
+    out_dir.mkdir()
+
+    out_stack = stack_bands.make_stack(data_layers_list, str(out_dir),
+                                       bounding_box=BOUNDING_BOX, out_res=RES)
+    # Layers are combined as a VRT rather than warping the stack, with
+    # only the layer which isn't on the grid warped
+    assert os.path.splitext(out_stack)[1] == '.vrt'
+    assert not os.path.isfile(str(out_dir / 'on_grid_on_grid.{}'.format(stack_bands.GDAL_EXT)))
+    assert os.path.isfile(str(out_dir / 'on_grid_fine.{}'.format(stack_bands.GDAL_EXT)))
+
+    stack_info = _read_stack(out_stack)
+    assert stack_info['names'] == ['on_grid', 'fine']
+    numpy.testing.assert_allclose(stack_info['geotransform'], [0, RES, 0, 1000, 0, -RES])
+    for stack_data, layer_data in zip(stack_info['data'], expected_data):
+        assert stack_data.dtype == numpy.float32
+        numpy.testing.assert_array_equal(stack_data, layer_data)
+
+    # No data from the config is only used for the layer without one
+    assert stack_info['nodata'] == [CONFIG_NODATA, -1]
+
+@needs_vrt_tools
+def test_make_stack_on_grid_stage_cache(tmp_path):
+    data_layers_list, expected_data = _make_layers(tmp_path)
+    out_dir = tmp_path / 'stack'
+    out_dir.mkdir()
+    cache = stage_cache.StageCache(str(tmp_path / 'cache'))
+
+    out_stack = stack_bands.make_stack(data_layers_list, str(out_dir),
+                                       bounding_box=BOUNDING_BOX, out_res=RES,
+                                       stage_cache=cache)
+    # Stack is written to GDAL_FORMAT, so doesn't reference the layers
+    # warped to the temporary directory
+    assert os.path.splitext(out_stack)[1] == '.' + stack_bands.GDAL_EXT
+    assert cache.get_stack_key_for_file(out_stack) is not None
+    shutil.rmtree(str(out_dir))
+
+    stack_info = _read_stack(out_stack)
+    assert stack_info['driver'] == stack_bands.GDAL_FORMAT
+    assert stack_info['names'] == ['on_grid', 'fine']
+    # GeoTIFF only has one no data value for all bands
+    if stack_bands.GDAL_FORMAT != 'GTiff':
+        assert stack_info['nodata'] == [CONFIG_NODATA, -1]
+    for stack_data, layer_data in zip(stack_info['data'], expected_data):
+        numpy.testing.assert_array_equal(stack_data, layer_data)
@@ -0,0 +1,90 @@
+"""
+Tests for terrain_layers
+"""
+
+import shutil
+
+import numpy
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from soilscape_upscaling import terrain_layers
+from soilscape_upscaling import upscaling_common
+from soilscape_upscaling import warp_cache
+
+pytestmark = pytest.mark.skipif(shutil.which('gdalwarp') is None,
+                                reason='gdalwarp not available')
+
+RES = 100
+BOUNDING_BOX = ['0.0', '0.0', '4000.0', '2000.0']
+# Tiles of 20 x 20 pixels (see tiling.get_tile_bounding_boxes)
+TILE_BOUNDING_BOXES = [['0.0', '0.0', '2000.0', '2000.0'],
+                       ['2000.0', '0.0', '4000.0', '2000.0']]
+
+def _make_dem(out_raster, margin_pixels=5):
+    """
+    Make DEM with a valley running east, so water crosses from the
+    western tile to the eastern tile.
+    """
+    x_size = 40 + 2 * margin_pixels
+    y_size = 20 + 2 * margin_pixels
+    rows, cols = numpy.mgrid[0:y_size, 0:x_size]
+    dem = 500 - 2.0 * cols + 3.0 * numpy.abs(rows - y_size / 2.0) \
+          + 0.1 * numpy.sin(rows * 1.3 + cols * 0.7)
+
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(out_raster, x_size, y_size, 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform([-margin_pixels * RES, RES, 0,
+                             2000 + margin_pixels * RES, 0, -RES])
+    dataset.SetProjection(warp_cache._get_srs(upscaling_common.UPSCALING_PROJ).ExportToWkt())
+    dataset.GetRasterBand(1).WriteArray(dem.astype(numpy.float32))
+    dataset = None
+    return out_raster
+
+def _read_window(in_raster, bounding_box):
+    """
+    Read the window of a raster for a bounding box on the same grid.
+    """
+    grid = warp_cache.get_raster_grid(in_raster)
+    min_x, min_y, max_x, max_y = [float(v) for v in bounding_box]
+    col_offset = int(round((min_x - grid['geotransform'][0]) / RES))
+    row_offset = int(round((grid['geotransform'][3] - max_y) / RES))
+    num_cols = int(round((max_x - min_x) / RES))
+    num_rows = int(round((max_y - min_y) / RES))
+    dataset = gdal.Open(in_raster, gdal.GA_ReadOnly)
+    data = dataset.GetRasterBand(1).ReadAsArray(col_offset, row_offset, num_cols, num_rows)
+    dataset = None
+    return data
+
+@pytest.mark.parametrize('derivative', ['flow_accum', 'twi'])
+def test_tiled_matches_untiled(tmp_path, derivative):
+    dem_path = _make_dem(str(tmp_path / 'dem.tif'))
+    data_layers_list = [upscaling_common.DataLayer({'name' : 'elevation',
+                                                    'path' : dem_path}),
+                        upscaling_common.DataLayer({'name' : derivative,
+                                                    'source' : 'elevation',
+                                                    'derive' : derivative,
+                                                    'margin' : '500'})]
+    terrain = terrain_layers.TerrainLayers(str(tmp_path / 'terrain'))
+
+    untiled_layer = terrain.get_layer(data_layers_list[1], data_layers_list,
+                                      BOUNDING_BOX, RES, upscaling_common.UPSCALING_PROJ)
+    untiled = _read_window(untiled_layer, BOUNDING_BOX)
+
+    for tile_bounding_box in TILE_BOUNDING_BOXES:
+        tile_layer = terrain.get_layer(data_layers_list[1], data_layers_list,
+                                       tile_bounding_box, RES,
+                                       upscaling_common.UPSCALING_PROJ,
+                                       full_bounding_box=BOUNDING_BOX)
+        numpy.testing.assert_array_equal(_read_window(tile_layer, tile_bounding_box),
+                                         _read_window(untiled_layer, tile_bounding_box))
+
+    # Flow from the western tile reaches the eastern tile, so calculating
+    # each tile separately gives different values
+    east_bounding_box = TILE_BOUNDING_BOXES[1]
+    east_only = terrain.get_layer(data_layers_list[1], data_layers_list,
+                                  east_bounding_box, RES, upscaling_common.UPSCALING_PROJ)
+    assert not numpy.array_equal(_read_window(east_only, east_bounding_box),
+                                 _read_window(untiled_layer, east_bounding_box))
+    assert untiled.shape == (20, 40)
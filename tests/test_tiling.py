@@ -0,0 +1,182 @@
+"""
+Tests for tiling
+"""
+
+import copy
+import csv
+import shutil
+
+import numpy
+import pandas
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+pytest.importorskip('rios')
+
+from osgeo import osr
+
+from soilscape_upscaling import extract_image_stats
+from soilscape_upscaling import rf_upscaling
+from soilscape_upscaling import stack_bands
+from soilscape_upscaling import station_index
+from soilscape_upscaling import tiling
+from soilscape_upscaling import upscaling_common
+from soilscape_upscaling import warp_cache
+
+pytestmark = pytest.mark.skipif(any(shutil.which(tool) is None
+                                    for tool in ['gdalwarp', 'gdalbuildvrt',
+                                                 'gdal_translate']),
+                                reason='GDAL command line tools not available')
+
+RES = 100
+# 30 x 20 pixels, split into tiles of 8 x 8 pixels with smaller tiles
+# on the right and bottom edges
+BOUNDING_BOX = ['0.0', '0.0', '3000.0', '2000.0']
+NUM_COLS = 30
+NUM_ROWS = 20
+TILE_SIZE = 8
+NODATA = -9999
+# Column of no data within a tile
+NODATA_COL = 12
+
+def _make_raster(out_raster, data, geotransform, nodata=None):
+    y_size, x_size = data.shape
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(out_raster, x_size, y_size, 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(warp_cache._get_srs(upscaling_common.UPSCALING_PROJ).ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(data.astype(numpy.float32))
+    dataset = None
+    return out_raster
+
+def _make_layers(tmp_path, margin_pixels=3):
+    """
+    Make layers for the bounding box. Most layers are on the grid and
+    cover a larger area, one has a smaller pixel size (offset from the
+    grid) so is warped for each tile.
+    """
+    rng = numpy.random.default_rng(0)
+    x_size = NUM_COLS + 2 * margin_pixels
+    y_size = NUM_ROWS + 2 * margin_pixels
+    on_grid_gt = [-margin_pixels * RES, RES, 0, 2000 + margin_pixels * RES, 0, -RES]
+    rows, cols = numpy.mgrid[0:y_size, 0:x_size]
+
+    smooth = numpy.sin(cols / 5.0) + numpy.cos(rows / 4.0)
+    smooth[:, NODATA_COL + margin_pixels] = NODATA
+    _make_raster(str(tmp_path / 'smooth.tif'), smooth, on_grid_gt, nodata=NODATA)
+    _make_raster(str(tmp_path / 'random.tif'), rng.random((y_size, x_size)), on_grid_gt)
+    _make_raster(str(tmp_path / 'mask.tif'), numpy.ones((y_size, x_size)), on_grid_gt)
+
+    fine_gt = [-RES - RES / 4.0, RES / 2.0, 0, 2000 + RES + RES / 4.0, 0, -RES / 2.0]
+    _make_raster(str(tmp_path / 'fine.tif'),
+                 rng.random((2 * NUM_ROWS + 5, 2 * NUM_COLS + 5)), fine_gt)
+
+    data_layers_list = []
+    for layer_name in ['smooth', 'random', 'fine', 'mask']:
+        layer_dict = {'name' : layer_name,
+                      'path' : str(tmp_path / '{}.tif'.format(layer_name))}
+        if layer_name == 'mask':
+            layer_dict['type'] = 'mask'
+        if layer_name == 'smooth':
+            layer_dict['nodata'] = str(NODATA)
+        data_layers_list.append(upscaling_common.DataLayer(layer_dict))
+    return data_layers_list
+
+def _make_sensor_csv(out_csv, num_sensors=60):
+    """
+    Write sensors at the centre of random pixels. Sensors are sorted by
+    tile so the training data for the tiles, which is combined in tile
+    order, is in the same order as for the whole area.
+    """
+    rng = numpy.random.default_rng(1)
+    pixels = set()
+    while len(pixels) < num_sensors:
+        row = int(rng.integers(NUM_ROWS))
+        col = int(rng.integers(NUM_COLS))
+        if col != NODATA_COL:
+            pixels.add((row // TILE_SIZE, col // TILE_SIZE, row, col))
+    pixels = sorted(pixels)
+
+    grid_srs = warp_cache._get_srs(upscaling_common.UPSCALING_PROJ)
+    wgs84_srs = warp_cache._get_srs('+proj=longlat +datum=WGS84 +no_defs')
+    transform = osr.CoordinateTransformation(grid_srs, wgs84_srs)
+    centres = [((col + 0.5) * RES, 2000 - (row + 0.5) * RES) for _, _, row, col in pixels]
+    lon_lat = transform.TransformPoints(centres)
+
+    with open(out_csv, 'w') as out_f:
+        out_csv_writer = csv.writer(out_f)
+        out_csv_writer.writerow(['SensorID', 'Latitude', 'Longitude', 'SoilMoisture'])
+        for i, ((_, _, row, col), point) in enumerate(zip(pixels, lon_lat)):
+            soil_moisture = float(0.2 + 0.1 * numpy.sin(col / 5.0) + 0.01 * row)
+            out_csv_writer.writerow(['sensor{}'.format(i), repr(point[1]), repr(point[0]),
+                                     repr(soil_moisture)])
+    return out_csv
+
+def _read_image(in_image):
+    dataset = gdal.Open(in_image, gdal.GA_ReadOnly)
+    data = dataset.GetRasterBand(1).ReadAsArray()
+    geotransform = dataset.GetGeoTransform()
+    dataset = None
+    return data, geotransform
+
+def test_tiled_matches_untiled(tmp_path):
+    data_layers_list = _make_layers(tmp_path)
+    sensor_csv = _make_sensor_csv(str(tmp_path / 'sensor_data.csv'))
+
+    untiled_dir = tmp_path / 'untiled'
+    untiled_dir.mkdir()
+    untiled_layers_list = copy.deepcopy(data_layers_list)
+    untiled_stack = stack_bands.make_stack(untiled_layers_list, str(untiled_dir),
+                                           bounding_box=BOUNDING_BOX, out_res=RES)
+    untiled_train_csv = str(tmp_path / 'untiled_train.csv')
+    extract_image_stats.extract_layer_stats_csv(sensor_csv, untiled_train_csv,
+                                                untiled_layers_list, untiled_stack,
+                                                station_index=station_index.StationIndex())
+    untiled_image = str(tmp_path / 'untiled_predict_sm.tif')
+    untiled_par = rf_upscaling.run_random_forests(untiled_train_csv, untiled_stack,
+                                                  untiled_image, untiled_layers_list,
+                                                  n_estimators=20)
+
+    tiled_dir = tmp_path / 'tiled'
+    tiled_dir.mkdir()
+    tiled_train_csv = str(tmp_path / 'tiled_train.csv')
+    tiled_image = str(tmp_path / 'tiled_predict_sm.tif')
+    tiled_par = tiling.run_tiled_upscaling(sensor_csv, tiled_train_csv, tiled_image,
+                                           copy.deepcopy(data_layers_list), str(tiled_dir),
+                                           bounding_box=BOUNDING_BOX, out_res=RES,
+                                           tile_size=TILE_SIZE, num_workers=2,
+                                           n_estimators=20,
+                                           station_index=station_index.StationIndex())
+    assert len(tiling.get_tile_bounding_boxes(BOUNDING_BOX, RES, TILE_SIZE)) == 12
+
+    # Same training data, so the same model
+    pandas.testing.assert_frame_equal(pandas.read_csv(tiled_train_csv),
+                                      pandas.read_csv(untiled_train_csv))
+    assert tiled_par['nSamples'] == untiled_par['nSamples']
+    assert tiled_par['RMSE'] == untiled_par['RMSE']
+
+    untiled, untiled_gt = _read_image(untiled_image)
+    tiled, tiled_gt = _read_image(tiled_image)
+    assert tiled.shape == (NUM_ROWS, NUM_COLS)
+    numpy.testing.assert_allclose(tiled_gt, untiled_gt)
+    numpy.testing.assert_array_equal(tiled, untiled)
+
+    # Pixels either side of each tile edge are predicted and match
+    edge_cols = [col for edge in range(TILE_SIZE, NUM_COLS, TILE_SIZE)
+                 for col in [edge - 1, edge]]
+    edge_rows = [row for edge in range(TILE_SIZE, NUM_ROWS, TILE_SIZE)
+                 for row in [edge - 1, edge]]
+    assert (tiled[:, edge_cols] != 0).all()
+    assert (tiled[edge_rows, :][:, numpy.arange(NUM_COLS) != NODATA_COL] != 0).all()
+    numpy.testing.assert_array_equal(tiled[:, edge_cols], untiled[:, edge_cols])
+    numpy.testing.assert_array_equal(tiled[edge_rows, :], untiled[edge_rows, :])
+    # Including the last column and row, in the smaller tiles
+    numpy.testing.assert_array_equal(tiled[-1, :], untiled[-1, :])
+    numpy.testing.assert_array_equal(tiled[:, -1], untiled[:, -1])
+
+    assert (tiled[:, NODATA_COL] == 0).all()
+    assert tiled_par['averageSMPredict'] == pytest.approx(untiled_par['averageSMPredict'])
+    assert tiled_par['sdSMPredict'] == pytest.approx(untiled_par['sdSMPredict'])
@@ -0,0 +1,119 @@
+"""
+Tests for upscaling_service
+"""
+
+import os
+import tempfile
+import threading
+
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('rios')
+
+from soilscape_upscaling import upscaling_service
+from soilscape_upscaling.data_extractors import soilscape_db_tuning
+
+@pytest.fixture
+def service_client(tmp_path):
+    service = upscaling_service.UpscalingService(str(tmp_path / 'work'), max_jobs=1)
+    # Unix socket paths are limited to ~100 characters so don't use tmp_path
+    socket_dir = tempfile.mkdtemp(prefix='upscaling_')
+    socket_path = os.path.join(socket_dir, 'service.sock')
+    server = upscaling_service.make_server(service, socket_path=socket_path)
+    server_thread = threading.Thread(target=server.serve_forever)
+    server_thread.daemon = True
+    server_thread.start()
+    try:
+        yield service, upscaling_service.UpscalingClient(socket_path=socket_path)
+    finally:
+        server.shutdown()
+        server.server_close()
+        service.shutdown()
+        os.remove(socket_path)
+        os.rmdir(socket_dir)
+
+def _stub_upscale(request):
+    return {'outImage' : '{}_predict_sm.kea'.format(request['date']),
+            'nSamples' : 12}
+
+@pytest.mark.parametrize('date_str', ['2015-06-01', '20150601'])
+def test_submit_status_result(service_client, date_str):
+    service, client = service_client
+    service.actions['upscale'] = _stub_upscale
+
+    job_id = client.submit({'action' : 'upscale', 'config' : 'tonzi.cfg',
+                            'date' : date_str, 'sensor_csv' : 'sensors.csv'})
+    assert client.get_job(job_id)['status'] in ['queued', 'running', 'finished']
+
+    job = client.wait(job_id, poll_interval=0.05, timeout=30)
+    assert job['status'] == 'finished'
+    assert job['error'] is None
+    # Dates are passed to jobs as YYYY-MM-DD
+    assert job['request']['date'] == '2015-06-01'
+    assert job['result'] == {'outImage' : '2015-06-01_predict_sm.kea',
+                             'nSamples' : 12}
+    assert client.get_status()['jobs'] == {'finished' : 1}
+
+def test_failed_job(service_client):
+    service, client = service_client
+
+    def _failing_upscale(request):
+        raise ValueError('no sensors')
+    service.actions['upscale'] = _failing_upscale
+
+    job_id = client.submit({'action' : 'upscale', 'config' : 'tonzi.cfg',
+                            'date' : '20150601'})
+    job = client.wait(job_id, poll_interval=0.05, timeout=30)
+    assert job['status'] == 'failed'
+    assert job['error'] == 'ValueError: no sensors'
+
+def test_invalid_date_rejected(service_client):
+    _, client = service_client
+    with pytest.raises(Exception, match='YYYY-MM-DD or YYYYMMDD'):
+        client.submit({'action' : 'upscale', 'config' : 'tonzi.cfg',
+                       'date' : '01/06/2015'})
+
+def test_extract_from_resident_database(service_client, tmp_path):
+    service, client = service_client
+    sqlite_file = str(tmp_path / 'soilscape.db')
+    soilscape_db_tuning.create_test_database(sqlite_file, num_nodes=3, num_years=1,
+                                             interval_minutes=180)
+    layer_set = {'hash' : 'test',
+                 'default' : {'sqlite_db' : sqlite_file, 'sensor_ids' : '1 2 3',
+                              'time_interval_hours' : '24'}}
+
+    def _extract_upscale(request):
+        out_csv = str(tmp_path / 'sensors_{}.csv'.format(request['date']))
+        num_sensors = service._extract_sensor_data(request, layer_set, out_csv)
+        return {'numSensors' : num_sensors,
+                'extractor' : id(service._get_extractor(layer_set))}
+    service.actions['upscale'] = _extract_upscale
+
+    results = []
+    for date_str in ['2013-03-01', '2013-03-02']:
+        job_id = client.submit({'action' : 'upscale', 'config' : 'tonzi.cfg',
+                                'date' : date_str})
+        job = client.wait(job_id, poll_interval=0.05, timeout=30)
+        assert job['status'] == 'finished', job['error']
+        results.append(job['result'])
+    assert [result['numSensors'] for result in results] == [3, 3]
+    # The extractor (and database connection) is kept between jobs
+    assert results[0]['extractor'] == results[1]['extractor']
+
+def test_static_locks_removed(service_client, monkeypatch):
+    service, _ = service_client
+    monkeypatch.setattr(upscaling_service.stack_bands, 'warp_static_layers',
+                        lambda layers, *args: list(layers))
+    layer_set = {'hash' : 'test', 'layers' : []}
+    for res in [100.0, 30.0, 100.0]:
+        service._get_static_layers(layer_set, ['0', '0', '3000', '3000'], res,
+                                   upscaling_service.upscaling_common.UPSCALING_PROJ)
+    assert service.get_status()['static_grids'] == 2
+    assert service._static_locks == {}
+
+def test_rolling_climate_per_layer_set(service_client):
+    service, _ = service_client
+    rolling_a = service._get_rolling_climate({'hash' : 'a'})
+    assert service._get_rolling_climate({'hash' : 'a'}) is rolling_a
+    assert service._get_rolling_climate({'hash' : 'b'}) is not rolling_a
@@ -0,0 +1,90 @@
+"""
+Tests for warp_cache
+"""
+
+import shutil
+
+import numpy
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from soilscape_upscaling import upscaling_common
+from soilscape_upscaling import warp_cache
+
+pytestmark = pytest.mark.skipif(shutil.which('gdalwarp') is None,
+                                reason='gdalwarp not available')
+
+METHODS = ['near', 'bilinear', 'cubic', 'average']
+
+# TxSON bounding box
+BOUNDING_BOX = [-9552162.102, 3674308.402, -9513582.102, 3714088.402]
+
+UTM_PROJ = '+proj=utm +zone=14 +datum=WGS84 +units=m +no_defs'
+NAD83_PROJ = '+proj=longlat +datum=NAD83 +no_defs'
+
+def _make_raster(out_raster, geotransform, projection, x_size, y_size,
+                 nodata=None, seed=0):
+    rng = numpy.random.default_rng(seed)
+    rows, cols = numpy.mgrid[0:y_size, 0:x_size]
+    data = 20 + 5 * numpy.sin(cols / 7.0) + 3 * numpy.cos(rows / 5.0) \
+           + rng.normal(0, 0.5, (y_size, x_size))
+    if nodata is not None:
+        data[rng.random((y_size, x_size)) < 0.05] = nodata
+
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(out_raster, x_size, y_size, 1, gdal.GDT_Float32)
+    dataset.SetGeoTransform(geotransform)
+    dataset.SetProjection(warp_cache._get_srs(projection).ExportToWkt())
+    band = dataset.GetRasterBand(1)
+    if nodata is not None:
+        band.SetNoDataValue(nodata)
+    band.WriteArray(data.astype(numpy.float32))
+    dataset = None
+    return out_raster
+
+def _check_comparison(comparison, tolerance):
+    for method in METHODS:
+        assert comparison[method]['num_mismatched_valid'] == 0, method
+        assert comparison[method]['max_abs_diff'] <= tolerance, method
+
+def test_same_projection_downsample(tmp_path):
+    geotransform = [BOUNDING_BOX[0] - 600, 30, 0, BOUNDING_BOX[3] + 600, 0, -30]
+    in_raster = _make_raster(str(tmp_path / 'in.tif'), geotransform,
+                             upscaling_common.UPSCALING_PROJ, 1400, 1400)
+    comparison = warp_cache.compare_with_gdalwarp(in_raster, BOUNDING_BOX,
+                                                  methods=METHODS,
+                                                  out_dir=str(tmp_path))
+    _check_comparison(comparison, 1e-4)
+
+def test_same_projection_upsample_nodata(tmp_path):
+    geotransform = [BOUNDING_BOX[0] - 2000, 1000, 0, BOUNDING_BOX[3] + 2000, 0, -1000]
+    in_raster = _make_raster(str(tmp_path / 'in.tif'), geotransform,
+                             upscaling_common.UPSCALING_PROJ, 45, 45, nodata=-9999)
+    comparison = warp_cache.compare_with_gdalwarp(in_raster, BOUNDING_BOX,
+                                                  methods=METHODS,
+                                                  out_dir=str(tmp_path))
+    _check_comparison(comparison, 1e-4)
+
+def test_reproject_geographic(tmp_path):
+    # Similar to PRISM, extends past the bounding box on the west side only
+    geotransform = [-98.8, 1 / 24.0, 0, 31.0, 0, -1 / 24.0]
+    in_raster = _make_raster(str(tmp_path / 'in.tif'), geotransform,
+                             NAD83_PROJ, 60, 60)
+    comparison = warp_cache.compare_with_gdalwarp(in_raster, BOUNDING_BOX,
+                                                  methods=METHODS,
+                                                  out_dir=str(tmp_path))
+    _check_comparison(comparison, 1e-4)
+
+def test_reproject_utm(tmp_path):
+    geotransform = [492000, 30, 0, 3381000, 0, -30]
+    in_raster = _make_raster(str(tmp_path / 'in.tif'), geotransform,
+                             UTM_PROJ, 1800, 1800)
+    # gdalwarp estimates the scale factor used to widen kernels from the
+    # size of the source window, so allow for small differences
+    comparison = warp_cache.compare_with_gdalwarp(in_raster, BOUNDING_BOX,
+                                                  methods=METHODS,
+                                                  out_dir=str(tmp_path),
+                                                  error_threshold=0)
+    _check_comparison(comparison, 0.01)
+    assert comparison['near']['max_abs_diff'] == 0
@@ -0,0 +1,149 @@
+"""
+Tests for work_queue
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from soilscape_upscaling import work_queue
+
+def _make_units(seeds=None, dates=None):
+    units_list = []
+    for config_file in ['a.cfg', 'b.cfg']:
+        for seed in (seeds or [None]):
+            for date_str in (dates or [None]):
+                units_list.append({'config' : config_file,
+                                   'seed' : seed,
+                                   'date' : date_str,
+                                   'command' : ['script.py', config_file],
+                                   'cwd' : '.'})
+    return units_list
+
+def test_submit_twice_without_seed_or_date(tmp_path):
+    queue = work_queue.WorkQueue(str(tmp_path / 'queue.db'))
+    assert queue.add_units(_make_units()) == 2
+    assert queue.add_units(_make_units()) == 0
+    assert queue.get_counts()['pending'] == 2
+
+def test_submit_twice_with_seeds_and_dates(tmp_path):
+    queue_file = str(tmp_path / 'queue.db')
+    queue = work_queue.WorkQueue(queue_file)
+    units_list = _make_units(seeds=[1, 2], dates=['20160101', '20160102'])
+    assert queue.add_units(units_list) == 8
+    # Reopen, as a second submit would
+    queue = work_queue.WorkQueue(queue_file)
+    assert queue.add_units(units_list) == 0
+    assert queue.add_units(_make_units(seeds=[1, 2])) == 4
+    assert queue.add_units(_make_units(dates=['20160101'])) == 2
+    assert queue.get_counts()['pending'] == 14
+
+def _add_script_units(queue, tmp_path, script_code, num_units):
+    script = tmp_path / 'unit.py'
+    script.write_text(script_code)
+    units_list = [{'config' : 'unit{}.cfg'.format(i),
+                   'seed' : None,
+                   'date' : None,
+                   'command' : [str(script), str(tmp_path / 'out_{}.txt'.format(i))],
+                   'cwd' : str(tmp_path)} for i in range(num_units)]
+    queue.add_units(units_list)
+
+def test_claim_exclusive(tmp_path):
+    queue = work_queue.WorkQueue(str(tmp_path / 'queue.db'))
+    queue.add_units(_make_units()[:1])
+    unit = queue.claim('worker1')
+    assert unit is not None
+    assert queue.claim('worker2') is None
+    assert not queue.renew(unit['unit_id'], 'worker2')
+    assert not queue.finish(unit['unit_id'], 'worker2', True)
+    assert queue.renew(unit['unit_id'], 'worker1')
+    assert queue.finish(unit['unit_id'], 'worker1', True)
+    assert queue.get_counts()['done'] == 1
+
+def test_lease_expiry_and_reclaim(tmp_path):
+    queue = work_queue.WorkQueue(str(tmp_path / 'queue.db'))
+    queue.add_units(_make_units()[:1])
+    unit = queue.claim('worker1', lease_seconds=0.05)
+    time.sleep(0.1)
+    reclaimed = queue.claim('worker2')
+    assert reclaimed['unit_id'] == unit['unit_id']
+    assert reclaimed['attempts'] == 2
+    # The first worker can't renew or record a result once reclaimed
+    assert not queue.renew(unit['unit_id'], 'worker1')
+    assert not queue.finish(unit['unit_id'], 'worker1', True)
+    assert queue.finish(reclaimed['unit_id'], 'worker2', True)
+    assert queue.get_units('done')[0]['worker'] == 'worker2'
+
+def test_retry_and_reset_failed(tmp_path):
+    queue = work_queue.WorkQueue(str(tmp_path / 'queue.db'), max_attempts=2)
+    queue.add_units(_make_units()[:1])
+    for attempt in [1, 2]:
+        unit = queue.claim('worker1')
+        assert unit['attempts'] == attempt
+        assert queue.finish(unit['unit_id'], 'worker1', False)
+    assert queue.get_counts()['failed'] == 1
+    assert queue.claim('worker1') is None
+
+    assert queue.reset_failed() == 1
+    unit = queue.claim('worker1')
+    assert unit['attempts'] == 1
+
+def test_two_workers_drain_queue(tmp_path):
+    queue_file = str(tmp_path / 'queue.db')
+    queue = work_queue.WorkQueue(queue_file)
+    num_units = 8
+    _add_script_units(queue, tmp_path,
+                      'import sys, time\n'
+                      'time.sleep(0.2)\n'
+                      'with open(sys.argv[1], "a") as out_f:\n'
+                      '    out_f.write("run\\n")\n', num_units)
+
+    num_run = [0, 0]
+    def run(i):
+        num_run[i] = work_queue.run_worker(queue_file, log_dir=str(tmp_path / 'logs'),
+                                           poll_seconds=0.1,
+                                           worker_id='worker{}'.format(i))
+    workers = [threading.Thread(target=run, args=(i,)) for i in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert sum(num_run) == num_units
+    assert min(num_run) > 0
+    assert queue.get_counts()['done'] == num_units
+    # Each unit was run once
+    for i in range(num_units):
+        assert (tmp_path / 'out_{}.txt'.format(i)).read_text() == 'run\n'
+
+def test_lost_lease_stops_unit(tmp_path):
+    queue_file = str(tmp_path / 'queue.db')
+    queue = work_queue.WorkQueue(queue_file)
+    _add_script_units(queue, tmp_path,
+                      'import os, sys, time\n'
+                      'with open(sys.argv[1], "w") as out_f:\n'
+                      '    out_f.write(str(os.getpid()))\n'
+                      'time.sleep(60)\n', 1)
+    pid_file = tmp_path / 'out_0.txt'
+
+    def take_unit():
+        # Wait for the unit to start then record it as done by another worker
+        while not pid_file.exists() or pid_file.read_text() == '':
+            time.sleep(0.05)
+        with sqlite3.connect(queue_file) as queue_db:
+            queue_db.execute("UPDATE units SET worker = 'worker2', status = 'done'")
+
+    thief = threading.Thread(target=take_unit)
+    thief.start()
+    start_time = time.time()
+    work_queue.run_worker(queue_file, log_dir=str(tmp_path / 'logs'),
+                          lease_seconds=0.3, poll_seconds=0.1, worker_id='worker1')
+    thief.join()
+
+    assert time.time() - start_time < 30
+    with pytest.raises(ProcessLookupError):
+        os.kill(int(pid_file.read_text()), 0)
+    assert queue.get_units()[0]['worker'] == 'worker2'